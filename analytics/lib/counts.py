@@ -6,15 +6,16 @@ from typing import Callable, Dict, List, \
     Optional, Tuple, Type, Union
 
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import F
 
 from analytics.models import BaseCount, \
     FillState, InstallationCount, RealmCount, StreamCount, \
     UserCount, installation_epoch, last_successful_fill
 from zerver.lib.logging_util import log_to_file
+from zerver.lib.parallel import run_parallel
 from zerver.lib.timestamp import ceiling_to_day, \
-    ceiling_to_hour, floor_to_hour, verify_UTC
+    ceiling_to_hour, floor_to_day, floor_to_hour, verify_UTC
 from zerver.models import Message, Realm, RealmAuditLog, \
     Stream, UserActivityInterval, UserProfile, models
 
@@ -26,6 +27,11 @@ log_to_file(logger, settings.ANALYTICS_LOG_PATH)
 # You can't subtract timedelta.max from a datetime, so use this instead
 TIMEDELTA_MAX = timedelta(days=365*1000)
 
+# Stats that can compute many periods in one query (see
+# DataCollector.range_pull_function) fill at most this many periods at
+# a time, e.g. a week of an hourly stat.
+MAX_RANGE_FILL_PERIODS = 24*7
+
 ## Class definitions ##
 
 class CountStat:
@@ -63,34 +69,64 @@ class DependentCountStat(CountStat):
 
 class DataCollector:
     def __init__(self, output_table: Type[BaseCount],
-                 pull_function: Optional[Callable[[str, datetime, datetime, Optional[Realm]], int]]) -> None:
+                 pull_function: Optional[Callable[[str, datetime, datetime, Optional[Realm]], int]],
+                 range_pull_function: Optional[Callable[[str, datetime, datetime, Optional[Realm]],
+                                                        int]]=None) -> None:
         self.output_table = output_table
         self.pull_function = pull_function
+        # Optional; computes the rows for every period ending in
+        # (start_time, end_time] with a single query.
+        self.range_pull_function = range_pull_function
 
 ## CountStat-level operations ##
 
-def process_count_stat(stat: CountStat, fill_to_time: datetime,
-                       realm: Optional[Realm]=None) -> None:
-    # TODO: The realm argument is not yet supported, in that we don't
-    # have a solution for how to update FillState if it is passed.  It
-    # exists solely as partial plumbing for when we do fully implement
-    # doing single-realm analytics runs for use cases like data import.
-    #
-    # Also, note that for the realm argument to be properly supported,
-    # the CountStat object passed in needs to have come from
-    # E.g. get_count_stats(realm), i.e. have the realm_id already
-    # entered into the SQL query defined by the CountState object.
+def get_time_increment(stat: CountStat) -> timedelta:
     if stat.frequency == CountStat.HOUR:
-        time_increment = timedelta(hours=1)
+        return timedelta(hours=1)
     elif stat.frequency == CountStat.DAY:
-        time_increment = timedelta(days=1)
+        return timedelta(days=1)
     else:
         raise AssertionError("Unknown frequency: %s" % (stat.frequency,))
 
+def can_fill_range(stat: CountStat) -> bool:
+    # Periods can only be computed together if they don't overlap.
+    return (stat.data_collector.range_pull_function is not None and
+            stat.interval == get_time_increment(stat))
+
+def get_fill_ranges(stat: CountStat, currently_filled: datetime,
+                    fill_to_time: datetime) -> List[Tuple[datetime, datetime]]:
+    """Splits the periods ending in (currently_filled, fill_to_time] into
+    (range_start, range_end] ranges that are each filled at once."""
+    time_increment = get_time_increment(stat)
+    if can_fill_range(stat):
+        max_periods = MAX_RANGE_FILL_PERIODS
+    else:
+        max_periods = 1
+
+    ranges = []  # type: List[Tuple[datetime, datetime]]
+    while currently_filled + time_increment <= fill_to_time:
+        periods = min(max_periods, (fill_to_time - currently_filled) // time_increment)
+        range_end = currently_filled + periods * time_increment
+        ranges.append((currently_filled, range_end))
+        currently_filled = range_end
+    return ranges
+
+def process_count_stat(stat: CountStat, fill_to_time: datetime,
+                       realm: Optional[Realm]=None) -> None:
+    # Note that for the realm argument to be properly supported, the
+    # CountStat object passed in needs to have come from
+    # E.g. get_count_stats(realm), i.e. have the realm_id already
+    # entered into the SQL query defined by the CountState object.
+    time_increment = get_time_increment(stat)
+
     verify_UTC(fill_to_time)
     if floor_to_hour(fill_to_time) != fill_to_time:
         raise ValueError("fill_to_time must be on an hour boundary: %s" % (fill_to_time,))
 
+    if realm is not None:
+        do_backfill_count_stat_for_realm(stat, fill_to_time, realm)
+        return
+
     fill_state = FillState.objects.filter(property=stat.property).first()
     if fill_state is None:
         currently_filled = installation_epoch()
@@ -118,17 +154,94 @@ def process_count_stat(stat: CountStat, fill_to_time: datetime,
                 return
             fill_to_time = min(fill_to_time, dependency_fill_time)
 
-    currently_filled = currently_filled + time_increment
-    while currently_filled <= fill_to_time:
-        logger.info("START %s %s" % (stat.property, currently_filled))
+    for (range_start, range_end) in get_fill_ranges(stat, currently_filled, fill_to_time):
+        logger.info("START %s %s" % (stat.property, range_end))
         start = time.time()
-        do_update_fill_state(fill_state, currently_filled, FillState.STARTED)
-        do_fill_count_stat_at_hour(stat, currently_filled, realm)
-        do_update_fill_state(fill_state, currently_filled, FillState.DONE)
+        if range_end - range_start == time_increment:
+            do_update_fill_state(fill_state, range_end, FillState.STARTED)
+            do_fill_count_stat_at_hour(stat, range_end)
+            do_update_fill_state(fill_state, range_end, FillState.DONE)
+        else:
+            # do_delete_counts_at_hour can only undo a single period,
+            # so fills of several periods are atomic instead.
+            with transaction.atomic():
+                do_fill_count_stat_for_range(stat, range_start, range_end)
+                do_update_fill_state(fill_state, range_end, FillState.DONE)
         end = time.time()
-        currently_filled = currently_filled + time_increment
         logger.info("DONE %s (%dms)" % (stat.property, (end-start)*1000))
 
+def do_backfill_count_stat_for_realm(stat: CountStat, fill_to_time: datetime,
+                                     realm: Realm) -> None:
+    """Recomputes a stat for a single realm, e.g. after importing it.
+
+    FillState is left alone: the realm is filled from its creation up
+    to the stat's last successful fill, after which the regular runs
+    for all realms pick it up."""
+    if isinstance(stat, LoggingCountStat):
+        # There's nothing to recompute from; see get_count_stats.
+        logger.info("SKIP %s for realm %s" % (stat.property, realm.string_id))
+        return
+
+    last_fill = last_successful_fill(stat.property)
+    if last_fill is None:
+        logger.info("SKIP %s for realm %s; stat never run" % (stat.property, realm.string_id))
+        return
+    fill_to_time = min(fill_to_time, last_fill)
+
+    if stat.frequency == CountStat.HOUR:
+        currently_filled = floor_to_hour(realm.date_created)
+    else:
+        currently_filled = floor_to_day(realm.date_created)
+
+    time_increment = get_time_increment(stat)
+    for (range_start, range_end) in get_fill_ranges(stat, currently_filled, fill_to_time):
+        logger.info("START %s %s for realm %s" % (stat.property, range_end, realm.string_id))
+        start = time.time()
+        with transaction.atomic():
+            for table in [UserCount, StreamCount, RealmCount]:
+                table.objects.filter(realm=realm, property=stat.property,
+                                     end_time__gt=range_start, end_time__lte=range_end).delete()
+            if range_end - range_start == time_increment:
+                do_fill_count_stat_at_hour(stat, range_end, realm)
+            else:
+                do_fill_count_stat_for_range(stat, range_start, range_end, realm)
+            InstallationCount.objects.filter(property=stat.property, end_time__gt=range_start,
+                                             end_time__lte=range_end).delete()
+            do_aggregate_to_installation_count(stat, range_end, range_start)
+        end = time.time()
+        logger.info("DONE %s for realm %s (%dms)" % (stat.property, realm.string_id,
+                                                     (end-start)*1000))
+
+def process_count_stats(stats: List[CountStat], fill_to_time: datetime,
+                        realm: Optional[Realm]=None, processes: int=1) -> None:
+    """Runs process_count_stat for each of stats.  With several
+    processes, stats are processed concurrently, except that
+    DependentCountStats are processed in order after all other stats."""
+    independent_stats = [stat for stat in stats if not isinstance(stat, DependentCountStat)]
+    dependent_stats = [stat for stat in stats if isinstance(stat, DependentCountStat)]
+
+    if processes == 1:
+        for stat in independent_stats:
+            process_count_stat(stat, fill_to_time, realm)
+    else:
+        def process_count_stat_job(stat: CountStat) -> int:
+            try:
+                process_count_stat(stat, fill_to_time, realm)
+            except Exception:
+                logger.exception("Error processing %s" % (stat.property,))
+                return 1
+            return 0
+
+        # Close our database connection, so that each forked
+        # process opens its own.
+        connection.close()
+        for (status, stat) in run_parallel(process_count_stat_job, independent_stats, processes):
+            if status != 0:
+                raise Exception("Failed to process %s" % (stat.property,))
+
+    for stat in dependent_stats:
+        process_count_stat(stat, fill_to_time, realm)
+
 def do_update_fill_state(fill_state: FillState, end_time: datetime, state: int) -> None:
     fill_state.end_time = end_time
     fill_state.state = state
@@ -146,6 +259,17 @@ def do_fill_count_stat_at_hour(stat: CountStat, end_time: datetime, realm: Optio
                     (stat.property, (time.time()-timer)*1000, rows_added))
     do_aggregate_to_summary_table(stat, end_time, realm)
 
+def do_fill_count_stat_for_range(stat: CountStat, range_start: datetime, range_end: datetime,
+                                 realm: Optional[Realm]=None) -> None:
+    # Fills every period ending in (range_start, range_end]; see can_fill_range.
+    assert(can_fill_range(stat))
+    timer = time.time()
+    assert(stat.data_collector.range_pull_function is not None)
+    rows_added = stat.data_collector.range_pull_function(stat.property, range_start, range_end, realm)
+    logger.info("%s run range_pull_function (%dms/%sr)" %
+                (stat.property, (time.time()-timer)*1000, rows_added))
+    do_aggregate_to_summary_table(stat, range_end, realm, range_start)
+
 def do_delete_counts_at_hour(stat: CountStat, end_time: datetime) -> None:
     if isinstance(stat, LoggingCountStat):
         InstallationCount.objects.filter(property=stat.property, end_time=end_time).delete()
@@ -157,8 +281,16 @@ def do_delete_counts_at_hour(stat: CountStat, end_time: datetime) -> None:
         RealmCount.objects.filter(property=stat.property, end_time=end_time).delete()
         InstallationCount.objects.filter(property=stat.property, end_time=end_time).delete()
 
+def get_end_time_clause(table: str, range_start: Optional[datetime]) -> str:
+    if range_start is None:
+        return "%s.end_time = %%(end_time)s" % (table,)
+    return "%s.end_time > %%(range_start)s AND %s.end_time <= %%(end_time)s" % (table, table)
+
+# Aggregates the rows for end_time, or with range_start, for every
+# end_time in (range_start, end_time].
 def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime,
-                                  realm: Optional[Realm]=None) -> None:
+                                  realm: Optional[Realm]=None,
+                                  range_start: Optional[datetime]=None) -> None:
     cursor = connection.cursor()
 
     # Aggregate into RealmCount
@@ -174,48 +306,54 @@ def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime,
                 (realm_id, value, property, subgroup, end_time)
             SELECT
                 zerver_realm.id, COALESCE(sum(%(output_table)s.value), 0), '%(property)s',
-                %(output_table)s.subgroup, %%(end_time)s
+                %(output_table)s.subgroup, %(output_table)s.end_time
             FROM zerver_realm
             JOIN %(output_table)s
             ON
                 zerver_realm.id = %(output_table)s.realm_id
             WHERE
                 %(output_table)s.property = '%(property)s' AND
-                %(output_table)s.end_time = %%(end_time)s
+                %(end_time_clause)s
                 %(realm_clause)s
-            GROUP BY zerver_realm.id, %(output_table)s.subgroup
+            GROUP BY zerver_realm.id, %(output_table)s.subgroup, %(output_table)s.end_time
         """ % {'output_table': output_table._meta.db_table,
                'property': stat.property,
+               'end_time_clause': get_end_time_clause(output_table._meta.db_table, range_start),
                'realm_clause': realm_clause}
         start = time.time()
-        cursor.execute(realmcount_query, {'end_time': end_time})
+        cursor.execute(realmcount_query, {'end_time': end_time, 'range_start': range_start})
         end = time.time()
         logger.info("%s RealmCount aggregation (%dms/%sr)" % (
             stat.property, (end - start) * 1000, cursor.rowcount))
 
+    cursor.close()
+
     if realm is None:
         # Aggregate into InstallationCount.  Only run if we just
-        # processed counts for all realms.
-        #
-        # TODO: Add support for updating installation data after
-        # changing an individual realm's values.
-        installationcount_query = """
-            INSERT INTO analytics_installationcount
-                (value, property, subgroup, end_time)
-            SELECT
-                sum(value), '%(property)s', analytics_realmcount.subgroup, %%(end_time)s
-            FROM analytics_realmcount
-            WHERE
-                property = '%(property)s' AND
-                end_time = %%(end_time)s
-            GROUP BY analytics_realmcount.subgroup
-            """ % {'property': stat.property}
-        start = time.time()
-        cursor.execute(installationcount_query, {'end_time': end_time})
-        end = time.time()
-        logger.info("%s InstallationCount aggregation (%dms/%sr)" % (
-            stat.property, (end - start) * 1000, cursor.rowcount))
+        # processed counts for all realms; do_backfill_count_stat_for_realm
+        # rebuilds InstallationCount itself.
+        do_aggregate_to_installation_count(stat, end_time, range_start)
 
+def do_aggregate_to_installation_count(stat: CountStat, end_time: datetime,
+                                       range_start: Optional[datetime]=None) -> None:
+    cursor = connection.cursor()
+    installationcount_query = """
+        INSERT INTO analytics_installationcount
+            (value, property, subgroup, end_time)
+        SELECT
+            sum(value), '%(property)s', analytics_realmcount.subgroup, analytics_realmcount.end_time
+        FROM analytics_realmcount
+        WHERE
+            property = '%(property)s' AND
+            %(end_time_clause)s
+        GROUP BY analytics_realmcount.subgroup, analytics_realmcount.end_time
+        """ % {'property': stat.property,
+               'end_time_clause': get_end_time_clause('analytics_realmcount', range_start)}
+    start = time.time()
+    cursor.execute(installationcount_query, {'end_time': end_time, 'range_start': range_start})
+    end = time.time()
+    logger.info("%s InstallationCount aggregation (%dms/%sr)" % (
+        stat.property, (end - start) * 1000, cursor.rowcount))
     cursor.close()
 
 ## Utility functions called from outside counts.py ##
@@ -282,7 +420,8 @@ def do_pull_by_sql_query(property: str, start_time: datetime, end_time: datetime
     return rowcount
 
 def sql_data_collector(output_table: Type[BaseCount], query: str,
-                       group_by: Optional[Tuple[models.Model, str]]) -> DataCollector:
+                       group_by: Optional[Tuple[models.Model, str]],
+                       range_query: Optional[str]=None) -> DataCollector:
     def pull_function(property: str, start_time: datetime, end_time: datetime,
                       realm: Optional[Realm] = None) -> int:
         # The pull function type needs to accept a Realm argument
@@ -292,7 +431,29 @@ def sql_data_collector(output_table: Type[BaseCount], query: str,
         # realm should have been already encoded in the `query` we're
         # passed.
         return do_pull_by_sql_query(property, start_time, end_time, query, group_by)
-    return DataCollector(output_table, pull_function)
+
+    def range_pull_function(property: str, start_time: datetime, end_time: datetime,
+                            realm: Optional[Realm] = None) -> int:
+        assert(range_query is not None)
+        return do_pull_by_sql_query(property, start_time, end_time, range_query, group_by)
+
+    if range_query is None:
+        return DataCollector(output_table, pull_function)
+    return DataCollector(output_table, pull_function, range_pull_function)
+
+def get_period_end_time_sql(frequency: Optional[str]) -> Tuple[str, str]:
+    """Returns the SQL for the end_time of rows counting messages, and
+    the clause to add to the query's GROUP BY.
+
+    Without a frequency, the query counts the single period
+    [time_start, time_end).  With one, it counts every period of that
+    frequency in [time_start, time_end), keyed by the end of the
+    period each message was sent in."""
+    if frequency is None:
+        return "%%(time_end)s", ""
+    end_time = ("(date_trunc('{frequency}', zerver_message.date_sent AT TIME ZONE 'UTC') "
+                "AT TIME ZONE 'UTC' + interval '1 {frequency}')").format(frequency=frequency)
+    return end_time, ", " + end_time
 
 def do_pull_minutes_active(property: str, start_time: datetime, end_time: datetime,
                            realm: Optional[Realm] = None) -> int:
@@ -316,42 +477,45 @@ def do_pull_minutes_active(property: str, start_time: datetime, end_time: dateti
     UserCount.objects.bulk_create(rows)
     return len(rows)
 
-def count_message_by_user_query(realm: Optional[Realm]) -> str:
+def count_message_by_user_query(realm: Optional[Realm], frequency: Optional[str]=None) -> str:
     if realm is None:
         realm_clause = ""
     else:
         realm_clause = "zerver_userprofile.realm_id = %s AND" % (realm.id,)
+    end_time, period_group_by = get_period_end_time_sql(frequency)
     return """
     INSERT INTO analytics_usercount
         (user_id, realm_id, value, property, subgroup, end_time)
     SELECT
         zerver_userprofile.id, zerver_userprofile.realm_id, count(*),
-        '%(property)s', %(subgroup)s, %%(time_end)s
+        '%(property)s', %(subgroup)s, {end_time}
     FROM zerver_userprofile
     JOIN zerver_message
     ON
         zerver_userprofile.id = zerver_message.sender_id
     WHERE
-        zerver_userprofile.date_joined < %%(time_end)s AND
+        zerver_userprofile.date_joined < {end_time} AND
         zerver_message.date_sent >= %%(time_start)s AND
         {realm_clause}
         zerver_message.date_sent < %%(time_end)s
-    GROUP BY zerver_userprofile.id %(group_by_clause)s
-""".format(realm_clause=realm_clause)
+    GROUP BY zerver_userprofile.id {period_group_by} %(group_by_clause)s
+""".format(realm_clause=realm_clause, end_time=end_time, period_group_by=period_group_by)
 
 # Note: ignores the group_by / group_by_clause.
-def count_message_type_by_user_query(realm: Optional[Realm]) -> str:
+def count_message_type_by_user_query(realm: Optional[Realm], frequency: Optional[str]=None) -> str:
     if realm is None:
         realm_clause = ""
     else:
         realm_clause = "zerver_userprofile.realm_id = %s AND" % (realm.id,)
+    end_time, period_group_by = get_period_end_time_sql(frequency)
     return """
     INSERT INTO analytics_usercount
             (realm_id, user_id, value, property, subgroup, end_time)
-    SELECT realm_id, id, SUM(count) AS value, '%(property)s', message_type, %%(time_end)s
+    SELECT realm_id, id, SUM(count) AS value, '%(property)s', message_type, end_time
     FROM
     (
         SELECT zerver_userprofile.realm_id, zerver_userprofile.id, count(*),
+        {end_time} AS end_time,
         CASE WHEN
                   zerver_recipient.type = 1 THEN 'private_message'
              WHEN
@@ -377,25 +541,26 @@ def count_message_type_by_user_query(realm: Optional[Realm]) -> str:
             zerver_recipient.type_id = zerver_stream.id
         GROUP BY
             zerver_userprofile.realm_id, zerver_userprofile.id,
-            zerver_recipient.type, zerver_stream.invite_only
+            zerver_recipient.type, zerver_stream.invite_only {period_group_by}
     ) AS subquery
-    GROUP BY realm_id, id, message_type
-""".format(realm_clause=realm_clause)
+    GROUP BY realm_id, id, message_type, end_time
+""".format(realm_clause=realm_clause, end_time=end_time, period_group_by=period_group_by)
 
 # This query joins to the UserProfile table since all current queries that
 # use this also subgroup on UserProfile.is_bot. If in the future there is a
 # stat that counts messages by stream and doesn't need the UserProfile
 # table, consider writing a new query for efficiency.
-def count_message_by_stream_query(realm: Optional[Realm]) -> str:
+def count_message_by_stream_query(realm: Optional[Realm], frequency: Optional[str]=None) -> str:
     if realm is None:
         realm_clause = ""
     else:
         realm_clause = "zerver_stream.realm_id = %s AND" % (realm.id,)
+    end_time, period_group_by = get_period_end_time_sql(frequency)
     return """
     INSERT INTO analytics_streamcount
         (stream_id, realm_id, value, property, subgroup, end_time)
     SELECT
-        zerver_stream.id, zerver_stream.realm_id, count(*), '%(property)s', %(subgroup)s, %%(time_end)s
+        zerver_stream.id, zerver_stream.realm_id, count(*), '%(property)s', %(subgroup)s, {end_time}
     FROM zerver_stream
     JOIN zerver_recipient
     ON
@@ -407,13 +572,13 @@ def count_message_by_stream_query(realm: Optional[Realm]) -> str:
     ON
         zerver_message.sender_id = zerver_userprofile.id
     WHERE
-        zerver_stream.date_created < %%(time_end)s AND
+        zerver_stream.date_created < {end_time} AND
         zerver_recipient.type = 2 AND
         zerver_message.date_sent >= %%(time_start)s AND
         {realm_clause}
         zerver_message.date_sent < %%(time_end)s
-    GROUP BY zerver_stream.id %(group_by_clause)s
-""".format(realm_clause=realm_clause)
+    GROUP BY zerver_stream.id {period_group_by} %(group_by_clause)s
+""".format(realm_clause=realm_clause, end_time=end_time, period_group_by=period_group_by)
 
 # Hardcodes the query needed by active_users:is_bot:day, since that is
 # currently the only stat that uses this.
@@ -556,20 +721,29 @@ def get_count_stats(realm: Optional[Realm]=None) -> Dict[str, CountStat]:
         # Stats that count the number of messages sent in various ways.
         # These are also the set of stats that read from the Message table.
 
+        # These can also fill many periods in one query, which matters
+        # when catching up after analytics haven't run for a while.
+
         CountStat('messages_sent:is_bot:hour',
                   sql_data_collector(UserCount, count_message_by_user_query(
-                      realm), (UserProfile, 'is_bot')),
+                      realm), (UserProfile, 'is_bot'),
+                      count_message_by_user_query(realm, CountStat.HOUR)),
                   CountStat.HOUR),
         CountStat('messages_sent:message_type:day',
                   sql_data_collector(
-                      UserCount, count_message_type_by_user_query(realm), None),
+                      UserCount, count_message_type_by_user_query(realm), None,
+                      count_message_type_by_user_query(realm, CountStat.DAY)),
                   CountStat.DAY),
         CountStat('messages_sent:client:day',
                   sql_data_collector(UserCount, count_message_by_user_query(realm),
-                                     (Message, 'sending_client_id')), CountStat.DAY),
+                                     (Message, 'sending_client_id'),
+                                     count_message_by_user_query(realm, CountStat.DAY)),
+                  CountStat.DAY),
         CountStat('messages_in_stream:is_bot:day',
                   sql_data_collector(StreamCount, count_message_by_stream_query(realm),
-                                     (UserProfile, 'is_bot')), CountStat.DAY),
+                                     (UserProfile, 'is_bot'),
+                                     count_message_by_stream_query(realm, CountStat.DAY)),
+                  CountStat.DAY),
 
         # Number of Users stats
         # Stats that count the number of active users in the UserProfile.is_active sense.
@@ -4,19 +4,20 @@ from argparse import ArgumentParser
 from typing import Any, Dict
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
 from django.utils.dateparse import parse_datetime
 from django.utils.timezone import now as timezone_now
 from django.utils.timezone import utc as timezone_utc
 
-from analytics.lib.counts import COUNT_STATS, logger, process_count_stat
+from analytics.lib.counts import COUNT_STATS, get_count_stats, logger, \
+    process_count_stat, process_count_stats
 from scripts.lib.zulip_tools import ENDC, WARNING
+from zerver.lib.management import ZulipBaseCommand
 from zerver.lib.remote_server import send_analytics_to_remote_server
 from zerver.lib.timestamp import floor_to_hour
 from zerver.models import Realm
 
 
-class Command(BaseCommand):
+class Command(ZulipBaseCommand):
     help = """Fills Analytics tables.
 
     Run as a cron job that runs every hour."""
@@ -34,6 +35,12 @@ class Command(BaseCommand):
         parser.add_argument('--stat', '-s',
                             type=str,
                             help="CountStat to process. If omitted, all stats are processed.")
+        parser.add_argument('--processes',
+                            type=int,
+                            help="Number of processes to process independent stats with.",
+                            default=1)
+        self.add_realm_args(parser, help="Only recompute stats for this realm, e.g. after "
+                                         "importing it, up to where they are already filled.")
         parser.add_argument('--verbose',
                             action='store_true',
                             help="Print timing information to stdout.",
@@ -66,21 +73,31 @@ class Command(BaseCommand):
 
         fill_to_time = floor_to_hour(fill_to_time.astimezone(timezone_utc))
 
+        realm = self.get_realm(options)
+        if realm is not None:
+            # The stats' queries need to be restricted to the realm.
+            count_stats = get_count_stats(realm)
+        else:
+            count_stats = COUNT_STATS
+
         if options['stat'] is not None:
-            stats = [COUNT_STATS[options['stat']]]
+            stats = [count_stats[options['stat']]]
         else:
-            stats = list(COUNT_STATS.values())
+            stats = list(count_stats.values())
 
         logger.info("Starting updating analytics counts through %s" % (fill_to_time,))
         if options['verbose']:
             start = time.time()
             last = start
 
-        for stat in stats:
-            process_count_stat(stat, fill_to_time)
-            if options['verbose']:
-                print("Updated %s in %.3fs" % (stat.property, time.time() - last))
-                last = time.time()
+        if options['processes'] > 1:
+            process_count_stats(stats, fill_to_time, realm, options['processes'])
+        else:
+            for stat in stats:
+                process_count_stat(stat, fill_to_time, realm)
+                if options['verbose']:
+                    print("Updated %s in %.3fs" % (stat.property, time.time() - last))
+                    last = time.time()
 
         if options['verbose']:
             print("Finished updating analytics counts through %s in %.3fs" %
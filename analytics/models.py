@@ -25,7 +25,9 @@ def installation_epoch() -> datetime.datetime:
     return floor_to_day(earliest_realm_creation)
 
 def last_successful_fill(property: str) -> Optional[datetime.datetime]:
-    fillstate = FillState.objects.filter(property=property).first()
+    return successful_fill_time(FillState.objects.filter(property=property).first())
+
+def successful_fill_time(fillstate: Optional[FillState]) -> Optional[datetime.datetime]:
     if fillstate is None:
         return None
     if fillstate.state == FillState.DONE:
@@ -13,8 +13,8 @@ from django.utils.timezone import utc as timezone_utc
 from analytics.lib.counts import COUNT_STATS, CountStat, get_count_stats, \
     DependentCountStat, LoggingCountStat, do_aggregate_to_summary_table, \
     do_drop_all_analytics_tables, do_drop_single_stat, \
-    do_fill_count_stat_at_hour, do_increment_logging_stat, \
-    process_count_stat, sql_data_collector
+    do_fill_count_stat_at_hour, do_increment_logging_stat, get_fill_ranges, \
+    process_count_stat, process_count_stats, sql_data_collector
 from analytics.models import BaseCount, \
     FillState, InstallationCount, RealmCount, StreamCount, \
     UserCount, installation_epoch
@@ -309,6 +309,83 @@ class TestProcessCountStat(AnalyticsTestCase):
         self.assertEqual(InstallationCount.objects.filter(property='stat4').count(), 1)
         self.assertFillStateEquals(stat4, hour24)
 
+    def test_process_count_stats_runs_dependent_stats_last(self) -> None:
+        stat1 = self.make_dummy_count_stat('stat1')
+        query = """INSERT INTO analytics_realmcount (realm_id, value, property, end_time)
+                   VALUES (%s, 1, '%s', %%%%(time_end)s)""" % (self.default_realm.id, 'stat2')
+        stat2 = DependentCountStat('stat2', sql_data_collector(RealmCount, query, None),
+                                   CountStat.HOUR, dependencies=['stat1'])
+        current_time = installation_epoch() + self.HOUR
+        process_count_stats([stat2, stat1], current_time)
+        self.assertFillStateEquals(stat1, current_time)
+        self.assertFillStateEquals(stat2, current_time)
+
+    def test_get_fill_ranges(self) -> None:
+        start = installation_epoch()
+        stat = COUNT_STATS['messages_sent:is_bot:hour']
+        self.assertEqual(get_fill_ranges(stat, start, start + 200*self.HOUR),
+                         [(start, start + 168*self.HOUR),
+                          (start + 168*self.HOUR, start + 200*self.HOUR)])
+        self.assertEqual(get_fill_ranges(stat, start, start), [])
+
+        # Stats without a range query fill one period at a time, and
+        # day stats don't fill partial days.
+        stat = COUNT_STATS['active_users_audit:is_bot:day']
+        self.assertEqual(get_fill_ranges(stat, start, start + 2*self.DAY + self.HOUR),
+                         [(start, start + self.DAY), (start + self.DAY, start + 2*self.DAY)])
+
+    def test_range_fill(self) -> None:
+        stat = COUNT_STATS['messages_sent:is_bot:hour']
+        self.current_property = stat.property
+        FillState.objects.create(property=stat.property, state=FillState.DONE,
+                                 end_time=self.TIME_ZERO - 3*self.HOUR)
+
+        user = self.create_user(date_joined=self.TIME_ZERO - 4*self.HOUR)
+        recipient = Recipient.objects.get(type_id=user.id, type=Recipient.PERSONAL)
+        for minutes_ago in [150, 90, 30, 20]:
+            self.create_message(user, recipient,
+                                date_sent=self.TIME_ZERO - minutes_ago*self.MINUTE)
+
+        with mock.patch('analytics.lib.counts.do_fill_count_stat_at_hour') as mock_fill:
+            process_count_stat(stat, self.TIME_ZERO)
+        mock_fill.assert_not_called()
+
+        self.assertFillStateEquals(stat, self.TIME_ZERO)
+        expected_rows = [[1, 'false', self.TIME_ZERO - 2*self.HOUR],
+                         [1, 'false', self.TIME_ZERO - self.HOUR],
+                         [2, 'false', self.TIME_ZERO]]  # type: List[List[object]]
+        self.assertTableState(UserCount, ['value', 'subgroup', 'end_time'], expected_rows)
+        self.assertTableState(RealmCount, ['value', 'subgroup', 'end_time'], expected_rows)
+        self.assertTableState(InstallationCount, ['value', 'subgroup', 'end_time'], expected_rows)
+
+    def test_backfill_realm(self) -> None:
+        stat = COUNT_STATS['messages_sent:is_bot:hour']
+        self.current_property = stat.property
+        second_realm = Realm.objects.create(
+            string_id='second-realm', name='Second Realm',
+            date_created=self.TIME_ZERO - 2*self.DAY)
+        FillState.objects.create(property=stat.property, state=FillState.DONE,
+                                 end_time=self.TIME_LAST_HOUR)
+
+        user = self.create_user()
+        second_user = self.create_user(realm=second_realm)
+        for sender in [user, second_user]:
+            recipient = Recipient.objects.get(type_id=sender.id, type=Recipient.PERSONAL)
+            self.create_message(sender, recipient)
+        process_count_stat(stat, self.TIME_ZERO)
+
+        # E.g. more of the realm's history being imported.
+        recipient = Recipient.objects.get(type_id=user.id, type=Recipient.PERSONAL)
+        self.create_message(user, recipient)
+        process_count_stat(get_count_stats(self.default_realm)[stat.property],
+                           self.TIME_ZERO + self.HOUR, self.default_realm)
+
+        # Only filled through the stat's last fill, which is untouched.
+        self.assertFillStateEquals(stat, self.TIME_ZERO)
+        self.assertTableState(RealmCount, ['value', 'subgroup', 'realm'],
+                              [[2, 'false', self.default_realm], [1, 'false', second_realm]])
+        self.assertTableState(InstallationCount, ['value', 'subgroup'], [[3, 'false']])
+
 class TestCountStats(AnalyticsTestCase):
     def setUp(self) -> None:
         super().setUp()
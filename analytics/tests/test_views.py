@@ -183,6 +183,28 @@ class TestGetChartData(ZulipTestCase):
             'result': 'success',
         })
 
+    def test_chart_data_cached_until_fill(self) -> None:
+        stat = COUNT_STATS['messages_sent:is_bot:hour']
+        self.insert_data(stat, ['true', 'false'], ['false'])
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assert_json_success(result)
+        self.assertEqual(result.json()['everyone'], {'bot': self.data(100), 'human': self.data(101)})
+
+        # Rows added without the stat's FillState advancing aren't shown yet.
+        RealmCount.objects.create(property=stat.property, subgroup='true',
+                                  end_time=self.end_times_hour[3], value=5, realm=self.realm)
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assertEqual(result.json()['everyone'], {'bot': self.data(100), 'human': self.data(101)})
+
+        FillState.objects.filter(property=stat.property).update(
+            end_time=self.end_times_hour[3] + timedelta(hours=1))
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assertEqual(result.json()['everyone'], {'bot': [0, 0, 100, 5, 0],
+                                                     'human': self.data(101) + [0]})
+
     def test_include_empty_subgroups(self) -> None:
         FillState.objects.create(
             property='realm_active_humans::day', end_time=self.end_times_day[0],
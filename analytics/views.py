@@ -1,5 +1,6 @@
 import itertools
 import logging
+from array import array
 import re
 import time
 import urllib
@@ -27,15 +28,19 @@ from jinja2 import Markup as mark_safe
 
 from analytics.lib.counts import COUNT_STATS, CountStat
 from analytics.lib.time_utils import time_range
-from analytics.models import BaseCount, InstallationCount, \
-    RealmCount, StreamCount, UserCount, last_successful_fill, installation_epoch
+from analytics.models import BaseCount, FillState, InstallationCount, \
+    RealmCount, StreamCount, UserCount, installation_epoch, successful_fill_time
 from confirmation.models import Confirmation, confirmation_url, _properties
 from zerver.decorator import require_server_admin, require_server_admin_api, \
     to_non_negative_int, to_utc_datetime, zulip_login_required, require_non_guest_user
+from zerver.lib.cache import cache_delete, cache_with_key
 from zerver.lib.exceptions import JsonableError
+from zerver.lib.replicas import get_read_connection, use_read_replica
 from zerver.lib.request import REQ, has_request_variables
 from zerver.lib.response import json_success
-from zerver.lib.timestamp import convert_to_UTC, timestamp_to_datetime
+from zerver.lib.timestamp import convert_to_UTC, datetime_to_timestamp, \
+    timestamp_to_datetime
+from zerver.lib.validator import check_bool
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.views.invite import get_invitee_emails_set
 from zerver.lib.subdomains import get_subdomain_from_hostname
@@ -146,6 +151,7 @@ def get_chart_data_for_remote_installation(
     return get_chart_data(request=request, user_profile=user_profile, for_installation=True,
                           remote=True, server=server, **kwargs)
 
+@use_read_replica
 @require_non_guest_user
 @has_request_variables
 def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name: str=REQ(),
@@ -222,6 +228,12 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
         # careful not to access it in those code paths.
         realm = user_profile.realm
 
+    # Used to cache the time series; remote servers don't have fillstate data.
+    fill_states = {}  # type: Dict[CountStat, Optional[FillState]]
+    if not remote:
+        fill_states = {stat: FillState.objects.filter(property=stat.property).first()
+                       for stat in stats}
+
     if remote:
         # For remote servers, we don't have fillstate data, and thus
         # should simply use the first and last data points for the
@@ -242,7 +254,7 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
             else:
                 start = realm.date_created
         if end is None:
-            end = max(last_successful_fill(stat.property) or
+            end = max(successful_fill_time(fill_states[stat]) or
                       datetime.min.replace(tzinfo=timezone_utc) for stat in stats)
         if start > end:
             logging.warning("User from realm %s attempted to access /stats, but the computed "
@@ -276,7 +288,8 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
         data[aggregation_level[table]] = {}
         for stat in stats:
             data[aggregation_level[table]].update(get_time_series_by_subgroup(
-                stat, table, id_value[table], end_times, subgroup_to_label[stat], include_empty_subgroups))
+                stat, table, id_value[table], end_times, subgroup_to_label[stat], include_empty_subgroups,
+                fill_states.get(stat)))
 
     if labels_sort_function is not None:
         data['display_order'] = labels_sort_function(data)
@@ -352,21 +365,57 @@ def rewrite_client_arrays(value_arrays: Dict[str, List[int]]) -> Dict[str, List[
             mapped_arrays[mapped_label] = [value_arrays[label][i] for i in range(0, len(array))]
     return mapped_arrays
 
+# For each subgroup, the end times (as timestamps) and values of its
+# rows, as compact arrays.
+CountColumns = Dict[Optional[str], Tuple['array[int]', 'array[int]']]
+
+def get_count_columns(stat: CountStat, table: Type[BaseCount], key_id: int) -> CountColumns:
+    queryset = table_filtered_to_id(table, key_id).filter(property=stat.property) \
+                                                  .values_list('subgroup', 'end_time', 'value')
+    columns = {}  # type: CountColumns
+    for subgroup, end_time, value in queryset:
+        if subgroup not in columns:
+            columns[subgroup] = (array('q'), array('q'))
+        end_timestamps, values = columns[subgroup]
+        end_timestamps.append(datetime_to_timestamp(end_time))
+        values.append(value)
+    return columns
+
+def count_columns_cache_key(stat: CountStat, table: Type[BaseCount], key_id: int,
+                            fill_state: FillState) -> str:
+    return "count_columns:%s:%s:%s:%s:%s:%s" % (
+        table.__name__, key_id, stat.property, fill_state.id,
+        datetime_to_timestamp(fill_state.end_time), fill_state.state)
+
+# The stat's FillState is part of the cache key, so the cached data is
+# invalidated as soon as update_analytics_counts writes more of it, or
+# the stat's data is cleared (which deletes its FillState).
+@cache_with_key(count_columns_cache_key, timeout=3600*24*7)
+def get_cached_count_columns(stat: CountStat, table: Type[BaseCount], key_id: int,
+                             fill_state: FillState) -> CountColumns:
+    return get_count_columns(stat, table, key_id)
+
 def get_time_series_by_subgroup(stat: CountStat,
                                 table: Type[BaseCount],
                                 key_id: int,
                                 end_times: List[datetime],
                                 subgroup_to_label: Dict[Optional[str], str],
-                                include_empty_subgroups: bool) -> Dict[str, List[int]]:
-    queryset = table_filtered_to_id(table, key_id).filter(property=stat.property) \
-                                                  .values_list('subgroup', 'end_time', 'value')
-    value_dicts = defaultdict(lambda: defaultdict(int))  # type: Dict[Optional[str], Dict[datetime, int]]
-    for subgroup, end_time, value in queryset:
-        value_dicts[subgroup][end_time] = value
+                                include_empty_subgroups: bool,
+                                fill_state: Optional[FillState]=None) -> Dict[str, List[int]]:
+    if fill_state is None:
+        columns = get_count_columns(stat, table, key_id)
+    else:
+        columns = get_cached_count_columns(stat, table, key_id, fill_state)
+
+    end_timestamps = [datetime_to_timestamp(end_time) for end_time in end_times]
     value_arrays = {}
     for subgroup, label in subgroup_to_label.items():
-        if (subgroup in value_dicts) or include_empty_subgroups:
-            value_arrays[label] = [value_dicts[subgroup][end_time] for end_time in end_times]
+        if subgroup in columns:
+            value_by_end_time = dict(zip(*columns[subgroup]))
+            value_arrays[label] = [value_by_end_time.get(end_timestamp, 0)
+                                   for end_timestamp in end_timestamps]
+        elif include_empty_subgroups:
+            value_arrays[label] = [0] * len(end_times)
 
     if stat == COUNT_STATS['messages_sent:client:day']:
         # HACK: We rewrite these arrays to collapse the Client objects
@@ -426,7 +475,7 @@ def get_realm_day_counts() -> Dict[str, Dict[str, str]]:
             r.string_id,
             age
     '''
-    cursor = connection.cursor()
+    cursor = get_read_connection().cursor()
     cursor.execute(query)
     rows = dictfetchall(cursor)
     cursor.close()
@@ -569,7 +618,7 @@ def realm_summary_table(realm_minutes: Dict[str, float]) -> str:
         ORDER BY dau_count DESC, string_id ASC
         '''
 
-    cursor = connection.cursor()
+    cursor = get_read_connection().cursor()
     cursor.execute(query)
     rows = dictfetchall(cursor)
     cursor.close()
@@ -777,7 +826,7 @@ def sent_messages_report(realm: str) -> str:
         ) bots on
             series.day = bots.date_sent
     '''
-    cursor = connection.cursor()
+    cursor = get_read_connection().cursor()
     cursor.execute(query, [realm, realm])
     rows = cursor.fetchall()
     cursor.close()
@@ -787,7 +836,7 @@ def sent_messages_report(realm: str) -> str:
 def ad_hoc_queries() -> List[Dict[str, str]]:
     def get_page(query: str, cols: List[str], title: str,
                  totals_columns: List[int]=[]) -> Dict[str, str]:
-        cursor = connection.cursor()
+        cursor = get_read_connection().cursor()
         cursor.execute(query)
         rows = cursor.fetchall()
         rows = list(map(list, rows))
@@ -1010,9 +1059,15 @@ def ad_hoc_queries() -> List[Dict[str, str]]:
 
     return pages
 
-@require_server_admin
-@has_request_variables
-def get_activity(request: HttpRequest) -> HttpResponse:
+# The activity pages run several large queries over the whole
+# server, so they are only recomputed every few minutes.
+ACTIVITY_CACHE_TIMEOUT = 5 * 60
+
+def activity_pages_cache_key() -> str:
+    return "analytics_activity_pages"
+
+@cache_with_key(activity_pages_cache_key, timeout=ACTIVITY_CACHE_TIMEOUT)
+def get_activity_pages() -> List[Tuple[str, str]]:
     duration_content, realm_minutes = user_activity_intervals()  # type: Tuple[mark_safe, Dict[str, float]]
     counts_content = realm_summary_table(realm_minutes)  # type: str
     data = [
@@ -1021,6 +1076,16 @@ def get_activity(request: HttpRequest) -> HttpResponse:
     ]
     for page in ad_hoc_queries():
         data.append((page['title'], page['content']))
+    return data
+
+@use_read_replica
+@require_server_admin
+@has_request_variables
+def get_activity(request: HttpRequest,
+                 refresh: bool=REQ(validator=check_bool, default=False)) -> HttpResponse:
+    if refresh:
+        cache_delete(activity_pages_cache_key())
+    data = get_activity_pages()
 
     title = 'Activity'
 
@@ -1428,6 +1493,7 @@ def realm_user_summary_table(all_records: List[QuerySet],
     content = make_table(title, cols, rows, has_row_class=True)
     return user_records, content
 
+@use_read_replica
 @require_server_admin
 def get_realm_activity(request: HttpRequest, realm_str: str) -> HttpResponse:
     data = []  # type: List[Tuple[str, str]]
@@ -1463,6 +1529,7 @@ def get_realm_activity(request: HttpRequest, realm_str: str) -> HttpResponse:
         context=dict(data=data, realm_link=None, title=title),
     )
 
+@use_read_replica
 @require_server_admin
 def get_user_activity(request: HttpRequest, email: str) -> HttpResponse:
     records = get_user_activity_records_for_email(email)
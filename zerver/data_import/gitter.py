@@ -14,7 +14,9 @@ from zerver.lib.export import MESSAGE_BATCH_CHUNK_SIZE
 from zerver.data_import.import_util import ZerverFieldsT, build_zerver_realm, \
     build_avatar, build_subscription, build_recipient, build_usermessages, \
     build_defaultstream, process_avatars, build_realm, build_stream, \
-    build_message, create_converted_data_files, make_subscriber_map
+    build_message, create_converted_data_files, make_subscriber_map, chunked, \
+    convert_message_chunks
+from zerver.data_import.sequencer import NEXT_ID
 
 # stubs
 GitterDataT = List[Dict[str, Any]]
@@ -154,26 +156,20 @@ def convert_gitter_workspace_messages(gitter_data: GitterDataT, output_dir: str,
                                       subscriber_map: Dict[int, Set[int]],
                                       user_map: Dict[str, int],
                                       user_short_name_to_full_name: Dict[str, str],
-                                      chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE) -> None:
+                                      chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE,
+                                      threads: int=1) -> None:
     """
     Messages are stored in batches
     """
     logging.info('######### IMPORTING MESSAGES STARTED #########\n')
-    message_id = 0
     recipient_id = 0  # Corresponding to stream "gitter"
 
-    low_index = 0
-    upper_index = low_index + chunk_size
-    dump_file_id = 1
-
-    while True:
-        message_json = {}
+    def convert_chunk(message_data: GitterDataT) -> Tuple[ZerverFieldsT,
+                                                          Dict[str, List[Any]]]:
         zerver_message = []
         zerver_usermessage = []  # type: List[ZerverFieldsT]
-        message_data = gitter_data[low_index: upper_index]
-        if len(message_data) == 0:
-            break
         for message in message_data:
+            message_id = NEXT_ID('message')
             message_time = dateutil.parser.parse(message['sent']).timestamp()
             mentioned_user_ids = get_usermentions(message, user_map,
                                                   user_short_name_to_full_name)
@@ -194,17 +190,18 @@ def convert_gitter_workspace_messages(gitter_data: GitterDataT, output_dir: str,
                 is_private=False,
             )
 
-            message_id += 1
-
-        message_json['zerver_message'] = zerver_message
-        message_json['zerver_usermessage'] = zerver_usermessage
-        message_filename = os.path.join(output_dir, "messages-%06d.json" % (dump_file_id,))
-        logging.info("Writing Messages to %s\n" % (message_filename,))
-        write_data_to_file(os.path.join(message_filename), message_json)
-
-        low_index = upper_index
-        upper_index = chunk_size + low_index
-        dump_file_id += 1
+        message_json = dict(
+            zerver_message=zerver_message,
+            zerver_usermessage=zerver_usermessage)
+        return message_json, {}
+
+    convert_message_chunks(
+        chunks=chunked(gitter_data, chunk_size),
+        convert_chunk=convert_chunk,
+        output_dir=output_dir,
+        id_sequences=['message', 'user_message'],
+        threads=threads,
+    )
 
     logging.info('######### IMPORTING MESSAGES FINISHED #########\n')
 
@@ -255,7 +252,7 @@ def do_convert_data(gitter_data_file: str, output_dir: str, threads: int=6) -> N
 
     convert_gitter_workspace_messages(
         gitter_data, output_dir, subscriber_map, user_map,
-        user_short_name_to_full_name)
+        user_short_name_to_full_name, threads=threads)
 
     avatar_folder = os.path.join(output_dir, 'avatars')
     avatar_realm_folder = os.path.join(avatar_folder, str(realm_id))
@@ -279,7 +276,3 @@ def do_convert_data(gitter_data_file: str, output_dir: str, threads: int=6) -> N
 
     logging.info('######### DATA CONVERSION FINISHED #########\n')
     logging.info("Zulip data dump created at %s" % (output_dir,))
-
-def write_data_to_file(output_file: str, data: Any) -> None:
-    with open(output_file, "w") as f:
-        f.write(ujson.dumps(data, indent=4))
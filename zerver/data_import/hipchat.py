@@ -2,6 +2,7 @@ import base64
 import dateutil
 import glob
 import hypchat
+import itertools
 import logging
 import os
 import re
@@ -9,15 +10,11 @@ import shutil
 import subprocess
 import ujson
 
-from typing import Any, Callable, Dict, List, Optional, Set
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 from django.conf import settings
 from django.utils.timezone import now as timezone_now
 
-from zerver.lib.utils import (
-    process_list_in_batches,
-)
-
 from zerver.models import (
     RealmEmoji,
     Recipient,
@@ -35,6 +32,8 @@ from zerver.data_import.import_util import (
     build_stream_subscriptions,
     build_user_profile,
     build_zerver_realm,
+    chunked,
+    convert_message_chunks,
     create_converted_data_files,
     make_subscriber_map,
     make_user_messages,
@@ -430,7 +429,6 @@ def write_emoticon_data(realm_id: int,
 
 def write_message_data(realm_id: int,
                        slim_mode: bool,
-                       message_key: str,
                        zerver_recipient: List[ZerverFieldsT],
                        subscriber_map: Dict[int, Set[int]],
                        data_dir: str,
@@ -439,7 +437,8 @@ def write_message_data(realm_id: int,
                        stream_id_mapper: IdMapper,
                        user_id_mapper: IdMapper,
                        user_handler: UserHandler,
-                       attachment_handler: AttachmentHandler) -> None:
+                       attachment_handler: AttachmentHandler,
+                       threads: int=1) -> None:
 
     stream_id_to_recipient_id = {
         d['type_id']: d['id']
@@ -466,16 +465,71 @@ def write_message_data(realm_id: int,
         recipient_id = user_id_to_recipient_id[user_id]
         return recipient_id
 
+    chunks = itertools.chain.from_iterable(
+        get_message_chunks(
+            realm_id=realm_id,
+            slim_mode=slim_mode,
+            message_key=message_key,
+            data_dir=data_dir,
+            masking_content=masking_content,
+            user_id_mapper=user_id_mapper,
+            user_handler=user_handler,
+        )
+        for message_key in ['UserMessage',
+                            'NotificationMessage',
+                            'PrivateUserMessage']
+    )
+
+    def convert_chunk(raw_messages: List[ZerverFieldsT]) -> Tuple[ZerverFieldsT,
+                                                                  Dict[str, List[Any]]]:
+        # Each chunk comes from a single history file, so its
+        # messages are either all PMs or all stream messages.
+        is_pm_data = raw_messages[0]['is_pm_data']
+        if is_pm_data:
+            get_recipient_id = get_pm_recipient_id
+        else:
+            get_recipient_id = get_stream_recipient_id
+
+        # We may be in a forked process, so attachments are
+        # collected per chunk and merged into attachment_handler
+        # afterwards.
+        chunk_attachment_handler = AttachmentHandler()
+        message_json = process_raw_message_batch(
+            realm_id=realm_id,
+            raw_messages=raw_messages,
+            subscriber_map=subscriber_map,
+            user_id_mapper=user_id_mapper,
+            user_handler=user_handler,
+            attachment_handler=chunk_attachment_handler,
+            get_recipient_id=get_recipient_id,
+            is_pm_data=is_pm_data,
+        )
+        return message_json, dict(attachment_info=chunk_attachment_handler.get_info())
+
+    extras = convert_message_chunks(
+        chunks=chunks,
+        convert_chunk=convert_chunk,
+        output_dir=output_dir,
+        id_sequences=['message', 'user_message'],
+        threads=threads,
+    )
+    attachment_handler.merge_info(extras['attachment_info'])
+
+def get_message_chunks(realm_id: int,
+                       slim_mode: bool,
+                       message_key: str,
+                       data_dir: str,
+                       masking_content: bool,
+                       user_id_mapper: IdMapper,
+                       user_handler: UserHandler) -> Iterator[List[ZerverFieldsT]]:
     if message_key in ['UserMessage', 'NotificationMessage']:
         is_pm_data = False
         dir_glob = os.path.join(data_dir, 'rooms', '*', 'history.json')
-        get_recipient_id = get_stream_recipient_id
         get_files_dir = lambda fn_id: os.path.join(data_dir, 'rooms', str(fn_id), 'files')
 
     elif message_key == 'PrivateUserMessage':
         is_pm_data = True
         dir_glob = os.path.join(data_dir, 'users', '*', 'history.json')
-        get_recipient_id = get_pm_recipient_id
         get_files_dir = lambda fn_id: os.path.join(data_dir, 'users', 'files')
 
     else:
@@ -487,22 +541,17 @@ def write_message_data(realm_id: int,
         fn_id = os.path.basename(dir)
         files_dir = get_files_dir(fn_id)
 
-        process_message_file(
+        yield from process_message_file(
             realm_id=realm_id,
             slim_mode=slim_mode,
             fn=fn,
             fn_id=fn_id,
             files_dir=files_dir,
-            get_recipient_id=get_recipient_id,
             message_key=message_key,
-            subscriber_map=subscriber_map,
-            data_dir=data_dir,
-            output_dir=output_dir,
             is_pm_data=is_pm_data,
             masking_content=masking_content,
             user_id_mapper=user_id_mapper,
             user_handler=user_handler,
-            attachment_handler=attachment_handler,
         )
 
 def get_hipchat_sender_id(realm_id: int,
@@ -559,16 +608,11 @@ def process_message_file(realm_id: int,
                          fn: str,
                          fn_id: str,
                          files_dir: str,
-                         get_recipient_id: Callable[[ZerverFieldsT], int],
                          message_key: str,
-                         subscriber_map: Dict[int, Set[int]],
-                         data_dir: str,
-                         output_dir: str,
                          is_pm_data: bool,
                          masking_content: bool,
                          user_id_mapper: IdMapper,
-                         user_handler: UserHandler,
-                         attachment_handler: AttachmentHandler) -> None:
+                         user_handler: UserHandler) -> Iterator[List[ZerverFieldsT]]:
 
     def get_raw_messages(fn: str) -> List[ZerverFieldsT]:
         with open(fn) as f:
@@ -616,6 +660,7 @@ def process_message_file(realm_id: int,
                 date_sent=str_date_to_float(d['timestamp']),
                 attachment=d.get('attachment'),
                 files_dir=files_dir,
+                is_pm_data=is_pm_data,
             )
 
         raw_messages = []
@@ -629,26 +674,7 @@ def process_message_file(realm_id: int,
 
     raw_messages = get_raw_messages(fn)
 
-    def process_batch(lst: List[Any]) -> None:
-        process_raw_message_batch(
-            realm_id=realm_id,
-            raw_messages=lst,
-            subscriber_map=subscriber_map,
-            user_id_mapper=user_id_mapper,
-            user_handler=user_handler,
-            attachment_handler=attachment_handler,
-            get_recipient_id=get_recipient_id,
-            is_pm_data=is_pm_data,
-            output_dir=output_dir,
-        )
-
-    chunk_size = 1000
-
-    process_list_in_batches(
-        lst=raw_messages,
-        chunk_size=chunk_size,
-        process_batch=process_batch,
-    )
+    return chunked(raw_messages, chunk_size=1000)
 
 def process_raw_message_batch(realm_id: int,
                               raw_messages: List[Dict[str, Any]],
@@ -657,8 +683,7 @@ def process_raw_message_batch(realm_id: int,
                               user_handler: UserHandler,
                               attachment_handler: AttachmentHandler,
                               get_recipient_id: Callable[[ZerverFieldsT], int],
-                              is_pm_data: bool,
-                              output_dir: str) -> None:
+                              is_pm_data: bool) -> ZerverFieldsT:
 
     def fix_mentions(content: str,
                      mention_user_ids: Set[int]) -> str:
@@ -753,16 +778,14 @@ def process_raw_message_batch(realm_id: int,
         zerver_message=zerver_message,
         zerver_usermessage=zerver_usermessage,
     )
-
-    dump_file_id = NEXT_ID('dump_file_id')
-    message_file = "/messages-%06d.json" % (dump_file_id,)
-    create_converted_data_files(message_json, output_dir, message_file)
+    return message_json
 
 def do_convert_data(input_tar_file: str,
                     output_dir: str,
                     masking_content: bool,
                     api_token: Optional[str]=None,
-                    slim_mode: bool=False) -> None:
+                    slim_mode: bool=False,
+                    threads: int=1) -> None:
     input_data_dir = untar_input_file(input_tar_file)
 
     attachment_handler = AttachmentHandler()
@@ -848,23 +871,20 @@ def do_convert_data(input_tar_file: str,
     )
 
     logging.info('Start importing message data')
-    for message_key in ['UserMessage',
-                        'NotificationMessage',
-                        'PrivateUserMessage']:
-        write_message_data(
-            realm_id=realm_id,
-            slim_mode=slim_mode,
-            message_key=message_key,
-            zerver_recipient=zerver_recipient,
-            subscriber_map=subscriber_map,
-            data_dir=input_data_dir,
-            output_dir=output_dir,
-            masking_content=masking_content,
-            stream_id_mapper=stream_id_mapper,
-            user_id_mapper=user_id_mapper,
-            user_handler=user_handler,
-            attachment_handler=attachment_handler,
-        )
+    write_message_data(
+        realm_id=realm_id,
+        slim_mode=slim_mode,
+        zerver_recipient=zerver_recipient,
+        subscriber_map=subscriber_map,
+        data_dir=input_data_dir,
+        output_dir=output_dir,
+        masking_content=masking_content,
+        stream_id_mapper=stream_id_mapper,
+        user_id_mapper=user_id_mapper,
+        user_handler=user_handler,
+        attachment_handler=attachment_handler,
+        threads=threads,
+    )
 
     # Order is important here...don't write users until
     # we process everything else, since we may introduce
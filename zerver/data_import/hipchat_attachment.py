@@ -76,6 +76,21 @@ class AttachmentHandler:
 
         return content
 
+    def get_info(self) -> List[Dict[str, Any]]:
+        # Returns our info in a JSON-friendly form, for merge_info.
+        return [
+            dict(info, message_ids=sorted(info['message_ids']))
+            for info in self.info_dict.values()
+        ]
+
+    def merge_info(self, info_list: List[Dict[str, Any]]) -> None:
+        for info in info_list:
+            target_path = info['target_path']
+            if target_path in self.info_dict:
+                self.info_dict[target_path]['message_ids'].update(info['message_ids'])
+            else:
+                self.info_dict[target_path] = dict(info, message_ids=set(info['message_ids']))
+
     def write_info(self, output_dir: str, realm_id: int) -> None:
         attachments = []  # type: List[Dict[str, Any]]
         uploads_records = []  # type: List[Dict[str, Any]]
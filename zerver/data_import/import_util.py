@@ -1,12 +1,14 @@
 import random
 import requests
+from collections import defaultdict
 import shutil
 import logging
 import os
 import traceback
 import ujson
 
-from typing import List, Dict, Any, Optional, Set, Callable, Iterable, Tuple, TypeVar
+from typing import List, Dict, Any, Optional, Set, Callable, Iterable, Iterator, \
+    Tuple, TypeVar
 from django.forms.models import model_to_dict
 
 from zerver.models import Realm, RealmEmoji, Subscription, Recipient, \
@@ -691,3 +693,87 @@ def create_converted_data_files(data: Any, output_dir: str, file_path: str) -> N
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     with open(output_file, 'w') as fp:
         ujson.dump(data, fp, indent=4)
+
+ChunkItem = TypeVar('ChunkItem')
+def chunked(items: Iterable[ChunkItem], chunk_size: int) -> Iterator[List[ChunkItem]]:
+    chunk = []  # type: List[ChunkItem]
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# When converting message chunks in parallel, each chunk gets its own
+# block of this many ids in each of the sequences used while
+# converting messages, so that worker processes never hand out the
+# same id.  The importer renumbers all of these ids, so the resulting
+# gaps are harmless.
+CHUNK_ID_BLOCK_SIZE = 10 ** 9
+
+def convert_message_chunks(
+        chunks: Iterable[List[ZerverFieldsT]],
+        convert_chunk: Callable[[List[ZerverFieldsT]], Tuple[ZerverFieldsT, Dict[str, List[Any]]]],
+        output_dir: str,
+        id_sequences: List[str],
+        threads: int=1) -> Dict[str, List[Any]]:
+    """
+    The shared message conversion pipeline for our data import tools.
+
+    convert_chunk converts one chunk of third-party messages; it
+    returns the data for that chunk's messages-*.json file (i.e.
+    zerver_message and zerver_usermessage), and a dictionary of
+    lists of other data (e.g. reactions and attachments), which are
+    concatenated across all the chunks and returned.
+
+    With threads > 1, chunks are converted in parallel, forked
+    processes.  `chunks` is consumed lazily, so only about `threads`
+    chunks of messages are in memory at once; id_sequences lists the
+    NEXT_ID sequences that convert_chunk uses, which are given a
+    disjoint block of ids in each process.
+    """
+    extras = defaultdict(list)  # type: Dict[str, List[Any]]
+
+    def write_message_file(dump_file_id: int, message_json: ZerverFieldsT) -> None:
+        message_file = "/messages-%06d.json" % (dump_file_id,)
+        logging.info("Writing Messages to %s\n" % (output_dir + message_file,))
+        create_converted_data_files(message_json, output_dir, message_file)
+
+    if threads == 1:
+        for dump_file_id, chunk in enumerate(chunks, start=1):
+            message_json, extra = convert_chunk(chunk)
+            write_message_file(dump_file_id, message_json)
+            for key, value in extra.items():
+                extras[key] += value
+        return extras
+
+    def extra_file(dump_file_id: int) -> str:
+        return "/messages-%06d.extra.json" % (dump_file_id,)
+
+    def convert_job(job: Tuple[int, List[ZerverFieldsT]]) -> int:
+        (dump_file_id, chunk) = job
+        try:
+            for name in id_sequences:
+                NEXT_ID.restart(name, dump_file_id * CHUNK_ID_BLOCK_SIZE)
+            message_json, extra = convert_chunk(chunk)
+            write_message_file(dump_file_id, message_json)
+            create_converted_data_files(extra, output_dir, extra_file(dump_file_id))
+        except Exception:
+            logging.exception("Error converting message chunk %s" % (dump_file_id,))
+            return 1
+        return 0
+
+    num_chunks = 0
+    for (status, job) in run_parallel(convert_job, enumerate(chunks, start=1), threads=threads):
+        if status != 0:
+            raise Exception("Failed to convert message chunk %s" % (job[0],))
+        num_chunks += 1
+
+    for dump_file_id in range(1, num_chunks + 1):
+        extra_path = output_dir + extra_file(dump_file_id)
+        with open(extra_path) as f:
+            for key, value in ujson.load(f).items():
+                extras[key] += value
+        os.remove(extra_path)
+    return extras
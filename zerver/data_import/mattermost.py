@@ -2,6 +2,7 @@
 spec:
 https://docs.mattermost.com/administration/bulk-export.html
 """
+import itertools
 import os
 import logging
 import subprocess
@@ -9,23 +10,21 @@ import ujson
 import re
 import shutil
 
-from typing import Any, Callable, Dict, List, Set
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
 
 from django.conf import settings
 from django.utils.timezone import now as timezone_now
 from django.forms.models import model_to_dict
 
 from zerver.models import Recipient, RealmEmoji, Reaction, UserProfile
-from zerver.lib.utils import (
-    process_list_in_batches,
-)
 from zerver.lib.emoji import name_to_codepoint
 from zerver.data_import.import_util import ZerverFieldsT, build_zerver_realm, \
     build_stream, build_realm, build_message, create_converted_data_files, \
     make_subscriber_map, build_recipients, build_user_profile, \
     build_stream_subscriptions, build_huddle_subscriptions, \
     build_personal_subscriptions, SubscriberHandler, \
-    build_realm_emoji, make_user_messages, build_huddle
+    build_realm_emoji, make_user_messages, build_huddle, chunked, \
+    convert_message_chunks
 
 from zerver.data_import.mattermost_user import UserHandler
 from zerver.data_import.sequencer import NEXT_ID, IdMapper
@@ -291,10 +290,8 @@ def process_raw_message_batch(realm_id: int,
                               user_handler: UserHandler,
                               get_recipient_id_from_receiver_name: Callable[[str, int], int],
                               is_pm_data: bool,
-                              output_dir: str,
                               zerver_realmemoji: List[Dict[str, Any]],
-                              total_reactions: List[Dict[str, Any]],
-                              ) -> None:
+                              ) -> Tuple[ZerverFieldsT, Dict[str, List[Any]]]:
 
     def fix_mentions(content: str, mention_user_ids: Set[int]) -> str:
         for user_id in mention_user_ids:
@@ -317,6 +314,7 @@ def process_raw_message_batch(realm_id: int,
     h = html2text.HTML2Text()
 
     pm_members = {}
+    reactions = []  # type: List[ZerverFieldsT]
 
     for raw_message in raw_messages:
         message_id = NEXT_ID('message')
@@ -365,7 +363,7 @@ def process_raw_message_batch(realm_id: int,
             has_attachment=False,
         )
         zerver_message.append(message)
-        build_reactions(realm_id, total_reactions, raw_message["reactions"], message_id,
+        build_reactions(realm_id, reactions, raw_message["reactions"], message_id,
                         user_id_mapper, zerver_realmemoji)
 
     zerver_usermessage = make_user_messages(
@@ -379,25 +377,13 @@ def process_raw_message_batch(realm_id: int,
         zerver_message=zerver_message,
         zerver_usermessage=zerver_usermessage,
     )
-
-    dump_file_id = NEXT_ID('dump_file_id' + str(realm_id))
-    message_file = "/messages-%06d.json" % (dump_file_id,)
-    create_converted_data_files(message_json, output_dir, message_file)
+    return message_json, dict(reactions=reactions)
 
 def process_posts(num_teams: int,
                   team_name: str,
-                  realm_id: int,
                   post_data: List[Dict[str, Any]],
-                  get_recipient_id_from_receiver_name: Callable[[str, int], int],
-                  subscriber_map: Dict[int, Set[int]],
-                  output_dir: str,
-                  is_pm_data: bool,
                   masking_content: bool,
-                  user_id_mapper: IdMapper,
-                  user_handler: UserHandler,
-                  username_to_user: Dict[str, Dict[str, Any]],
-                  zerver_realmemoji: List[Dict[str, Any]],
-                  total_reactions: List[Dict[str, Any]]) -> None:
+                  user_id_mapper: IdMapper) -> Iterator[Dict[str, Any]]:
 
     post_data_list = []
     for post in post_data:
@@ -447,9 +433,8 @@ def process_posts(num_teams: int,
             raise AssertionError("Post without channel or channel_members key.")
         return message_dict
 
-    raw_messages = []
     for post_dict in post_data_list:
-        raw_messages.append(message_to_dict(post_dict))
+        yield message_to_dict(post_dict)
         message_replies = post_dict["replies"]
         # Replies to a message in Mattermost are stored in the main message object.
         # For now, we just append the replies immediately after the original message.
@@ -459,29 +444,7 @@ def process_posts(num_teams: int,
                     reply["channel"] = post_dict["channel"]
                 else:  # nocoverage
                     reply["channel_members"] = post_dict["channel_members"]
-                raw_messages.append(message_to_dict(reply))
-
-    def process_batch(lst: List[Dict[str, Any]]) -> None:
-        process_raw_message_batch(
-            realm_id=realm_id,
-            raw_messages=lst,
-            subscriber_map=subscriber_map,
-            user_id_mapper=user_id_mapper,
-            user_handler=user_handler,
-            get_recipient_id_from_receiver_name=get_recipient_id_from_receiver_name,
-            is_pm_data=is_pm_data,
-            output_dir=output_dir,
-            zerver_realmemoji=zerver_realmemoji,
-            total_reactions=total_reactions,
-        )
-
-    chunk_size = 1000
-
-    process_list_in_batches(
-        lst=raw_messages,
-        chunk_size=chunk_size,
-        process_batch=process_batch,
-    )
+                yield message_to_dict(reply)
 
 def write_message_data(num_teams: int,
                        team_name: str,
@@ -497,7 +460,7 @@ def write_message_data(num_teams: int,
                        user_handler: UserHandler,
                        username_to_user: Dict[str, Dict[str, Any]],
                        zerver_realmemoji: List[Dict[str, Any]],
-                       total_reactions: List[Dict[str, Any]]) -> None:
+                       threads: int=1) -> List[ZerverFieldsT]:
     stream_id_to_recipient_id = {}
     huddle_id_to_recipient_id = {}
     user_id_to_recipient_id = {}
@@ -530,24 +493,44 @@ def write_message_data(num_teams: int,
         post_types = ["channel_post"]
         logging.warning("Skipping importing huddles and PMs since there are multiple teams in the export")
 
-    for post_type in post_types:
-        process_posts(
-            num_teams=num_teams,
-            team_name=team_name,
+    # Chunks never mix channel posts with direct posts, so each
+    # chunk's first message tells us which kind it holds.
+    chunks = itertools.chain.from_iterable(
+        chunked(
+            process_posts(
+                num_teams=num_teams,
+                team_name=team_name,
+                post_data=post_data[post_type],
+                masking_content=masking_content,
+                user_id_mapper=user_id_mapper,
+            ),
+            chunk_size=1000,
+        )
+        for post_type in post_types
+    )
+
+    def convert_chunk(raw_messages: List[ZerverFieldsT]) -> Tuple[ZerverFieldsT,
+                                                                  Dict[str, List[Any]]]:
+        return process_raw_message_batch(
             realm_id=realm_id,
-            post_data=post_data[post_type],
-            get_recipient_id_from_receiver_name=get_recipient_id_from_receiver_name,
+            raw_messages=raw_messages,
             subscriber_map=subscriber_map,
-            output_dir=output_dir,
-            is_pm_data=post_type == "direct_post",
-            masking_content=masking_content,
             user_id_mapper=user_id_mapper,
             user_handler=user_handler,
-            username_to_user=username_to_user,
+            get_recipient_id_from_receiver_name=get_recipient_id_from_receiver_name,
+            is_pm_data="channel_name" not in raw_messages[0],
             zerver_realmemoji=zerver_realmemoji,
-            total_reactions=total_reactions,
         )
 
+    extras = convert_message_chunks(
+        chunks=chunks,
+        convert_chunk=convert_chunk,
+        output_dir=output_dir,
+        id_sequences=['message', 'user_message', 'reaction'],
+        threads=threads,
+    )
+    return extras['reactions']
+
 def write_emoticon_data(realm_id: int,
                         custom_emoji_data: List[Dict[str, Any]],
                         data_dir: str,
@@ -693,7 +676,8 @@ def mattermost_data_file_to_dict(mattermost_data_file: str) -> Dict[str, Any]:
                 mattermost_data[data_type].append(row[data_type])
     return mattermost_data
 
-def do_convert_data(mattermost_data_dir: str, output_dir: str, masking_content: bool) -> None:
+def do_convert_data(mattermost_data_dir: str, output_dir: str, masking_content: bool,
+                    threads: int=1) -> None:
     username_to_user = {}  # type: Dict[str, Dict[str, Any]]
 
     os.makedirs(output_dir, exist_ok=True)
@@ -796,8 +780,7 @@ def do_convert_data(mattermost_data_dir: str, output_dir: str, masking_content:
             zerver_subscription=zerver_subscription,
         )
 
-        total_reactions = []  # type: List[Dict[str, Any]]
-        write_message_data(
+        realm['zerver_reaction'] = write_message_data(
             num_teams=len(mattermost_data["team"]),
             team_name=team_name,
             realm_id=realm_id,
@@ -812,9 +795,8 @@ def do_convert_data(mattermost_data_dir: str, output_dir: str, masking_content:
             user_handler=user_handler,
             username_to_user=username_to_user,
             zerver_realmemoji=zerver_realmemoji,
-            total_reactions=total_reactions,
+            threads=threads,
         )
-        realm['zerver_reaction'] = total_reactions
         realm['zerver_userprofile'] = user_handler.get_all_users()
         realm['sort_by_date'] = True
 
@@ -11,8 +11,8 @@ for data imports that's usually easy to
 manage.  See hipchat.py for example usage.
 '''
 
-def _seq() -> Callable[[], int]:
-    i = 0
+def _seq(start: int=0) -> Callable[[], int]:
+    i = start
 
     def next_one() -> int:
         nonlocal i
@@ -21,22 +21,32 @@ def _seq() -> Callable[[], int]:
 
     return next_one
 
-def sequencer() -> Callable[[str], int]:
+class Sequencer:
     '''
         Use like this:
 
         NEXT_ID = sequencer()
         message_id = NEXT_ID('message')
     '''
-    seq_dict = dict()  # type: Dict[str, Callable[[], int]]
+    def __init__(self) -> None:
+        self.seq_dict = dict()  # type: Dict[str, Callable[[], int]]
 
-    def next_one(name: str) -> int:
-        if name not in seq_dict:
-            seq_dict[name] = _seq()
-        seq = seq_dict[name]
+    def __call__(self, name: str) -> int:
+        if name not in self.seq_dict:
+            self.seq_dict[name] = _seq()
+        seq = self.seq_dict[name]
         return seq()
 
-    return next_one
+    def restart(self, name: str, start: int) -> None:
+        '''
+        Makes the next id for `name` be start + 1.  This is useful
+        for giving each of several worker processes its own
+        disjoint block of ids.
+        '''
+        self.seq_dict[name] = _seq(start)
+
+def sequencer() -> Sequencer:
+    return Sequencer()
 
 '''
 NEXT_ID is a singleton used by an entire process, which is
@@ -20,7 +20,7 @@ from zerver.data_import.import_util import ZerverFieldsT, build_zerver_realm, \
     build_avatar, build_subscription, build_recipient, build_usermessages, \
     build_defaultstream, build_attachment, process_avatars, process_uploads, \
     process_emojis, build_realm, build_stream, build_huddle, build_message, \
-    create_converted_data_files, make_subscriber_map
+    create_converted_data_files, make_subscriber_map, chunked, convert_message_chunks
 from zerver.data_import.sequencer import NEXT_ID
 from zerver.lib.upload import random_name, sanitize_name
 from zerver.lib.export import MESSAGE_BATCH_CHUNK_SIZE
@@ -546,9 +546,10 @@ def convert_slack_workspace_messages(slack_data_dir: str, users: List[ZerverFiel
                                      zerver_userprofile: List[ZerverFieldsT],
                                      zerver_realmemoji: List[ZerverFieldsT], domain_name: str,
                                      output_dir: str,
-                                     chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE) -> Tuple[List[ZerverFieldsT],
-                                                                                        List[ZerverFieldsT],
-                                                                                        List[ZerverFieldsT]]:
+                                     chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE,
+                                     threads: int=1) -> Tuple[List[ZerverFieldsT],
+                                                              List[ZerverFieldsT],
+                                                              List[ZerverFieldsT]]:
     """
     Returns:
     1. reactions, which is a list of the reactions
@@ -563,27 +564,12 @@ def convert_slack_workspace_messages(slack_data_dir: str, users: List[ZerverFiel
     all_messages = get_messages_iterator(slack_data_dir, added_channels, added_mpims, dm_members)
     logging.info('######### IMPORTING MESSAGES STARTED #########\n')
 
-    total_reactions = []  # type: List[ZerverFieldsT]
-    total_attachments = []  # type: List[ZerverFieldsT]
-    total_uploads = []  # type: List[ZerverFieldsT]
-
-    dump_file_id = 1
-
     subscriber_map = make_subscriber_map(
         zerver_subscription=realm['zerver_subscription'],
     )
 
-    while True:
-        message_data = []
-        _counter = 0
-        for msg in all_messages:
-            _counter += 1
-            message_data.append(msg)
-            if _counter == chunk_size:
-                break
-        if len(message_data) == 0:
-            break
-
+    def convert_chunk(message_data: List[ZerverFieldsT]) -> Tuple[ZerverFieldsT,
+                                                                   Dict[str, List[Any]]]:
         zerver_message, zerver_usermessage, attachment, uploads, reactions = \
             channel_message_to_zerver_message(
                 realm_id, users, slack_user_id_to_zulip_user_id, slack_recipient_name_to_zulip_recipient_id,
@@ -593,19 +579,22 @@ def convert_slack_workspace_messages(slack_data_dir: str, users: List[ZerverFiel
         message_json = dict(
             zerver_message=zerver_message,
             zerver_usermessage=zerver_usermessage)
-
-        message_file = "/messages-%06d.json" % (dump_file_id,)
-        logging.info("Writing Messages to %s\n" % (output_dir + message_file,))
-        create_converted_data_files(message_json, output_dir, message_file)
-
-        total_reactions += reactions
-        total_attachments += attachment
-        total_uploads += uploads
-
-        dump_file_id += 1
+        extra = dict(
+            reactions=reactions,
+            uploads=uploads,
+            attachment=attachment)
+        return message_json, extra
+
+    extras = convert_message_chunks(
+        chunks=chunked(all_messages, chunk_size),
+        convert_chunk=convert_chunk,
+        output_dir=output_dir,
+        id_sequences=['message', 'user_message', 'attachment', 'reaction'],
+        threads=threads,
+    )
 
     logging.info('######### IMPORTING MESSAGES FINISHED #########\n')
-    return total_reactions, total_uploads, total_attachments
+    return extras['reactions'], extras['uploads'], extras['attachment']
 
 def get_messages_iterator(slack_data_dir: str, added_channels: Dict[str, Any],
                           added_mpims: AddedMPIMsT, dm_members: DMMembersT) -> Iterator[ZerverFieldsT]:
@@ -1058,7 +1047,8 @@ def do_convert_data(slack_zip_file: str, output_dir: str, token: str, threads: i
     reactions, uploads_list, zerver_attachment = convert_slack_workspace_messages(
         slack_data_dir, user_list, realm_id, slack_user_id_to_zulip_user_id,
         slack_recipient_name_to_zulip_recipient_id, added_channels, added_mpims, dm_members, realm,
-        realm['zerver_userprofile'], realm['zerver_realmemoji'], domain_name, output_dir)
+        realm['zerver_userprofile'], realm['zerver_realmemoji'], domain_name, output_dir,
+        threads=threads)
 
     # Move zerver_reactions to realm.json file
     realm['zerver_reaction'] = reactions
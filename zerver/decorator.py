@@ -10,7 +10,8 @@ from django.contrib.auth import REDIRECT_FIELD_NAME, login as django_login
 from django.views.decorators.csrf import csrf_exempt
 from django.http import QueryDict, HttpResponseNotAllowed, HttpRequest
 from django.http.multipartparser import MultiPartParser
-from zerver.models import Realm, UserProfile, get_client, get_user_profile_by_api_key
+from zerver.models import Realm, UserProfile, get_client, get_user_profile_by_api_key, \
+    get_api_key_auth_record
 from zerver.lib.response import json_error, json_unauthorized, json_success
 from django.shortcuts import resolve_url
 from django.utils.decorators import available_attrs
@@ -236,15 +237,26 @@ def access_user_by_api_key(request: HttpRequest, api_key: str, email: Optional[s
     if not has_api_key_format(api_key):
         raise InvalidAPIKeyFormatError()
 
-    try:
-        user_profile = get_user_profile_by_api_key(api_key)
-    except UserProfile.DoesNotExist:
+    # Check the cached auth record first, so that requests with an
+    # invalid key, or for a deactivated account, are rejected without
+    # loading the UserProfile.
+    record = get_api_key_auth_record(api_key)
+    if record is None:
         raise InvalidAPIKeyError()
-    if email is not None and email.lower() != user_profile.delivery_email.lower():
+    if email is not None and email.lower() != record['delivery_email'].lower():
         # This covers the case that the API key is correct, but for a
         # different user.  We may end up wanting to relaxing this
         # constraint or give a different error message in the future.
         raise InvalidAPIKeyError()
+    if record['realm_deactivated']:
+        raise JsonableError(_("This organization has been deactivated"))
+    if not record['is_active']:
+        raise JsonableError(_("Account is deactivated"))
+
+    try:
+        user_profile = get_user_profile_by_api_key(api_key)
+    except UserProfile.DoesNotExist:
+        raise InvalidAPIKeyError()
 
     validate_account_and_subdomain(request, user_profile)
 
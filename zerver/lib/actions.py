@@ -30,16 +30,15 @@ from zerver.lib.bot_config import (
 from zerver.lib.cache import (
     bot_dict_fields,
     display_recipient_cache_key,
+    delete_api_key_auth_records,
     delete_user_profile_caches,
     to_dict_cache_key_id,
-    user_profile_by_api_key_cache_key,
 )
 from zerver.lib.context_managers import lockfile
 from zerver.lib.email_mirror_helpers import encode_email_address, encode_email_address_helper
 from zerver.lib.emoji import emoji_name_to_emoji_code, get_emoji_file_name
 from zerver.lib.exceptions import StreamDoesNotExistError, \
     StreamWithIDDoesNotExistError
-from zerver.lib.export import get_realm_exports_serialized
 from zerver.lib.external_accounts import DEFAULT_EXTERNAL_ACCOUNTS
 from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.message import (
@@ -98,7 +97,7 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
     Client, DefaultStream, DefaultStreamGroup, UserPresence, \
     ScheduledEmail, MAX_TOPIC_NAME_LENGTH, \
     MAX_MESSAGE_LENGTH, get_client, get_stream, \
-    get_user_profile_by_id, PreregistrationUser, \
+    get_user_profile_by_id, bulk_get_user_profiles_by_id, PreregistrationUser, \
     email_allowed_for_realm, email_to_username, \
     get_user_by_delivery_email, get_stream_cache_key, active_non_guest_user_ids, \
     UserActivityInterval, active_user_ids, get_active_streams, \
@@ -156,9 +155,6 @@ from zerver.lib.types import ProfileFieldData
 
 from analytics.models import StreamCount
 
-if settings.BILLING_ENABLED:
-    from corporate.lib.stripe import update_license_ledger_if_needed
-
 import ujson
 import time
 import datetime
@@ -519,6 +515,9 @@ def do_create_user(email: str, password: Optional[str], realm: Realm, full_name:
     do_increment_logging_stat(user_profile.realm, COUNT_STATS['active_users_log:is_bot:day'],
                               user_profile.is_bot, event_time)
     if settings.BILLING_ENABLED:
+        # Imported here, so that processes that never change a
+        # realm's user count don't load Stripe.
+        from corporate.lib.stripe import update_license_ledger_if_needed
         update_license_ledger_if_needed(user_profile.realm, event_time)
 
     notify_created_user(user_profile)
@@ -550,6 +549,7 @@ def do_activate_user(user_profile: UserProfile) -> None:
     do_increment_logging_stat(user_profile.realm, COUNT_STATS['active_users_log:is_bot:day'],
                               user_profile.is_bot, event_time)
     if settings.BILLING_ENABLED:
+        from corporate.lib.stripe import update_license_ledger_if_needed
         update_license_ledger_if_needed(user_profile.realm, event_time)
 
     notify_created_user(user_profile)
@@ -570,6 +570,7 @@ def do_reactivate_user(user_profile: UserProfile, acting_user: Optional[UserProf
     do_increment_logging_stat(user_profile.realm, COUNT_STATS['active_users_log:is_bot:day'],
                               user_profile.is_bot, event_time)
     if settings.BILLING_ENABLED:
+        from corporate.lib.stripe import update_license_ledger_if_needed
         update_license_ledger_if_needed(user_profile.realm, event_time)
 
     notify_created_user(user_profile)
@@ -783,6 +784,7 @@ def do_deactivate_user(user_profile: UserProfile,
     do_increment_logging_stat(user_profile.realm, COUNT_STATS['active_users_log:is_bot:day'],
                               user_profile.is_bot, event_time, increment=-1)
     if settings.BILLING_ENABLED:
+        from corporate.lib.stripe import update_license_ledger_if_needed
         update_license_ledger_if_needed(user_profile.realm, event_time)
 
     event = dict(type="realm_user", op="remove",
@@ -986,8 +988,8 @@ def get_typing_user_profiles(recipient: Recipient, sender_id: int) -> List[UserP
     else:
         raise ValueError('Bad recipient type')
 
-    users = [get_user_profile_by_id(user_id) for user_id in user_ids]
-    return users
+    users_by_id = bulk_get_user_profiles_by_id(user_ids)
+    return [users_by_id[user_id] for user_id in user_ids]
 
 RecipientInfoResult = TypedDict('RecipientInfoResult', {
     'active_user_ids': Set[int],
@@ -3361,7 +3363,7 @@ def do_regenerate_api_key(user_profile: UserProfile, acting_user: UserProfile) -
     # We need to explicitly delete the old API key from our caches,
     # because the on-save handler for flushing the UserProfile object
     # in zerver/lib/cache.py only has access to the new API key.
-    cache_delete(user_profile_by_api_key_cache_key(old_api_key))
+    delete_api_key_auth_records([old_api_key])
 
     event_time = timezone_now()
     RealmAuditLog.objects.create(realm=user_profile.realm, acting_user=acting_user,
@@ -5901,6 +5903,8 @@ def get_zoom_video_call_url(realm: Realm) -> str:
     return response['join_url']
 
 def notify_realm_export(user_profile: UserProfile) -> None:
+    # zerver.lib.export is large and rarely needed; see tools/profile-imports.
+    from zerver.lib.export import get_realm_exports_serialized
     # In the future, we may want to send this event to all realm admins.
     event = dict(type='realm_export',
                  exports=get_realm_exports_serialized(user_profile))
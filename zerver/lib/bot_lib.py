@@ -4,15 +4,15 @@ import importlib
 from zerver.lib.actions import internal_send_private_message, \
     internal_send_stream_message_by_name, internal_send_huddle_message
 from zerver.models import UserProfile, get_active_user
-from zerver.lib.bot_storage import get_bot_storage, set_bot_storage, \
-    is_key_in_bot_storage, remove_bot_storage
+from zerver.lib.bot_storage import get_bot_storage, get_bot_storage_values, \
+    set_bot_storage, is_key_in_bot_storage, remove_bot_storage
 from zerver.lib.bot_config import get_bot_config, ConfigError
 from zerver.lib.integrations import EMBEDDED_BOTS
 from zerver.lib.topic import get_topic_from_message_info
 
 from django.utils.translation import ugettext as _
 
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 our_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -37,18 +37,36 @@ class StateHandler:
         self.user_profile = user_profile
         self.marshal = lambda obj: json.dumps(obj)
         self.demarshal = lambda obj: json.loads(obj)
+        # Bots tend to read the same few keys repeatedly while handling
+        # a message, so we remember the (marshaled) values we've read
+        # or written.  Writes still go straight to the database.
+        self.cache = {}  # type: Dict[str, str]
 
     def get(self, key: str) -> str:
-        return self.demarshal(get_bot_storage(self.user_profile, key))
+        if key not in self.cache:
+            self.cache[key] = get_bot_storage(self.user_profile, key)
+        return self.demarshal(self.cache[key])
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        missing_keys = [key for key in keys if key not in self.cache]
+        if missing_keys:
+            self.cache.update(get_bot_storage_values(self.user_profile, missing_keys))
+        return {key: self.demarshal(self.cache[key]) for key in keys}
 
     def put(self, key: str, value: str) -> None:
-        set_bot_storage(self.user_profile, [(key, self.marshal(value))])
+        self.put_many({key: value})
+
+    def put_many(self, entries: Dict[str, str]) -> None:
+        marshaled_entries = [(key, self.marshal(value)) for key, value in entries.items()]
+        set_bot_storage(self.user_profile, marshaled_entries)
+        self.cache.update(marshaled_entries)
 
     def remove(self, key: str) -> None:
         remove_bot_storage(self.user_profile, [key])
+        self.cache.pop(key, None)
 
     def contains(self, key: str) -> bool:
-        return is_key_in_bot_storage(self.user_profile, key)
+        return key in self.cache or is_key_in_bot_storage(self.user_profile, key)
 
 class EmbeddedBotQuitException(Exception):
     pass
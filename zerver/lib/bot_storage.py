@@ -1,10 +1,11 @@
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Sum
 from django.db.models.query import F
 from django.db.models.functions import Length
 from zerver.models import BotStorageData, UserProfile
 
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 
 class StateError(Exception):
     pass
@@ -15,6 +16,13 @@ def get_bot_storage(bot_profile: UserProfile, key: str) -> str:
     except BotStorageData.DoesNotExist:
         raise StateError("Key does not exist.")
 
+def get_bot_storage_values(bot_profile: UserProfile, keys: List[str]) -> Dict[str, str]:
+    values = dict(BotStorageData.objects.filter(bot_profile=bot_profile, key__in=keys)
+                                        .values_list('key', 'value'))
+    if len(values) < len(set(keys)):
+        raise StateError("Key does not exist.")
+    return values
+
 def get_bot_storage_size(bot_profile: UserProfile, key: Optional[str]=None) -> int:
     if key is None:
         return BotStorageData.objects.filter(bot_profile=bot_profile) \
@@ -28,21 +36,37 @@ def get_bot_storage_size(bot_profile: UserProfile, key: Optional[str]=None) -> i
 
 def set_bot_storage(bot_profile: UserProfile, entries: List[Tuple[str, str]]) -> None:
     storage_size_limit = settings.USER_STATE_SIZE_LIMIT
-    storage_size_difference = 0
     for key, value in entries:
         if type(key) is not str:
             raise StateError("Key type is {}, but should be str.".format(type(key)))
         if type(value) is not str:
             raise StateError("Value type is {}, but should be str.".format(type(value)))
-        storage_size_difference += (len(key) + len(value)) - get_bot_storage_size(bot_profile, key)
+    # Later entries for a key replace earlier ones.
+    new_values = dict(entries)
+
+    # We fetch all the existing entries at once, rather than
+    # querying for each key.
+    existing_entries = {
+        entry.key: entry
+        for entry in BotStorageData.objects.filter(bot_profile=bot_profile,
+                                                   key__in=list(new_values.keys()))
+    }
+    storage_size_difference = sum(len(key) + len(value) for key, value in new_values.items())
+    storage_size_difference -= sum(len(key) + len(entry.value)
+                                   for key, entry in existing_entries.items())
     new_storage_size = get_bot_storage_size(bot_profile) + storage_size_difference
     if new_storage_size > storage_size_limit:
         raise StateError("Request exceeds storage limit by {} characters. The limit is {} characters."
                          .format(new_storage_size - storage_size_limit, storage_size_limit))
-    else:
-        for key, value in entries:
-            BotStorageData.objects.update_or_create(bot_profile=bot_profile, key=key,
-                                                    defaults={'value': value})
+
+    for key, entry in existing_entries.items():
+        entry.value = new_values[key]
+    with transaction.atomic():
+        BotStorageData.objects.bulk_update(existing_entries.values(), ['value'])
+        BotStorageData.objects.bulk_create([
+            BotStorageData(bot_profile=bot_profile, key=key, value=value)
+            for key, value in new_values.items() if key not in existing_entries
+        ])
 
 def remove_bot_storage(bot_profile: UserProfile, keys: List[str]) -> None:
     queryset = BotStorageData.objects.filter(bot_profile=bot_profile, key__in=keys)
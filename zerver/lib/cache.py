@@ -1,4 +1,5 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/caching.html for docs
+from collections import OrderedDict
 from functools import wraps
 
 from django.utils.lru_cache import lru_cache
@@ -12,6 +13,7 @@ from django.http import HttpRequest
 from typing import Any, Callable, Dict, Iterable, List, \
     Optional, Sequence, TypeVar, Tuple, TYPE_CHECKING
 
+from zerver.lib.request_profile import record_cache_keys
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
 import time
 import base64
@@ -109,6 +111,7 @@ def bounce_key_prefix_for_testing(test_name: str) -> None:
     # We are taking the hash of the KEY_PREFIX to decrease the size of the key.
     # Memcached keys should have a length of less than 250.
     KEY_PREFIX = hashlib.sha1(KEY_PREFIX.encode('utf-8')).hexdigest() + ":"
+    api_key_local_cache.clear()
 
 def get_cache_backend(cache_name: Optional[str]) -> BaseCache:
     if cache_name is None:
@@ -222,6 +225,7 @@ def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optio
     final_key = KEY_PREFIX + key
     validate_cache_key(final_key)
 
+    record_cache_keys('set', [key])
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(final_key, (val,), timeout=timeout)
@@ -231,6 +235,7 @@ def cache_get(key: str, cache_name: Optional[str]=None) -> Any:
     final_key = KEY_PREFIX + key
     validate_cache_key(final_key)
 
+    record_cache_keys('get', [key])
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(final_key)
@@ -238,6 +243,7 @@ def cache_get(key: str, cache_name: Optional[str]=None) -> Any:
     return ret
 
 def cache_get_many(keys: List[str], cache_name: Optional[str]=None) -> Dict[str, Any]:
+    record_cache_keys('get', keys)
     keys = [KEY_PREFIX + key for key in keys]
     for key in keys:
         validate_cache_key(key)
@@ -269,6 +275,7 @@ def cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
         new_key = KEY_PREFIX + key
         validate_cache_key(new_key)
         new_items[new_key] = items[key]
+    record_cache_keys('set', items.keys())
     items = new_items
     remote_cache_stats_start()
     get_cache_backend(cache_name).set_many(items, timeout=timeout)
@@ -297,11 +304,14 @@ def cache_delete(key: str, cache_name: Optional[str]=None) -> None:
     final_key = KEY_PREFIX + key
     validate_cache_key(final_key)
 
+    record_cache_keys('delete', [key])
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(final_key)
     remote_cache_stats_finish()
 
 def cache_delete_many(items: Iterable[str], cache_name: Optional[str]=None) -> None:
+    items = list(items)
+    record_cache_keys('delete', items)
     keys = [KEY_PREFIX + item for item in items]
     for key in keys:
         validate_cache_key(key)
@@ -410,6 +420,9 @@ def generic_bulk_cached_fetch(
 def preview_url_cache_key(url: str) -> str:
     return "preview_url:%s" % (make_safe_digest(url),)
 
+def preview_url_failure_cache_key(url: str) -> str:
+    return "preview_url_failure:%s" % (make_safe_digest(url),)
+
 def display_recipient_cache_key(recipient_id: int) -> str:
     return "display_recipient_dict:%d" % (recipient_id,)
 
@@ -437,7 +450,44 @@ def user_profile_by_id_cache_key(user_profile_id: int) -> str:
     return "user_profile_by_id:%s" % (user_profile_id,)
 
 def user_profile_by_api_key_cache_key(api_key: str) -> str:
-    return "user_profile_by_api_key:%s" % (api_key,)
+    # Holds an api_key_auth_record, not a UserProfile; see
+    # get_api_key_auth_record.
+    return "api_key_auth_record:%s" % (api_key,)
+
+# Every API request looks up its API key, so we keep a small
+# per-process LRU of API key auth records (or None, for invalid keys)
+# in front of the remote cache.  Changes made in this process evict
+# entries via delete_api_key_auth_records; entries expire after
+# API_KEY_LOCAL_CACHE_SECONDS, which bounds how long a change made by
+# another process (e.g. deactivating the user) goes unnoticed here.
+API_KEY_LOCAL_CACHE_SIZE = 1000
+API_KEY_LOCAL_CACHE_SECONDS = 10
+api_key_local_cache = OrderedDict()  # type: OrderedDict[str, Tuple[float, Optional[Dict[str, Any]]]]
+
+def get_local_api_key_auth_record(api_key: str) -> Optional[Tuple[Optional[Dict[str, Any]]]]:
+    """Returns a singleton tuple of the locally cached record, so that
+    cached invalid keys can be distinguished from a cache miss."""
+    entry = api_key_local_cache.get(api_key)
+    if entry is None:
+        return None
+    expires_at, record = entry
+    if expires_at < time.time():
+        api_key_local_cache.pop(api_key, None)
+        return None
+    api_key_local_cache.move_to_end(api_key)
+    return (record,)
+
+def set_local_api_key_auth_record(api_key: str, record: Optional[Dict[str, Any]]) -> None:
+    api_key_local_cache[api_key] = (time.time() + API_KEY_LOCAL_CACHE_SECONDS, record)
+    api_key_local_cache.move_to_end(api_key)
+    while len(api_key_local_cache) > API_KEY_LOCAL_CACHE_SIZE:
+        api_key_local_cache.popitem(last=False)
+
+def delete_api_key_auth_records(api_keys: Iterable[str]) -> None:
+    api_keys = list(api_keys)
+    for api_key in api_keys:
+        api_key_local_cache.pop(api_key, None)
+    cache_delete_many([user_profile_by_api_key_cache_key(api_key) for api_key in api_keys])
 
 realm_user_dict_fields = [
     'id', 'full_name', 'short_name', 'email',
@@ -483,6 +533,7 @@ def delete_user_profile_caches(user_profiles: Iterable['UserProfile']) -> None:
         keys.append(user_profile_by_email_cache_key(user_profile.delivery_email))
         keys.append(user_profile_by_id_cache_key(user_profile.id))
         for api_key in get_all_api_keys(user_profile):
+            api_key_local_cache.pop(api_key, None)
             keys.append(user_profile_by_api_key_cache_key(api_key))
         keys.append(user_profile_cache_key(user_profile.email, user_profile.realm))
         if user_profile.is_bot and is_cross_realm_bot_email(user_profile.email):
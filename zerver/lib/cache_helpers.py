@@ -44,10 +44,17 @@ def message_cache_items(items_for_remote_cache: Dict[str, Tuple[bytes]],
     value = MessageDict.to_dict_uncached(message)
     items_for_remote_cache[key] = (value,)
 
-def user_cache_items(items_for_remote_cache: Dict[str, Tuple[UserProfile]],
+def user_cache_items(items_for_remote_cache: Dict[str, Tuple[Any]],
                      user_profile: UserProfile) -> None:
+    # See get_api_key_auth_record.
+    api_key_auth_record = dict(
+        id=user_profile.id,
+        delivery_email=user_profile.delivery_email,
+        is_active=user_profile.is_active,
+        realm_deactivated=user_profile.realm.deactivated,
+    )
     for api_key in get_all_api_keys(user_profile):
-        items_for_remote_cache[user_profile_by_api_key_cache_key(api_key)] = (user_profile,)
+        items_for_remote_cache[user_profile_by_api_key_cache_key(api_key)] = (api_key_auth_record,)
     items_for_remote_cache[user_profile_cache_key(user_profile.email,
                                                   user_profile.realm)] = (user_profile,)
     # We have other user_profile caches, but none of them are on the
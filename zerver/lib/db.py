@@ -1,10 +1,18 @@
+import logging
 import time
+from functools import wraps
 from psycopg2.extensions import cursor, connection
+from psycopg2.sql import Composable
+from django.conf import settings
+
+from zerver.lib.request_profile import fingerprint_sql, record_sql
+from zerver.lib.utils import statsd
 
 from typing import Callable, Optional, Iterable, Any, Dict, List, Union, TypeVar, \
-    Mapping
+    Mapping, cast
 
 CursorObj = TypeVar('CursorObj', bound=cursor)
+FuncT = TypeVar('FuncT', bound=Callable[..., Any])
 ParamsT = Union[Iterable[Any], Mapping[str, Any]]
 
 # Similar to the tracking done in Django's CursorDebugWrapper, but done at the
@@ -19,9 +27,17 @@ def wrapper_execute(self: CursorObj,
     finally:
         stop = time.time()
         duration = stop - start
-        self.connection.queries.append({
+        query = {
             'time': "%.3f" % (duration,),
-        })
+        }
+        if isinstance(sql, Composable):
+            sql = sql.as_string(self)
+        if settings.QUERY_BUDGET_MODE is not None:
+            # See zerver/lib/query_budget.py.
+            query['fingerprint'] = fingerprint_sql(sql)
+        self.connection.queries.append(query)
+        self.connection.last_used = stop
+        record_sql(sql, duration)
 
 class TimeTrackingCursor(cursor):
     """A psycopg2 cursor class that tracks the time spent executing queries."""
@@ -39,7 +55,10 @@ class TimeTrackingConnection(connection):
 
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         self.queries = []  # type: List[Dict[str, str]]
+        self.connected_at = time.time()
+        self.last_used = self.connected_at
         super().__init__(*args, **kwargs)
+        statsd.incr("db.connections.opened")
 
     def cursor(self, *args: Any, **kwargs: Any) -> TimeTrackingCursor:
         kwargs.setdefault('cursor_factory', TimeTrackingCursor)
@@ -50,3 +69,54 @@ def reset_queries() -> None:
     for conn in connections.all():
         if conn.connection is not None:
             conn.connection.queries = []
+
+def check_database_connections() -> None:
+    """Called by long-running processes, like queue workers, before each
+    unit of work, since Django only manages connections around HTTP
+    requests.  Connections that are older than CONN_MAX_AGE, or broken
+    by an earlier error, are closed.  Connections that have been idle
+    for over DATABASE_HEALTH_CHECK_IDLE_SECONDS are checked with a
+    trivial query first, so that a connection dropped while idle
+    (e.g. by a database restart or a pooler's idle timeout) is
+    replaced, rather than failing the work's first query.
+
+    Connections in a transaction are left alone, since closing one
+    would lose the transaction's work."""
+    from django.db import connections
+    now = time.time()
+    for conn in connections.all():
+        if conn.connection is None or conn.in_atomic_block:
+            continue
+        statsd.timing("db.connections.age", (now - conn.connection.connected_at) * 1000)
+        conn.close_if_unusable_or_obsolete()
+        if conn.connection is None:
+            statsd.incr("db.connections.recycled")
+            continue
+        if now - conn.connection.last_used < settings.DATABASE_HEALTH_CHECK_IDLE_SECONDS:
+            continue
+        if not conn.is_usable():
+            logging.warning("Closing unusable database connection (idle %.0fs)" % (
+                now - conn.connection.last_used,))
+            statsd.incr("db.connections.unusable")
+            conn.close()
+
+def retry_on_connection_loss(func: FuncT) -> FuncT:
+    """Retries func once, on a fresh connection, if the database
+    connection is lost while running it.  Only for functions that
+    just read from the database, since a write may or may not have
+    happened before the connection was lost; and it's not used
+    inside a transaction, whose earlier work can't be retried."""
+    @wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        from django.db import DEFAULT_DB_ALIAS, InterfaceError, OperationalError, connections
+        try:
+            return func(*args, **kwargs)
+        except (InterfaceError, OperationalError):
+            conn = connections[DEFAULT_DB_ALIAS]
+            if conn.in_atomic_block or (conn.connection is not None and conn.is_usable()):
+                raise
+            logging.warning("Database connection lost in %s; retrying" % (func.__name__,))
+            statsd.incr("db.connections.retried_reads")
+            conn.close()
+            return func(*args, **kwargs)
+    return cast(FuncT, wrapper)
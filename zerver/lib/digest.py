@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Set, Tuple, Union
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
 
 from collections import defaultdict
 import datetime
@@ -6,6 +6,7 @@ import logging
 import pytz
 
 from django.conf import settings
+from django.db.models import QuerySet
 from django.utils.timezone import now as timezone_now
 
 from confirmation.models import one_click_unsubscribe_link
@@ -22,24 +23,25 @@ logger = logging.getLogger(__name__)
 log_to_file(logger, settings.DIGEST_LOG_PATH)
 
 DIGEST_CUTOFF = 5
+# Number of users whose digests are computed together, sharing the
+# work for users subscribed to the same streams.
+DIGEST_BATCH_SIZE = 100
 
 # Digests accumulate 2 types of interesting traffic for a user:
 # 1. New streams
 # 2. Interesting stream traffic, as determined by the longest and most
 #    diversely comment upon topics.
 
-def inactive_since(user_profile: UserProfile, cutoff: datetime.datetime) -> bool:
-    # Hasn't used the app in the last DIGEST_CUTOFF (5) days.
-    most_recent_visit = [row.last_visit for row in
-                         UserActivity.objects.filter(
-                             user_profile=user_profile)]
-
-    if not most_recent_visit:
-        # This person has never used the app.
-        return True
-
-    last_visit = max(most_recent_visit)
-    return last_visit < cutoff
+def get_inactive_user_ids(realm: Realm, cutoff: datetime.datetime) -> List[int]:
+    # Users who want digests and haven't used the app since the
+    # cutoff, typically DIGEST_CUTOFF (5) days ago; this includes
+    # users who have never used the app at all.
+    recently_active_user_ids = UserActivity.objects.filter(
+        user_profile__realm=realm,
+        last_visit__gte=cutoff).values('user_profile_id')
+    return list(UserProfile.objects.filter(
+        realm=realm, is_active=True, is_bot=False, enable_digest_emails=True).exclude(
+            id__in=recently_active_user_ids).order_by('id').values_list('id', flat=True))
 
 def should_process_digest(realm_str: str) -> bool:
     if realm_str in settings.SYSTEM_ONLY_REALMS:
@@ -49,9 +51,9 @@ def should_process_digest(realm_str: str) -> bool:
 
 # Changes to this should also be reflected in
 # zerver/worker/queue_processors.py:DigestWorker.consume()
-def queue_digest_recipient(user_profile: UserProfile, cutoff: datetime.datetime) -> None:
+def queue_digest_recipients(user_ids: List[int], cutoff: datetime.datetime) -> None:
     # Convert cutoff to epoch seconds for transit.
-    event = {"user_profile_id": user_profile.id,
+    event = {"user_ids": user_ids,
              "cutoff": cutoff.strftime('%s')}
     queue_json_publish("digest_emails", event)
 
@@ -64,14 +66,11 @@ def enqueue_emails(cutoff: datetime.datetime) -> None:
         if not should_process_digest(realm.string_id):
             continue
 
-        user_profiles = UserProfile.objects.filter(
-            realm=realm, is_active=True, is_bot=False, enable_digest_emails=True)
-
-        for user_profile in user_profiles:
-            if inactive_since(user_profile, cutoff):
-                queue_digest_recipient(user_profile, cutoff)
-                logger.info("User %s is inactive, queuing for potential digest" % (
-                    user_profile.id,))
+        user_ids = get_inactive_user_ids(realm, cutoff)
+        for i in range(0, len(user_ids), DIGEST_BATCH_SIZE):
+            batch = user_ids[i:i + DIGEST_BATCH_SIZE]
+            queue_digest_recipients(batch, cutoff)
+            logger.info("Users %s are inactive, queuing for potential digest" % (batch,))
 
 def gather_hot_conversations(user_profile: UserProfile, messages: List[Message]) -> List[Dict[str, Any]]:
     # Gather stream conversations of 2 types:
@@ -161,13 +160,46 @@ def gather_new_streams(user_profile: UserProfile,
 def enough_traffic(hot_conversations: str, new_streams: int) -> bool:
     return bool(hot_conversations or new_streams)
 
-def handle_digest_email(user_profile_id: int, cutoff: float,
-                        render_to_web: bool = False) -> Union[None, Dict[str, Any]]:
-    user_profile = get_user_profile_by_id(user_profile_id)
-
-    # Convert from epoch seconds to a datetime object.
-    cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=pytz.utc)
+def get_digest_stream_ids(user_profiles: List[UserProfile],
+                          cutoff_date: datetime.datetime) -> Dict[int, List[int]]:
+    """Returns a dict mapping each user's ID to the IDs of the streams
+    whose traffic their digest covers."""
+    home_view_streams = defaultdict(list)  # type: Dict[int, List[int]]
+    for (user_profile_id, stream_id) in Subscription.objects.filter(
+            user_profile__in=user_profiles,
+            recipient__type=Recipient.STREAM,
+            active=True,
+            is_muted=False).values_list('user_profile_id', 'recipient__type_id'):
+        home_view_streams[user_profile_id].append(stream_id)
+
+    stream_ids = {}  # type: Dict[int, List[int]]
+    for user_profile in user_profiles:
+        if not user_profile.long_term_idle:
+            stream_ids[user_profile.id] = home_view_streams[user_profile.id]
+        else:
+            stream_ids[user_profile.id] = exclude_subscription_modified_streams(
+                user_profile, home_view_streams[user_profile.id], cutoff_date)
+    return stream_ids
+
+HotConversationsCache = Dict[Tuple[int, FrozenSet[int], str], List[Dict[str, Any]]]
+NewStreamsCache = Dict[Tuple[int, bool], Tuple[int, Dict[str, List[str]]]]
+
+def get_digest_messages(stream_ids: Iterable[int],
+                        cutoff_date: datetime.datetime) -> 'QuerySet[Message]':
+    # Fetch list of all messages sent after cutoff_date where the user is subscribed
+    return Message.objects.filter(
+        recipient__type=Recipient.STREAM,
+        recipient__type_id__in=stream_ids,
+        date_sent__gt=cutoff_date).select_related('recipient', 'sender', 'sending_client')
 
+def build_digest_context(user_profile: UserProfile, stream_ids: Iterable[int],
+                         cutoff_date: datetime.datetime,
+                         hot_conversations_cache: Optional[HotConversationsCache]=None,
+                         new_streams_cache: Optional[NewStreamsCache]=None) -> Dict[str, Any]:
+    """The caches let digests for many users share their common
+    pieces: hot conversations only depend on the user's realm,
+    subscribed streams and emojiset, and new streams only on the
+    realm and whether the user can access public streams."""
     context = common_context(user_profile)
 
     # Start building email template data.
@@ -175,6 +207,47 @@ def handle_digest_email(user_profile_id: int, cutoff: float,
         'unsubscribe_link': one_click_unsubscribe_link(user_profile, "digest")
     })
 
+    # Gather hot conversations.
+    if hot_conversations_cache is None:
+        context["hot_conversations"] = gather_hot_conversations(
+            user_profile, get_digest_messages(stream_ids, cutoff_date))
+    else:
+        hot_conversations_key = (user_profile.realm_id, frozenset(stream_ids),
+                                 user_profile.emojiset)
+        if hot_conversations_key not in hot_conversations_cache:
+            hot_conversations_cache[hot_conversations_key] = gather_hot_conversations(
+                user_profile, get_digest_messages(stream_ids, cutoff_date))
+        context["hot_conversations"] = hot_conversations_cache[hot_conversations_key]
+
+    # Gather new streams.
+    if new_streams_cache is None:
+        new_streams_count, new_streams = gather_new_streams(user_profile, cutoff_date)
+    else:
+        new_streams_key = (user_profile.realm_id, user_profile.can_access_public_streams())
+        if new_streams_key not in new_streams_cache:
+            new_streams_cache[new_streams_key] = gather_new_streams(user_profile, cutoff_date)
+        new_streams_count, new_streams = new_streams_cache[new_streams_key]
+    context["new_streams"] = new_streams
+    context["new_streams_count"] = new_streams_count
+
+    # TODO: Set has_preheader if we want to include a preheader.
+    return context
+
+def maybe_send_digest_email(user_profile: UserProfile, context: Dict[str, Any]) -> None:
+    # We don't want to send emails containing almost no information.
+    if enough_traffic(context["hot_conversations"], context["new_streams_count"]):
+        logger.info("Sending digest email for user %s" % (user_profile.id,))
+        # Send now, as a ScheduledEmail
+        send_future_email('zerver/emails/digest', user_profile.realm, to_user_ids=[user_profile.id],
+                          from_name="Zulip Digest", from_address=FromAddress.NOREPLY, context=context)
+
+def handle_digest_email(user_profile_id: int, cutoff: float,
+                        render_to_web: bool = False) -> Union[None, Dict[str, Any]]:
+    user_profile = get_user_profile_by_id(user_profile_id)
+
+    # Convert from epoch seconds to a datetime object.
+    cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=pytz.utc)
+
     home_view_streams = Subscription.objects.filter(
         user_profile=user_profile,
         recipient__type=Recipient.STREAM,
@@ -186,35 +259,28 @@ def handle_digest_email(user_profile_id: int, cutoff: float,
     else:
         stream_ids = exclude_subscription_modified_streams(user_profile, home_view_streams, cutoff_date)
 
-    # Fetch list of all messages sent after cutoff_date where the user is subscribed
-    messages = Message.objects.filter(
-        recipient__type=Recipient.STREAM,
-        recipient__type_id__in=stream_ids,
-        date_sent__gt=cutoff_date).select_related('recipient', 'sender', 'sending_client')
-
-    # Gather hot conversations.
-    context["hot_conversations"] = gather_hot_conversations(
-        user_profile, messages)
-
-    # Gather new streams.
-    new_streams_count, new_streams = gather_new_streams(
-        user_profile, cutoff_date)
-    context["new_streams"] = new_streams
-    context["new_streams_count"] = new_streams_count
-
-    # TODO: Set has_preheader if we want to include a preheader.
+    context = build_digest_context(user_profile, stream_ids, cutoff_date)
 
     if render_to_web:
         return context
 
-    # We don't want to send emails containing almost no information.
-    if enough_traffic(context["hot_conversations"], new_streams_count):
-        logger.info("Sending digest email for user %s" % (user_profile.id,))
-        # Send now, as a ScheduledEmail
-        send_future_email('zerver/emails/digest', user_profile.realm, to_user_ids=[user_profile.id],
-                          from_name="Zulip Digest", from_address=FromAddress.NOREPLY, context=context)
+    maybe_send_digest_email(user_profile, context)
     return None
 
+def bulk_handle_digest_email(user_ids: List[int], cutoff: float) -> None:
+    # Convert from epoch seconds to a datetime object.
+    cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=pytz.utc)
+
+    user_profiles = list(UserProfile.objects.filter(id__in=user_ids).select_related('realm'))
+    stream_ids = get_digest_stream_ids(user_profiles, cutoff_date)
+
+    hot_conversations_cache = {}  # type: HotConversationsCache
+    new_streams_cache = {}  # type: NewStreamsCache
+    for user_profile in user_profiles:
+        context = build_digest_context(user_profile, stream_ids[user_profile.id], cutoff_date,
+                                       hot_conversations_cache, new_streams_cache)
+        maybe_send_digest_email(user_profile, context)
+
 def exclude_subscription_modified_streams(user_profile: UserProfile,
                                           stream_ids: List[int],
                                           cutoff_date: datetime.datetime) -> List[int]:
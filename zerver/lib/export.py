@@ -23,6 +23,7 @@ import tempfile
 import shutil
 from scripts.lib.zulip_tools import overwrite_symlink
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
+from zerver.lib.replicas import get_current_replica
 from analytics.models import RealmCount, UserCount, StreamCount
 from zerver.models import UserProfile, Realm, Client, Huddle, Stream, \
     UserMessage, Subscription, Message, RealmEmoji, RealmFilter, Reaction, \
@@ -32,7 +33,7 @@ from zerver.models import UserProfile, Realm, Client, Huddle, Stream, \
     RealmAuditLog, UserHotspot, MutedTopic, Service, UserGroup, \
     UserGroupMembership, BotStorageData, BotConfigData
 import zerver.lib.upload
-from typing import Any, Callable, Dict, List, Optional, Set, Tuple, \
+from typing import Any, Callable, Dict, IO, List, Optional, Set, Tuple, \
     Union
 
 # Custom mypy types follow:
@@ -61,6 +62,8 @@ PostProcessData = Any  # TODO: make more specific
 MessageOutput = Dict[str, Union[List[Record], List[int], int]]
 
 MESSAGE_BATCH_CHUNK_SIZE = 1000
+# How many model instances export_from_config fetches at a time.
+TABLE_CHUNK_SIZE = 1000
 
 ALL_ZULIP_TABLES = {
     'analytics_fillstate',
@@ -303,8 +306,38 @@ def sanity_check_output(data: TableData) -> None:
             logging.warning('??? NO DATA EXPORTED FOR TABLE %s!!!' % (table,))
 
 def write_data_to_file(output_file: Path, data: Any) -> None:
+    """Writes `data` as a JSON document.  Our exported tables can have
+    millions of rows, so rather than building the whole document as
+    one giant string (doubling our peak memory use), we serialize
+    lists one row at a time."""
     with open(output_file, "w") as f:
-        f.write(ujson.dumps(data, indent=4))
+        if isinstance(data, dict):
+            f.write("{")
+            for i, (key, value) in enumerate(data.items()):
+                f.write(",\n" if i else "\n")
+                f.write("    %s: " % (ujson.dumps(key),))
+                write_json_value(f, value, indent="    ")
+            f.write("\n}")
+        else:
+            write_json_value(f, data, indent="")
+
+def write_data_to_file_atomically(output_file: Path, data: Any) -> None:
+    """Like write_data_to_file, but the file only appears once it's
+    complete, so that an interrupted export never leaves behind a
+    truncated file that a resumed export would take as finished."""
+    temp_file = output_file + '.tmp'
+    write_data_to_file(output_file=temp_file, data=data)
+    os.rename(temp_file, output_file)
+
+def write_json_value(f: IO[str], value: Any, indent: str) -> None:
+    if not isinstance(value, list) or len(value) == 0:
+        f.write(ujson.dumps(value))
+        return
+    f.write("[")
+    for i, row in enumerate(value):
+        f.write(",\n" if i else "\n")
+        f.write(indent + "    " + ujson.dumps(row))
+    f.write("\n" + indent + "]")
 
 def make_raw(query: Any, exclude: Optional[List[Field]]=None) -> List[Record]:
     '''
@@ -328,6 +361,23 @@ def make_raw(query: Any, exclude: Optional[List[Field]]=None) -> List[Record]:
 
     return rows
 
+def make_raw_in_chunks(query: Any, exclude: Optional[List[Field]]=None,
+                       chunk_size: int=TABLE_CHUNK_SIZE) -> List[Record]:
+    '''
+    Like make_raw, but fetches the rows chunk_size at a time, in id
+    order, so that we never hold more than chunk_size model instances
+    (as opposed to the much smaller dictionaries) in memory.
+    '''
+    rows = []  # type: List[Record]
+    min_id = -1
+    while True:
+        chunk = list(query.filter(id__gt=min_id).order_by('id')[0:chunk_size])
+        if len(chunk) == 0:
+            break
+        rows += make_raw(chunk, exclude=exclude)
+        min_id = chunk[-1].id
+    return rows
+
 def floatify_datetime_fields(data: TableData, table: TableName) -> None:
     for item in data[table]:
         for field in DATE_FIELDS[table]:
@@ -452,9 +502,9 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
     for t in exported_tables:
         logging.info('Exporting via export_from_config:  %s' % (t,))
 
-    rows = None
+    rows = None  # type: Optional[List[Record]]
     if config.is_seeded:
-        rows = [seed_object]
+        rows = make_raw([seed_object], exclude=config.exclude)
 
     elif config.custom_fetch:
         config.custom_fetch(
@@ -482,7 +532,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
     elif config.use_all:
         assert model is not None
         query = model.objects.all()
-        rows = list(query)
+        rows = make_raw_in_chunks(query, exclude=config.exclude)
 
     elif config.normal_parent:
         # In this mode, our current model is figuratively Article,
@@ -499,7 +549,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
             filter_parms.update(config.filter_args)
         assert model is not None
         query = model.objects.filter(**filter_parms)
-        rows = list(query)
+        rows = make_raw_in_chunks(query, exclude=config.exclude)
 
     elif config.id_source:
         # In this mode, we are the figurative Blog, and we now
@@ -517,12 +567,12 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
         if config.filter_args:
             filter_parms.update(config.filter_args)
         query = model.objects.filter(**filter_parms)
-        rows = list(query)
+        rows = make_raw_in_chunks(query, exclude=config.exclude)
 
     # Post-process rows (which won't apply to custom fetches/concats)
     if rows is not None:
         assert table is not None  # Hint for mypy
-        response[table] = make_raw(rows, exclude=config.exclude)
+        response[table] = rows
         if table in DATE_FIELDS:
             floatify_datetime_fields(response, table)
 
@@ -937,7 +987,9 @@ def fetch_usermessages(realm: Realm,
         consented_user_ids = get_consented_user_ids(consent_message_id)
         user_profile_ids = user_profile_ids & consented_user_ids
     user_message_chunk = []
-    for user_message in user_message_query:
+    # Use .iterator() to avoid Django caching every model instance for
+    # the duration of the loop.
+    for user_message in user_message_query.iterator():
         if user_message.user_profile_id not in user_profile_ids:
             continue
         user_message_obj = model_to_dict(user_message)
@@ -954,19 +1006,28 @@ def export_usermessages_batch(input_path: Path, output_path: Path,
     objects. (This is called by the export_usermessage_batch
     management command)."""
     with open(input_path, "r") as input_file:
-        output = ujson.loads(input_file.read())
-    message_ids = [item['id'] for item in output['zerver_message']]
-    user_profile_ids = set(output['zerver_userprofile_ids'])
-    del output['zerver_userprofile_ids']
-    realm = Realm.objects.get(id=output['realm_id'])
-    del output['realm_id']
+        partial = ujson.loads(input_file.read())
+    message_ids = partial['zerver_message_ids']
+    user_profile_ids = set(partial['zerver_userprofile_ids'])
+    realm = Realm.objects.get(id=partial['realm_id'])
+
+    output = {}  # type: MessageOutput
+    output['zerver_message'] = fetch_message_data(message_ids)
+    logging.info("Fetched Messages for %s" % (output_path,))
     output['zerver_usermessage'] = fetch_usermessages(realm, set(message_ids), user_profile_ids,
                                                       output_path, consent_message_id)
     write_message_export(output_path, output)
     os.unlink(input_path)
 
+def fetch_message_data(message_ids: List[int]) -> List[Record]:
+    table_data = {}  # type: TableData
+    table_data['zerver_message'] = make_raw(
+        Message.objects.filter(id__in=message_ids).order_by('id').iterator())
+    floatify_datetime_fields(table_data, 'zerver_message')
+    return table_data['zerver_message']
+
 def write_message_export(message_filename: Path, output: MessageOutput) -> None:
-    write_data_to_file(output_file=message_filename, data=output)
+    write_data_to_file_atomically(output_file=message_filename, data=output)
     logging.info("Dumped to %s" % (message_filename,))
 
 def export_partial_message_files(realm: Realm,
@@ -974,7 +1035,8 @@ def export_partial_message_files(realm: Realm,
                                  chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE,
                                  output_dir: Optional[Path]=None,
                                  public_only: bool=False,
-                                 consent_message_id: Optional[int]=None) -> Set[int]:
+                                 consent_message_id: Optional[int]=None,
+                                 resume: bool=False) -> Set[int]:
     if output_dir is None:
         output_dir = tempfile.mkdtemp(prefix="zulip-export")
 
@@ -1071,62 +1133,96 @@ def export_partial_message_files(realm: Realm,
         ]
 
     all_message_ids = set()  # type: Set[int]
-    dump_file_id = 1
-
-    for message_query in message_queries:
-        dump_file_id = write_message_partial_for_query(
+    shards = get_message_shards(message_queries, chunk_size, output_dir, resume=resume)
+    for dump_file_id, (query_index, first_id, last_id) in enumerate(shards, start=1):
+        message_ids = list(message_queries[query_index].filter(
+            id__gte=first_id, id__lte=last_id).values_list('id', flat=True))
+        assert len(all_message_ids.intersection(message_ids)) == 0
+        all_message_ids.update(message_ids)
+        write_message_partial(
             realm=realm,
-            message_query=message_query,
+            message_ids=message_ids,
             dump_file_id=dump_file_id,
-            all_message_ids=all_message_ids,
             output_dir=output_dir,
             user_profile_ids=user_ids_for_us,
-            chunk_size=chunk_size,
+            resume=resume,
         )
 
     return all_message_ids
 
-def write_message_partial_for_query(realm: Realm, message_query: Any, dump_file_id: int,
-                                    all_message_ids: Set[int], output_dir: Path,
-                                    user_profile_ids: Set[int],
-                                    chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE) -> int:
-    min_id = -1
-
-    while True:
-        actual_query = message_query.filter(id__gt=min_id)[0:chunk_size]
-        message_chunk = make_raw(actual_query)
-        message_ids = set(m['id'] for m in message_chunk)
-        assert len(message_ids.intersection(all_message_ids)) == 0
-
-        all_message_ids.update(message_ids)
-
-        if len(message_chunk) == 0:
-            break
+def get_message_shards(message_queries: List[Any], chunk_size: int, output_dir: Path,
+                       resume: bool=False) -> List[Tuple[int, int, int]]:
+    """Splits the messages matching message_queries into shards of
+    chunk_size messages, returning each as a (query_index, first_id,
+    last_id) range; the nth shard is exported to messages-<n>.json.
+
+    We find the ends of each range in the database, rather than by
+    stepping through the id space from the minimum to the maximum ID,
+    since a realm's messages can be spread thinly among those of the
+    other realms on the server; that would give mostly empty shards.
+
+    The shards' ID ranges are recorded in message_shards.json, so that
+    a resumed export recreates the same shards, matching the files
+    that were already written, even if messages have been sent or
+    deleted since.  (Messages sent since aren't exported.)
+    """
+    manifest_filename = os.path.join(output_dir, "message_shards.json")
+    if resume and os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            return [(query_index, first_id, last_id)
+                    for (query_index, first_id, last_id) in ujson.load(f)]
+
+    shards = []  # type: List[Tuple[int, int, int]]
+    for query_index, message_query in enumerate(message_queries):
+        min_id = -1
+        while True:
+            remaining_ids = message_query.filter(id__gt=min_id).values_list('id', flat=True)
+            first_id = remaining_ids.first()
+            if first_id is None:
+                break
+            last_ids = list(remaining_ids[chunk_size - 1:chunk_size])
+            last_id = last_ids[0] if last_ids else remaining_ids.last()
+            shards.append((query_index, first_id, last_id))
+            min_id = last_id
+    write_data_to_file_atomically(output_file=manifest_filename, data=shards)
+    return shards
+
+def write_message_partial(realm: Realm, message_ids: List[int], dump_file_id: int,
+                          output_dir: Path, user_profile_ids: Set[int],
+                          resume: bool=False) -> None:
+    """Writes the .partial file for one shard of messages.
+
+    The .partial files contain just the message IDs; fetching the
+    actual Message rows (which contain all the message content, and
+    are thus by far the largest part of an export) is done along with
+    the UserMessage rows by the parallel export_usermessage_batch
+    processes.
+
+    With resume=True, shards whose final messages-*.json file was
+    already written by a previous, interrupted export are skipped.
+    """
+    # Figure out the name of our shard file.
+    message_filename = os.path.join(output_dir, "messages-%06d.json" % (dump_file_id,))
+    if resume and os.path.exists(message_filename):
+        logging.info("Already exported %s; skipping" % (message_filename,))
+        return
 
-        # Figure out the name of our shard file.
-        message_filename = os.path.join(output_dir, "messages-%06d.json" % (dump_file_id,))
-        message_filename += '.partial'
-        logging.info("Fetched Messages for %s" % (message_filename,))
+    # A .locked file left behind by an interrupted export
+    # will be regenerated from the new .partial file.
+    locked_filename = message_filename + '.locked'
+    if os.path.exists(locked_filename):
+        os.unlink(locked_filename)
 
-        # Clean up our messages.
-        table_data = {}  # type: TableData
-        table_data['zerver_message'] = message_chunk
-        floatify_datetime_fields(table_data, 'zerver_message')
-
-        # Build up our output for the .partial file, which needs
-        # a list of user_profile_ids to search for (as well as
-        # the realm id).
-        output = {}  # type: MessageOutput
-        output['zerver_message'] = table_data['zerver_message']
-        output['zerver_userprofile_ids'] = list(user_profile_ids)
-        output['realm_id'] = realm.id
-
-        # And write the data.
-        write_message_export(message_filename, output)
-        min_id = max(message_ids)
-        dump_file_id += 1
+    # Build up our output for the .partial file, which needs
+    # the message IDs and a list of user_profile_ids to search
+    # for (as well as the realm id).
+    output = {}  # type: MessageOutput
+    output['zerver_message_ids'] = message_ids
+    output['zerver_userprofile_ids'] = list(user_profile_ids)
+    output['realm_id'] = realm.id
 
-    return dump_file_id
+    # And write the data.
+    write_message_export(message_filename + '.partial', output)
 
 def export_uploads_and_avatars(realm: Realm, output_dir: Path) -> None:
     uploads_output_dir = os.path.join(output_dir, 'uploads')
@@ -1449,7 +1545,8 @@ def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
 def do_export_realm(realm: Realm, output_dir: Path, threads: int,
                     exportable_user_ids: Optional[Set[int]]=None,
                     public_only: bool=False,
-                    consent_message_id: Optional[int]=None) -> str:
+                    consent_message_id: Optional[int]=None,
+                    resume: bool=False) -> str:
     response = {}  # type: TableData
 
     # We need at least one thread running to export
@@ -1476,15 +1573,17 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     logging.info("Exporting uploaded files and avatars")
     export_uploads_and_avatars(realm, output_dir)
 
-    # We (sort of) export zerver_message rows here.  We write
-    # them to .partial files that are subsequently fleshed out
-    # by parallel processes to add in zerver_usermessage data.
-    # This is for performance reasons, of course.  Some installations
-    # have millions of messages.
+    # We (sort of) export zerver_message rows here.  We write the
+    # IDs of the messages to export to .partial files that are
+    # subsequently fleshed out by parallel processes to add in the
+    # zerver_message and zerver_usermessage data.  This is for
+    # performance reasons, of course.  Some installations have
+    # millions of messages.
     logging.info("Exporting .partial files messages")
     message_ids = export_partial_message_files(realm, response, output_dir=output_dir,
                                                public_only=public_only,
-                                               consent_message_id=consent_message_id)
+                                               consent_message_id=consent_message_id,
+                                               resume=resume)
     logging.info('%d messages were exported' % (len(message_ids),))
 
     # zerver_reaction
@@ -1555,6 +1654,7 @@ def launch_user_message_subprocesses(threads: int, output_dir: Path,
                                      consent_message_id: Optional[int]=None) -> None:
     logging.info('Launching %d PARALLEL subprocesses to export UserMessage rows' % (threads,))
     pids = {}
+    replica = get_current_replica()
 
     for shard_id in range(threads):
         arguments = [
@@ -1565,6 +1665,9 @@ def launch_user_message_subprocesses(threads: int, output_dir: Path,
         ]
         if consent_message_id is not None:
             arguments.extend(['--consent-message-id', str(consent_message_id)])
+        if replica is not None:
+            # Read from the same replica as the rest of the export.
+            arguments.extend(['--replica', replica])
 
         process = subprocess.Popen(arguments)
         pids[process.pid] = shard_id
@@ -1733,10 +1836,12 @@ def export_realm_wrapper(realm: Realm, output_dir: str,
                          threads: int, upload: bool,
                          public_only: bool,
                          delete_after_upload: bool,
-                         consent_message_id: Optional[int]=None) -> Optional[str]:
+                         consent_message_id: Optional[int]=None,
+                         resume: bool=False) -> Optional[str]:
     tarball_path = do_export_realm(realm=realm, output_dir=output_dir,
                                    threads=threads, public_only=public_only,
-                                   consent_message_id=consent_message_id)
+                                   consent_message_id=consent_message_id,
+                                   resume=resume)
     print("Finished exporting to %s" % (output_dir,))
     print("Tarball written to %s" % (tarball_path,))
 
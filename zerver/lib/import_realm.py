@@ -1,4 +1,7 @@
+from array import array
+from bisect import bisect_left
 import datetime
+import io
 import logging
 import os
 import ujson
@@ -11,12 +14,11 @@ from django.conf import settings
 from django.db import connection
 from django.db.models import Max
 from django.utils.timezone import utc as timezone_utc, now as timezone_now
-from typing import Any, Dict, List, Optional, Set, Tuple, \
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Set, Tuple, \
     Iterable, cast
 
 from analytics.models import RealmCount, StreamCount, UserCount
-from zerver.lib.actions import UserMessageLite, bulk_insert_ums, \
-    do_change_plan_type, do_change_avatar_fields
+from zerver.lib.actions import do_change_plan_type, do_change_avatar_fields
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bulk_create import bulk_create_users, bulk_set_users_or_streams_recipient_fields
 from zerver.lib.timestamp import datetime_to_timestamp
@@ -27,7 +29,7 @@ from zerver.lib.bugdown import version as bugdown_version
 from zerver.lib.actions import render_stream_description
 from zerver.lib.upload import random_name, sanitize_name, \
     guess_type, BadImageError
-from zerver.lib.utils import generate_api_key, process_list_in_batches
+from zerver.lib.utils import generate_api_key
 from zerver.lib.parallel import run_parallel
 from zerver.models import UserProfile, Realm, Client, Huddle, Stream, \
     UserMessage, Subscription, Message, RealmEmoji, \
@@ -96,6 +98,29 @@ path_maps = {
     'attachment_path': {},
 }  # type: Dict[str, Dict[str, str]]
 
+class ArrayIdMap(Mapping[int, int]):
+    """A read-only old id -> new id map, stored as two sorted arrays of
+    64-bit integers rather than a dict.  We use this for the message
+    id map, which can have many millions of entries; a dict uses
+    roughly 10x as much memory for the same data."""
+    def __init__(self, old_ids: List[int], new_ids: List[int]) -> None:
+        assert len(old_ids) == len(new_ids)
+        order = sorted(range(len(old_ids)), key=old_ids.__getitem__)
+        self.old_ids = array('q', (old_ids[i] for i in order))
+        self.new_ids = array('q', (new_ids[i] for i in order))
+
+    def __getitem__(self, old_id: int) -> int:
+        i = bisect_left(self.old_ids, old_id)
+        if i == len(self.old_ids) or self.old_ids[i] != old_id:
+            raise KeyError(old_id)
+        return self.new_ids[i]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.old_ids)
+
+    def __len__(self) -> int:
+        return len(self.old_ids)
+
 def update_id_map(table: TableName, old_id: int, new_id: int) -> None:
     if table not in ID_MAP:
         raise Exception('''
@@ -541,25 +566,19 @@ def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
     # We let the DB itself generate ids.  Note that
     # no tables use user_message.id as a foreign key,
     # so we can safely avoid all re-mapping complexity.
+    #
+    # UserMessage is by far our largest table, so rather than INSERT
+    # statements, we load the rows with COPY, which avoids most of
+    # the per-row parsing and planning overhead in PostgreSQL.
+    buf = io.StringIO()
+    for item in lst:
+        buf.write('%d\t%d\t%d\n' % (item['user_profile_id'], item['message_id'], item['flags']))
+    buf.seek(0)
 
-    def process_batch(items: List[Dict[str, Any]]) -> None:
-        ums = [
-            UserMessageLite(
-                user_profile_id = item['user_profile_id'],
-                message_id = item['message_id'],
-                flags=item['flags'],
-            )
-            for item in items
-        ]
-        bulk_insert_ums(ums)
-
-    chunk_size = 10000
-
-    process_list_in_batches(
-        lst=lst,
-        chunk_size=chunk_size,
-        process_batch=process_batch,
-    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            'COPY zerver_usermessage (user_profile_id, message_id, flags) FROM STDIN',
+            buf)
 
     logging.info("Successfully imported %s from %s[%s]." % (model, table, dump_file_id))
 
@@ -761,11 +780,52 @@ def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_av
 # Because the Python object => JSON conversion process is not fully
 # faithful, we have to use a set of fixers (e.g. on DateTime objects
 # and Foreign Keys) to do the import correctly.
-def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm:
+def get_secondary_indexes(tables: List[str]) -> List[Tuple[str, str]]:
+    """Returns the (name, definition) pairs of the non-unique indexes on
+    the given tables.  Unique indexes (including primary keys) are
+    excluded, since constraints depend on them."""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE schemaname = current_schema()
+            AND tablename = ANY(%s)
+            AND indexdef NOT LIKE 'CREATE UNIQUE INDEX%%'
+        """, [tables])
+        return [(index_name, index_def) for (index_name, index_def) in cursor.fetchall()]
+
+def drop_indexes(indexes: List[Tuple[str, str]]) -> None:
+    with connection.cursor() as cursor:
+        for (index_name, index_def) in indexes:
+            logging.info("Dropping index %s" % (index_name,))
+            cursor.execute('DROP INDEX IF EXISTS "%s"' % (index_name,))
+
+def recreate_indexes(indexes: List[Tuple[str, str]]) -> None:
+    # IF NOT EXISTS makes this safe to run even if we failed partway
+    # through drop_indexes, with some of the indexes still in place.
+    with connection.cursor() as cursor:
+        for (index_name, index_def) in indexes:
+            logging.info("Recreating index: %s" % (index_def,))
+            cursor.execute(index_def.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1))
+
+def other_realms_exist() -> bool:
+    return Realm.objects.exclude(string_id=settings.SYSTEM_BOT_REALM).exists()
+
+# Tables whose secondary indexes we drop during a --defer-indexes
+# import; building an index once at the end is much faster than
+# updating it for every one of millions of inserted rows.
+DEFERRED_INDEX_TABLES = ['zerver_message', 'zerver_usermessage']
+
+def do_import_realm(import_dir: Path, subdomain: str, processes: int=1,
+                    defer_indexes: bool=False) -> Realm:
     logging.info("Importing realm dump %s" % (import_dir,))
     if not os.path.exists(import_dir):
         raise Exception("Missing import directory!")
 
+    # Dropping the message indexes would cripple every other realm on
+    # the server, so only allow it when importing into an empty one.
+    if defer_indexes and other_realms_exist():
+        raise Exception("Deferring indexes is only allowed on a server with no other realms!")
+
     realm_data_filename = os.path.join(import_dir, "realm.json")
     if not os.path.exists(realm_data_filename):
         raise Exception("Missing realm.json file!")
@@ -1009,7 +1069,15 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
     }
 
     # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
+    deferred_indexes = []  # type: List[Tuple[str, str]]
+    if defer_indexes:
+        deferred_indexes = get_secondary_indexes(DEFERRED_INDEX_TABLES)
+    try:
+        drop_indexes(deferred_indexes)
+        import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir,
+                            processes=processes)
+    finally:
+        recreate_indexes(deferred_indexes)
 
     re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
     re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
@@ -1102,12 +1170,7 @@ def update_message_foreign_keys(import_dir: Path,
 
     new_id_list = allocate_ids(model_class=Message, count=count)
 
-    for old_id, new_id in zip(old_id_list, new_id_list):
-        update_id_map(
-            table='message',
-            old_id=old_id,
-            new_id=new_id,
-        )
+    ID_MAP['message'] = ArrayIdMap(old_id_list, new_id_list)  # type: ignore # read-only Mapping
 
     # We don't touch user_message keys here; that happens later when
     # we're actually read the files a second time to get actual data.
@@ -1172,54 +1235,85 @@ def get_incoming_message_ids(import_dir: Path,
 
 def import_message_data(realm: Realm,
                         sender_map: Dict[int, Record],
-                        import_dir: Path) -> None:
+                        import_dir: Path,
+                        processes: int=1) -> None:
+    message_filenames = []
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, "messages-%06d.json" % (dump_file_id,))
         if not os.path.exists(message_filename):
             break
+        message_filenames.append((dump_file_id, message_filename))
+        dump_file_id += 1
 
-        with open(message_filename) as f:
-            data = ujson.load(f)
+    # Each message file contains a disjoint set of messages and their
+    # UserMessage rows, and we've already allocated the new message
+    # ids in update_message_foreign_keys, so the files can be imported
+    # independently of each other.
+    if processes == 1:
+        for (dump_file_id, message_filename) in message_filenames:
+            import_message_file(realm, sender_map, message_filename, dump_file_id)
+        return
 
-        logging.info("Importing message dump %s" % (message_filename,))
-        re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
-        re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
-        re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
-        fix_datetime_fields(data, 'zerver_message')
-        # Parser to update message content with the updated attachment urls
-        fix_upload_links(data, 'zerver_message')
-
-        # We already create mappings for zerver_message ids
-        # in update_message_foreign_keys(), so here we simply
-        # apply them.
-        message_id_map = ID_MAP['message']
-        for row in data['zerver_message']:
-            row['id'] = message_id_map[row['id']]
+    def import_message_file_job(job: Tuple[int, str]) -> int:
+        (dump_file_id, message_filename) = job
+        try:
+            import_message_file(realm, sender_map, message_filename, dump_file_id)
+        except Exception:
+            logging.exception("Error importing message dump %s" % (message_filename,))
+            return 1
+        return 0
 
-        for row in data['zerver_usermessage']:
-            assert(row['message'] in message_id_map)
+    # The forked processes must not share our database connection.
+    connection.close()
+    for (status, job) in run_parallel(import_message_file_job, message_filenames, processes):
+        if status != 0:
+            raise Exception("Failed to import message dump %s" % (job[1],))
 
-        fix_message_rendered_content(
-            realm=realm,
-            sender_map=sender_map,
-            messages=data['zerver_message'],
-        )
-        logging.info("Successfully rendered markdown for message batch")
+def import_message_file(realm: Realm,
+                        sender_map: Dict[int, Record],
+                        message_filename: Path,
+                        dump_file_id: int) -> None:
+    with open(message_filename) as f:
+        data = ujson.load(f)
 
-        # A LOT HAPPENS HERE.
-        # This is where we actually import the message data.
-        bulk_import_model(data, Message)
+    logging.info("Importing message dump %s" % (message_filename,))
+    re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
+    re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
+    re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
+    fix_datetime_fields(data, 'zerver_message')
+    # Parser to update message content with the updated attachment urls
+    fix_upload_links(data, 'zerver_message')
+
+    # We already create mappings for zerver_message ids
+    # in update_message_foreign_keys(), so here we simply
+    # apply them.
+    message_id_map = ID_MAP['message']
+    for row in data['zerver_message']:
+        row['id'] = message_id_map[row['id']]
+
+    for row in data['zerver_usermessage']:
+        assert(row['message'] in message_id_map)
+
+    fix_message_rendered_content(
+        realm=realm,
+        sender_map=sender_map,
+        messages=data['zerver_message'],
+    )
+    logging.info("Successfully rendered markdown for message batch")
 
-        # Due to the structure of these message chunks, we're
-        # guaranteed to have already imported all the Message objects
-        # for this batch of UserMessage objects.
-        re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
-        re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
-        fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
+    # A LOT HAPPENS HERE.
+    # This is where we actually import the message data.
+    bulk_import_model(data, Message)
 
-        bulk_import_user_message_data(data, dump_file_id)
-        dump_file_id += 1
+    # Due to the structure of these message chunks, we're
+    # guaranteed to have already imported all the Message objects
+    # for this batch of UserMessage objects.
+    re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
+    re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
+    fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
+
+    bulk_import_user_message_data(data, dump_file_id)
 
 def import_attachments(data: TableData) -> None:
 
@@ -1272,6 +1366,8 @@ def import_attachments(data: TableData) -> None:
     # Update 'path_id' for the attachments
     for attachment in data[parent_db_table_name]:
         attachment['path_id'] = path_maps['attachment_path'][attachment['path_id']]
+        # Exports don't include thumbnails.
+        attachment['has_thumbnails'] = False
 
     # Next, load the parent rows.
     bulk_import_model(data, parent_model)
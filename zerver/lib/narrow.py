@@ -7,7 +7,7 @@ from zerver.lib.topic import (
 from django.conf import settings
 from django.utils.translation import ugettext as _
 
-from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
 
 stop_words_list = None  # type: Optional[List[str]]
 def read_stop_words() -> List[str]:
@@ -34,30 +34,38 @@ def is_web_public_compatible(narrow: Iterable[Dict[str, str]]) -> bool:
             return False
     return True
 
+# Operators whose operands are compared case-insensitively.
+CASE_INSENSITIVE_OPERATORS = ["stream", "topic", "sender"]
+
+def normalize_narrow(narrow: Iterable[Sequence[str]]) -> List[Tuple[str, str]]:
+    return [(element[0],
+             element[1].lower() if element[0] in CASE_INSENSITIVE_OPERATORS else element[1])
+            for element in narrow]
+
 def build_narrow_filter(narrow: Iterable[Sequence[str]]) -> Callable[[Mapping[str, Any]], bool]:
     """Changes to this function should come with corresponding changes to
-    BuildNarrowFilterTest."""
+    BuildNarrowFilterTest and build_narrow_index_key."""
     check_supported_events_narrow_filter(narrow)
+    # We lowercase the operands once here, rather than for every event.
+    normalized_narrow = normalize_narrow(narrow)
 
     def narrow_filter(event: Mapping[str, Any]) -> bool:
         message = event["message"]
         flags = event["flags"]
-        for element in narrow:
-            operator = element[0]
-            operand = element[1]
+        for (operator, operand) in normalized_narrow:
             if operator == "stream":
                 if message["type"] != "stream":
                     return False
-                if operand.lower() != message["display_recipient"].lower():
+                if operand != message["display_recipient"].lower():
                     return False
             elif operator == "topic":
                 if message["type"] != "stream":
                     return False
                 topic_name = get_topic_from_message_info(message)
-                if operand.lower() != topic_name.lower():
+                if operand != topic_name.lower():
                     return False
             elif operator == "sender":
-                if operand.lower() != message["sender_email"].lower():
+                if operand != message["sender_email"].lower():
                     return False
             elif operator == "is" and operand == "private":
                 if message["type"] != "private":
@@ -74,3 +82,48 @@ def build_narrow_filter(narrow: Iterable[Sequence[str]]) -> Callable[[Mapping[st
 
         return True
     return narrow_filter
+
+def build_narrow_index_key(narrow: Iterable[Sequence[str]]) -> Optional[Tuple[str, ...]]:
+    """Returns the key under which Tornado indexes a client with this
+    narrow for the public stream messages it receives without being a
+    recipient (see get_client_info_for_message_event).  Those events
+    are stream messages without flags, so a narrow that requires a
+    private message or flags like starred can never match one, and we
+    return None.  Otherwise, we return the most selective key that
+    every matching message has among those listed in
+    get_narrow_index_keys_for_message.
+
+    This must stay consistent with build_narrow_filter, which still
+    makes the final decision for every candidate client."""
+    check_supported_events_narrow_filter(narrow)
+    operands = {}  # type: Dict[str, str]
+    for (operator, operand) in normalize_narrow(narrow):
+        if operator == "is":
+            if operand in ["private", "starred", "alerted", "mentioned"]:
+                return None
+            continue
+        operands.setdefault(operator, operand)
+
+    if "stream" in operands and "topic" in operands:
+        return ("stream_topic", operands["stream"], operands["topic"])
+    if "stream" in operands:
+        return ("stream", operands["stream"])
+    if "topic" in operands:
+        return ("topic", operands["topic"])
+    if "sender" in operands:
+        return ("sender", operands["sender"])
+    return ("all",)
+
+def get_narrow_index_keys_for_message(stream_name: str, topic_name: str,
+                                      sender_email: str) -> List[Tuple[str, ...]]:
+    """Returns every key build_narrow_index_key could have returned for a
+    narrow that matches a stream message with these fields."""
+    stream_name = stream_name.lower()
+    topic_name = topic_name.lower()
+    return [
+        ("all",),
+        ("stream", stream_name),
+        ("stream_topic", stream_name, topic_name),
+        ("topic", topic_name),
+        ("sender", sender_email.lower()),
+    ]
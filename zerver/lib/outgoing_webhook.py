@@ -1,10 +1,16 @@
-from typing import Any, AnyStr, Dict, Optional
+from typing import Any, AnyStr, Dict, List, Optional, Tuple
 
 import requests
 import json
 import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from requests import Response
+from requests.adapters import HTTPAdapter
 
+from django.conf import settings
+from django.db import connection
 from django.utils.translation import ugettext as _
 
 from zerver.models import UserProfile, get_user_profile_by_id, get_client, \
@@ -18,6 +24,35 @@ from zerver.decorator import JsonableError
 
 from version import ZULIP_VERSION
 
+# Requests for a batch of outgoing webhook events are made concurrently
+# (see do_rest_calls), with at most MAX_CONCURRENT_REQUESTS in flight,
+# and at most MAX_CONCURRENT_REQUESTS_PER_SERVICE to any one bot server.
+MAX_CONCURRENT_REQUESTS = 10
+MAX_CONCURRENT_REQUESTS_PER_SERVICE = 2
+# OutgoingWebhookWorker defers a server's requests beyond this many to
+# its next batch, so that a slow server can't hold up a batch (and
+# thus every other bot's requests) for long.
+MAX_REQUESTS_PER_SERVICE_PER_BATCH = MAX_CONCURRENT_REQUESTS_PER_SERVICE
+# Failed requests are retried after this delay, doubling each time.
+RETRY_BASE_DELAY_SECONDS = 5
+
+# (base_url, request_data, event, service_handler), as for do_rest_call.
+RestCall = Tuple[str, Any, Dict[str, Any], Any]
+
+session = None  # type: Optional[requests.Session]
+
+def get_outgoing_webhook_session() -> requests.Session:
+    """Returns a session shared by all of this process's outgoing webhook
+    requests, so that repeated requests to a bot server can reuse
+    keep-alive connections to it."""
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=MAX_CONCURRENT_REQUESTS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
 class OutgoingWebhookServiceInterface:
 
     def __init__(self, token: str, user_profile: UserProfile, service_name: str) -> None:
@@ -50,7 +85,9 @@ class GenericOutgoingWebhookService(OutgoingWebhookServiceInterface):
             'content-type': 'application/json',
             'User-Agent': user_agent,
         }
-        response = requests.request('POST', base_url, data=request_data, headers=headers)
+        response = get_outgoing_webhook_session().request(
+            'POST', base_url, data=request_data, headers=headers,
+            timeout=settings.OUTGOING_WEBHOOK_TIMEOUT_SECONDS)
         return response
 
     def process_success(self, response_json: Dict[str, Any],
@@ -99,7 +136,9 @@ class SlackOutgoingWebhookService(OutgoingWebhookServiceInterface):
     def send_data_to_server(self,
                             base_url: str,
                             request_data: Any) -> Response:
-        response = requests.request('POST', base_url, data=request_data)
+        response = get_outgoing_webhook_session().request(
+            'POST', base_url, data=request_data,
+            timeout=settings.OUTGOING_WEBHOOK_TIMEOUT_SECONDS)
         return response
 
     def process_success(self, response_json: Dict[str, Any],
@@ -240,6 +279,9 @@ def request_retry(event: Dict[str, Any],
         logging.warning("Maximum retries exceeded for trigger:%s event:%s" % (
             bot_user.email, event['command']))
 
+    # Rather than retrying immediately, give the bot's server some
+    # time to recover; OutgoingWebhookWorker holds the event until then.
+    event['retry_at'] = time.time() + RETRY_BASE_DELAY_SECONDS * 2 ** event.get('failed_tries', 0)
     retry_event('outgoing_webhooks', event, failure_processor)
 
 def process_success_response(event: Dict[str, Any],
@@ -308,3 +350,39 @@ def do_rest_call(base_url: str,
         logging.exception("Outhook trigger failed:\n %s" % (e,))
         fail_with_message(event, response_message)
         notify_bot_owner(event, request_data, exception=e)
+
+def do_rest_calls(calls: List[RestCall]) -> None:
+    """Makes a batch of outgoing webhook requests concurrently, so that a
+    slow bot server only delays the requests to that server."""
+    if len(calls) <= 1:
+        for call in calls:
+            do_rest_call(*call)
+        return
+
+    # Each server's requests are split into a few lanes, each made one
+    # after another by a single thread; that caps the concurrency per
+    # server without a slow server's requests tying up every thread.
+    calls_by_url = defaultdict(list)  # type: Dict[str, List[RestCall]]
+    for call in calls:
+        calls_by_url[call[0]].append(call)
+    lanes = []  # type: List[List[RestCall]]
+    for url_calls in calls_by_url.values():
+        for i in range(MAX_CONCURRENT_REQUESTS_PER_SERVICE):
+            if url_calls[i::MAX_CONCURRENT_REQUESTS_PER_SERVICE]:
+                lanes.append(url_calls[i::MAX_CONCURRENT_REQUESTS_PER_SERVICE])
+
+    def run_lane(lane: List[RestCall]) -> None:
+        try:
+            for call in lane:
+                try:
+                    do_rest_call(*call)
+                except Exception:
+                    logging.exception("Outgoing webhook request to %s failed" % (call[0],))
+        finally:
+            # Responses are sent using a database connection per thread.
+            connection.close()
+
+    # Create the shared session before the threads race to do so.
+    get_outgoing_webhook_session()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        list(executor.map(run_lane, lanes))
@@ -0,0 +1,93 @@
+# Query budgets catch views that start making more database queries
+# than they used to, which is otherwise only noticed when a test
+# happens to assert on a query count.
+#
+# With QUERY_BUDGET_MODE set, TimeTrackingCursor records a fingerprint
+# (see zerver.lib.request_profile.fingerprint_sql) for each query, and
+# at the end of each request, write_log_line checks them against the
+# view's budget: the total number of queries, and how many times any
+# single query shape may repeat, which is usually an N+1 pattern of
+# fetching related objects one at a time in a loop.
+#
+# Views declare their budget with the @query_budget decorator;
+# everything else gets QUERY_BUDGET_DEFAULT_MAX_QUERIES.  In 'warn'
+# mode, suitable for production, violations are logged; in 'fail'
+# mode, used by `test-backend --query-budget`, they are collected, and
+# ZulipTestCase fails the test that made the request once it's done.
+# (Raising from write_log_line instead would replace the response the
+# test is checking.)
+import logging
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+
+from zerver.lib.types import ViewFuncT
+
+logger = logging.getLogger('zulip.query_budget')
+
+# Violations found in 'fail' mode; see pop_query_budget_violations.
+collected_violations = []  # type: List[str]
+
+class QueryBudget:
+    def __init__(self, max_queries: int, max_repeats: Optional[int]=None) -> None:
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+
+def query_budget(max_queries: int,
+                 max_repeats: Optional[int]=None) -> Callable[[ViewFuncT], ViewFuncT]:
+    """Declares the number of database queries that a view is expected
+    to make, for views that are either much cheaper or much more
+    expensive than the default.  Use it as the outermost decorator."""
+    def decorator(view_func: ViewFuncT) -> ViewFuncT:
+        view_func.query_budget = QueryBudget(max_queries, max_repeats)  # type: ignore # custom attribute
+        return view_func
+    return decorator
+
+def get_view_query_budget(view_func: Callable[..., object]) -> QueryBudget:
+    budget = getattr(view_func, 'query_budget', None)
+    if budget is None:
+        budget = QueryBudget(settings.QUERY_BUDGET_DEFAULT_MAX_QUERIES)
+    return budget
+
+def get_query_budget_violations(queries: List[Dict[str, str]],
+                                budget: QueryBudget) -> List[str]:
+    violations = []
+    if len(queries) > budget.max_queries:
+        violations.append("%d queries, over its budget of %d" % (
+            len(queries), budget.max_queries))
+
+    max_repeats = budget.max_repeats
+    if max_repeats is None:
+        max_repeats = settings.QUERY_BUDGET_MAX_REPEATS
+    counts = {}  # type: Dict[str, int]
+    for query in queries:
+        fingerprint = query.get('fingerprint')
+        if fingerprint is not None:
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+    for fingerprint, count in sorted(counts.items(), key=lambda item: -item[1]):
+        if count > max_repeats:
+            violations.append("%d repeats of %s" % (count, fingerprint))
+    return violations
+
+def check_query_budget(queries: List[Dict[str, str]], budget: Optional[QueryBudget],
+                       method: str, path: str) -> None:
+    if settings.QUERY_BUDGET_MODE is None:
+        return
+    if budget is None:
+        # write_log_line is called for requests that never reached a
+        # view, e.g. because they were rejected by another middleware.
+        budget = QueryBudget(settings.QUERY_BUDGET_DEFAULT_MAX_QUERIES)
+
+    violations = get_query_budget_violations(queries, budget)
+    if not violations:
+        return
+    message = "Query budget exceeded by %s %s: %s" % (method, path, "; ".join(violations))
+    if settings.QUERY_BUDGET_MODE == 'fail':
+        collected_violations.append(message)
+        return
+    logger.warning(message)
+
+def pop_query_budget_violations() -> List[str]:
+    violations = list(collected_violations)
+    del collected_violations[:]
+    return violations
@@ -1,9 +1,13 @@
+from abc import ABC, abstractmethod
 from collections import defaultdict
+from concurrent.futures import Future
 import logging
+import os
 import random
+import sqlite3
 import threading
 import time
-from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Union
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple, Union
 
 from django.conf import settings
 import pika
@@ -18,11 +22,51 @@ from zerver.lib.utils import statsd
 MAX_REQUEST_RETRIES = 3
 Consumer = Callable[[BlockingChannel, Basic.Deliver, pika.BasicProperties, str], None]
 
+class QueueClient(ABC):
+    '''The interface shared by all queue backends.  Code outside this
+    module should only rely on these methods (plus register_consumer
+    for the pika-specific backends), so that a deployment can switch
+    settings.QUEUE_BACKEND without changes elsewhere.'''
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def ready(self) -> bool:
+        pass
+
+    @abstractmethod
+    def publish(self, queue_name: str, body: str) -> None:
+        pass
+
+    @abstractmethod
+    def json_publish(self, queue_name: str, body: Union[Mapping[str, Any], str]) -> None:
+        pass
+
+    @abstractmethod
+    def register_json_consumer(self, queue_name: str,
+                               callback: Callable[[Dict[str, Any]], None]) -> None:
+        pass
+
+    @abstractmethod
+    def drain_queue(self, queue_name: str, json: bool=False,
+                    limit: Optional[int]=None) -> List[Dict[str, Any]]:
+        pass
+
+    @abstractmethod
+    def start_consuming(self) -> None:
+        pass
+
+    @abstractmethod
+    def stop_consuming(self) -> None:
+        pass
+
 # This simple queuing library doesn't expose much of the power of
 # rabbitmq/pika's queuing system; its purpose is to just provide an
 # interface for external files to put things into queues and take them
 # out from bots without having to import pika code all over our codebase.
-class SimpleQueueClient:
+class SimpleQueueClient(QueueClient):
     def __init__(self,
                  # Disable RabbitMQ heartbeats by default because BlockingConnection can't process them
                  rabbitmq_heartbeat: Optional[int] = 0,
@@ -156,12 +200,13 @@ class SimpleQueueClient:
             callback(ujson.loads(body))
         self.register_consumer(queue_name, wrapped_callback)
 
-    def drain_queue(self, queue_name: str, json: bool=False) -> List[Dict[str, Any]]:
-        "Returns all messages in the desired queue"
+    def drain_queue(self, queue_name: str, json: bool=False,
+                    limit: Optional[int]=None) -> List[Dict[str, Any]]:
+        "Returns all messages in the desired queue, or the first `limit` of them"
         messages = []
 
         def opened() -> None:
-            while True:
+            while limit is None or len(messages) < limit:
                 (meta, _, message) = self.channel.basic_get(queue_name)
 
                 if not message:
@@ -305,13 +350,315 @@ class TornadoQueueClient(SimpleQueueClient):
                           lambda: self.channel.basic_consume(queue_name, wrapped_consumer,
                                                              consumer_tag=self._generate_ctag(queue_name)))
 
-queue_client = None  # type: Optional[SimpleQueueClient]
-def get_queue_client() -> SimpleQueueClient:
+# The local backend stores every queue in a single SQLite database in
+# WAL mode, as an append-only log of messages plus one consumer offset
+# per queue.  This avoids running a RabbitMQ server on small
+# single-host installations and makes it possible to benchmark the
+# whole queue pipeline without external services.
+#
+# Durability is handled by SQLite: with journal_mode=WAL and
+# synchronous=NORMAL, commits are appended to the write-ahead log
+# without an fsync, and the log is only fsynced when it is
+# checkpointed, so fsyncs are batched across many publishes.
+#
+# As with RabbitMQ, delivery to consumers registered with
+# register_json_consumer is at-least-once: a consumer claims a batch of
+# messages by advancing the queue's offset past them, and records a
+# claim with a lease, which it deletes once the batch has been
+# processed.  If the consumer raises, the rest of the batch is put back
+# on the queue; if the process dies, the batch is put back once the
+# lease expires.  Like RabbitMQ's, drain_queue acknowledges messages as
+# it returns them.
+class LocalQueueClient(QueueClient):
+    # How many messages a consumer claims from the log at a time.
+    BATCH_SIZE = 100
+    # How long a consumer has to process a batch before it's assumed
+    # to have died, and the batch is delivered again.
+    LEASE_SECS = 10 * 60
+    # How long start_consuming sleeps when every queue is empty.
+    POLL_INTERVAL_SECS = 0.05
+    # Consumed messages are deleted from the log once this many have
+    # accumulated below a queue's offset.
+    TRIM_THRESHOLD = 1000
+
+    def __init__(self, db_path: Optional[str]=None) -> None:
+        self.log = logging.getLogger('zulip.queue')
+        if db_path is None:
+            db_path = settings.LOCAL_QUEUE_DB_PATH
+        self.db_path = db_path
+        self.consumers = defaultdict(list)  # type: Dict[str, List[Callable[[Dict[str, Any]], None]]]
+        self.connection = None  # type: Optional[sqlite3.Connection]
+        self.consuming = False
+        self._connect()
+
+    def _connect(self) -> None:
+        start = time.time()
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # We manage transactions ourselves (isolation_level=None), and
+        # publishes from different threads are serialized by queue_lock.
+        self.connection = sqlite3.connect(self.db_path, timeout=30,
+                                          isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS queue_message (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue_name TEXT NOT NULL,
+                body BLOB NOT NULL
+            )""")
+        self.connection.execute("""
+            CREATE INDEX IF NOT EXISTS queue_message_queue_name_id
+            ON queue_message (queue_name, id)""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS queue_offset (
+                queue_name TEXT PRIMARY KEY,
+                consumed_id INTEGER NOT NULL
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS queue_claim (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue_name TEXT NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+        self.log.info('LocalQueueClient connected (connecting took %.3fs)' % (time.time() - start,))
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def ready(self) -> bool:
+        return self.connection is not None
+
+    def _append(self, queue_name: str, data: bytes) -> None:
+        self.connection.execute("INSERT INTO queue_message (queue_name, body) VALUES (?, ?)",
+                                (queue_name, data))
+
+    def publish(self, queue_name: str, body: str) -> None:
+        self._append(queue_name, body.encode('utf-8'))
+        statsd.incr("local_queue.publish.%s" % (queue_name,))
+
+    def json_publish(self, queue_name: str, body: Union[Mapping[str, Any], str]) -> None:
+        self.publish(queue_name, ujson.dumps(body))
+
+    def _has_pending(self, queue_name: str) -> bool:
+        """Whether there's anything for _claim to do.  This only reads,
+        so idle consumers polling for messages don't compete with
+        publishers for SQLite's write lock."""
+        (pending,) = self.connection.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM queue_message WHERE queue_name = ? AND id > COALESCE(
+                    (SELECT consumed_id FROM queue_offset WHERE queue_name = ?), 0)
+            ) OR EXISTS (
+                SELECT 1 FROM queue_claim WHERE queue_name = ? AND expires_at < ?
+            )""", (queue_name, queue_name, queue_name, time.time())).fetchone()
+        return bool(pending)
+
+    def _claim(self, queue_name: str, limit: Optional[int],
+               lease: bool) -> Tuple[Optional[int], List[bytes]]:
+        """Atomically advances the consumer offset for queue_name past
+        the next `limit` messages (or all of them, if limit is None),
+        and returns their bodies, along with the ID of the claim on
+        them if `lease` is set (see release).  Claiming under BEGIN
+        IMMEDIATE ensures that two processes consuming from the same
+        queue never receive the same message."""
+        if not self._has_pending(queue_name):
+            return (None, [])
+
+        claim_id = None  # type: Optional[int]
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            self._requeue_expired_claims(cursor, queue_name)
+            cursor.execute("SELECT consumed_id FROM queue_offset WHERE queue_name = ?",
+                           (queue_name,))
+            row = cursor.fetchone()
+            consumed_id = row[0] if row is not None else 0
+            query = "SELECT id, body FROM queue_message WHERE queue_name = ? AND id > ? ORDER BY id"
+            params = [queue_name, consumed_id]  # type: List[Any]
+            if limit is not None:
+                query += " LIMIT ?"
+                params.append(limit)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            if rows:
+                new_consumed_id = rows[-1][0]
+                cursor.execute("INSERT OR REPLACE INTO queue_offset (queue_name, consumed_id) "
+                               "VALUES (?, ?)", (queue_name, new_consumed_id))
+                if lease:
+                    cursor.execute("INSERT INTO queue_claim (queue_name, first_id, last_id, expires_at) "
+                                   "VALUES (?, ?, ?, ?)",
+                                   (queue_name, rows[0][0], new_consumed_id,
+                                    time.time() + self.LEASE_SECS))
+                    claim_id = cursor.lastrowid
+                self._maybe_trim(cursor, queue_name, new_consumed_id)
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        return (claim_id, [bytes(body) for (_, body) in rows])
+
+    def _requeue_expired_claims(self, cursor: sqlite3.Cursor, queue_name: str) -> None:
+        cursor.execute("SELECT id, first_id, last_id FROM queue_claim "
+                       "WHERE queue_name = ? AND expires_at < ?", (queue_name, time.time()))
+        for (claim_id, first_id, last_id) in cursor.fetchall():
+            self.log.warning("Requeuing messages %d-%d on %s, whose consumer didn't finish them"
+                             % (first_id, last_id, queue_name))
+            cursor.execute("INSERT INTO queue_message (queue_name, body) "
+                           "SELECT queue_name, body FROM queue_message "
+                           "WHERE queue_name = ? AND id BETWEEN ? AND ? ORDER BY id",
+                           (queue_name, first_id, last_id))
+            cursor.execute("DELETE FROM queue_claim WHERE id = ?", (claim_id,))
+
+    def _release(self, claim_id: int) -> None:
+        self.connection.execute("DELETE FROM queue_claim WHERE id = ?", (claim_id,))
+
+    def _maybe_trim(self, cursor: sqlite3.Cursor, queue_name: str, consumed_id: int) -> None:
+        # Claimed messages are kept until they're released, in case
+        # they need to be put back on the queue.
+        cursor.execute("SELECT MIN(first_id) FROM queue_claim WHERE queue_name = ?", (queue_name,))
+        min_claimed_id = cursor.fetchone()[0]
+        if min_claimed_id is not None:
+            consumed_id = min(consumed_id, min_claimed_id - 1)
+        cursor.execute("SELECT MIN(id) FROM queue_message WHERE queue_name = ?", (queue_name,))
+        min_id = cursor.fetchone()[0]
+        if min_id is not None and consumed_id - min_id >= self.TRIM_THRESHOLD:
+            cursor.execute("DELETE FROM queue_message WHERE queue_name = ? AND id <= ?",
+                           (queue_name, consumed_id))
+
+    def register_json_consumer(self, queue_name: str,
+                               callback: Callable[[Dict[str, Any]], None]) -> None:
+        self.consumers[queue_name].append(callback)
+
+    def drain_queue(self, queue_name: str, json: bool=False,
+                    limit: Optional[int]=None) -> List[Dict[str, Any]]:
+        "Returns all messages in the desired queue, or the first `limit` of them"
+        (_, messages) = self._claim(queue_name, limit, lease=False)
+        if json:
+            return [ujson.loads(message) for message in messages]
+        return messages  # type: ignore # bytes, to match SimpleQueueClient
+
+    def consume_pending(self, queue_name: str) -> int:
+        """Delivers up to BATCH_SIZE pending messages on queue_name to its
+        registered consumers, returning the number delivered."""
+        (claim_id, messages) = self._claim(queue_name, self.BATCH_SIZE, lease=True)
+        if claim_id is None:
+            return 0
+        for i, message in enumerate(messages):
+            event = ujson.loads(message)
+            try:
+                for callback in self.consumers[queue_name]:
+                    callback(event)
+            except Exception:
+                # Like a RabbitMQ nack: put the failed message and the
+                # rest of the claimed batch back on the queue.
+                for unprocessed in messages[i:]:
+                    self._append(queue_name, unprocessed)
+                self._release(claim_id)
+                raise
+        self._release(claim_id)
+        return len(messages)
+
+    def start_consuming(self) -> None:
+        self.consuming = True
+        while self.consuming:
+            delivered = 0
+            for queue_name in list(self.consumers.keys()):
+                delivered += self.consume_pending(queue_name)
+                if not self.consuming:
+                    break
+            if delivered == 0 and self.consuming:
+                time.sleep(self.POLL_INTERVAL_SECS)
+
+    def stop_consuming(self) -> None:
+        self.consuming = False
+
+class TornadoLocalQueueClient(LocalQueueClient):
+    """LocalQueueClient for use inside Tornado, where we can't block
+    in start_consuming.  Instead, a thread with its own SQLite
+    connection polls for and claims messages, and hands each batch to
+    the ioloop to deliver to the consumers, so that the ioloop never
+    waits on SQLite to find out whether there's anything to do."""
+    def __init__(self, db_path: Optional[str]=None) -> None:
+        super().__init__(db_path)
+        self._io_loop = None  # type: Optional[ioloop.IOLoop]
+        self._poller = None  # type: Optional[threading.Thread]
+
+    def _poll(self) -> None:
+        client = LocalQueueClient(self.db_path)
+        try:
+            while self.consuming:
+                delivered = 0
+                for queue_name in list(self.consumers.keys()):
+                    delivered += self._consume_pending_on_ioloop(client, queue_name)
+                if delivered == 0 and self.consuming:
+                    time.sleep(self.POLL_INTERVAL_SECS)
+        finally:
+            client.close()
+
+    def _consume_pending_on_ioloop(self, client: LocalQueueClient, queue_name: str) -> int:
+        """Like consume_pending, but run from the polling thread; returns
+        the number of messages the consumers processed successfully."""
+        (claim_id, messages) = client._claim(queue_name, self.BATCH_SIZE, lease=True)
+        if claim_id is None:
+            return 0
+        processed = Future()  # type: Future
+
+        def deliver() -> None:
+            count = 0
+            try:
+                for message in messages:
+                    event = ujson.loads(message)
+                    for callback in self.consumers[queue_name]:
+                        callback(event)
+                    count += 1
+            except Exception:
+                self.log.exception("TornadoLocalQueueClient consumer for %s failed" % (queue_name,))
+            finally:
+                processed.set_result(count)
+
+        assert self._io_loop is not None
+        self._io_loop.add_callback(deliver)
+        count = processed.result()
+        # As in consume_pending, the failed message and the rest of
+        # the batch go back on the queue.
+        for unprocessed in messages[count:]:
+            client._append(queue_name, unprocessed)
+        client._release(claim_id)
+        return count
+
+    def register_json_consumer(self, queue_name: str,
+                               callback: Callable[[Dict[str, Any]], None]) -> None:
+        super().register_json_consumer(queue_name, callback)
+        if self._poller is None:
+            self._io_loop = ioloop.IOLoop.current()
+            self.consuming = True
+            self._poller = threading.Thread(target=self._poll, name='local-queue-poller',
+                                            daemon=True)
+            self._poller.start()
+
+    def close(self) -> None:
+        self.consuming = False
+        self._poller = None
+        super().close()
+
+queue_client = None  # type: Optional[QueueClient]
+def get_queue_client() -> QueueClient:
     global queue_client
-    if queue_client is None:
-        if settings.RUNNING_INSIDE_TORNADO and settings.USING_RABBITMQ:
+    if queue_client is None and settings.USING_QUEUE_WORKERS:
+        if settings.QUEUE_BACKEND == 'local':
+            if settings.RUNNING_INSIDE_TORNADO:
+                queue_client = TornadoLocalQueueClient()
+            else:
+                queue_client = LocalQueueClient()
+        elif settings.RUNNING_INSIDE_TORNADO:
             queue_client = TornadoQueueClient()
-        elif settings.USING_RABBITMQ:
+        else:
             queue_client = SimpleQueueClient()
 
     return queue_client
@@ -328,7 +675,7 @@ def queue_json_publish(queue_name: str,
                        processor: Callable[[Any], None]=None) -> None:
     # most events are dicts, but zerver.middleware.write_log_line uses a str
     with queue_lock:
-        if settings.USING_RABBITMQ:
+        if settings.USING_QUEUE_WORKERS:
             get_queue_client().json_publish(queue_name, event)
         elif processor:
             processor(event)
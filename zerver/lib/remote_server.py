@@ -11,7 +11,6 @@ from django.utils.translation import ugettext as _
 from analytics.models import InstallationCount, RealmCount
 from version import ZULIP_VERSION
 from zerver.lib.exceptions import JsonableError
-from zerver.lib.export import floatify_datetime_fields
 from zerver.models import RealmAuditLog
 
 class PushNotificationBouncerException(Exception):
@@ -124,6 +123,9 @@ def build_analytics_data(realm_count_query: Any,
         realmauditlog_query.order_by("id")[0:MAX_CLIENT_BATCH_SIZE]
     ]
 
+    # Imported here, to keep zerver.lib.export out of every process
+    # that sends push notifications; see tools/profile-imports.
+    from zerver.lib.export import floatify_datetime_fields
     floatify_datetime_fields(data, 'analytics_realmcount')
     floatify_datetime_fields(data, 'analytics_installationcount')
     floatify_datetime_fields(data, 'zerver_realmauditlog')
@@ -0,0 +1,155 @@
+# Routing of read-only code paths to postgres streaming replicas.
+#
+# Nothing is sent to a replica unless it's inside a `read_replica`
+# block (or a view decorated with `use_read_replica`); those should
+# only contain code that reads from the database, since the reads
+# will not see writes made in the same block.  Writes inside the
+# block still go to the primary.
+#
+# A replica is only used if its replication lag, checked at most
+# every REPLICA_LAG_CHECK_INTERVAL seconds, is under
+# DATABASE_REPLICA_MAX_LAG_SECONDS.  And so that users see their own
+# changes, anything on behalf of a user who has made a write request
+# in the last DATABASE_REPLICA_STICKY_SECONDS reads from the primary.
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.http import HttpRequest, HttpResponse
+
+from zerver.lib.cache import cache_get, cache_set
+from zerver.lib.types import ViewFuncT
+
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+# (time checked, lag in seconds or None if unavailable), by alias.
+replica_lag = {}  # type: Dict[str, Tuple[float, Optional[float]]]
+
+state = threading.local()
+
+def replica_sticky_cache_key(user_profile_id: int) -> str:
+    return "replica_sticky:%d" % (user_profile_id,)
+
+def note_user_write(user_profile_id: int) -> None:
+    if not settings.DATABASE_REPLICAS:
+        return
+    cache_set(replica_sticky_cache_key(user_profile_id), True,
+              timeout=settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+def user_recently_wrote(user_profile_id: int) -> bool:
+    return cache_get(replica_sticky_cache_key(user_profile_id)) is not None
+
+def check_replica_lag(alias: str) -> Optional[float]:
+    try:
+        with connections[alias].cursor() as cursor:
+            # NULL if the server isn't a replica, or hasn't replayed
+            # anything yet.  When the primary is idle, this
+            # overestimates the lag, which only costs us some reads
+            # going to the primary.
+            cursor.execute("SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())")
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        logging.warning("Database replica %s is unavailable" % (alias,), exc_info=True)
+        connections[alias].close()
+        return None
+    if lag is None:
+        return None
+    return float(lag)
+
+def get_replica_lag(alias: str) -> Optional[float]:
+    now = time.time()
+    if alias in replica_lag:
+        checked_at, lag = replica_lag[alias]
+        if now - checked_at < REPLICA_LAG_CHECK_INTERVAL:
+            return lag
+    lag = check_replica_lag(alias)
+    replica_lag[alias] = (now, lag)
+    return lag
+
+def choose_replica(user_profile_id: Optional[int]=None) -> Optional[str]:
+    """Returns the alias of a usable replica, or None if reads should
+    go to the primary."""
+    if not settings.DATABASE_REPLICAS:
+        return None
+    if user_profile_id is not None and user_recently_wrote(user_profile_id):
+        return None
+    usable = []
+    for alias in settings.DATABASE_REPLICAS:
+        lag = get_replica_lag(alias)
+        if lag is not None and lag <= settings.DATABASE_REPLICA_MAX_LAG_SECONDS:
+            usable.append(alias)
+    if not usable:
+        return None
+    return random.choice(usable)
+
+def get_current_replica() -> Optional[str]:
+    return getattr(state, 'replica', None)
+
+@contextmanager
+def read_replica(user_profile_id: Optional[int]=None) -> Iterator[None]:
+    """Sends the database reads in the block to a replica, if there's
+    one that's caught up and the user (if any) on whose behalf we're
+    reading hasn't just written something."""
+    previous = get_current_replica()
+    # Inside a transaction, we may have written something the block
+    # needs to see.
+    if previous is None and not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        state.replica = choose_replica(user_profile_id)
+    try:
+        yield
+    finally:
+        state.replica = previous
+
+@contextmanager
+def use_replica(alias: Optional[str]) -> Iterator[None]:
+    """Sends the database reads in the block to the given replica (or
+    the primary, if None).  This is for subprocesses doing part of the
+    work of a read_replica block, which should read from the replica
+    their parent chose."""
+    previous = get_current_replica()
+    state.replica = alias
+    try:
+        yield
+    finally:
+        state.replica = previous
+
+def use_read_replica(view_func: ViewFuncT) -> ViewFuncT:
+    @wraps(view_func)
+    def _wrapped_view_func(request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+        user_profile_id = None
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            user_profile_id = user.id
+        with read_replica(user_profile_id):
+            return view_func(request, *args, **kwargs)
+    return _wrapped_view_func  # type: ignore # https://github.com/python/mypy/issues/1927
+
+def get_read_connection() -> BaseDatabaseWrapper:
+    """For raw SQL reads, which aren't routed by ReplicaRouter."""
+    return connections[get_current_replica() or DEFAULT_DB_ALIAS]
+
+class ReplicaRouter:
+    """Installed in DATABASE_ROUTERS when replicas are configured."""
+
+    def db_for_read(self, model: Any, **hints: Any) -> str:
+        # Explicitly the primary outside read_replica blocks; otherwise
+        # Django would follow relations of objects loaded from a
+        # replica (including ones stored in the cache) to that replica.
+        return get_current_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model: Any, **hints: Any) -> str:
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1: Any, obj2: Any, **hints: Any) -> bool:
+        # Replicas have the same data as the primary.
+        return True
+
+    def allow_migrate(self, db: str, app_label: str, **hints: Any) -> bool:
+        return db == DEFAULT_DB_ALIAS
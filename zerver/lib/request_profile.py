@@ -0,0 +1,131 @@
+# Sampled per-request profiles, for figuring out *why* a request was
+# slow after the fact.  The aggregate timings in write_log_line tell us
+# that a request spent 800ms in the database; a profile tells us which
+# queries those were.
+#
+# Profiling is done for a random REQUEST_PROFILE_SAMPLE_RATE fraction
+# of requests.  For those, TimeTrackingCursor and the cache_* functions
+# record what they did here, and if the request ends up taking longer
+# than REQUEST_PROFILE_SLOW_THRESHOLD_SECONDS, the profile is written
+# as a line of JSON to REQUEST_PROFILE_LOG_PATH, which logrotate keeps
+# to two files of about 10MB.  See the request_profile_report
+# management command for reading it.
+import logging
+import random
+import re
+import time
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+import ujson
+from django.conf import settings
+
+logger = logging.getLogger('zulip.request_profile')
+
+# Caps on how much we record for a single request, so that a request
+# running thousands of distinct queries doesn't blow up the profile.
+MAX_SQL_FINGERPRINTS = 200
+MAX_CACHE_KEY_FAMILIES = 200
+
+SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+SQL_PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|%s")
+SQL_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+SQL_IN_LIST_RE = re.compile(r"\bIN \((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+SQL_WHITESPACE_RE = re.compile(r"\s+")
+
+CACHE_KEY_HEX_RE = re.compile(r"[0-9a-f]{16,}")
+CACHE_KEY_NUMBER_RE = re.compile(r"\d+")
+
+def fingerprint_sql(sql: Union[str, bytes]) -> str:
+    """Normalizes a query so that queries differing only in their
+    parameters share a fingerprint: literals and placeholders become
+    ?, and IN lists of any length collapse to IN (...)."""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', errors='replace')
+    sql = SQL_STRING_RE.sub('?', sql)
+    sql = SQL_PLACEHOLDER_RE.sub('?', sql)
+    sql = SQL_NUMBER_RE.sub('?', sql)
+    sql = SQL_IN_LIST_RE.sub('IN (...)', sql)
+    return SQL_WHITESPACE_RE.sub(' ', sql).strip()
+
+def cache_key_family(key: str) -> str:
+    """Reduces a cache key like user_profile_by_id:42 to the family
+    user_profile_by_id:*, so that we can count keys by kind without
+    recording user data."""
+    key = CACHE_KEY_HEX_RE.sub('*', key)
+    return CACHE_KEY_NUMBER_RE.sub('*', key)
+
+class RequestProfile:
+    def __init__(self) -> None:
+        self.time_started = time.time()
+        # fingerprint -> [count, total seconds]
+        self.sql = {}  # type: Dict[str, List[float]]
+        # operation -> cache key family -> count
+        self.cache = {}  # type: Dict[str, Dict[str, int]]
+
+    def record_sql(self, sql: Union[str, bytes], duration: float) -> None:
+        fingerprint = fingerprint_sql(sql)
+        if fingerprint not in self.sql:
+            if len(self.sql) >= MAX_SQL_FINGERPRINTS:
+                fingerprint = '(other)'
+            self.sql.setdefault(fingerprint, [0, 0.0])
+        self.sql[fingerprint][0] += 1
+        self.sql[fingerprint][1] += duration
+
+    def record_cache(self, operation: str, keys: Iterable[str]) -> None:
+        families = self.cache.setdefault(operation, {})
+        for key in keys:
+            family = cache_key_family(key)
+            if family not in families and len(families) >= MAX_CACHE_KEY_FAMILIES:
+                family = '(other)'
+            families[family] = families.get(family, 0) + 1
+
+    def to_dict(self, path: str, method: str, status_code: int, time_delta: float,
+                bugdown_time: float, bugdown_count: int) -> Dict[str, Any]:
+        sql = sorted(self.sql.items(), key=lambda item: -item[1][1])
+        return dict(
+            timestamp=int(self.time_started),
+            path=path,
+            method=method,
+            status_code=status_code,
+            time=round(time_delta, 3),
+            sql=[dict(query=fingerprint, count=int(count), time=round(duration, 3))
+                 for fingerprint, (count, duration) in sql],
+            cache=self.cache,
+            markdown=dict(count=bugdown_count, time=round(bugdown_time, 3)),
+        )
+
+# The profile of the request we're currently doing work for, if it
+# was sampled.  The profile itself lives in the request's _log_data;
+# this just points at it so that the database and cache code can find
+# it.  Tornado interleaves requests, so the middleware detaches a
+# request's profile when its handler suspends (e.g. a long-polling
+# get_events request waiting for events) and reattaches it on resume;
+# that way the wait, and the work for other requests done meanwhile,
+# aren't credited to the suspended request.
+active_profile = None  # type: Optional[RequestProfile]
+
+def new_request_profile() -> Optional[RequestProfile]:
+    if random.random() < settings.REQUEST_PROFILE_SAMPLE_RATE:
+        return RequestProfile()
+    return None
+
+def set_active_request_profile(profile: Optional[RequestProfile]) -> None:
+    global active_profile
+    active_profile = profile
+
+def record_sql(sql: Union[str, bytes], duration: float) -> None:
+    if active_profile is not None:
+        active_profile.record_sql(sql, duration)
+
+def record_cache_keys(operation: str, keys: Iterable[str]) -> None:
+    if active_profile is not None:
+        active_profile.record_cache(operation, keys)
+
+def finish_request_profile(profile: Optional[RequestProfile], path: str, method: str,
+                           status_code: int, time_delta: float,
+                           bugdown_time: float, bugdown_count: int) -> None:
+    set_active_request_profile(None)
+    if profile is None or time_delta < settings.REQUEST_PROFILE_SLOW_THRESHOLD_SECONDS:
+        return
+    logger.info(ujson.dumps(profile.to_dict(path, method, status_code, time_delta,
+                                            bugdown_time, bugdown_count)))
@@ -8,6 +8,7 @@ from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from zerver.decorator import authenticated_json_view, authenticated_rest_api_view, \
     process_as_post, authenticated_uploads_api_view, \
     ReturnT
+from zerver.lib.query_budget import get_view_query_budget
 from zerver.lib.response import json_method_not_allowed, json_unauthorized
 from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
 from django.conf import settings
@@ -96,6 +97,9 @@ def rest_dispatch(request: HttpRequest, **kwargs: Any) -> HttpResponse:
         # by some of the later wrappers.
         request._query = target_function.__name__
 
+        if hasattr(request, '_log_data'):
+            request._log_data['query_budget'] = get_view_query_budget(target_function)
+
         # We want to support authentication by both cookies (web client)
         # and API keys (API clients). In the former case, we want to
         # do a check to ensure that CSRF etc is honored, but in the latter
@@ -1,4 +1,5 @@
 from datetime import timedelta
+import time
 
 from django.conf import settings
 from django.db import connection, transaction
@@ -6,12 +7,13 @@ from django.db.models import Model
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.logging_util import log_to_file
+from zerver.lib.parallel import run_parallel
 from zerver.models import (Message, UserMessage, ArchivedUserMessage, Realm,
                            Attachment, ArchivedAttachment, Reaction, ArchivedReaction,
                            SubMessage, ArchivedSubMessage, Recipient, Stream, ArchiveTransaction,
                            get_user_including_cross_realm)
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import logging
 
@@ -19,6 +21,10 @@ logger = logging.getLogger('zulip.retention')
 log_to_file(logger, settings.RETENTION_LOG_PATH)
 
 MESSAGE_BATCH_SIZE = 1000
+# Bounds for the chunk size when RETENTION_TARGET_CHUNK_SECONDS is set.
+MIN_MESSAGE_BATCH_SIZE = 100
+MAX_MESSAGE_BATCH_SIZE = 10000
+REPLICATION_LAG_POLL_SECONDS = 5
 
 models_with_message_key = [
     {
@@ -75,6 +81,63 @@ def ids_list_to_sql_query_format(ids: List[int]) -> str:
 
     return ids_string
 
+def get_next_chunk_size(chunk_size: int, elapsed: float) -> int:
+    # Large transactions hold locks and generate WAL in big bursts,
+    # while small ones spend most of their time on overhead, so we
+    # aim for chunks that take RETENTION_TARGET_CHUNK_SECONDS.
+    target = settings.RETENTION_TARGET_CHUNK_SECONDS
+    if target is None or elapsed <= 0:
+        return chunk_size
+    # Change the size by at most a factor of 2 at a time, so that one
+    # unusually slow or fast chunk doesn't throw us off.
+    scale = min(2.0, max(0.5, target / elapsed))
+    return min(MAX_MESSAGE_BATCH_SIZE, max(MIN_MESSAGE_BATCH_SIZE, int(chunk_size * scale)))
+
+class ReplicationLagUnavailableError(Exception):
+    pass
+
+def get_replication_lag() -> Optional[float]:
+    """Returns the largest replay lag among the replicas streaming from
+    this database server, in seconds, or None if it's unknown because
+    a replica is behind but postgres hasn't measured its lag recently.
+
+    Only superusers and members of the pg_read_all_stats role can see
+    the replication status in pg_stat_replication; for everyone else,
+    it's NULL, and we raise ReplicationLagUnavailableError rather than
+    silently not throttling."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT state, EXTRACT(EPOCH FROM replay_lag), "
+                       "replay_lsn = pg_current_wal_lsn() "
+                       "FROM pg_stat_replication")
+        rows = cursor.fetchall()
+    max_lag = 0.0
+    for (state, lag, caught_up) in rows:
+        if state is None:
+            raise ReplicationLagUnavailableError(
+                "The database role can't see replication lag; it needs to be "
+                "granted pg_read_all_stats to use RETENTION_MAX_REPLICATION_LAG_SECONDS")
+        if lag is None:
+            # The lag is also NULL once an idle replica has caught up.
+            if caught_up:
+                continue
+            return None
+        max_lag = max(max_lag, float(lag))
+    return max_lag
+
+def wait_for_replication_lag() -> None:
+    max_lag = settings.RETENTION_MAX_REPLICATION_LAG_SECONDS
+    if max_lag is None:
+        return
+    while True:
+        lag = get_replication_lag()
+        if lag is None:
+            logger.warning("Replication lag is unknown; waiting before continuing.")
+        elif lag <= max_lag:
+            return
+        else:
+            logger.info("Replication lag is {:.1f}s; waiting before continuing.".format(lag))
+        time.sleep(REPLICATION_LAG_POLL_SECONDS)
+
 def run_archiving_in_chunks(query: str, type: int, realm: Optional[Realm]=None,
                             chunk_size: int=MESSAGE_BATCH_SIZE, **kwargs: Any) -> int:
     # This function is carefully designed to achieve our
@@ -87,6 +150,8 @@ def run_archiving_in_chunks(query: str, type: int, realm: Optional[Realm]=None,
 
     message_count = 0
     while True:
+        wait_for_replication_lag()
+        start = time.time()
         with transaction.atomic():
             archive_transaction = ArchiveTransaction.objects.create(type=type, realm=realm)
             logger.info("Archiving in {}".format(archive_transaction))
@@ -108,6 +173,7 @@ def run_archiving_in_chunks(query: str, type: int, realm: Optional[Realm]=None,
         # which means we are done:
         if len(new_chunk) < chunk_size:
             break
+        chunk_size = get_next_chunk_size(chunk_size, time.time() - start)
 
     return message_count
 
@@ -271,8 +337,7 @@ def archive_personal_and_huddle_messages(realm: Realm, chunk_size: int=MESSAGE_B
     message_count = move_expired_personal_and_huddle_messages_to_archive(realm, chunk_size)
     logger.info("Done. Archived {} messages".format(message_count))
 
-def archive_stream_messages(realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE) -> None:
-    logger.info("Archiving stream messages for realm " + realm.string_id)
+def get_stream_retention_policies(realm: Realm) -> List[Tuple[Recipient, int]]:
     # We don't archive, if the stream has message_retention_days set to -1,
     # or if neither the stream nor the realm have a retention policy.
     streams = Stream.objects.select_related("recipient").filter(
@@ -289,28 +354,90 @@ def archive_stream_messages(realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE) ->
             assert realm.message_retention_days is not None
             retention_policy_dict[stream.id] = realm.message_retention_days
 
-    recipients = [stream.recipient for stream in streams]
+    return [(stream.recipient, retention_policy_dict[stream.id]) for stream in streams]
+
+def archive_stream_messages(realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE) -> None:
+    logger.info("Archiving stream messages for realm " + realm.string_id)
     message_count = 0
-    for recipient in recipients:
+    for (recipient, message_retention_days) in get_stream_retention_policies(realm):
         message_count += archive_messages_by_recipient(
-            recipient, retention_policy_dict[recipient.type_id], realm, chunk_size
+            recipient, message_retention_days, realm, chunk_size
         )
 
     logger.info("Done. Archived {} messages.".format(message_count))
 
-def archive_messages(chunk_size: int=MESSAGE_BATCH_SIZE) -> None:
+# An archiving partition is a realm together with either one of its
+# streams' recipients and that stream's retention period, or None for
+# the realm's personal and huddle messages.  Partitions never share
+# messages, so they can be archived in parallel.
+ArchivingPartition = Tuple[Realm, Optional[Recipient], Optional[int]]
+
+def get_archiving_partitions(realms: List[Realm]) -> List[ArchivingPartition]:
+    partitions = []  # type: List[ArchivingPartition]
+    for realm in realms:
+        for (recipient, message_retention_days) in get_stream_retention_policies(realm):
+            partitions.append((realm, recipient, message_retention_days))
+        if realm.message_retention_days:
+            partitions.append((realm, None, None))
+    return partitions
+
+def archive_partition(partition: ArchivingPartition, chunk_size: int) -> None:
+    (realm, recipient, message_retention_days) = partition
+    if recipient is None:
+        archive_personal_and_huddle_messages(realm, chunk_size)
+    else:
+        assert message_retention_days is not None
+        message_count = archive_messages_by_recipient(recipient, message_retention_days,
+                                                      realm, chunk_size)
+        logger.info("Archived {} messages from recipient {} in realm {}".format(
+            message_count, recipient.id, realm.string_id))
+
+def archive_messages(chunk_size: int=MESSAGE_BATCH_SIZE, processes: int=1) -> None:
     logger.info("Starting the archiving process with chunk_size {}".format(chunk_size))
 
     # We exclude SYSTEM_BOT_REALM here because the logic for archiving
     # private messages and huddles isn't designed to correctly handle
     # that realm.  In practice, excluding it has no effect, because
     # that realm is expected to always have message_retention_days=None.
-    for realm in Realm.objects.exclude(string_id=settings.SYSTEM_BOT_REALM):
-        archive_stream_messages(realm, chunk_size)
-        if realm.message_retention_days:
-            archive_personal_and_huddle_messages(realm, chunk_size)
-
-        # Messages have been archived for the realm, now we can clean up attachments:
+    realms = list(Realm.objects.exclude(string_id=settings.SYSTEM_BOT_REALM))
+
+    if processes == 1:
+        for realm in realms:
+            archive_stream_messages(realm, chunk_size)
+            if realm.message_retention_days:
+                archive_personal_and_huddle_messages(realm, chunk_size)
+
+            # Messages have been archived for the realm, now we can clean up attachments:
+            delete_expired_attachments(realm)
+        return
+
+    partitions = get_archiving_partitions(realms)
+    logger.info("Archiving {} partitions with {} processes".format(len(partitions), processes))
+
+    def archive_partition_job(partition: ArchivingPartition) -> int:
+        try:
+            archive_partition(partition, chunk_size)
+        except Exception:
+            logger.exception("Error archiving partition {}".format(partition))
+            return 1
+        return 0
+
+    # Every chunk is committed as its own ArchiveTransaction, and the
+    # archiving queries only select messages that haven't been
+    # archived yet, so if we're interrupted, the next run picks up
+    # where each partition left off.
+    #
+    # The forked processes must not share our database connection.
+    connection.close()
+    finished = 0
+    for (status, partition) in run_parallel(archive_partition_job, partitions, processes):
+        if status != 0:
+            raise Exception("Failed to archive partition {}".format(partition))
+        finished += 1
+        logger.info("Finished archiving partition {} of {}".format(finished, len(partitions)))
+
+    # Messages have been archived for every realm, now we can clean up attachments:
+    for realm in realms:
         delete_expired_attachments(realm)
 
 def move_messages_to_archive(message_ids: List[int], chunk_size: int=MESSAGE_BATCH_SIZE) -> None:
@@ -415,6 +542,7 @@ def restore_data_from_archive_by_transactions(archive_transactions: List[Archive
     # transactions:
     message_count = 0
     for archive_transaction in archive_transactions:
+        wait_for_replication_lag()
         message_count += restore_data_from_archive(archive_transaction)
 
     return message_count
@@ -427,9 +555,31 @@ def restore_data_from_archive_by_realm(realm: Realm) -> None:
 
     logger.info("Finished. Restored {} messages from realm {}".format(message_count, realm.string_id))
 
-def restore_all_data_from_archive(restore_manual_transactions: bool=True) -> None:
-    for realm in Realm.objects.all():
-        restore_data_from_archive_by_realm(realm)
+def restore_all_data_from_archive(restore_manual_transactions: bool=True,
+                                  processes: int=1) -> None:
+    realms = list(Realm.objects.all())
+    if processes == 1:
+        for realm in realms:
+            restore_data_from_archive_by_realm(realm)
+    else:
+        # Different realms' retention-based transactions never share
+        # messages, so we can restore them in parallel.
+        def restore_realm_job(realm: Realm) -> int:
+            try:
+                restore_data_from_archive_by_realm(realm)
+            except Exception:
+                logger.exception("Error restoring realm {}".format(realm.string_id))
+                return 1
+            return 0
+
+        # The forked processes must not share our database connection.
+        connection.close()
+        finished = 0
+        for (status, realm) in run_parallel(restore_realm_job, realms, processes):
+            if status != 0:
+                raise Exception("Failed to restore realm {}".format(realm.string_id))
+            finished += 1
+            logger.info("Finished restoring realm {} of {}".format(finished, len(realms)))
 
     if restore_manual_transactions:
         restore_data_from_archive_by_transactions(
@@ -3,18 +3,21 @@
 from zerver.lib.logging_util import log_to_file
 from collections import defaultdict
 import logging
-from django.db import transaction
-from django.db.models import Max
+from django.db import connection, transaction
+from django.db.models import Max, OuterRef, Subquery
 from django.conf import settings
 from django.utils.timezone import now as timezone_now
 from typing import DefaultDict, Dict, List, Optional, Union, Any
 
+from zerver.lib.cache import delete_user_profile_caches
+from zerver.lib.parallel import run_parallel
 from zerver.models import UserProfile, UserMessage, RealmAuditLog, \
     Subscription, Message, Recipient, UserActivity, Realm
 
 logger = logging.getLogger("zulip.soft_deactivation")
 log_to_file(logger, settings.SOFT_DEACTIVATION_LOG_PATH)
 BULK_CREATE_BATCH_SIZE = 10000
+CATCH_UP_BATCH_SIZE = 100
 
 def filter_by_subscription_history(user_profile: UserProfile,
                                    all_stream_messages: DefaultDict[int, List[Message]],
@@ -220,26 +223,50 @@ def do_soft_deactivate_users(users: List[UserProfile]) -> List[UserProfile]:
         if len(user_batch) == 0:
             break
         with transaction.atomic():
+            # Fetch the last message each user in the batch received
+            # in a single query; the subquery is answered from the
+            # (user_profile_id, message_id) index, so this is as cheap
+            # as doing it one user at a time.
+            last_message_ids = dict(UserProfile.objects.filter(
+                id__in=[user.id for user in user_batch]).annotate(
+                    last_message_id=Subquery(UserMessage.objects.filter(
+                        user_profile_id=OuterRef('id')).order_by(
+                            '-message_id').values('message_id')[:1])).values_list(
+                                'id', 'last_message_id'))
+
             realm_logs = []
+            event_time = timezone_now()
             for user in user_batch:
-                do_soft_deactivate_user(user)
-                event_time = timezone_now()
-                log = RealmAuditLog(
+                last_message_id = last_message_ids.get(user.id)
+                if last_message_id is None:  # nocoverage
+                    # In the unlikely event that a user somehow has never
+                    # received a message, we just use the overall max message ID.
+                    last_message_id = Message.objects.aggregate(Max('id'))['id__max']
+                user.last_active_message_id = last_message_id
+                user.long_term_idle = True
+                realm_logs.append(RealmAuditLog(
                     realm=user.realm,
                     modified_user=user,
                     event_type=RealmAuditLog.USER_SOFT_DEACTIVATED,
                     event_time=event_time
-                )
-                realm_logs.append(log)
+                ))
                 users_soft_deactivated.append(user)
+            UserProfile.objects.bulk_update(user_batch, ['long_term_idle',
+                                                         'last_active_message_id'])
+            # bulk_update doesn't send post_save, so we flush the
+            # cached UserProfile objects ourselves.
+            delete_user_profile_caches(user_batch)
             RealmAuditLog.objects.bulk_create(realm_logs)
 
+        for user in user_batch:
+            logger.info('Soft Deactivated user %s' % (user.id,))
         logging.info("Soft-deactivated batch of %s users; %s remain to process" %
                      (len(user_batch), len(users)))
 
     return users_soft_deactivated
 
-def do_auto_soft_deactivate_users(inactive_for_days: int, realm: Optional[Realm]) -> List[UserProfile]:
+def do_auto_soft_deactivate_users(inactive_for_days: int, realm: Optional[Realm],
+                                  processes: int=1) -> List[UserProfile]:
     filter_kwargs = {}  # type: Dict[str, Realm]
     if realm is not None:
         filter_kwargs = dict(user_profile__realm=realm)
@@ -253,7 +280,7 @@ def do_auto_soft_deactivate_users(inactive_for_days: int, realm: Optional[Realm]
     if realm is not None:
         filter_kwargs = dict(realm=realm)
     users_to_catch_up = get_soft_deactivated_users_for_catch_up(filter_kwargs)
-    do_catch_up_soft_deactivated_users(users_to_catch_up)
+    do_catch_up_soft_deactivated_users(users_to_catch_up, processes=processes)
     return users_deactivated
 
 def reactivate_user_if_soft_deactivated(user_profile: UserProfile) -> Union[UserProfile, None]:
@@ -295,15 +322,140 @@ def do_soft_activate_users(users: List[UserProfile]) -> List[UserProfile]:
             users_soft_activated.append(user_activated)
     return users_soft_activated
 
-def do_catch_up_soft_deactivated_users(users: List[UserProfile]) -> List[UserProfile]:
-    users_caught_up = []
-    for user_profile in users:
-        if user_profile.long_term_idle:
-            add_missing_messages(user_profile)
-            users_caught_up.append(user_profile)
+def do_catch_up_soft_deactivated_users(users: List[UserProfile],
+                                       processes: int=1) -> List[UserProfile]:
+    """Catches up the long_term_idle users among `users`, using the
+    set-based bulk_add_missing_messages in batches of
+    CATCH_UP_BATCH_SIZE users.  With processes > 1, the batches are
+    processed in parallel by forked worker processes."""
+    users_caught_up = [user_profile for user_profile in users
+                       if user_profile.long_term_idle]
+    user_ids = [user_profile.id for user_profile in users_caught_up]
+    batches = [user_ids[i:i + CATCH_UP_BATCH_SIZE]
+               for i in range(0, len(user_ids), CATCH_UP_BATCH_SIZE)]
+
+    if processes == 1:
+        for batch in batches:
+            catch_up_batch(batch)
+    else:
+        def catch_up_batch_job(batch: List[int]) -> int:
+            try:
+                catch_up_batch(batch)
+            except Exception:
+                logger.exception("Error catching up users %s" % (batch,))
+                return 1
+            return 0
+
+        # The forked processes must not share our database connection.
+        connection.close()
+        for (status, batch) in run_parallel(catch_up_batch_job, batches, processes):
+            if status != 0:
+                raise Exception("Failed to catch up users %s" % (batch,))
+
     logger.info("Caught up %d soft-deactivated users" % (len(users_caught_up),))
     return users_caught_up
 
+def catch_up_batch(user_ids: List[int]) -> None:
+    with transaction.atomic():
+        count = bulk_add_missing_messages(user_ids)
+    logger.info("Added %d missing UserMessage rows for %d soft-deactivated users" % (
+        count, len(user_ids)))
+
+def bulk_add_missing_messages(user_ids: List[int]) -> int:
+    """A set-based equivalent of calling add_missing_messages on each
+    of the given soft-deactivated users, which does all of the work in
+    a single SQL statement and returns the number of UserMessage rows
+    created.
+
+    The subscription_interval CTE turns each user's RealmAuditLog
+    subscription history for a stream into the intervals of message
+    IDs (start_id, end_id] during which they were subscribed: each
+    subscribe event opens an interval, which is closed by the next
+    event if that is an unsubscribe.  As in add_missing_messages, we
+    order by event_last_message_id and tiebreak by the RealmAuditLog
+    ID, and only consider streams the user has a Subscription row for.
+
+    We then insert a UserMessage row for every message sent to those
+    streams inside one of the intervals and after the user's
+    last_active_message_id, which doesn't already have one, and
+    advance last_active_message_id for each user to the last
+    message we added for them.
+    """
+    if not user_ids:
+        return 0
+
+    query = """
+    WITH subscription_log AS (
+        SELECT
+            modified_user_id AS user_profile_id,
+            modified_stream_id AS stream_id,
+            event_type,
+            event_last_message_id,
+            lead(event_type) OVER w AS next_event_type,
+            lead(event_last_message_id) OVER w AS next_event_last_message_id
+        FROM zerver_realmauditlog
+        WHERE modified_user_id = ANY(%(user_ids)s)
+            AND modified_stream_id IS NOT NULL
+            AND event_type IN (%(created)s, %(activated)s, %(deactivated)s)
+        WINDOW w AS (PARTITION BY modified_user_id, modified_stream_id
+                     ORDER BY event_last_message_id, id)
+    ), subscription_interval AS (
+        SELECT
+            user_profile_id,
+            stream_id,
+            event_last_message_id AS start_id,
+            next_event_last_message_id AS end_id
+        FROM subscription_log
+        WHERE event_type IN (%(created)s, %(activated)s)
+            AND (next_event_type IS NULL OR next_event_type = %(deactivated)s)
+    ), inserted AS (
+        INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+        SELECT DISTINCT sub_interval.user_profile_id, message.id, 0
+        FROM subscription_interval sub_interval
+        JOIN zerver_userprofile user_profile
+            ON user_profile.id = sub_interval.user_profile_id
+        JOIN zerver_recipient recipient
+            ON recipient.type = %(stream_type)s AND recipient.type_id = sub_interval.stream_id
+        JOIN zerver_subscription subscription
+            ON subscription.user_profile_id = sub_interval.user_profile_id
+            AND subscription.recipient_id = recipient.id
+        JOIN zerver_message message
+            ON message.recipient_id = recipient.id
+            AND message.id > user_profile.last_active_message_id
+            AND message.id > sub_interval.start_id
+            AND (sub_interval.end_id IS NULL OR message.id <= sub_interval.end_id)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM zerver_usermessage usermessage
+            WHERE usermessage.user_profile_id = sub_interval.user_profile_id
+                AND usermessage.message_id = message.id
+        )
+        RETURNING user_profile_id, message_id
+    ), updated AS (
+        UPDATE zerver_userprofile
+        SET last_active_message_id = last_inserted.message_id
+        FROM (
+            SELECT user_profile_id, max(message_id) AS message_id
+            FROM inserted
+            GROUP BY user_profile_id
+        ) last_inserted
+        WHERE zerver_userprofile.id = last_inserted.user_profile_id
+    )
+    SELECT count(*) FROM inserted
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, dict(
+            user_ids=list(user_ids),
+            created=RealmAuditLog.SUBSCRIPTION_CREATED,
+            activated=RealmAuditLog.SUBSCRIPTION_ACTIVATED,
+            deactivated=RealmAuditLog.SUBSCRIPTION_DEACTIVATED,
+            stream_type=Recipient.STREAM,
+        ))
+        count = cursor.fetchone()[0]
+    # The UPDATE of last_active_message_id bypasses the ORM.
+    delete_user_profile_caches(
+        UserProfile.objects.filter(id__in=user_ids).select_related('realm'))
+    return count
+
 def get_soft_deactivated_users_for_catch_up(filter_kwargs: Any) -> List[UserProfile]:
     users_to_catch_up = UserProfile.objects.select_related().filter(
         long_term_idle=True,
@@ -1,7 +1,8 @@
-from typing import Optional, Any
+from typing import Any, Dict
 
-from django.db import connection
+from django.db import connections
 from zerver.lib.db import TimeTrackingConnection
+from zerver.lib.replicas import get_read_connection
 
 import sqlalchemy
 
@@ -23,17 +24,20 @@ class NonClosingPool(sqlalchemy.pool.NullPool):
                               logging_name=self._orig_logging_name,
                               _dispatch=self.dispatch)
 
-sqlalchemy_engine = None  # type: Optional[Any]
+# By Django database alias; in read_replica blocks, we use the
+# replica's connection.
+sqlalchemy_engines = {}  # type: Dict[str, Any]
 def get_sqlalchemy_connection() -> sqlalchemy.engine.base.Connection:
-    global sqlalchemy_engine
-    if sqlalchemy_engine is None:
+    alias = get_read_connection().alias
+    if alias not in sqlalchemy_engines:
         def get_dj_conn() -> TimeTrackingConnection:
+            connection = connections[alias]
             connection.ensure_connection()
             return connection.connection
-        sqlalchemy_engine = sqlalchemy.create_engine('postgresql://',
-                                                     creator=get_dj_conn,
-                                                     poolclass=NonClosingPool,
-                                                     pool_reset_on_return=False)
-    sa_connection = sqlalchemy_engine.connect()
+        sqlalchemy_engines[alias] = sqlalchemy.create_engine('postgresql://',
+                                                             creator=get_dj_conn,
+                                                             poolclass=NonClosingPool,
+                                                             pool_reset_on_return=False)
+    sa_connection = sqlalchemy_engines[alias].connect()
     sa_connection.execution_options(autocommit=False)
     return sa_connection
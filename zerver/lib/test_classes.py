@@ -22,6 +22,7 @@ from django.utils import translation
 
 from two_factor.models import PhoneDevice
 from zerver.lib.initial_password import initial_password
+from zerver.lib.query_budget import pop_query_budget_violations
 from zerver.lib.utils import is_remote_server
 from zerver.lib.users import get_api_key
 from zerver.lib.sessions import get_session_dict_user
@@ -98,6 +99,8 @@ class ZulipTestCase(TestCase):
     def setUp(self) -> None:
         super().setUp()
         self.API_KEYS = {}  # type: Dict[str, str]
+        # Don't blame this test for requests made outside a ZulipTestCase.
+        pop_query_budget_violations()
 
     def tearDown(self) -> None:
         super().tearDown()
@@ -113,6 +116,11 @@ class ZulipTestCase(TestCase):
                 self.mock_ldap.reset()
             self.mock_initialize.stop()
 
+        # See `test-backend --query-budget`.
+        violations = pop_query_budget_violations()
+        if violations:
+            self.fail("\n".join(violations))
+
     '''
     WRAPPER_COMMENT:
 
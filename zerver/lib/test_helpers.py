@@ -292,13 +292,20 @@ class MockPythonResponse:
         if headers is None:
             headers = {'content-type': 'text/html'}
         self.headers = headers
+        self.encoding = 'utf-8'
+        self.closed = False
 
     @property
     def ok(self) -> bool:
         return self.status_code == 200
 
-    def iter_content(self, n: int) -> Generator[str, Any, None]:
-        yield self.text[:n]
+    def iter_content(self, n: int) -> Generator[bytes, Any, None]:
+        content = self.text.encode(self.encoding)
+        for i in range(0, len(content), n):
+            yield content[i:i + n]
+
+    def close(self) -> None:
+        self.closed = True
 
 
 INSTRUMENTING = os.environ.get('TEST_INSTRUMENT_URL_COVERAGE', '') == 'TRUE'
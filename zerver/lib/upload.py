@@ -1,4 +1,4 @@
-from typing import Optional, Tuple, Any
+from typing import Any, Iterable, Optional, Tuple
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
@@ -9,6 +9,7 @@ import unicodedata
 
 from zerver.lib.avatar_hash import user_avatar_path
 from zerver.lib.exceptions import JsonableError, ErrorCode
+from zerver.lib.queue import queue_json_publish
 
 from boto.s3.bucket import Bucket
 from boto.s3.key import Key
@@ -29,6 +30,7 @@ from PIL import Image, ImageOps, ExifTags
 from PIL.Image import DecompressionBombError
 from PIL.GifImagePlugin import GifImageFile
 import io
+import itertools
 import random
 import logging
 import shutil
@@ -44,6 +46,26 @@ DEFAULT_EMOJI_SIZE = 64
 MAX_EMOJI_GIF_SIZE = 128
 MAX_EMOJI_GIF_FILE_SIZE_BYTES = 128 * 1024 * 1024  # 128 kb
 
+# Files larger than this are uploaded to S3 in parts of this size,
+# which bounds the memory used for each upload.  S3 requires all
+# parts but the last to be at least 5MiB.
+S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+# With PREGENERATE_THUMBNAILS, uploaded images of these types get
+# thumbnails of each of these sizes, which are the maximum heights
+# used by the /thumbnail endpoint.
+THUMBNAIL_MIME_TYPES = [
+    "image/gif",
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+]
+THUMBNAIL_SIZES = {
+    'thumbnail': 300,
+}
+# Thumbnails never change once generated, so browsers can keep them.
+THUMBNAIL_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
 INLINE_MIME_TYPES = [
     "application/pdf",
     "image/gif",
@@ -65,6 +87,11 @@ INLINE_MIME_TYPES = [
 #
 # This is great, because passing the pseudofile object that Django gives
 # you to boto would be a pain.
+#
+# Message files uploaded through the API are never read into memory as
+# a whole: upload_message_file_from_stream copies them to their final
+# location chunk by chunk, and large files go to S3 as a multipart
+# upload.
 
 # To come up with a s3 key we randomly generate a "directory". The
 # "file name" is the original filename provided by the user run
@@ -193,6 +220,29 @@ def resize_emoji(image_data: bytes, size: int=DEFAULT_EMOJI_SIZE) -> bytes:
     except DecompressionBombError:
         raise BadImageError(_("Image size exceeds limit."))
 
+def resize_thumbnail(image_data: bytes, height: int) -> bytes:
+    try:
+        im = Image.open(io.BytesIO(image_data))
+        image_format = im.format
+        if getattr(im, 'is_animated', False):
+            # Resizing animated images loses the animation; see resize_gif.
+            return image_data
+        im = exif_rotate(im)
+        if im.size[1] > height:
+            width = max(1, round(im.size[0] * height / im.size[1]))
+            im = im.resize((width, height), Image.ANTIALIAS)
+        out = io.BytesIO()
+        im.save(out, format=image_format)
+        return out.getvalue()
+    except IOError:
+        raise BadImageError(_("Could not decode image; did you upload an image file?"))
+    except DecompressionBombError:
+        raise BadImageError(_("Image size exceeds limit."))
+
+def get_thumbnail_path_id(path_id: str, size: str) -> str:
+    # Thumbnails are stored alongside the uploaded files, so that they
+    # can be served the same way.
+    return "thumbnails/%s/%s" % (path_id, size)
 
 ### Common
 
@@ -203,6 +253,12 @@ class ZulipUploadBackend:
                             target_realm: Optional[Realm]=None) -> str:
         raise NotImplementedError()
 
+    def upload_message_file_from_stream(self, uploaded_file_name: str,
+                                        content_type: Optional[str], user_file: File,
+                                        user_profile: UserProfile,
+                                        target_realm: Optional[Realm]=None) -> str:
+        raise NotImplementedError()
+
     def upload_avatar_image(self, user_file: File,
                             acting_user_profile: UserProfile,
                             target_user_profile: UserProfile,
@@ -215,6 +271,13 @@ class ZulipUploadBackend:
     def delete_message_image(self, path_id: str) -> bool:
         raise NotImplementedError()
 
+    def read_message_file(self, path_id: str) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    def write_message_thumbnail(self, path_id: str, size: str, content_type: Optional[str],
+                                thumbnail_data: bytes) -> None:
+        raise NotImplementedError()
+
     def get_avatar_url(self, hash_key: str, medium: bool=False) -> str:
         raise NotImplementedError()
 
@@ -294,6 +357,52 @@ def upload_image_to_s3(
 
     key.set_contents_from_string(contents, headers=headers)
 
+def upload_stream_to_s3(
+        bucket_name: str,
+        file_name: str,
+        content_type: Optional[str],
+        user_profile: UserProfile,
+        user_file: File) -> int:
+    """Uploads user_file in parts of S3_MULTIPART_CHUNK_SIZE, returning
+    the number of bytes uploaded."""
+    conn = S3Connection(settings.S3_KEY, settings.S3_SECRET_KEY)
+    bucket = get_bucket(conn, bucket_name)
+    metadata = {
+        "user_profile_id": str(user_profile.id),
+        "realm_id": str(user_profile.realm_id),
+    }
+
+    headers = {}
+    if content_type is not None:
+        headers["Content-Type"] = content_type
+    if content_type not in INLINE_MIME_TYPES:
+        headers["Content-Disposition"] = "attachment"
+
+    chunks = user_file.chunks(chunk_size=S3_MULTIPART_CHUNK_SIZE)
+    first_chunk = next(chunks, b"")
+    second_chunk = next(chunks, None)
+    if second_chunk is None:
+        # Too small for a multipart upload.
+        key = Key(bucket)
+        key.key = file_name
+        for name, value in metadata.items():
+            key.set_metadata(name, value)
+        key.set_contents_from_string(first_chunk, headers=headers)
+        return len(first_chunk)
+
+    multipart_upload = bucket.initiate_multipart_upload(file_name, headers=headers,
+                                                        metadata=metadata)
+    uploaded_size = 0
+    try:
+        for part_num, chunk in enumerate(itertools.chain([first_chunk, second_chunk], chunks), 1):
+            multipart_upload.upload_part_from_file(io.BytesIO(chunk), part_num)
+            uploaded_size += len(chunk)
+        multipart_upload.complete_upload()
+    except Exception:
+        multipart_upload.cancel_upload()
+        raise
+    return uploaded_size
+
 def check_upload_within_quota(realm: Realm, uploaded_file_size: int) -> None:
     upload_quota = realm.upload_quota_bytes()
     if upload_quota is None:
@@ -350,17 +459,22 @@ class S3UploadBackend(ZulipUploadBackend):
         logging.warning("%s does not exist. Its entry in the database will be removed." % (file_name,))
         return False
 
-    def upload_message_file(self, uploaded_file_name: str, uploaded_file_size: int,
-                            content_type: Optional[str], file_data: bytes,
-                            user_profile: UserProfile, target_realm: Optional[Realm]=None) -> str:
-        bucket_name = settings.S3_AUTH_UPLOADS_BUCKET
+    def generate_message_upload_path(self, uploaded_file_name: str, user_profile: UserProfile,
+                                     target_realm: Optional[Realm]=None) -> str:
         if target_realm is None:
             target_realm = user_profile.realm
-        s3_file_name = "/".join([
+        return "/".join([
             str(target_realm.id),
             random_name(18),
             sanitize_name(uploaded_file_name)
         ])
+
+    def upload_message_file(self, uploaded_file_name: str, uploaded_file_size: int,
+                            content_type: Optional[str], file_data: bytes,
+                            user_profile: UserProfile, target_realm: Optional[Realm]=None) -> str:
+        bucket_name = settings.S3_AUTH_UPLOADS_BUCKET
+        s3_file_name = self.generate_message_upload_path(uploaded_file_name, user_profile,
+                                                         target_realm)
         url = "/user_uploads/%s" % (s3_file_name,)
 
         upload_image_to_s3(
@@ -374,9 +488,45 @@ class S3UploadBackend(ZulipUploadBackend):
         create_attachment(uploaded_file_name, s3_file_name, user_profile, uploaded_file_size)
         return url
 
+    def upload_message_file_from_stream(self, uploaded_file_name: str,
+                                        content_type: Optional[str], user_file: File,
+                                        user_profile: UserProfile,
+                                        target_realm: Optional[Realm]=None) -> str:
+        s3_file_name = self.generate_message_upload_path(uploaded_file_name, user_profile,
+                                                         target_realm)
+        uploaded_file_size = upload_stream_to_s3(
+            settings.S3_AUTH_UPLOADS_BUCKET,
+            s3_file_name,
+            content_type,
+            user_profile,
+            user_file
+        )
+        create_attachment(uploaded_file_name, s3_file_name, user_profile, uploaded_file_size)
+        return "/user_uploads/%s" % (s3_file_name,)
+
     def delete_message_image(self, path_id: str) -> bool:
+        bucket = get_bucket(self.connection, settings.S3_AUTH_UPLOADS_BUCKET)
+        bucket.delete_keys([get_thumbnail_path_id(path_id, size)
+                            for size in THUMBNAIL_SIZES])
         return self.delete_file_from_s3(path_id, settings.S3_AUTH_UPLOADS_BUCKET)
 
+    def read_message_file(self, path_id: str) -> Optional[bytes]:
+        bucket = get_bucket(self.connection, settings.S3_AUTH_UPLOADS_BUCKET)
+        key = bucket.get_key(path_id)  # type: Optional[Key]
+        if key is None:
+            return None
+        return key.get_contents_as_string()
+
+    def write_message_thumbnail(self, path_id: str, size: str, content_type: Optional[str],
+                                thumbnail_data: bytes) -> None:
+        bucket = get_bucket(self.connection, settings.S3_AUTH_UPLOADS_BUCKET)
+        key = Key(bucket)
+        key.key = get_thumbnail_path_id(path_id, size)
+        headers = {"Cache-Control": "private, max-age=%d, immutable" % (THUMBNAIL_CACHE_MAX_AGE,)}
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        key.set_contents_from_string(thumbnail_data, headers=headers)
+
     def write_avatar_images(self, s3_file_name: str, target_user_profile: UserProfile,
                             image_data: bytes, content_type: Optional[str]) -> None:
         bucket_name = settings.S3_AVATAR_BUCKET
@@ -633,6 +783,16 @@ def write_local_file(type: str, path: str, file_data: bytes) -> None:
     with open(file_path, 'wb') as f:
         f.write(file_data)
 
+def write_local_file_from_chunks(type: str, path: str, chunks: Iterable[bytes]) -> int:
+    file_path = os.path.join(settings.LOCAL_UPLOADS_DIR, type, path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    file_size = 0
+    with open(file_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            file_size += len(chunk)
+    return file_size
+
 def read_local_file(type: str, path: str) -> bytes:
     file_path = os.path.join(settings.LOCAL_UPLOADS_DIR, type, path)
     with open(file_path, 'rb') as f:
@@ -655,25 +815,53 @@ def get_local_file_path(path_id: str) -> Optional[str]:
     else:
         return None
 
+def get_local_thumbnail_path(path_id: str, size: str) -> Optional[str]:
+    return get_local_file_path(get_thumbnail_path_id(path_id, size))
+
 class LocalUploadBackend(ZulipUploadBackend):
-    def upload_message_file(self, uploaded_file_name: str, uploaded_file_size: int,
-                            content_type: Optional[str], file_data: bytes,
-                            user_profile: UserProfile, target_realm: Optional[Realm]=None) -> str:
+    def generate_message_upload_path(self, uploaded_file_name: str,
+                                     user_profile: UserProfile) -> str:
         # Split into 256 subdirectories to prevent directories from getting too big
-        path = "/".join([
+        return "/".join([
             str(user_profile.realm_id),
             format(random.randint(0, 255), 'x'),
             random_name(18),
             sanitize_name(uploaded_file_name)
         ])
 
+    def upload_message_file(self, uploaded_file_name: str, uploaded_file_size: int,
+                            content_type: Optional[str], file_data: bytes,
+                            user_profile: UserProfile, target_realm: Optional[Realm]=None) -> str:
+        path = self.generate_message_upload_path(uploaded_file_name, user_profile)
+
         write_local_file('files', path, file_data)
         create_attachment(uploaded_file_name, path, user_profile, uploaded_file_size)
         return '/user_uploads/' + path
 
+    def upload_message_file_from_stream(self, uploaded_file_name: str,
+                                        content_type: Optional[str], user_file: File,
+                                        user_profile: UserProfile,
+                                        target_realm: Optional[Realm]=None) -> str:
+        path = self.generate_message_upload_path(uploaded_file_name, user_profile)
+
+        uploaded_file_size = write_local_file_from_chunks('files', path, user_file.chunks())
+        create_attachment(uploaded_file_name, path, user_profile, uploaded_file_size)
+        return '/user_uploads/' + path
+
     def delete_message_image(self, path_id: str) -> bool:
+        shutil.rmtree(os.path.join(settings.LOCAL_UPLOADS_DIR, 'files', 'thumbnails', path_id),
+                      ignore_errors=True)
         return delete_local_file('files', path_id)
 
+    def read_message_file(self, path_id: str) -> Optional[bytes]:
+        if get_local_file_path(path_id) is None:
+            return None
+        return read_local_file('files', path_id)
+
+    def write_message_thumbnail(self, path_id: str, size: str, content_type: Optional[str],
+                                thumbnail_data: bytes) -> None:
+        write_local_file('files', get_thumbnail_path_id(path_id, size), thumbnail_data)
+
     def write_avatar_images(self, file_path: str, image_data: bytes) -> None:
         write_local_file('avatars', file_path + '.original', image_data)
 
@@ -866,6 +1054,13 @@ def upload_message_file(uploaded_file_name: str, uploaded_file_size: int,
                                               content_type, file_data, user_profile,
                                               target_realm=target_realm)
 
+def upload_message_file_from_stream(uploaded_file_name: str, content_type: Optional[str],
+                                    user_file: File, user_profile: UserProfile,
+                                    target_realm: Optional[Realm]=None) -> str:
+    return upload_backend.upload_message_file_from_stream(uploaded_file_name, content_type,
+                                                          user_file, user_profile,
+                                                          target_realm=target_realm)
+
 def claim_attachment(user_profile: UserProfile,
                      path_id: str,
                      message: Message,
@@ -887,8 +1082,33 @@ def create_attachment(file_name: str, path_id: str, user_profile: UserProfile,
 def upload_message_image_from_request(request: HttpRequest, user_file: File,
                                       user_profile: UserProfile) -> str:
     uploaded_file_name, uploaded_file_size, content_type = get_file_info(request, user_file)
-    return upload_message_file(uploaded_file_name, uploaded_file_size,
-                               content_type, user_file.read(), user_profile)
+    uri = upload_message_file_from_stream(uploaded_file_name, content_type,
+                                          user_file, user_profile)
+    if settings.PREGENERATE_THUMBNAILS and content_type in THUMBNAIL_MIME_TYPES:
+        queue_json_publish('deferred_work', {
+            'type': 'generate_thumbnails',
+            'path_id': uri[len('/user_uploads/'):],
+        })
+    return uri
+
+def generate_message_thumbnails(path_id: str) -> None:
+    """Generates and stores thumbnails of each of THUMBNAIL_SIZES for an
+    uploaded image, so that /thumbnail can serve them directly."""
+    image_data = upload_backend.read_message_file(path_id)
+    if image_data is None:
+        # The file was deleted before we got to it.
+        return
+
+    content_type = guess_type(path_id)[0]
+    for size, height in THUMBNAIL_SIZES.items():
+        try:
+            thumbnail_data = resize_thumbnail(image_data, height)
+        except BadImageError:
+            logging.info("Could not generate thumbnails for %s" % (path_id,))
+            return
+        upload_backend.write_message_thumbnail(path_id, size, content_type, thumbnail_data)
+    # This saves /thumbnail from checking the storage on every request.
+    Attachment.objects.filter(path_id=path_id).update(has_thumbnails=True)
 
 def upload_export_tarball(realm: Realm, tarball_path: str) -> str:
     return upload_backend.upload_export_tarball(realm, tarball_path)
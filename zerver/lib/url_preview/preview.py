@@ -1,14 +1,22 @@
+import codecs
+import logging
 import re
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
 import requests
 
 from django.conf import settings
+from django.db import connection
 from django.utils.encoding import smart_text
 import magic
-from typing import Any, Optional, Dict, Callable
+from typing import Any, Optional, Deque, Dict, Callable, Iterable, Iterator
 from typing.re import Match
 
 from version import ZULIP_VERSION
-from zerver.lib.cache import cache_with_key, get_cache_with_key, preview_url_cache_key
+from zerver.lib.cache import cache_get, cache_set, cache_with_key, get_cache_with_key, \
+    preview_url_cache_key, preview_url_failure_cache_key
 from zerver.lib.url_preview.oembed import get_oembed_data
 from zerver.lib.url_preview.parsers import OpenGraphParser, GenericParser
 
@@ -27,6 +35,17 @@ link_regex = re.compile(
 # Set a custom user agent, since some sites block us with the default requests header
 HEADERS = {'User-Agent': 'Zulip URL preview/%s' % (ZULIP_VERSION,)}
 TIMEOUT = 15
+# Network errors are often transient, so rather than caching them
+# forever like other failed previews, we just avoid retrying the
+# URL for a while.
+FAILURE_CACHE_TIMEOUT = 60 * 60
+# We only need a page's <head> for most previews, and never more than
+# this many characters of it.
+MAX_HTML_SIZE = 1024 * 1024
+HTML_CHUNK_SIZE = 16 * 1024
+# Limits on fetching previews for many URLs at once; see fetch_link_embed_data.
+MAX_CONCURRENT_FETCHES = 8
+MAX_CONCURRENT_FETCHES_PER_DOMAIN = 2
 
 
 def is_link(url: str) -> Match[str]:
@@ -37,7 +56,7 @@ def guess_mimetype_from_content(response: requests.Response) -> str:
     try:
         content = next(response.iter_content(1000))
     except StopIteration:
-        content = ''
+        content = b''
     return mime_magic.from_buffer(content)
 
 def valid_content_type(url: str) -> bool:
@@ -46,22 +65,62 @@ def valid_content_type(url: str) -> bool:
     except requests.RequestException:
         return False
 
-    if not response.ok:
-        return False
-
-    content_type = response.headers.get('content-type')
-    # Be accommodating of bad servers: assume content may be html if no content-type header
-    if not content_type or content_type.startswith('text/html'):
-        # Verify that the content is actually HTML if the server claims it is
-        content_type = guess_mimetype_from_content(response)
-    return content_type.startswith('text/html')
+    try:
+        if not response.ok:
+            return False
+
+        content_type = response.headers.get('content-type')
+        # Be accommodating of bad servers: assume content may be html if no content-type header
+        if not content_type or content_type.startswith('text/html'):
+            # Verify that the content is actually HTML if the server claims it is
+            content_type = guess_mimetype_from_content(response)
+        return content_type.startswith('text/html')
+    finally:
+        response.close()
+
+class HtmlReader:
+    """Reads the HTML of a streamed response incrementally, so that we
+    can stop downloading a page once we've seen the part we need."""
+
+    def __init__(self, response: requests.Response) -> None:
+        self.chunks = response.iter_content(HTML_CHUNK_SIZE)
+        try:
+            decoder_class = codecs.getincrementaldecoder(response.encoding or 'utf-8')
+        except LookupError:
+            decoder_class = codecs.getincrementaldecoder('utf-8')
+        self.decoder = decoder_class(errors='replace')
+        self.html = ''
+        self.finished = False
+
+    def read_until(self, marker: Optional[str]=None) -> str:
+        """Reads until marker (case-insensitive) has been seen, or to the
+        end of the page if marker is None, and returns all the HTML read
+        so far."""
+        search_start = 0
+        while not self.finished and len(self.html) < MAX_HTML_SIZE:
+            if marker is not None:
+                if marker in self.html[search_start:].lower():
+                    break
+                search_start = max(0, len(self.html) - len(marker))
+
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.html += self.decoder.decode(b'', final=True)
+                self.finished = True
+            else:
+                self.html += self.decoder.decode(chunk)
+        return self.html
 
 def catch_network_errors(func: Callable[..., Any]) -> Callable[..., Any]:
-    def wrapper(*args: Any, **kwargs: Any) -> Any:
+    def wrapper(url: str, *args: Any, **kwargs: Any) -> Any:
+        failure_key = preview_url_failure_cache_key(url)
+        if cache_get(failure_key, cache_name=CACHE_NAME) is not None:
+            return None
         try:
-            return func(*args, **kwargs)
+            return func(url, *args, **kwargs)
         except requests.exceptions.RequestException:
-            pass
+            cache_set(failure_key, True, cache_name=CACHE_NAME, timeout=FAILURE_CACHE_TIMEOUT)
     return wrapper
 
 @catch_network_errors
@@ -83,18 +142,87 @@ def get_link_embed_data(url: str,
         return data
 
     response = requests.get(url, stream=True, headers=HEADERS, timeout=TIMEOUT)
-    if response.ok:
-        og_data = OpenGraphParser(response.text).extract_data()
-        for key in ['title', 'description', 'image']:
-            if not data.get(key) and og_data.get(key):
-                data[key] = og_data[key]
-
-        generic_data = GenericParser(response.text).extract_data() or {}
-        for key in ['title', 'description', 'image']:
-            if not data.get(key) and generic_data.get(key):
-                data[key] = generic_data[key]
+    try:
+        if response.ok:
+            reader = HtmlReader(response)
+            # Open Graph tags are only valid in the <head>, so for
+            # pages that have them all, we can skip the body entirely.
+            html = reader.read_until('</head>')
+            og_data = OpenGraphParser(html).extract_data()
+            for key in ['title', 'description', 'image']:
+                if not data.get(key) and og_data.get(key):
+                    data[key] = og_data[key]
+
+            if not all(data.get(key) for key in ['title', 'description', 'image']):
+                # The generic parser falls back to the body's
+                # paragraphs and images, so it needs the whole page.
+                html = reader.read_until()
+                generic_data = GenericParser(html).extract_data() or {}
+                for key in ['title', 'description', 'image']:
+                    if not data.get(key) and generic_data.get(key):
+                        data[key] = generic_data[key]
+    finally:
+        response.close()
     return data
 
+def fetch_link_embed_data(urls: Iterable[str]) -> Iterator[str]:
+    """Fetches (and caches) the embed data for all of urls concurrently,
+    so that one slow site doesn't hold up previews for the others,
+    yielding each URL once it's been fetched.  We limit how many
+    requests we make to any one domain at once, to avoid hammering a
+    site that's linked many times.
+
+    A URL whose preview fails with an unexpected error is logged and
+    still yielded, without a preview, so that the failure doesn't
+    affect the other URLs."""
+    def fetch_or_log(url: str) -> None:
+        try:
+            get_link_embed_data(url)
+        except Exception:
+            logging.exception("Error fetching preview for %s" % (url,))
+
+    url_set = set(urls)
+    if len(url_set) <= 1:
+        for url in url_set:
+            fetch_or_log(url)
+            yield url
+        return
+
+    # We only submit a URL once its domain is below the limit, rather
+    # than having threads wait for their domain, so that a domain
+    # linked many times can't tie up all of the threads.
+    urls_by_domain = defaultdict(deque)  # type: Dict[Optional[str], Deque[str]]
+    for url in url_set:
+        urls_by_domain[urlsplit(url).hostname].append(url)
+    in_flight = defaultdict(int)  # type: Dict[Optional[str], int]
+
+    def fetch(url: str) -> None:
+        try:
+            fetch_or_log(url)
+        finally:
+            # The database cache opens a connection in each thread.
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES) as executor:
+        futures = {}  # type: Dict[Future, str]
+
+        def submit_ready_urls() -> None:
+            for domain, domain_urls in urls_by_domain.items():
+                while (domain_urls and len(futures) < MAX_CONCURRENT_FETCHES and
+                       in_flight[domain] < MAX_CONCURRENT_FETCHES_PER_DOMAIN):
+                    url = domain_urls.popleft()
+                    in_flight[domain] += 1
+                    futures[executor.submit(fetch, url)] = url
+
+        submit_ready_urls()
+        while futures:
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = futures.pop(future)
+                in_flight[urlsplit(url).hostname] -= 1
+                yield url
+            submit_ready_urls()
+
 @get_cache_with_key(preview_url_cache_key, cache_name=CACHE_NAME)
 def link_embed_data_from_cache(url: str, maxwidth: Optional[int]=640, maxheight: Optional[int]=480) -> Any:
     return
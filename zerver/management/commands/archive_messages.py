@@ -2,13 +2,21 @@ from __future__ import absolute_import
 
 from typing import Any
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandParser
 
 from zerver.lib.retention import archive_messages, clean_archived_data
 
 
 class Command(BaseCommand):
 
-    def handle(self, *args: Any, **options: str) -> None:
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--processes',
+                            type=int,
+                            default=1,
+                            help='Number of processes to archive messages with; each '
+                                 'archives one stream, or one realm\'s private messages, '
+                                 'at a time.')
+
+    def handle(self, *args: Any, **options: Any) -> None:
         clean_archived_data()
-        archive_messages()
+        archive_messages(processes=options['processes'])
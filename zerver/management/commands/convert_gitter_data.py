@@ -25,7 +25,7 @@ class Command(BaseCommand):
                             dest='threads',
                             action="store",
                             default=6,
-                            help='Threads to download avatars and attachments faster')
+                            help='Threads to convert messages and download avatars faster')
 
         parser.formatter_class = argparse.RawTextHelpFormatter
 
@@ -52,6 +52,12 @@ class Command(BaseCommand):
                             action="store",
                             help='API token for the HipChat API for fetching subscribers.')
 
+        parser.add_argument('--threads',
+                            dest='threads',
+                            action="store",
+                            default=6,
+                            help='Threads to use in converting messages in parallel')
+
         parser.formatter_class = argparse.RawTextHelpFormatter
 
     def handle(self, *args: Any, **options: Any) -> None:
@@ -70,6 +76,10 @@ class Command(BaseCommand):
 
         output_dir = os.path.realpath(output_dir)
 
+        num_threads = int(options['threads'])
+        if num_threads < 1:
+            raise CommandError('You must have at least one thread.')
+
         for path in options['hipchat_tar']:
             if not os.path.exists(path):
                 raise CommandError("Tar file not found: '%s'" % (path,))
@@ -81,4 +91,5 @@ class Command(BaseCommand):
                 masking_content=options.get('masking_content', False),
                 slim_mode=options['slim_mode'],
                 api_token=options.get("api_token"),
+                threads=num_threads,
             )
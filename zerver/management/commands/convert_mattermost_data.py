@@ -37,6 +37,12 @@ class Command(BaseCommand):
                             action="store_true",
                             help='Mask the content for privacy during QA.')
 
+        parser.add_argument('--threads',
+                            dest='threads',
+                            action="store",
+                            default=6,
+                            help='Threads to use in converting messages in parallel')
+
         parser.formatter_class = argparse.RawTextHelpFormatter
 
     def handle(self, *args: Any, **options: Any) -> None:
@@ -53,6 +59,10 @@ class Command(BaseCommand):
             raise CommandError('Output directory should be empty!')
         output_dir = os.path.realpath(output_dir)
 
+        num_threads = int(options['threads'])
+        if num_threads < 1:
+            raise CommandError('You must have at least one thread.')
+
         data_dir = options['mattermost_data_dir']
         if not os.path.exists(data_dir):
             raise CommandError("Directory not found: '%s'" % (data_dir,))
@@ -63,4 +73,5 @@ class Command(BaseCommand):
             mattermost_data_dir=data_dir,
             output_dir=output_dir,
             masking_content=options.get('masking_content', False),
+            threads=num_threads,
         )
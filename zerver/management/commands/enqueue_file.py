@@ -9,7 +9,7 @@ from zerver.lib.queue import queue_json_publish
 
 
 def error(*args: Any) -> None:
-    raise Exception('We cannot enqueue because settings.USING_RABBITMQ is False.')
+    raise Exception('We cannot enqueue because settings.USING_QUEUE_WORKERS is False.')
 
 class Command(BaseCommand):
     help = """Read JSON lines from a file and enqueue them to a worker queue.
@@ -88,7 +88,7 @@ class Command(ZulipBaseCommand):
                             dest='threads',
                             action="store",
                             default=6,
-                            help='Threads to use in exporting UserMessage objects in parallel')
+                            help='Threads to use in exporting Message and UserMessage objects in parallel')
         parser.add_argument('--public-only',
                             action="store_true",
                             help='Export only public stream messages and associated attachments')
@@ -104,6 +104,10 @@ class Command(ZulipBaseCommand):
         parser.add_argument('--delete-after-upload',
                             action="store_true",
                             help='Automatically delete the local tarball after a successful export')
+        parser.add_argument('--resume',
+                            action="store_true",
+                            help='Resume an interrupted export into the same --output directory, '
+                                 'skipping message files that were already written')
         self.add_realm_args(parser, True)
 
     def handle(self, *args: Any, **options: Any) -> None:
@@ -113,13 +117,17 @@ class Command(ZulipBaseCommand):
         output_dir = options["output_dir"]
         public_only = options["public_only"]
         consent_message_id = options["consent_message_id"]
+        resume = options["resume"]
+
+        if resume and output_dir is None:
+            raise CommandError("--resume requires --output")
 
         if output_dir is None:
             output_dir = tempfile.mkdtemp(prefix="zulip-export-")
         else:
             output_dir = os.path.realpath(os.path.expanduser(output_dir))
             if os.path.exists(output_dir):
-                if os.listdir(output_dir):
+                if os.listdir(output_dir) and not resume:
                     raise CommandError(
                         "Refusing to overwrite nonempty directory: %s. Aborting..."
                         % (output_dir,)
@@ -131,7 +139,8 @@ class Command(ZulipBaseCommand):
         try:
             os.close(os.open(tarball_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
         except FileExistsError:
-            raise CommandError("Refusing to overwrite existing tarball: %s. Aborting..." % (tarball_path,))
+            if not resume:
+                raise CommandError("Refusing to overwrite existing tarball: %s. Aborting..." % (tarball_path,))
 
         print("\033[94mExporting realm\033[0m: %s" % (realm.string_id,))
 
@@ -173,4 +182,5 @@ class Command(ZulipBaseCommand):
                              threads=num_threads, upload=options['upload'],
                              public_only=public_only,
                              delete_after_upload=options["delete_after_upload"],
-                             consent_message_id=consent_message_id)
+                             consent_message_id=consent_message_id,
+                             resume=resume)
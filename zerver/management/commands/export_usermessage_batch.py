@@ -8,6 +8,7 @@ from typing import Any
 from django.core.management.base import BaseCommand
 
 from zerver.lib.export import export_usermessages_batch
+from zerver.lib.replicas import use_replica
 
 
 class Command(BaseCommand):
@@ -30,22 +31,28 @@ class Command(BaseCommand):
                             default=None,
                             type=int,
                             help='ID of the message advertising users to react with thumbs up')
+        parser.add_argument('--replica',
+                            dest='replica',
+                            action="store",
+                            default=None,
+                            help='Database replica to read from')
 
     def handle(self, *args: Any, **options: Any) -> None:
         logging.info("Starting UserMessage batch thread %s" % (options['thread'],))
-        files = set(glob.glob(os.path.join(options['path'], 'messages-*.json.partial')))
-        for partial_path in files:
-            locked_path = partial_path.replace(".json.partial", ".json.locked")
-            output_path = partial_path.replace(".json.partial", ".json")
-            try:
-                shutil.move(partial_path, locked_path)
-            except Exception:
-                # Already claimed by another process
-                continue
-            logging.info("Thread %s processing %s" % (options['thread'], output_path))
-            try:
-                export_usermessages_batch(locked_path, output_path, options["consent_message_id"])
-            except Exception:
-                # Put the item back in the free pool when we fail
-                shutil.move(locked_path, partial_path)
-                raise
+        with use_replica(options['replica']):
+            files = set(glob.glob(os.path.join(options['path'], 'messages-*.json.partial')))
+            for partial_path in files:
+                locked_path = partial_path.replace(".json.partial", ".json.locked")
+                output_path = partial_path.replace(".json.partial", ".json")
+                try:
+                    shutil.move(partial_path, locked_path)
+                except Exception:
+                    # Already claimed by another process
+                    continue
+                logging.info("Thread %s processing %s" % (options['thread'], output_path))
+                try:
+                    export_usermessages_batch(locked_path, output_path, options["consent_message_id"])
+                except Exception:
+                    # Put the item back in the free pool when we fail
+                    shutil.move(locked_path, partial_path)
+                    raise
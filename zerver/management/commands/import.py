@@ -9,7 +9,8 @@ from django.core.management.base import BaseCommand, CommandError, \
     CommandParser
 
 from zerver.forms import check_subdomain_available
-from zerver.lib.import_realm import do_import_realm, do_import_system_bots
+from zerver.lib.import_realm import do_import_realm, do_import_system_bots, \
+    other_realms_exist
 
 
 class Command(BaseCommand):
@@ -41,7 +42,14 @@ import a database dump from one or more JSON files."""
                             dest='processes',
                             action="store",
                             default=6,
-                            help='Number of processes to use for uploading Avatars to S3 in parallel')
+                            help='Number of processes to use for uploading Avatars to S3 '
+                                 'and importing messages in parallel')
+        parser.add_argument('--defer-indexes',
+                            action="store_true",
+                            help='Drop the secondary indexes on the message tables while importing\n'
+                                 'messages, and rebuild them afterwards.  Much faster for large\n'
+                                 'imports, but only allowed when importing a single export into\n'
+                                 'a server with no other realms.')
         parser.formatter_class = argparse.RawTextHelpFormatter
 
     def do_destroy_and_rebuild_database(self, db_name: str) -> None:
@@ -74,8 +82,15 @@ import a database dump from one or more JSON files."""
                                    "tarball, please unpack it first.")
             paths.append(path)
 
+        if options["defer_indexes"]:
+            if len(paths) > 1:
+                raise CommandError("--defer-indexes can only be used to import a single export.")
+            if other_realms_exist():
+                raise CommandError("--defer-indexes can only be used on a server with no other realms.")
+
         for path in paths:
             print("Processing dump: %s ..." % (path,))
-            realm = do_import_realm(path, subdomain, num_processes)
+            realm = do_import_realm(path, subdomain, num_processes,
+                                    defer_indexes=options["defer_indexes"])
             print("Checking the system bots.")
             do_import_system_bots(realm)
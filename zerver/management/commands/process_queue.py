@@ -40,12 +40,12 @@ class Command(BaseCommand):
             logger.warning("SIGUSR1 received. Restarting this queue processor.")
             sys.exit(3)
 
-        if not settings.USING_RABBITMQ:
+        if not settings.USING_QUEUE_WORKERS:
             # Make the warning silent when running the tests
             if settings.TEST_SUITE:
-                logger.info("Not using RabbitMQ queue workers in the test suite.")
+                logger.info("Not using queue workers in the test suite.")
             else:
-                logger.error("Cannot run a queue processor when USING_RABBITMQ is False!")
+                logger.error("Cannot run a queue processor when USING_QUEUE_WORKERS is False!")
             raise CommandError
 
         def run_threaded_workers(queues: List[str], logger: logging.Logger) -> None:
@@ -0,0 +1,84 @@
+import os
+import re
+from argparse import ArgumentParser
+from typing import Any, Dict, Iterable, List
+
+import ujson
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+ENDPOINT_ID_RE = re.compile(r"/\d+(?=/|$)")
+
+def normalize_endpoint(method: str, path: str) -> str:
+    # /json/messages/1234 and /json/messages/5678 are the same endpoint.
+    return "%s %s" % (method, ENDPOINT_ID_RE.sub('/<id>', path))
+
+def read_request_profiles(log_path: str) -> Iterable[Dict[str, Any]]:
+    # Read the rotated-out file first, so profiles come out oldest first.
+    for path in [log_path + '.1', log_path]:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield ujson.loads(line)
+                except ValueError:
+                    # A line truncated by a crash or rotation.
+                    continue
+
+def aggregate_request_profiles(profiles: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    endpoints = {}  # type: Dict[str, Dict[str, Any]]
+    for profile in profiles:
+        endpoint = normalize_endpoint(profile['method'], profile['path'])
+        stats = endpoints.setdefault(endpoint, dict(
+            requests=0, total_time=0.0, max_time=0.0,
+            markdown_time=0.0, sql={}, cache={}))
+        stats['requests'] += 1
+        stats['total_time'] += profile['time']
+        stats['max_time'] = max(stats['max_time'], profile['time'])
+        stats['markdown_time'] += profile['markdown']['time']
+        for query in profile['sql']:
+            count, duration = stats['sql'].get(query['query'], (0, 0.0))
+            stats['sql'][query['query']] = (count + query['count'], duration + query['time'])
+        for operation, families in profile['cache'].items():
+            for family, count in families.items():
+                key = "%s %s" % (operation, family)
+                stats['cache'][key] = stats['cache'].get(key, 0) + count
+    return endpoints
+
+class Command(BaseCommand):
+    help = """Summarize the slow request profiles recorded when
+REQUEST_PROFILE_SAMPLE_RATE is set, showing the endpoints that took
+the most total time and the queries and cache keys responsible."""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of endpoints, and of queries per endpoint, to show')
+        parser.add_argument('--endpoint',
+                            help='Only show endpoints containing this string')
+        parser.add_argument('--log-path', default=settings.REQUEST_PROFILE_LOG_PATH,
+                            help='Request profile log to read')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        top = options['top']
+        endpoints = aggregate_request_profiles(read_request_profiles(options['log_path']))
+        if options['endpoint'] is not None:
+            endpoints = {endpoint: stats for endpoint, stats in endpoints.items()
+                         if options['endpoint'] in endpoint}
+        if not endpoints:
+            print("No request profiles found in %s." % (options['log_path'],))
+            return
+
+        ranked = sorted(endpoints.items(), key=lambda item: -item[1]['total_time'])
+        for endpoint, stats in ranked[:top]:
+            print("%s: %d requests, %.3fs total, %.3fs avg, %.3fs max, %.3fs markdown" % (
+                endpoint, stats['requests'], stats['total_time'],
+                stats['total_time'] / stats['requests'], stats['max_time'],
+                stats['markdown_time']))
+            queries = sorted(stats['sql'].items(),
+                             key=lambda item: -item[1][1])  # type: List[Any]
+            for query, (count, duration) in queries[:top]:
+                print("    %8.3fs %6dq  %s" % (duration, count, query))
+            cache_keys = sorted(stats['cache'].items(), key=lambda item: -item[1])
+            for key, count in cache_keys[:top]:
+                print("    %6d cache %s" % (count, key))
@@ -33,6 +33,10 @@ To restore a specfic ArchiveTransaction:
                             dest='transaction_id',
                             type=int,
                             help='Restore a specific ArchiveTransaction.')
+        parser.add_argument('--processes',
+                            type=int,
+                            default=1,
+                            help='Number of processes to restore realms with.')
 
         self.add_realm_args(parser, help='Restore archived messages from the specified realm. '
                                          '(Does not restore manually deleted messages.)')
@@ -44,4 +48,5 @@ To restore a specfic ArchiveTransaction:
         elif options['transaction_id']:
             restore_data_from_archive(ArchiveTransaction.objects.get(id=options['transaction_id']))
         else:
-            restore_all_data_from_archive(restore_manual_transactions=options['restore_deleted'])
+            restore_all_data_from_archive(restore_manual_transactions=options['restore_deleted'],
+                                          processes=options['processes'])
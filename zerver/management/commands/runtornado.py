@@ -26,7 +26,7 @@ from zerver.tornado.event_queue import add_client_gc_hook, \
     missedmessage_hook, process_notification, setup_event_queue
 from zerver.tornado.sharding import notify_tornado_queue_name
 
-if settings.USING_RABBITMQ:
+if settings.USING_QUEUE_WORKERS:
     from zerver.lib.queue import get_queue_client
 
 
@@ -86,9 +86,9 @@ class Command(BaseCommand):
             print("Tornado server is running at http://%s:%s/" % (addr, port))
             print("Quit the server with %s." % (quit_command,))
 
-            if settings.USING_RABBITMQ:
+            if settings.USING_QUEUE_WORKERS:
                 queue_client = get_queue_client()
-                # Process notifications received via RabbitMQ
+                # Process notifications received via the queue
                 queue_client.register_json_consumer(notify_tornado_queue_name(int(port)),
                                                     process_notification)
 
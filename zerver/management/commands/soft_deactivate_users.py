@@ -44,6 +44,10 @@ class Command(ZulipBaseCommand):
                             type=int,
                             default=28,
                             help='Number of days of inactivity before soft-deactivation')
+        parser.add_argument('--processes',
+                            type=int,
+                            default=1,
+                            help='Number of processes to catch up soft-deactivated users with')
         parser.add_argument('users', metavar='<users>', type=str, nargs='*', default=[],
                             help="A list of user emails to soft activate/deactivate.")
 
@@ -78,7 +82,8 @@ class Command(ZulipBaseCommand):
                 users_deactivated = do_soft_deactivate_users(users_to_deactivate)
             else:
                 users_deactivated = do_auto_soft_deactivate_users(int(options['inactive_for']),
-                                                                  realm)
+                                                                  realm,
+                                                                  processes=options['processes'])
             logger.info('Soft Deactivated %d user(s)' % (len(users_deactivated),))
 
         else:
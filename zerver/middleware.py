@@ -26,7 +26,11 @@ from zerver.lib.db import reset_queries
 from zerver.lib.exceptions import ErrorCode, JsonableError, RateLimited
 from zerver.lib.html_to_text import get_content_description
 from zerver.lib.queue import queue_json_publish
+from zerver.lib.query_budget import check_query_budget, get_view_query_budget
 from zerver.lib.rate_limiter import RateLimitResult, max_api_calls
+from zerver.lib.replicas import note_user_write
+from zerver.lib.request_profile import finish_request_profile, new_request_profile, \
+    set_active_request_profile
 from zerver.lib.response import json_error, json_response_from_error
 from zerver.lib.subdomains import get_subdomain
 from zerver.lib.utils import statsd
@@ -41,6 +45,7 @@ def record_request_stop_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['remote_cache_requests_stopped'] = get_remote_cache_requests()
     log_data['bugdown_time_stopped'] = get_bugdown_time()
     log_data['bugdown_requests_stopped'] = get_bugdown_requests()
+    set_active_request_profile(None)
     if settings.PROFILE_ALL_REQUESTS:
         log_data["prof"].disable()
 
@@ -55,6 +60,7 @@ def record_request_restart_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['remote_cache_requests_restarted'] = get_remote_cache_requests()
     log_data['bugdown_time_restarted'] = get_bugdown_time()
     log_data['bugdown_requests_restarted'] = get_bugdown_requests()
+    set_active_request_profile(log_data.get('request_profile'))
 
 def async_request_timer_restart(request: HttpRequest) -> None:
     if "time_restarted" in request._log_data:
@@ -69,6 +75,8 @@ def record_request_start_data(log_data: MutableMapping[str, Any]) -> None:
         log_data["prof"].enable()
 
     reset_queries()
+    log_data['request_profile'] = new_request_profile()
+    set_active_request_profile(log_data['request_profile'])
     log_data['time_started'] = time.time()
     log_data['remote_cache_time_start'] = get_remote_cache_time()
     log_data['remote_cache_requests_start'] = get_remote_cache_requests()
@@ -163,6 +171,8 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
         startup_output = " (+start: %s)" % (format_timedelta(log_data["startup_time_delta"]),)
 
     bugdown_output = ""
+    bugdown_time_delta = 0.0
+    bugdown_count_delta = 0
     if 'bugdown_time_start' in log_data:
         bugdown_time_delta = get_bugdown_time() - log_data['bugdown_time_start']
         bugdown_count_delta = get_bugdown_requests() - log_data['bugdown_requests_start']
@@ -216,6 +226,11 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
         queue_json_publish("slow_queries", dict(
             query="%s (%s)" % (logger_line, email)))
 
+    # For a long-polling request, time_delta excludes the time spent
+    # waiting for events, matching what its profile covers.
+    finish_request_profile(log_data.get('request_profile'), path, method, status_code,
+                           time_delta, bugdown_time_delta, bugdown_count_delta)
+
     if settings.PROFILE_ALL_REQUESTS:
         log_data["prof"].disable()
         profile_path = "/tmp/profile.data.%s.%s" % (path.split("/")[-1], int(time_delta * 1000),)
@@ -235,6 +250,9 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
             error_data = u"[content more than 200 characters]"
         logger.info('status=%3d, data=%s, uid=%s' % (status_code, error_data, email))
 
+    # Last, since in the test suite's 'raise' mode this throws.
+    check_query_budget(queries, log_data.get('query_budget'), method, path)
+
 class LogRequests(MiddlewareMixin):
     # We primarily are doing logging using the process_view hook, but
     # for some views, process_view isn't run, so we call the start
@@ -270,6 +288,9 @@ class LogRequests(MiddlewareMixin):
         # And then completely reset our tracking to only cover work
         # done as part of this request
         record_request_start_data(request._log_data)
+        # rest_dispatch replaces this with the budget of the function
+        # it dispatches to.
+        request._log_data['query_budget'] = get_view_query_budget(view_func)
 
     def process_response(self, request: HttpRequest,
                          response: StreamingHttpResponse) -> StreamingHttpResponse:
@@ -294,6 +315,12 @@ class LogRequests(MiddlewareMixin):
         except Exception:
             client = "?"
 
+        # See zerver/lib/replicas.py.
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                note_user_write(user.id)
+
         if response.streaming:
             content_iter = response.streaming_content
             content = None
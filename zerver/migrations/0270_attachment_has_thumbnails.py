@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.10 on 2026-10-18 23:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0269_gitlab_auth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedattachment',
+            name='has_thumbnails',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='has_thumbnails',
+            field=models.BooleanField(default=False),
+        ),
+    ]
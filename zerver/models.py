@@ -13,6 +13,7 @@ from django.core.validators import URLValidator, MinLengthValidator, \
     RegexValidator, validate_email
 from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     user_profile_by_api_key_cache_key, active_non_guest_user_ids_cache_key, \
+    get_local_api_key_auth_record, set_local_api_key_auth_record, cache_get, \
     user_profile_by_id_cache_key, user_profile_by_email_cache_key, \
     user_profile_cache_key, generic_bulk_cached_fetch, cache_set, flush_stream, \
     cache_delete, active_user_ids_cache_key, \
@@ -20,8 +21,10 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     bot_dicts_in_realm_cache_key, realm_user_dict_fields, \
     bot_dict_fields, flush_message, flush_submessage, bot_profile_cache_key, \
     flush_used_upload_space_cache, get_realm_used_upload_space_cache_key
+from zerver.lib.db import retry_on_connection_loss
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from django.db import transaction
+from django.utils.crypto import constant_time_compare
 from django.utils.timezone import now as timezone_now
 from zerver.lib.timestamp import datetime_to_timestamp
 from django.db.models.signals import post_save, post_delete
@@ -526,6 +529,7 @@ class Realm(models.Model):
 
 post_save.connect(flush_realm, sender=Realm)
 
+@retry_on_connection_loss
 def get_realm(string_id: str) -> Realm:
     return Realm.objects.get(string_id=string_id)
 
@@ -1998,6 +2002,10 @@ class AbstractAttachment(models.Model):
     # messages/streams to check permissions before serving these files.
     is_realm_public = models.BooleanField(default=False)  # type: bool
 
+    # Whether thumbnails of this image have been generated and stored
+    # (see PREGENERATE_THUMBNAILS).
+    has_thumbnails = models.BooleanField(default=False)  # type: bool
+
     class Meta:
         abstract = True
 
@@ -2139,9 +2147,26 @@ class Subscription(models.Model):
     ]
 
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7)
+@retry_on_connection_loss
 def get_user_profile_by_id(uid: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=uid)
 
+def bulk_get_user_profiles_by_id(user_ids: Iterable[int]) -> Dict[int, UserProfile]:
+    """Like get_user_profile_by_id, but fetching all the users from the
+    cache in a single round trip, and any that aren't cached in a
+    single query.  Missing users are omitted from the result."""
+    def fetch_users_by_id(user_ids: List[int]) -> List[UserProfile]:
+        # realm is the only non-nullable foreign key, and thus the
+        # only relation that get_user_profile_by_id's select_related()
+        # follows; naming it keeps the cached objects the same size.
+        return list(UserProfile.objects.filter(id__in=user_ids).select_related('realm'))
+
+    return generic_bulk_cached_fetch(
+        cache_key_function=user_profile_by_id_cache_key,
+        query_function=fetch_users_by_id,
+        object_ids=list(set(user_ids)),
+    )
+
 @cache_with_key(user_profile_by_email_cache_key, timeout=3600*24*7)
 def get_user_profile_by_email(email: str) -> UserProfile:
     """This function is intended to be used by our unit tests and for
@@ -2152,9 +2177,53 @@ def get_user_profile_by_email(email: str) -> UserProfile:
     """
     return UserProfile.objects.select_related().get(delivery_email__iexact=email.strip())
 
-@cache_with_key(user_profile_by_api_key_cache_key, timeout=3600*24*7)
+# Invalid API keys are cached too, so that a client retrying with a
+# bad key doesn't cost a database query per request, but not for as
+# long as valid ones.
+INVALID_API_KEY_CACHE_SECONDS = 60
+
+def get_api_key_auth_record(api_key: str) -> Optional[Dict[str, Any]]:
+    """Returns the few fields of the user with this API key that we need
+    to accept or reject an API request, or None if the key is invalid.
+    This is much cheaper to cache, and to fetch from the remote cache,
+    than a whole UserProfile with its related objects."""
+    local_record = get_local_api_key_auth_record(api_key)
+    if local_record is not None:
+        return local_record[0]
+
+    key = user_profile_by_api_key_cache_key(api_key)
+    remote_record = cache_get(key)
+    if remote_record is not None:
+        record = remote_record[0]  # type: Optional[Dict[str, Any]]
+    else:
+        rows = list(UserProfile.objects.filter(api_key=api_key).values(
+            'id', 'delivery_email', 'is_active', 'realm__deactivated'))
+        if rows:
+            record = dict(
+                id=rows[0]['id'],
+                delivery_email=rows[0]['delivery_email'],
+                is_active=rows[0]['is_active'],
+                realm_deactivated=rows[0]['realm__deactivated'],
+            )
+            cache_set(key, record, timeout=3600*24*7)
+        else:
+            record = None
+            cache_set(key, record, timeout=INVALID_API_KEY_CACHE_SECONDS)
+
+    set_local_api_key_auth_record(api_key, record)
+    return record
+
 def get_user_profile_by_api_key(api_key: str) -> UserProfile:
-    return UserProfile.objects.select_related().get(api_key=api_key)
+    record = get_api_key_auth_record(api_key)
+    if record is None:
+        raise UserProfile.DoesNotExist()
+    user_profile = get_user_profile_by_id(record['id'])
+    # Guards against a stale cache entry for a key that has since been
+    # regenerated; compared in constant time, since the key came from
+    # the client.
+    if not constant_time_compare(user_profile.api_key, api_key):
+        raise UserProfile.DoesNotExist()
+    return user_profile
 
 def get_user_by_delivery_email(email: str, realm: Realm) -> UserProfile:
     """Fetches a user given their delivery email.  For use in
@@ -0,0 +1,70 @@
+import time
+from typing import List
+
+import mock
+from django.db import OperationalError
+
+from zerver.lib.db import check_database_connections, retry_on_connection_loss
+from zerver.lib.test_classes import ZulipTestCase
+
+class DatabaseConnectionTest(ZulipTestCase):
+    def mock_connection(self, idle_seconds: float, usable: bool) -> mock.MagicMock:
+        conn = mock.MagicMock()
+        conn.in_atomic_block = False
+        conn.connection.connected_at = time.time() - idle_seconds
+        conn.connection.last_used = time.time() - idle_seconds
+        conn.is_usable.return_value = usable
+        return conn
+
+    def test_check_database_connections(self) -> None:
+        busy_conn = self.mock_connection(idle_seconds=1, usable=False)
+        idle_conn = self.mock_connection(idle_seconds=600, usable=True)
+        dropped_conn = self.mock_connection(idle_seconds=600, usable=False)
+        # Closing this one would break its transaction.
+        atomic_conn = self.mock_connection(idle_seconds=600, usable=False)
+        atomic_conn.in_atomic_block = True
+        connections = mock.MagicMock()
+        connections.all.return_value = [busy_conn, idle_conn, dropped_conn, atomic_conn]
+
+        with mock.patch('django.db.connections', connections), \
+                mock.patch('logging.warning') as mock_warning:
+            check_database_connections()
+
+        busy_conn.is_usable.assert_not_called()
+        busy_conn.close.assert_not_called()
+        idle_conn.is_usable.assert_called_once_with()
+        idle_conn.close.assert_not_called()
+        dropped_conn.close.assert_called_once_with()
+        atomic_conn.close_if_unusable_or_obsolete.assert_not_called()
+        atomic_conn.is_usable.assert_not_called()
+        atomic_conn.close.assert_not_called()
+        self.assertEqual(mock_warning.call_count, 1)
+
+    def test_retry_on_connection_loss(self) -> None:
+        calls = []  # type: List[int]
+
+        @retry_on_connection_loss
+        def read() -> str:
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError("server closed the connection unexpectedly")
+            return 'result'
+
+        conn = self.mock_connection(idle_seconds=0, usable=False)
+        with mock.patch('django.db.connections', {'default': conn}), \
+                mock.patch('logging.warning'):
+            self.assertEqual(read(), 'result')
+        self.assertEqual(len(calls), 2)
+        conn.close.assert_called_once_with()
+
+        # Errors on a working connection, or inside a transaction,
+        # aren't retried.
+        for usable, in_atomic_block in [(True, False), (False, True)]:
+            calls.clear()
+            conn = self.mock_connection(idle_seconds=0, usable=usable)
+            conn.in_atomic_block = in_atomic_block
+            with mock.patch('django.db.connections', {'default': conn}):
+                with self.assertRaises(OperationalError):
+                    read()
+            self.assertEqual(len(calls), 1)
+            conn.close.assert_not_called()
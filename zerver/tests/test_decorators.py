@@ -18,6 +18,7 @@ from zerver.lib.exceptions import JsonableError, InvalidAPIKeyError, InvalidAPIK
 from zerver.lib.initial_password import initial_password
 from zerver.lib.test_helpers import (
     HostRequestMock,
+    queries_captured,
 )
 from zerver.lib.test_classes import (
     ZulipTestCase,
@@ -35,7 +36,7 @@ from zerver.decorator import (
     authenticated_json_view,
     authenticated_rest_api_view,
     authenticated_uploads_api_view,
-    authenticate_notify, cachify,
+    authenticate_notify, cachify, access_user_by_api_key,
     get_client_name, internal_notify_view, is_local_addr,
     rate_limit, validate_api_key,
     return_success_on_head_request, to_not_negative_int_or_none,
@@ -1339,6 +1340,29 @@ class TestValidateApiKey(ZulipTestCase):
         profile = validate_api_key(HostRequestMock(host="zulip.testserver"), self.default_bot.email.upper(), api_key)
         self.assertEqual(profile.id, self.default_bot.id)
 
+    def test_invalid_api_key_is_cached(self) -> None:
+        api_key = generate_api_key()
+        with self.assertRaises(InvalidAPIKeyError):
+            access_user_by_api_key(HostRequestMock(host="zulip.testserver"), api_key)
+        with queries_captured() as queries:
+            with self.assertRaises(InvalidAPIKeyError):
+                access_user_by_api_key(HostRequestMock(host="zulip.testserver"), api_key)
+        self.assert_length(queries, 0)
+
+    def test_api_key_auth_record_is_flushed(self) -> None:
+        api_key = get_api_key(self.default_bot)
+        request = HostRequestMock(host="zulip.testserver")
+        profile = access_user_by_api_key(request, api_key)
+        self.assertEqual(profile.id, self.default_bot.id)
+
+        # Deactivating the bot must evict its cached auth record.
+        self._change_is_active_field(self.default_bot, False)
+        with self.assertRaisesRegex(JsonableError, "Account is deactivated"):
+            access_user_by_api_key(request, api_key)
+        self._change_is_active_field(self.default_bot, True)
+        profile = access_user_by_api_key(request, api_key)
+        self.assertEqual(profile.id, self.default_bot.id)
+
     def test_valid_api_key_if_user_is_on_wrong_subdomain(self) -> None:
         with self.settings(RUNNING_INSIDE_TORNADO=False):
             api_key = get_api_key(self.default_bot)
@@ -11,11 +11,11 @@ from django.utils.timezone import now as timezone_now
 from confirmation.models import one_click_unsubscribe_link
 from zerver.lib.actions import create_stream_if_needed, do_create_user
 from zerver.lib.digest import gather_new_streams, handle_digest_email, enqueue_emails, \
-    exclude_subscription_modified_streams
+    exclude_subscription_modified_streams, bulk_handle_digest_email, gather_hot_conversations
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import queries_captured
 from zerver.models import get_client, get_realm, flush_per_request_caches, \
-    Realm, Message, UserActivity, UserProfile, RealmAuditLog, get_stream
+    Realm, Message, Recipient, Subscription, UserActivity, UserProfile, RealmAuditLog, get_stream
 
 class TestDigestEmailMessages(ZulipTestCase):
 
@@ -155,11 +155,62 @@ class TestDigestEmailMessages(ZulipTestCase):
         self.assertIn(stream_ids['Scotland'], filtered_stream_ids)
         self.assertIn(stream_ids['Denmark'], filtered_stream_ids)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.enough_traffic', return_value=True)
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_bulk_handle_digest_email(self,
+                                      mock_send_future_email: mock.MagicMock,
+                                      mock_enough_traffic: mock.MagicMock) -> None:
+        one_day_ago = timezone_now() - datetime.timedelta(days=1)
+        Message.objects.all().update(date_sent=one_day_ago)
+
+        othello = self.example_user('othello')
+        cordelia = self.example_user('cordelia')
+        for user_profile in [othello, cordelia]:
+            for stream in ['Verona', 'Denmark']:
+                self.subscribe(user_profile, stream)
+            # Leave only the two streams above visible in the digest.
+            self.mute_all_other_streams(user_profile, ['Verona', 'Denmark'])
+
+        senders = ['hamlet', 'iago', 'prospero', 'ZOE']
+        self.simulate_stream_conversation('Verona', senders)
+
+        one_hour_ago = timezone_now() - datetime.timedelta(seconds=3600)
+        cutoff = time.mktime(one_hour_ago.timetuple())
+
+        with mock.patch('zerver.lib.digest.gather_hot_conversations',
+                        wraps=gather_hot_conversations) as mock_gather_hot_conversations, \
+                mock.patch('zerver.lib.digest.gather_new_streams',
+                           wraps=gather_new_streams) as mock_gather_new_streams:
+            bulk_handle_digest_email([othello.id, cordelia.id], cutoff)
+
+        # Both users have the same streams, so their digests share
+        # the hot conversations and new streams.
+        self.assertEqual(mock_gather_hot_conversations.call_count, 1)
+        self.assertEqual(mock_gather_new_streams.call_count, 1)
+
+        self.assertEqual(mock_send_future_email.call_count, 2)
+        to_user_ids = [call[1]['to_user_ids'] for call in mock_send_future_email.call_args_list]
+        self.assertEqual(sorted(to_user_ids), sorted([[othello.id], [cordelia.id]]))
+        for call in mock_send_future_email.call_args_list:
+            context = call[1]['context']
+            self.assertEqual(len(context['hot_conversations']), 1)
+            self.assertIn('unsubscribe_link', context)
+
+    def mute_all_other_streams(self, user_profile: UserProfile, stream_names: List[str]) -> None:
+        Subscription.objects.filter(
+            user_profile=user_profile,
+            recipient__type=Recipient.STREAM).exclude(
+                recipient__type_id__in=[get_stream(name, user_profile.realm).id
+                                        for name in stream_names]).update(is_muted=True)
+
+    def count_queued_users(self, mock_queue_digest_recipients: mock.MagicMock) -> int:
+        return sum(len(call[0][0]) for call in mock_queue_digest_recipients.call_args_list)
+
+    @mock.patch('zerver.lib.digest.queue_digest_recipients')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_inactive_users_queued_for_digest(self, mock_django_timezone: mock.MagicMock,
-                                              mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                              mock_queue_digest_recipients: mock.MagicMock) -> None:
         # Turn on realm digest emails for all realms
         Realm.objects.update(digest_emails_enabled=True)
         cutoff = timezone_now()
@@ -170,8 +221,9 @@ class TestDigestEmailMessages(ZulipTestCase):
         # Check that all users without an a UserActivity entry are considered
         # inactive users and get enqueued.
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, all_user_profiles.count())
-        mock_queue_digest_recipient.reset_mock()
+        self.assertEqual(self.count_queued_users(mock_queue_digest_recipients),
+                         all_user_profiles.count())
+        mock_queue_digest_recipients.reset_mock()
         for realm in Realm.objects.filter(deactivated=False, digest_emails_enabled=True):
             user_profiles = all_user_profiles.filter(realm=realm)
             for user_profile in user_profiles:
@@ -182,17 +234,18 @@ class TestDigestEmailMessages(ZulipTestCase):
                     client=get_client('test_client'))
         # Check that inactive users are enqueued
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, all_user_profiles.count())
+        self.assertEqual(self.count_queued_users(mock_queue_digest_recipients),
+                         all_user_profiles.count())
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_recipients')
     @mock.patch('zerver.lib.digest.timezone_now')
     def test_disabled(self, mock_django_timezone: mock.MagicMock,
-                      mock_queue_digest_recipient: mock.MagicMock) -> None:
+                      mock_queue_digest_recipients: mock.MagicMock) -> None:
         cutoff = timezone_now()
         # A Tuesday
         mock_django_timezone.return_value = datetime.datetime(year=2016, month=1, day=5)
         enqueue_emails(cutoff)
-        mock_queue_digest_recipient.assert_not_called()
+        mock_queue_digest_recipients.assert_not_called()
 
     @mock.patch('zerver.lib.digest.enough_traffic', return_value=True)
     @mock.patch('zerver.lib.digest.timezone_now')
@@ -214,28 +267,28 @@ class TestDigestEmailMessages(ZulipTestCase):
                     count=0,
                     client=get_client('test_client'))
         # Check that an active user is not enqueued
-        with mock.patch('zerver.lib.digest.queue_digest_recipient') as mock_queue_digest_recipient:
+        with mock.patch('zerver.lib.digest.queue_digest_recipients') as mock_queue_digest_recipients:
             enqueue_emails(cutoff)
-            self.assertEqual(mock_queue_digest_recipient.call_count, 0)
+            self.assertEqual(mock_queue_digest_recipients.call_count, 0)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_recipients')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_only_enqueue_on_valid_day(self, mock_django_timezone: mock.MagicMock,
-                                       mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                       mock_queue_digest_recipients: mock.MagicMock) -> None:
         # Not a Tuesday
         mock_django_timezone.return_value = datetime.datetime(year=2016, month=1, day=6)
 
         # Check that digests are not sent on days other than Tuesday.
         cutoff = timezone_now()
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, 0)
+        self.assertEqual(mock_queue_digest_recipients.call_count, 0)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_recipients')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_no_email_digest_for_bots(self, mock_django_timezone: mock.MagicMock,
-                                      mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                      mock_queue_digest_recipients: mock.MagicMock) -> None:
         # Turn on realm digest emails for all realms
         Realm.objects.update(digest_emails_enabled=True)
         cutoff = timezone_now()
@@ -251,9 +304,9 @@ class TestDigestEmailMessages(ZulipTestCase):
 
         # Check that bots are not sent emails
         enqueue_emails(cutoff)
-        for arg in mock_queue_digest_recipient.call_args_list:
-            user = arg[0][0]
-            self.assertNotEqual(user.id, bot.id)
+        for arg in mock_queue_digest_recipients.call_args_list:
+            user_ids = arg[0][0]
+            self.assertNotIn(bot.id, user_ids)
 
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
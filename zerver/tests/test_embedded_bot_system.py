@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
 
 from mock import patch
+from typing import Any, Dict, List, Optional
 
-from zerver.lib.bot_lib import EmbeddedBotQuitException
+import threading
+import time
+
+from zerver.lib.bot_lib import EmbeddedBotQuitException, get_bot_handler
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.models import (
     UserProfile, get_display_recipient,
     get_service_profile, get_user, get_realm
 )
+from zerver.worker.queue_processors import EmbeddedBotWorker
 
 import ujson
 
@@ -72,6 +77,88 @@ class TestEmbeddedBotMessaging(ZulipTestCase):
                                          topic_name="bar")
                 mock_logging.assert_called_once_with("I'm quitting!")
 
+    def test_bot_handler_kept_warm(self) -> None:
+        assert self.bot_profile is not None
+        events = []
+        for content in ["foo", "bar"]:
+            with patch('zerver.lib.actions.queue_json_publish') as mock_publish:
+                self.send_personal_message(self.user_profile.email, self.bot_profile.email,
+                                           content=content)
+            events.extend(call[0][1] for call in mock_publish.call_args_list
+                          if call[0][0] == 'embedded_bots')
+        self.assert_length(events, 2)
+
+        worker = EmbeddedBotWorker()
+        with patch('zulip_bots.bots.helloworld.helloworld.HelloWorldHandler.initialize',
+                   create=True) as mock_initialize, \
+                patch('zerver.worker.queue_processors.get_bot_handler',
+                      wraps=get_bot_handler) as mock_get_bot_handler:
+            for event in events:
+                worker.consume(event)
+            mock_initialize.assert_called_once()
+            mock_get_bot_handler.assert_called_once_with('helloworld')
+
+            # A bot that raises an error gets a fresh handler next time.
+            with patch('zulip_bots.bots.helloworld.helloworld.HelloWorldHandler.handle_message',
+                       side_effect=ValueError()):
+                with self.assertRaises(ValueError):
+                    worker.consume(events[0])
+            worker.consume(events[1])
+            self.assertEqual(mock_get_bot_handler.call_count, 2)
+
+        last_message = self.get_last_message()
+        self.assertEqual(last_message.content, "beep boop")
+        self.assertEqual(last_message.sender_id, self.bot_profile.id)
+
+    def test_bot_timeout(self) -> None:
+        stuck_bot_id = self.example_user('hamlet').id
+        other_bot_id = self.example_user('cordelia').id
+        events = [
+            {'user_profile_id': stuck_bot_id, 'n': 1},
+            {'user_profile_id': stuck_bot_id, 'n': 2},
+            {'user_profile_id': other_bot_id, 'n': 3},
+        ]
+        release = threading.Event()
+        handled = []  # type: List[int]
+
+        def handle_event(event: Dict[str, Any], user_profile: Optional[UserProfile]=None) -> None:
+            if event['user_profile_id'] == stuck_bot_id:
+                release.wait()
+            handled.append(event['n'])
+
+        worker = EmbeddedBotWorker()
+        worker.bot_timeout_seconds = 0
+        with patch.object(worker, 'handle_event', side_effect=handle_event), \
+                patch('zerver.worker.queue_processors.queue_json_publish') as mock_publish, \
+                patch('logging.warning') as mock_warning:
+            worker.consume_batch(events)
+            self.assertEqual(handled, [3])
+            mock_warning.assert_called_once_with(
+                "Embedded bot %s timed out handling a message" % (stuck_bot_id,))
+            # The stuck bot's other message is put back on the queue,
+            # and so are new ones until it's done.
+            self.assertEqual([call[0][1]['n'] for call in mock_publish.call_args_list], [2])
+            self.assertEqual(worker.stuck_bots, {stuck_bot_id})
+            # With nothing else to do, we wait a bit rather than spin.
+            with patch('zerver.worker.queue_processors.time.sleep') as mock_sleep:
+                worker.consume_batch([events[1]])
+            mock_sleep.assert_called_once_with(worker.sleep_delay)
+            self.assertEqual(mock_publish.call_count, 2)
+
+            release.set()
+            while worker.stuck_bots:
+                time.sleep(0.01)
+            self.assertEqual(handled, [3, 1])
+            worker.consume_batch([events[1]])
+            self.assertEqual(handled, [3, 1, 2])
+
+            # The bot's thread is reused once it's no longer stuck.
+            stuck_executor = worker.executors[stuck_bot_id]
+            worker.bot_timeout_seconds = 60
+            worker.consume_batch([events[0], events[2]])
+            self.assertEqual(sorted(handled[3:]), [1, 3])
+            self.assertIs(worker.executors[stuck_bot_id], stuck_executor)
+
 class TestEmbeddedBotFailures(ZulipTestCase):
     def test_message_embedded_bot_with_invalid_service(self) -> None:
         user_profile = self.example_user("othello")
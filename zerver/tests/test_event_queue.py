@@ -3,7 +3,7 @@ import time
 import ujson
 
 from django.http import HttpRequest, HttpResponse
-from typing import Any, Callable, Dict, Tuple
+from typing import Any, Callable, Dict, List, Tuple
 
 from zerver.lib.actions import do_mute_topic, do_change_subscription_property
 from zerver.lib.test_classes import ZulipTestCase
@@ -11,7 +11,8 @@ from zerver.lib.test_helpers import POSTRequestMock
 from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
 from zerver.tornado.event_queue import maybe_enqueue_notifications, \
     allocate_client_descriptor, ClientDescriptor, \
-    get_client_descriptor, missedmessage_hook, persistent_queue_filename
+    get_client_descriptor, missedmessage_hook, persistent_queue_filename, \
+    realm_clients_narrowed, expiry_heap, gc_event_queues
 from zerver.tornado.views import get_events, cleanup_event_queue
 
 class MissedMessageNotificationsTest(ZulipTestCase):
@@ -213,6 +214,51 @@ class MissedMessageNotificationsTest(ZulipTestCase):
             last_for_client=True,
         )
 
+    def test_narrowed_stream_watchers(self) -> None:
+        cordelia = self.example_user('cordelia')
+        hamlet = self.example_user('hamlet')
+        realm = hamlet.realm
+        stream_name = 'Denmark'
+
+        self.unsubscribe(hamlet, stream_name)
+
+        def allocate_narrowed_client(narrow: List[List[str]]) -> ClientDescriptor:
+            return allocate_client_descriptor(dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name='home grown api program',
+                event_types=['message'],
+                last_connection_time=time.time(),
+                queue_timeout=0,
+                realm_id=realm.id,
+                user_profile_id=hamlet.id,
+                narrow=narrow,
+            ))
+
+        denmark_client = allocate_narrowed_client([['stream', 'denmark']])
+        verona_client = allocate_narrowed_client([['stream', 'Verona']])
+        topic_client = allocate_narrowed_client([['stream', 'Denmark'], ['topic', 'lunch']])
+        sender_client = allocate_narrowed_client([['sender', cordelia.email]])
+        private_client = allocate_narrowed_client([['is', 'private']])
+
+        self.assertEqual(realm_clients_narrowed[realm.id][('stream', 'verona')],
+                         [verona_client])
+        self.assertNotIn(None, realm_clients_narrowed[realm.id])
+
+        self.send_stream_message(cordelia.email, stream_name, topic_name='Lunch')
+
+        self.assertEqual(len(denmark_client.event_queue.contents()), 1)
+        self.assertEqual(len(topic_client.event_queue.contents()), 1)
+        self.assertEqual(len(sender_client.event_queue.contents()), 1)
+        self.assertEqual(len(verona_client.event_queue.contents()), 0)
+        self.assertEqual(len(private_client.event_queue.contents()), 0)
+
+        for client in [denmark_client, verona_client, topic_client, sender_client,
+                       private_client]:
+            client.cleanup()
+        self.assertNotIn(realm.id, realm_clients_narrowed)
+
     def test_end_to_end_missedmessage_hook(self) -> None:
         """Tests what arguments missedmessage_hook passes into maybe_enqueue_notifications.
         Combined with the previous test, this ensures that the missedmessage_hook is correct"""
@@ -517,6 +563,35 @@ class EventQueueTest(ZulipTestCase):
         new_client = ClientDescriptor.from_dict(client_dict)
         self.assertEqual(client_dict, new_client.to_dict())
 
+    def test_gc_event_queues(self) -> None:
+        expired_client = self.get_client_descriptor()
+        expired_client.last_connection_time -= 1000
+        reconnected_client = self.get_client_descriptor()
+        fresh_client = self.get_client_descriptor()
+
+        # The reconnected client's heap entry predates its reconnection.
+        now = time.time()
+        expiry_heap[:] = sorted([
+            (expired_client.expiry_deadline(now), expired_client.event_queue.id),
+            (now - 1, reconnected_client.event_queue.id),
+            (fresh_client.expiry_deadline(now), fresh_client.event_queue.id),
+        ])
+
+        # Stopping at the end of the time slice reschedules the GC.
+        with mock.patch('zerver.tornado.event_queue.EVENT_QUEUE_GC_SLICE_SECS', 0), \
+                mock.patch('tornado.ioloop.IOLoop.instance') as mock_instance:
+            gc_event_queues(9993)
+        mock_instance.return_value.add_callback.assert_called_once_with(gc_event_queues, 9993)
+        self.assertEqual(get_client_descriptor(expired_client.event_queue.id), expired_client)
+
+        gc_event_queues(9993)
+        self.assertIsNone(get_client_descriptor(expired_client.event_queue.id))
+        self.assertEqual(get_client_descriptor(reconnected_client.event_queue.id),
+                         reconnected_client)
+        self.assertEqual(get_client_descriptor(fresh_client.event_queue.id), fresh_client)
+        self.assertEqual(sorted(id for (deadline, id) in expiry_heap),
+                         sorted([reconnected_client.event_queue.id, fresh_client.event_queue.id]))
+
     def test_one_event(self) -> None:
         client = self.get_client_descriptor()
         queue = client.event_queue
@@ -1,6 +1,9 @@
 from zerver.data_import.hipchat import (
     get_hipchat_sender_id,
 )
+from zerver.data_import.hipchat_attachment import (
+    AttachmentHandler,
+)
 from zerver.data_import.hipchat_user import (
     UserHandler,
 )
@@ -82,3 +85,30 @@ class HipChatImporter(ZulipTestCase):
             )
 
             self.assertEqual(sender_id, hal_bot_sender_id)
+
+    def test_merge_attachment_info(self) -> None:
+        def make_info(message_id: int, target_path: str) -> Dict[str, Any]:
+            return dict(
+                message_ids={message_id},
+                sender_id=1,
+                local_fn='/tmp/' + target_path,
+                target_path=target_path,
+                name=target_path,
+                size=5,
+                mtime=0,
+                content='[{name}](/user_uploads/{name})'.format(name=target_path),
+            )
+
+        # Attachments from different chunks of messages get
+        # merged, even when two chunks use the same file.
+        attachment_handler = AttachmentHandler()
+        for infos in [[make_info(1, 'a.txt'), make_info(2, 'b.txt')],
+                      [make_info(3, 'a.txt')]]:
+            chunk_attachment_handler = AttachmentHandler()
+            chunk_attachment_handler.info_dict = {
+                info['target_path']: info for info in infos
+            }
+            attachment_handler.merge_info(chunk_attachment_handler.get_info())
+
+        self.assertEqual(attachment_handler.info_dict['a.txt']['message_ids'], {1, 3})
+        self.assertEqual(attachment_handler.info_dict['b.txt']['message_ids'], {2})
@@ -2,23 +2,34 @@
 
 from django.conf import settings
 
+import glob
 import os
 import ujson
 
 from mock import patch
-from typing import Any, Dict, List, Set, Optional, Tuple, Callable, \
-    FrozenSet
+from typing import Any, Dict, Iterable, Iterator, List, Set, Optional, Tuple, \
+    Callable, FrozenSet
+from django.db import connection
 from django.db.models import Q
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.export import (
     do_export_realm,
+    export_partial_message_files,
     export_usermessages_batch,
     do_export_user,
+    get_message_shards,
+    make_raw,
+    make_raw_in_chunks,
+    write_data_to_file,
 )
 from zerver.lib.import_realm import (
+    ArrayIdMap,
     do_import_realm,
+    drop_indexes,
     get_incoming_message_ids,
+    get_secondary_indexes,
+    recreate_indexes,
 )
 from zerver.lib.avatar_hash import (
     user_avatar_path,
@@ -494,6 +505,80 @@ class ImportExportTest(ZulipTestCase):
         self.assertIn(pm_b_msg_id, exported_message_ids)
         self.assertIn(pm_c_msg_id, exported_message_ids)
 
+    def test_write_data_to_file(self) -> None:
+        output_dir = self._make_output_dir()
+        output_file = os.path.join(output_dir, 'data.json')
+        for data in [
+            dict(zerver_realm=[dict(id=1, name='Zulip')],
+                 zerver_stream=[],
+                 zerver_userprofile=[dict(id=1), dict(id=2, full_name='\u2603')],
+                 realm_id=1),
+            [dict(path='1/ab/file.txt'), dict(path='1/cd/other.txt')],
+            [],
+        ]:
+            write_data_to_file(output_file, data)
+            with open(output_file) as f:
+                self.assertEqual(ujson.load(f), data)
+
+    def test_make_raw_in_chunks(self) -> None:
+        query = UserProfile.objects.filter(realm=get_realm('zulip'))
+        self.assertEqual(make_raw_in_chunks(query, exclude=['api_key'], chunk_size=3),
+                         make_raw(query.order_by('id'), exclude=['api_key']))
+
+    def test_get_message_shards(self) -> None:
+        output_dir = self._make_output_dir()
+        queries = [
+            Message.objects.filter(sender=self.example_user('hamlet')).order_by('id'),
+            Message.objects.filter(sender=self.example_user('cordelia')).order_by('id'),
+        ]
+        shards = get_message_shards(queries, 7, output_dir)
+
+        message_ids = []  # type: List[int]
+        for query_index, first_id, last_id in shards:
+            shard_ids = list(queries[query_index].filter(
+                id__gte=first_id, id__lte=last_id).values_list('id', flat=True))
+            self.assertTrue(1 <= len(shard_ids) <= 7)
+            self.assertEqual((shard_ids[0], shard_ids[-1]), (first_id, last_id))
+            message_ids += shard_ids
+        self.assertEqual(message_ids,
+                         [message_id for query in queries
+                          for message_id in query.values_list('id', flat=True)])
+
+        # Resuming reads the same ranges back from the manifest.
+        self.send_stream_message(self.example_email("hamlet"), "Denmark")
+        self.assertEqual(get_message_shards(queries, 7, output_dir, resume=True), shards)
+
+    def test_export_realm_resume(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        full_data = self._export_realm(realm)
+        output_dir = os.path.join(settings.TEST_WORKER_DIR, 'test-export')
+        with open(os.path.join(output_dir, 'messages-000001.json')) as f:
+            original_message_data = ujson.load(f)
+        os.unlink(os.path.join(output_dir, 'messages-000001.json'))
+
+        # The resumed export's shards match the original's, even
+        # though messages were sent in the meantime.
+        self.send_stream_message(self.example_email("hamlet"), "Denmark", "Sent since")
+
+        with patch('logging.info'), patch('zerver.lib.export.create_soft_link'):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=0, resume=True)
+
+        # Only the message file we deleted needs to be regenerated.
+        self.assertTrue(os.path.exists(os.path.join(output_dir, 'messages-000001.json.partial')))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'messages-000002.json.partial')))
+
+        with patch('logging.info'):
+            export_usermessages_batch(
+                input_path=os.path.join(output_dir, 'messages-000001.json.partial'),
+                output_path=os.path.join(output_dir, 'messages-000001.json'),
+            )
+        with open(os.path.join(output_dir, 'messages-000001.json')) as f:
+            message_data = ujson.load(f)
+        self.assertEqual(message_data, original_message_data)
+        self.assertEqual(message_data['zerver_message'],
+                         full_data['message']['zerver_message'][:len(message_data['zerver_message'])])
+        self.assertEqual(glob.glob(os.path.join(output_dir, '*.tmp')), [])
+
     def test_export_realm_with_exportable_user_ids(self) -> None:
         realm = Realm.objects.get(string_id='zulip')
 
@@ -1157,6 +1242,101 @@ class ImportExportTest(ZulipTestCase):
 
         self.assertEqual(message_ids, [555, 888, 999])
 
+    def test_array_id_map(self) -> None:
+        id_map = ArrayIdMap([30, 10, 20], [101, 102, 103])
+        self.assertEqual(len(id_map), 3)
+        self.assertEqual(id_map[10], 102)
+        self.assertEqual(id_map[20], 103)
+        self.assertEqual(id_map[30], 101)
+        self.assertIn(20, id_map)
+        self.assertNotIn(15, id_map)
+        self.assertNotIn(40, id_map)
+        with self.assertRaises(KeyError):
+            id_map[40]
+        self.assertEqual(list(id_map), [10, 20, 30])
+
+    def test_drop_and_recreate_indexes(self) -> None:
+        def count_secondary_indexes() -> int:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT COUNT(*) FROM pg_indexes
+                    WHERE tablename = 'zerver_usermessage'
+                    AND indexdef NOT LIKE 'CREATE UNIQUE INDEX%%'
+                """)
+                return cursor.fetchone()[0]
+
+        original_count = count_secondary_indexes()
+        indexes = get_secondary_indexes(['zerver_usermessage'])
+        self.assertEqual(len(indexes), original_count)
+        self.assertEqual(count_secondary_indexes(), original_count)
+
+        with patch('logging.info'):
+            # Dropping only some of the indexes, as if we failed partway
+            # through, must still recreate cleanly.
+            drop_indexes(indexes[:1])
+            self.assertEqual(count_secondary_indexes(), original_count - 1)
+            recreate_indexes(indexes)
+            self.assertEqual(count_secondary_indexes(), original_count)
+
+            drop_indexes(indexes)
+            self.assertEqual(count_secondary_indexes(), 0)
+            recreate_indexes(indexes)
+        self.assertEqual(count_secondary_indexes(), original_count)
+
+    def test_defer_indexes_refused_with_other_realms(self) -> None:
+        output_dir = self._make_output_dir()
+        with patch('logging.info'), \
+                self.assertRaisesRegex(Exception, 'no other realms'):
+            do_import_realm(output_dir, 'test-zulip', defer_indexes=True)
+        self.assertFalse(Realm.objects.filter(string_id='test-zulip').exists())
+
+    def test_import_realm_in_parallel(self) -> None:
+        realm = get_realm('zulip')
+        output_dir = self._make_output_dir()
+
+        def export_small_message_files(*args: Any, **kwargs: Any) -> Set[int]:
+            return export_partial_message_files(*args, chunk_size=100, **kwargs)
+
+        with patch('logging.info'), patch('zerver.lib.export.create_soft_link'), \
+                patch('zerver.lib.export.export_partial_message_files',
+                      side_effect=export_small_message_files):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=0)
+            partial_paths = sorted(glob.glob(os.path.join(output_dir, 'messages-*.json.partial')))
+            for partial_path in partial_paths:
+                export_usermessages_batch(input_path=partial_path,
+                                          output_path=partial_path.replace('.json.partial', '.json'))
+        self.assertGreater(len(partial_paths), 2)
+
+        num_messages = 0
+        num_usermessages = 0
+        for partial_path in partial_paths:
+            with open(partial_path.replace('.json.partial', '.json')) as f:
+                data = ujson.load(f)
+            num_messages += len(data['zerver_message'])
+            num_usermessages += len(data['zerver_usermessage'])
+
+        # Forked processes would have their own database connections,
+        # which can't see this test's transaction, so run the jobs here,
+        # last file first, since they mustn't depend on each other.
+        def run_in_reverse(job: Callable[[Any], int], data: Iterable[Any],
+                           threads: int) -> Iterator[Tuple[int, Any]]:
+            for item in reversed(list(data)):
+                yield job(item), item
+
+        messages_before = Message.objects.count()
+        usermessages_before = UserMessage.objects.count()
+        with patch('logging.info'), \
+                patch('zerver.lib.import_realm.run_parallel', side_effect=run_in_reverse), \
+                patch('zerver.lib.import_realm.connection.close'), \
+                self.settings(BILLING_ENABLED=False):
+            do_import_realm(output_dir, 'test-zulip', processes=3)
+
+        self.assertEqual(Message.objects.count() - messages_before, num_messages)
+        self.assertEqual(UserMessage.objects.count() - usermessages_before, num_usermessages)
+        imported_realm = get_realm('test-zulip')
+        self.assertEqual(UserMessage.objects.filter(user_profile__realm=imported_realm).count(),
+                         num_usermessages)
+
     def test_plan_type(self) -> None:
         realm = get_realm('zulip')
         realm.plan_type = Realm.STANDARD
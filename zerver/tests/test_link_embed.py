@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import mock
+import threading
+import time
 import ujson
-from typing import Any, Callable, Dict, Optional
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
 from requests.exceptions import ConnectionError
 from django.test import override_settings
 from django.utils.html import escape
@@ -13,7 +16,8 @@ from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import MockPythonResponse
 from zerver.worker.queue_processors import FetchLinksEmbedData
 from zerver.lib.url_preview.preview import (
-    get_link_embed_data, link_embed_data_from_cache)
+    HTML_CHUNK_SIZE, MAX_CONCURRENT_FETCHES, MAX_CONCURRENT_FETCHES_PER_DOMAIN, HtmlReader,
+    fetch_link_embed_data, get_link_embed_data, link_embed_data_from_cache)
 from zerver.lib.url_preview.oembed import get_oembed_data, strip_cdata
 from zerver.lib.url_preview.parsers import (
     OpenGraphParser, GenericParser)
@@ -605,6 +609,111 @@ class PreviewTestCase(ZulipTestCase):
             '<p><a href="http://test.org/" target="_blank" title="http://test.org/">http://test.org/</a></p>',
             msg.rendered_content)
 
+    def test_network_error_cached_briefly(self) -> None:
+        url = 'http://test.org/'
+        mocked_get = mock.Mock(side_effect=ConnectionError())
+        with mock.patch('zerver.lib.url_preview.preview.valid_content_type', side_effect=lambda k: True):
+            with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+                with mock.patch('requests.get', mocked_get):
+                    self.assertIsNone(get_link_embed_data(url))
+                    self.assertIsNone(get_link_embed_data(url))
+
+                with self.assertRaises(NotFoundInCache):
+                    link_embed_data_from_cache(url)
+        # The second lookup didn't try fetching the URL again.
+        self.assertEqual(mocked_get.call_count, 1)
+
+    def test_html_reader_stops_after_head(self) -> None:
+        body = '<p>%s</p>' % ('x' * 4 * HTML_CHUNK_SIZE,)
+        html = '<html><head><title>Test title</title></HEAD><body>%s</body></html>' % (body,)
+        reader = HtmlReader(MockPythonResponse(html, 200))
+
+        head = reader.read_until('</head>')
+        self.assertIn('</HEAD>', head)
+        self.assertLessEqual(len(head), HTML_CHUNK_SIZE)
+
+        self.assertEqual(reader.read_until(), html)
+
+    @override_settings(INLINE_URL_EMBED_PREVIEW=True)
+    def test_fetch_links_for_batch(self) -> None:
+        url = 'http://test.org/'
+        events = []
+        for recipient in ['cordelia', 'othello']:
+            with mock.patch('zerver.lib.actions.queue_json_publish') as patched:
+                self.send_personal_message(
+                    self.example_email('hamlet'),
+                    self.example_email(recipient),
+                    content=url,
+                )
+                events.append(patched.call_args[0][1])
+
+        mocked_response = mock.Mock(side_effect=self.create_mock_response(url))
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+            with mock.patch('requests.get', mocked_response), \
+                    mock.patch('zerver.lib.url_preview.preview.get_link_embed_data',
+                               wraps=get_link_embed_data) as mock_fetch:
+                FetchLinksEmbedData().consume_batch(events)
+
+        # Both messages link the same URL, so it is only fetched once.
+        mock_fetch.assert_called_once_with(url)
+        embedded_link = '<a href="{0}" target="_blank" title="The Rock">The Rock</a>'.format(url)
+        for event in events:
+            msg = Message.objects.get(id=event['message_id'])
+            self.assertIn(embedded_link, msg.rendered_content)
+
+    def test_fetch_link_embed_data_limits(self) -> None:
+        urls = ['http://busy.org/%d' % (i,) for i in range(10)] + \
+            ['http://site%d.org/' % (i,) for i in range(10)]
+        lock = threading.Lock()
+        in_flight = defaultdict(int)  # type: Dict[str, int]
+        max_in_flight = defaultdict(int)  # type: Dict[str, int]
+
+        def get_link_embed_data(url: str) -> None:
+            domain = 'busy' if 'busy' in url else 'other'
+            with lock:
+                in_flight[domain] += 1
+                max_in_flight[domain] = max(max_in_flight[domain], in_flight[domain])
+                max_in_flight['total'] = max(max_in_flight['total'], sum(in_flight.values()))
+            time.sleep(0.01)
+            with lock:
+                in_flight[domain] -= 1
+
+        with mock.patch('zerver.lib.url_preview.preview.get_link_embed_data',
+                        side_effect=get_link_embed_data), \
+                mock.patch('zerver.lib.url_preview.preview.connection'):
+            self.assertEqual(sorted(fetch_link_embed_data(urls)), sorted(urls))
+
+        self.assertLessEqual(max_in_flight['busy'], MAX_CONCURRENT_FETCHES_PER_DOMAIN)
+        self.assertLessEqual(max_in_flight['total'], MAX_CONCURRENT_FETCHES)
+
+    def test_messages_updated_as_links_fetched(self) -> None:
+        log = []  # type: List[str]
+
+        def fetch_link_embed_data(urls: Iterable[str]) -> Iterator[str]:
+            self.assertEqual(set(urls), {'http://a.org/', 'http://b.org/'})
+            for url in ['http://b.org/', 'http://a.org/']:
+                log.append('fetched %s' % (url,))
+                yield url
+
+        events = [
+            {'n': 1, 'urls': ['http://a.org/', 'http://b.org/']},
+            {'n': 2, 'urls': ['http://b.org/']},
+            {'n': 3, 'urls': []},
+        ]
+        worker = FetchLinksEmbedData()
+        with mock.patch('zerver.lib.url_preview.preview.fetch_link_embed_data',
+                        side_effect=fetch_link_embed_data), \
+                mock.patch.object(worker, 'update_embedded_data',
+                                  side_effect=lambda event: log.append('updated %d' % (event['n'],))):
+            worker.consume_batch(events)
+
+        # Each message is updated as soon as its own links are fetched.
+        self.assertEqual(log, [
+            'updated 3',
+            'fetched http://b.org/', 'updated 2',
+            'fetched http://a.org/', 'updated 1',
+        ])
+
     @override_settings(INLINE_URL_EMBED_PREVIEW=True)
     def test_invalid_url(self) -> None:
         url = 'http://test.org/'
@@ -3,9 +3,11 @@
 import glob
 import os
 import re
+import tempfile
 from datetime import timedelta
 from email.utils import parseaddr
 import mock
+import ujson
 from mock import MagicMock, patch, call
 from typing import List, Dict, Any, Optional
 
@@ -417,7 +419,7 @@ class TestExport(ZulipTestCase):
             call_command(self.COMMAND_NAME, "-r=zulip", "--consent-message-id={}".format(message.id))
             m.assert_called_once_with(realm=realm, public_only=False, consent_message_id=message.id,
                                       delete_after_upload=False, threads=mock.ANY, output_dir=mock.ANY,
-                                      upload=False)
+                                      upload=False, resume=False)
 
         with self.assertRaisesRegex(CommandError, "Message with given ID does not"):
             call_command(self.COMMAND_NAME, "-r=zulip", "--consent-message-id=123456")
@@ -432,3 +434,43 @@ class TestExport(ZulipTestCase):
         do_add_reaction(self.mit_user("sipbtest"), message, "outbox", "1f4e4",  Reaction.UNICODE_EMOJI)
         with self.assertRaisesRegex(CommandError, "Users from a different realm reacted to message. Aborting..."):
             call_command(self.COMMAND_NAME, "-r=zulip", "--consent-message-id={}".format(message.id))
+
+class TestRequestProfileReport(ZulipTestCase):
+    COMMAND_NAME = 'request_profile_report'
+
+    def test_aggregates_by_endpoint(self) -> None:
+        def profile(path: str, time: float) -> str:
+            return ujson.dumps(dict(
+                path=path, method='GET', status_code=200, time=time,
+                sql=[dict(query='SELECT * FROM zerver_message WHERE id = ?', count=3, time=time / 2)],
+                cache={'get': {'user_profile_by_id:*': 2}},
+                markdown=dict(count=0, time=0.0),
+            ))
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'request_profile.log')
+            with patch('builtins.print') as mock_print:
+                call_command(self.COMMAND_NAME, '--log-path=' + log_path)
+            mock_print.assert_called_once_with('No request profiles found in %s.' % (log_path,))
+
+            with open(log_path + '.1', 'w') as f:
+                f.write(profile('/json/messages/12', 2.0) + '\n')
+            with open(log_path, 'w') as f:
+                f.write(profile('/json/messages/34', 4.0) + '\n')
+                f.write(profile('/json/users', 1.0) + '\n')
+                f.write('{"truncated\n')
+
+            with patch('builtins.print') as mock_print:
+                call_command(self.COMMAND_NAME, '--log-path=' + log_path)
+            lines = [args[0] for args, kwargs in mock_print.call_args_list]
+            self.assertEqual(lines[0], 'GET /json/messages/<id>: 2 requests, 6.000s total, '
+                                       '3.000s avg, 4.000s max, 0.000s markdown')
+            self.assertIn('6q  SELECT * FROM zerver_message WHERE id = ?', lines[1])
+            self.assertIn('4 cache get user_profile_by_id:*', lines[2])
+            self.assertTrue(lines[3].startswith('GET /json/users: 1 requests'))
+
+            with patch('builtins.print') as mock_print:
+                call_command(self.COMMAND_NAME, '--log-path=' + log_path, '--endpoint=users')
+            lines = [args[0] for args, kwargs in mock_print.call_args_list]
+            self.assertEqual(len(lines), 3)
+            self.assertTrue(lines[0].startswith('GET /json/users'))
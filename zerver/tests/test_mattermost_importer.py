@@ -568,10 +568,13 @@ class MatterMostImporter(ZulipTestCase):
         mattermost_data_dir = self.fixture_file_name("direct_channel", "mattermost_fixtures")
         output_dir = self.make_import_output_dir("mattermost")
 
+        # The channel posts and direct posts are converted as two
+        # chunks, in parallel.
         do_convert_data(
             mattermost_data_dir=mattermost_data_dir,
             output_dir=output_dir,
-            masking_content=False
+            masking_content=False,
+            threads=2,
         )
 
         harry_team_output_dir = self.team_output_dir(output_dir, "gryffindor")
@@ -1,15 +1,23 @@
 import time
-from typing import List
+from typing import Any, Dict, List
+
+import ujson
 
 from bs4 import BeautifulSoup
 from django.conf import settings
 from django.test import override_settings
 from unittest.mock import Mock, patch
 from zerver.lib.actions import create_stream_if_needed
+from zerver.lib.query_budget import QueryBudget, get_query_budget_violations, \
+    get_view_query_budget, pop_query_budget_violations
 from zerver.lib.realm_icon import get_realm_icon_url
+from zerver.lib.request_profile import cache_key_family, fingerprint_sql, record_sql
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.middleware import is_slow_query, write_log_line
+from zerver.middleware import is_slow_query, record_request_restart_data, \
+    record_request_start_data, record_request_stop_data, write_log_line
 from zerver.models import get_realm, get_system_bot
+from zerver.views.home import home
+from zerver.views.messages import get_messages_backend
 
 class SlowQueryTest(ZulipTestCase):
     SLOW_QUERY_TIME = 10
@@ -59,6 +67,122 @@ class SlowQueryTest(ZulipTestCase):
                        remote_ip='123.456.789.012', email='unknown', client_name='?')
         mock_internal_send_stream_message.assert_not_called()
 
+class RequestProfileTest(ZulipTestCase):
+    def test_fingerprint_sql(self) -> None:
+        self.assertEqual(
+            fingerprint_sql(b"SELECT id FROM zerver_message\n  WHERE id IN (1, 2, 3) AND subject = 'it''s'"),
+            "SELECT id FROM zerver_message WHERE id IN (...) AND subject = ?")
+        self.assertEqual(
+            fingerprint_sql('UPDATE zerver_usermessage SET flags = %s WHERE id = %(id)s LIMIT 21'),
+            'UPDATE zerver_usermessage SET flags = ? WHERE id = ? LIMIT ?')
+        self.assertEqual(fingerprint_sql('SELECT "zerver_stream"."id" FROM "zerver_stream"'),
+                         'SELECT "zerver_stream"."id" FROM "zerver_stream"')
+
+    def test_cache_key_family(self) -> None:
+        self.assertEqual(cache_key_family('user_profile_by_id:42'), 'user_profile_by_id:*')
+        self.assertEqual(cache_key_family('bulk_message_users:0123456789abcdef0123'),
+                         'bulk_message_users:*')
+
+    def test_unsampled_request(self) -> None:
+        self.login(self.example_email('hamlet'))
+        with patch('zerver.lib.request_profile.logger.info') as mock_info:
+            self.client_get('/json/users')
+        mock_info.assert_not_called()
+
+    @override_settings(REQUEST_PROFILE_SAMPLE_RATE=1.0,
+                       REQUEST_PROFILE_SLOW_THRESHOLD_SECONDS=0.0)
+    def test_sampled_request(self) -> None:
+        self.login(self.example_email('hamlet'))
+        with patch('zerver.lib.request_profile.logger.info') as mock_info:
+            result = self.client_get('/json/users')
+        self.assert_json_success(result)
+        mock_info.assert_called_once()
+        profile = ujson.loads(mock_info.call_args[0][0])
+        self.assertEqual(profile['path'], '/json/users')
+        self.assertEqual(profile['method'], 'GET')
+        self.assertEqual(profile['status_code'], 200)
+        self.assertTrue(profile['sql'])
+        for query in profile['sql']:
+            self.assertNotIn('hamlet', query['query'])
+        self.assertIn('get', profile['cache'])
+        self.assertEqual(profile['markdown'], dict(count=0, time=0.0))
+
+    @override_settings(REQUEST_PROFILE_SAMPLE_RATE=1.0)
+    def test_fast_request_not_logged(self) -> None:
+        self.login(self.example_email('hamlet'))
+        with patch('zerver.lib.request_profile.logger.info') as mock_info:
+            self.client_get('/json/users')
+        mock_info.assert_not_called()
+
+class QueryBudgetTest(ZulipTestCase):
+    def test_get_query_budget_violations(self) -> None:
+        queries = [dict(time='0.001', fingerprint='SELECT * FROM zerver_stream WHERE id = ?')
+                   for i in range(4)]
+        queries.append(dict(time='0.001', fingerprint='SELECT * FROM zerver_realm'))
+        self.assertEqual(get_query_budget_violations(queries, QueryBudget(5, 4)), [])
+        self.assertEqual(get_query_budget_violations(queries, QueryBudget(4, 3)), [
+            '5 queries, over its budget of 4',
+            '4 repeats of SELECT * FROM zerver_stream WHERE id = ?',
+        ])
+
+    def test_view_query_budget(self) -> None:
+        self.assertEqual(get_view_query_budget(home).max_queries, 45)
+        self.assertEqual(get_view_query_budget(get_messages_backend).max_queries, 20)
+        budget = get_view_query_budget(lambda request: None)
+        self.assertEqual(budget.max_queries, settings.QUERY_BUDGET_DEFAULT_MAX_QUERIES)
+        self.assertIsNone(budget.max_repeats)
+
+    def test_disabled(self) -> None:
+        self.login(self.example_email('hamlet'))
+        with patch('zerver.lib.query_budget.logger.warning') as mock_warning:
+            self.client_get('/json/users')
+        mock_warning.assert_not_called()
+
+    @override_settings(QUERY_BUDGET_MODE='warn', QUERY_BUDGET_DEFAULT_MAX_QUERIES=1)
+    def test_warn_mode(self) -> None:
+        self.login(self.example_email('hamlet'))
+        with patch('zerver.lib.query_budget.logger.warning') as mock_warning:
+            result = self.client_get('/json/users')
+        self.assert_json_success(result)
+        mock_warning.assert_called_once()
+        self.assertRegex(mock_warning.call_args[0][0],
+                         r'^Query budget exceeded by GET /json/users: \d+ queries, '
+                         r'over its budget of 1')
+
+    @override_settings(QUERY_BUDGET_MODE='fail', QUERY_BUDGET_MAX_REPEATS=0)
+    def test_fail_mode(self) -> None:
+        self.login(self.example_email('hamlet'))
+        result = self.client_get('/json/users')
+        # The response is unaffected; tearDown fails the test instead.
+        self.assert_json_success(result)
+        violations = pop_query_budget_violations()
+        self.assert_length(violations, 1)
+        self.assertRegex(violations[0], r'^Query budget exceeded by GET /json/users: '
+                                        r'\d+ repeats of SELECT ')
+
+    @override_settings(REQUEST_PROFILE_SAMPLE_RATE=1.0)
+    def test_interleaved_requests(self) -> None:
+        # Tornado runs other requests while a long-polling request
+        # waits for events; their queries belong to their own profiles.
+        polling_log_data = dict()  # type: Dict[str, Any]
+        record_request_start_data(polling_log_data)
+        record_sql('SELECT 1', 0.1)
+        record_request_stop_data(polling_log_data)
+
+        other_log_data = dict()  # type: Dict[str, Any]
+        record_request_start_data(other_log_data)
+        record_sql('SELECT 2', 0.1)
+        record_request_stop_data(other_log_data)
+        record_sql('SELECT 3', 0.1)
+
+        record_request_restart_data(polling_log_data)
+        record_sql('SELECT 4', 0.1)
+        record_request_stop_data(polling_log_data)
+
+        self.assertEqual(set(polling_log_data['request_profile'].sql), {'SELECT ?'})
+        self.assertEqual(polling_log_data['request_profile'].sql['SELECT ?'][0], 2)
+        self.assertEqual(other_log_data['request_profile'].sql['SELECT ?'][0], 1)
+
 class OpenGraphTest(ZulipTestCase):
     def check_title_and_description(self, path: str, title: str,
                                     in_description: List[str],
@@ -23,6 +23,8 @@ from zerver.lib.message import (
 )
 from zerver.lib.narrow import (
     build_narrow_filter,
+    build_narrow_index_key,
+    get_narrow_index_keys_for_message,
     is_web_public_compatible,
 )
 from zerver.lib.request import JsonableError
@@ -451,6 +453,28 @@ class NarrowLibraryTest(TestCase):
             for e in reject_events:
                 self.assertFalse(narrow_filter(e))
 
+    def test_build_narrow_index_key(self) -> None:
+        self.assertEqual(build_narrow_index_key([]), ("all",))
+        self.assertEqual(build_narrow_index_key([["is", "unread"]]), ("all",))
+        self.assertEqual(build_narrow_index_key([["stream", "Denmark"]]),
+                         ("stream", "denmark"))
+        self.assertEqual(build_narrow_index_key([["topic", "Lunch"], ["stream", "Denmark"]]),
+                         ("stream_topic", "denmark", "lunch"))
+        self.assertEqual(build_narrow_index_key([["topic", "Lunch"]]), ("topic", "lunch"))
+        self.assertEqual(build_narrow_index_key([["sender", "Hamlet@zulip.com"]]),
+                         ("sender", "hamlet@zulip.com"))
+        self.assertEqual(build_narrow_index_key([["stream", "Denmark"], ["is", "private"]]), None)
+        self.assertEqual(build_narrow_index_key([["is", "starred"]]), None)
+
+        keys = get_narrow_index_keys_for_message("Denmark", "Lunch", "Hamlet@zulip.com")
+        for narrow in [[], [["stream", "denmark"]], [["topic", "LUNCH"]],
+                       [["stream", "Denmark"], ["topic", "lunch"], ["sender", "hamlet@zulip.com"]],
+                       [["sender", "hamlet@zulip.com"]]]:
+            self.assertIn(build_narrow_index_key(narrow), keys)
+        for narrow in [[["stream", "Verona"]], [["stream", "Denmark"], ["topic", "dinner"]],
+                       [["sender", "othello@zulip.com"]]]:
+            self.assertNotIn(build_narrow_index_key(narrow), keys)
+
     def test_build_narrow_filter_invalid(self) -> None:
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
@@ -4,18 +4,23 @@ import ujson
 import logging
 import mock
 import requests
+import time
 
 from typing import Any, Optional
 
 from zerver.lib.outgoing_webhook import (
     do_rest_call,
+    do_rest_calls,
     GenericOutgoingWebhookService,
     SlackOutgoingWebhookService,
+    MAX_REQUESTS_PER_SERVICE_PER_BATCH,
+    RETRY_BASE_DELAY_SECONDS,
 )
 
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.topic import TOPIC_NAME
 from zerver.models import get_realm, get_user, UserProfile, get_display_recipient
+from zerver.worker.queue_processors import OutgoingWebhookWorker
 
 from version import ZULIP_VERSION
 
@@ -61,13 +66,13 @@ class DoRestCallTests(ZulipTestCase):
     @mock.patch('zerver.lib.outgoing_webhook.send_response_message')
     def test_successful_request(self, mock_send: mock.Mock) -> None:
         response = ResponseMock(200, dict(content='whatever'))
-        with mock.patch('requests.request', return_value=response):
+        with mock.patch('requests.Session.request', return_value=response):
             do_rest_call('', None, self.mock_event, service_handler)
             self.assertTrue(mock_send.called)
 
         for service_class in [GenericOutgoingWebhookService, SlackOutgoingWebhookService]:
             handler = service_class(None, None, None)
-            with mock.patch('requests.request', return_value=response):
+            with mock.patch('requests.Session.request', return_value=response):
                 do_rest_call('', None, self.mock_event, handler)
                 self.assertTrue(mock_send.called)
 
@@ -75,7 +80,7 @@ class DoRestCallTests(ZulipTestCase):
         response = ResponseMock(500)
 
         self.mock_event['failed_tries'] = 3
-        with mock.patch('requests.request', return_value=response):
+        with mock.patch('requests.Session.request', return_value=response):
             do_rest_call('',  None, self.mock_event, service_handler)
             bot_owner_notification = self.get_last_message()
             self.assertEqual(bot_owner_notification.content,
@@ -87,7 +92,7 @@ The webhook got a response with status code *500*.''')
     @mock.patch('zerver.lib.outgoing_webhook.fail_with_message')
     def test_fail_request(self, mock_fail_with_message: mock.Mock) -> None:
         response = ResponseMock(400)
-        with mock.patch('requests.request', return_value=response):
+        with mock.patch('requests.Session.request', return_value=response):
             do_rest_call('', None, self.mock_event, service_handler)
             bot_owner_notification = self.get_last_message()
             self.assertTrue(mock_fail_with_message.called)
@@ -97,7 +102,7 @@ The webhook got a response with status code *400*.''')
             self.assertEqual(bot_owner_notification.recipient_id, self.bot_user.bot_owner.id)
 
     def test_headers(self) -> None:
-        with mock.patch('requests.request') as mock_request:
+        with mock.patch('requests.Session.request') as mock_request:
             do_rest_call('', 'payload-stub', self.mock_event, service_handler)
             kwargs = mock_request.call_args[1]
             self.assertEqual(kwargs['data'], 'payload-stub')
@@ -108,11 +113,12 @@ The webhook got a response with status code *400*.''')
                 'User-Agent': user_agent,
             }
             self.assertEqual(kwargs['headers'], headers)
+            self.assertEqual(kwargs['timeout'], 10)
 
     def test_error_handling(self) -> None:
         def helper(side_effect: Any, error_text: str) -> None:
             with mock.patch('logging.info'):
-                with mock.patch('requests.request', side_effect=side_effect):
+                with mock.patch('requests.Session.request', side_effect=side_effect):
                     do_rest_call('', None, self.mock_event, service_handler)
                     bot_owner_notification = self.get_last_message()
                     self.assertIn(error_text, bot_owner_notification.content)
@@ -122,8 +128,39 @@ The webhook got a response with status code *400*.''')
         helper(side_effect=timeout_error, error_text='A timeout occurred.')
         helper(side_effect=connection_error, error_text='A connection error occurred.')
 
+    def test_retry_delay(self) -> None:
+        self.mock_event['failed_tries'] = 1
+        with mock.patch('logging.info'), \
+                mock.patch('requests.Session.request', side_effect=timeout_error), \
+                mock.patch('zerver.lib.outgoing_webhook.retry_event') as mock_retry:
+            do_rest_call('', None, self.mock_event, service_handler)
+        mock_retry.assert_called_once()
+        # The delay doubles with each failure.
+        retry_in = mock_retry.call_args[0][1]['retry_at'] - time.time()
+        self.assertGreater(retry_in, RETRY_BASE_DELAY_SECONDS)
+        self.assertLessEqual(retry_in, 2 * RETRY_BASE_DELAY_SECONDS)
+
+    def test_do_rest_calls_concurrently(self) -> None:
+        calls = [(base_url, 'payload-%d' % (i,), self.mock_event, service_handler)
+                 for base_url in ['http://slow.example.com', 'http://fast.example.com']
+                 for i in range(3)]
+        with mock.patch('zerver.lib.outgoing_webhook.do_rest_call') as mock_call:
+            do_rest_calls(calls)
+        self.assertEqual(sorted(call[0] for call in mock_call.call_args_list), sorted(calls))
+
+    def test_worker_holds_retries_until_due(self) -> None:
+        event = dict(self.mock_event, retry_at=time.time() + 60)
+        worker = OutgoingWebhookWorker()
+        with mock.patch('zerver.worker.queue_processors.queue_json_publish') as mock_publish, \
+                mock.patch('zerver.worker.queue_processors.do_rest_calls') as mock_calls, \
+                mock.patch('time.sleep'):
+            worker.consume_batch([event])
+        mock_publish.assert_called_once()
+        self.assertEqual(mock_publish.call_args[0][:2], ('outgoing_webhooks', event))
+        mock_calls.assert_called_once_with([])
+
     @mock.patch('logging.exception')
-    @mock.patch('requests.request', side_effect=request_exception_error)
+    @mock.patch('requests.Session.request', side_effect=request_exception_error)
     @mock.patch('zerver.lib.outgoing_webhook.fail_with_message')
     def test_request_exception(self, mock_fail_with_message: mock.Mock,
                                mock_requests_request: mock.Mock, mock_logger: mock.Mock) -> None:
@@ -147,7 +184,30 @@ class TestOutgoingWebhookMessaging(ZulipTestCase):
                                                 bot_type=UserProfile.OUTGOING_WEBHOOK_BOT,
                                                 service_name='foo-service')
 
-    @mock.patch('requests.request', return_value=ResponseMock(200, {"response_string": "Hidley ho, I'm a webhook responding!"}))
+    def test_worker_defers_requests_beyond_batch_limit(self) -> None:
+        events = []
+        for i in range(MAX_REQUESTS_PER_SERVICE_PER_BATCH + 1):
+            with mock.patch('zerver.lib.actions.queue_json_publish') as mock_publish:
+                self.send_personal_message(self.user_profile.email, self.bot_profile.email,
+                                           content="foo %d" % (i,))
+            events.extend(call[0][1] for call in mock_publish.call_args_list
+                          if call[0][0] == 'outgoing_webhooks')
+
+        worker = OutgoingWebhookWorker()
+        with mock.patch('zerver.worker.queue_processors.queue_json_publish') as mock_publish, \
+                mock.patch('zerver.worker.queue_processors.do_rest_calls') as mock_calls:
+            worker.consume_batch(events)
+            self.assert_length(mock_calls.call_args[0][0], MAX_REQUESTS_PER_SERVICE_PER_BATCH)
+            mock_publish.assert_called_once()
+            deferred_event = mock_publish.call_args[0][1]
+            self.assertEqual(deferred_event['command'], "foo %d" % (MAX_REQUESTS_PER_SERVICE_PER_BATCH,))
+            self.assertEqual(deferred_event['service_name'], 'foo-service')
+
+            worker.consume_batch([deferred_event])
+            self.assert_length(mock_calls.call_args[0][0], 1)
+            mock_publish.assert_called_once()
+
+    @mock.patch('requests.Session.request', return_value=ResponseMock(200, {"response_string": "Hidley ho, I'm a webhook responding!"}))
     def test_pm_to_outgoing_webhook_bot(self, mock_requests_request: mock.Mock) -> None:
         self.send_personal_message(self.user_profile.email, self.bot_profile.email,
                                    content="foo")
@@ -161,7 +221,7 @@ class TestOutgoingWebhookMessaging(ZulipTestCase):
         self.assert_length(display_recipient, 1)  # type: ignore
         self.assertEqual(display_recipient[0]['email'], self.user_profile.email)   # type: ignore
 
-    @mock.patch('requests.request', return_value=ResponseMock(200, {"response_string": "Hidley ho, I'm a webhook responding!"}))
+    @mock.patch('requests.Session.request', return_value=ResponseMock(200, {"response_string": "Hidley ho, I'm a webhook responding!"}))
     def test_stream_message_to_outgoing_webhook_bot(self, mock_requests_request: mock.Mock) -> None:
         self.send_stream_message(self.user_profile.email, "Denmark",
                                  content="@**{}** foo".format(self.bot_profile.full_name),
@@ -5,7 +5,9 @@ from django.utils.timezone import now as timezone_now
 import mock
 
 from typing import Any, Dict
+from analytics.views import activity_pages_cache_key
 from zerver.lib.actions import do_deactivate_user
+from zerver.lib.cache import cache_delete
 from zerver.lib.presence import (
     get_status_dict_by_realm
 )
@@ -33,6 +35,11 @@ from zerver.models import (
 import datetime
 
 class ActivityTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # Other tests may have left the activity pages in the cache.
+        cache_delete(activity_pages_cache_key())
+
     @mock.patch("stripe.Customer.list", return_value=[])
     def test_activity(self, unused_mock: mock.Mock) -> None:
         self.login(self.example_email("hamlet"))
@@ -64,6 +71,19 @@ class ActivityTest(ZulipTestCase):
 
         self.assert_length(queries, 14)
 
+        # The activity pages are cached, unless a refresh is requested.
+        flush_per_request_caches()
+        with queries_captured() as cached_queries:
+            result = self.client_get('/activity')
+            self.assertEqual(result.status_code, 200)
+        self.assertLess(len(cached_queries), len(queries))
+
+        flush_per_request_caches()
+        with queries_captured() as refreshed_queries:
+            result = self.client_get('/activity', {'refresh': 'true'})
+            self.assertEqual(result.status_code, 200)
+        self.assert_length(refreshed_queries, 14)
+
         flush_per_request_caches()
         with queries_captured() as queries:
             result = self.client_get('/realm_activity/zulip/')
@@ -1,11 +1,13 @@
 import mock
-from typing import Any, Dict
+import os
+import tempfile
+from typing import Any, Dict, List
 
 from django.test import override_settings
 from pika.exceptions import ConnectionClosed, AMQPConnectionError
 
-from zerver.lib.queue import TornadoQueueClient, queue_json_publish, \
-    get_queue_client
+from zerver.lib.queue import LocalQueueClient, TornadoLocalQueueClient, \
+    TornadoQueueClient, queue_json_publish, get_queue_client
 from zerver.lib.test_classes import ZulipTestCase
 
 class TestTornadoQueueClient(ZulipTestCase):
@@ -19,7 +21,7 @@ class TestTornadoQueueClient(ZulipTestCase):
 
 
 class TestQueueImplementation(ZulipTestCase):
-    @override_settings(USING_RABBITMQ=True)
+    @override_settings(USING_QUEUE_WORKERS=True)
     def test_queue_basics(self) -> None:
         queue_client = get_queue_client()
         queue_client.publish("test_suite", 'test_event')
@@ -28,7 +30,7 @@ class TestQueueImplementation(ZulipTestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0], b'test_event')
 
-    @override_settings(USING_RABBITMQ=True)
+    @override_settings(USING_QUEUE_WORKERS=True)
     def test_queue_basics_json(self) -> None:
         queue_json_publish("test_suite", {"event": "my_event"})
 
@@ -37,7 +39,7 @@ class TestQueueImplementation(ZulipTestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]['event'], 'my_event')
 
-    @override_settings(USING_RABBITMQ=True)
+    @override_settings(USING_QUEUE_WORKERS=True)
     def test_register_consumer(self) -> None:
         output = []
 
@@ -55,7 +57,7 @@ class TestQueueImplementation(ZulipTestCase):
         self.assertEqual(len(output), 1)
         self.assertEqual(output[0]['event'], 'my_event')
 
-    @override_settings(USING_RABBITMQ=True)
+    @override_settings(USING_QUEUE_WORKERS=True)
     def test_register_consumer_nack(self) -> None:
         output = []
         count = 0
@@ -84,7 +86,7 @@ class TestQueueImplementation(ZulipTestCase):
         self.assertEqual(len(output), 1)
         self.assertEqual(output[0]['event'], 'my_event')
 
-    @override_settings(USING_RABBITMQ=True)
+    @override_settings(USING_QUEUE_WORKERS=True)
     def test_queue_error_json(self) -> None:
         queue_client = get_queue_client()
         actual_publish = queue_client.publish
@@ -106,8 +108,140 @@ class TestQueueImplementation(ZulipTestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]['event'], 'my_event')
 
-    @override_settings(USING_RABBITMQ=True)
+    @override_settings(USING_QUEUE_WORKERS=True)
     def tearDown(self) -> None:
         queue_client = get_queue_client()
         queue_client.drain_queue("test_suite")
         super().tearDown()
+
+class TestLocalQueueClient(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, 'queue.sqlite3')
+        self.queue_client = LocalQueueClient(self.db_path)
+
+    def tearDown(self) -> None:
+        self.queue_client.close()
+        self.tmpdir.cleanup()
+        super().tearDown()
+
+    def test_queue_basics(self) -> None:
+        self.queue_client.publish("test_suite", 'test_event')
+        self.queue_client.json_publish("other_queue", {"event": "other"})
+
+        result = self.queue_client.drain_queue("test_suite")
+        self.assertEqual(result, [b'test_event'])
+        self.assertEqual(self.queue_client.drain_queue("test_suite"), [])
+
+        result = self.queue_client.drain_queue("other_queue", json=True)
+        self.assertEqual(result, [{"event": "other"}])
+
+    def test_offsets_shared_between_clients(self) -> None:
+        for i in range(5):
+            self.queue_client.json_publish("test_suite", {"event": i})
+
+        other_client = LocalQueueClient(self.db_path)
+        other_client.BATCH_SIZE = 2
+        output = []  # type: List[Dict[str, Any]]
+        other_client.register_json_consumer("test_suite", output.append)
+        self.assertEqual(other_client.consume_pending("test_suite"), 2)
+        other_client.close()
+
+        result = self.queue_client.drain_queue("test_suite", json=True)
+        self.assertEqual([event['event'] for event in output], [0, 1])
+        self.assertEqual([event['event'] for event in result], [2, 3, 4])
+
+    def test_register_consumer(self) -> None:
+        output = []  # type: List[Dict[str, Any]]
+
+        def collect(event: Dict[str, Any]) -> None:
+            output.append(event)
+            self.queue_client.stop_consuming()
+
+        self.queue_client.register_json_consumer("test_suite", collect)
+        self.queue_client.json_publish("test_suite", {"event": "my_event"})
+        self.queue_client.start_consuming()
+
+        self.assertEqual(output, [{"event": "my_event"}])
+
+    def test_consumer_failure_requeues(self) -> None:
+        count = 0
+
+        def fail_once(event: Dict[str, Any]) -> None:
+            nonlocal count
+            count += 1
+            if count == 1:
+                raise Exception("Make me requeue!")
+
+        self.queue_client.register_json_consumer("test_suite", fail_once)
+        self.queue_client.json_publish("test_suite", {"event": 1})
+        self.queue_client.json_publish("test_suite", {"event": 2})
+        with self.assertRaises(Exception):
+            self.queue_client.consume_pending("test_suite")
+        self.assertEqual(self.queue_client.consume_pending("test_suite"), 2)
+        self.assertEqual(count, 3)
+
+    def test_expired_claims_requeued(self) -> None:
+        for i in range(3):
+            self.queue_client.json_publish("test_suite", {"event": i})
+
+        # A consumer that dies after claiming a batch.
+        other_client = LocalQueueClient(self.db_path)
+        other_client.LEASE_SECS = -1
+        other_client._claim("test_suite", 2, lease=True)
+        other_client.close()
+
+        output = []  # type: List[Dict[str, Any]]
+        self.queue_client.register_json_consumer("test_suite", output.append)
+        with mock.patch.object(self.queue_client.log, 'warning'):
+            self.assertEqual(self.queue_client.consume_pending("test_suite"), 3)
+        self.assertEqual(sorted(event['event'] for event in output), [0, 1, 2])
+        self.assertEqual(self.queue_client.consume_pending("test_suite"), 0)
+
+    def test_idle_consumer_does_not_lock(self) -> None:
+        statements = []  # type: List[str]
+        self.queue_client.connection.set_trace_callback(statements.append)
+        self.queue_client.register_json_consumer("test_suite", lambda event: None)
+        self.assertEqual(self.queue_client.consume_pending("test_suite"), 0)
+        self.assertFalse([sql for sql in statements if 'BEGIN' in sql])
+
+    def test_tornado_client_delivers_on_ioloop(self) -> None:
+        tornado_client = TornadoLocalQueueClient(self.db_path)
+        output = []  # type: List[Dict[str, Any]]
+        with mock.patch('zerver.lib.queue.threading.Thread') as mock_thread:
+            tornado_client.register_json_consumer("test_suite", output.append)
+        mock_thread.return_value.start.assert_called_once()
+
+        # The polling thread claims messages with its own connection,
+        # and only the consumers run on the ioloop.
+        io_loop = mock.Mock()
+        io_loop.add_callback.side_effect = lambda callback: callback()
+        tornado_client._io_loop = io_loop
+        self.queue_client.json_publish("test_suite", {"event": 1})
+        self.assertEqual(tornado_client._consume_pending_on_ioloop(self.queue_client, "test_suite"), 1)
+        io_loop.add_callback.assert_called_once()
+        self.assertEqual(output, [{"event": 1}])
+        self.assertEqual(tornado_client._consume_pending_on_ioloop(self.queue_client, "test_suite"), 0)
+        tornado_client.close()
+
+    def test_trim_consumed_messages(self) -> None:
+        self.queue_client.TRIM_THRESHOLD = 3
+        for i in range(5):
+            self.queue_client.json_publish("test_suite", {"event": i})
+        self.queue_client.drain_queue("test_suite")
+        (remaining,) = self.queue_client.connection.execute(
+            "SELECT COUNT(*) FROM queue_message").fetchone()
+        self.assertEqual(remaining, 0)
+
+    @override_settings(USING_QUEUE_WORKERS=True, QUEUE_BACKEND='local')
+    def test_get_queue_client(self) -> None:
+        with override_settings(LOCAL_QUEUE_DB_PATH=self.db_path), \
+                mock.patch('zerver.lib.queue.queue_client', None):
+            queue_json_publish("test_suite", {"event": "my_event"})
+            queue_client = get_queue_client()
+            self.assertIsInstance(queue_client, LocalQueueClient)
+            queue_client.close()
+
+        result = self.queue_client.drain_queue("test_suite", json=True)
+        self.assertEqual(result, [{"event": "my_event"}])
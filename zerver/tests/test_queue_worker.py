@@ -7,7 +7,7 @@ import re
 from django.conf import settings
 from django.test import override_settings
 from mock import patch, MagicMock
-from typing import Any, Callable, Dict, List, Mapping, Tuple
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
 from zerver.lib.actions import create_stream_if_needed
 from zerver.lib.email_mirror import RateLimitedRealmMirror
@@ -63,18 +63,19 @@ class WorkerTest(ZulipTestCase):
                 callback(data)
             self.queue = []
 
-        def drain_queue(self, queue_name: str, json: bool) -> List[Event]:
+        def drain_queue(self, queue_name: str, json: bool,
+                        limit: Optional[int]=None) -> List[Event]:
             assert json
             events = [
                 dct
                 for (queue_name, dct)
-                in self.queue
+                in self.queue[:limit]
             ]
 
             # IMPORTANT!
             # This next line prevents us from double draining
             # queues, which was a bug at one point.
-            self.queue = []
+            self.queue = self.queue[len(events):]
 
             return events
 
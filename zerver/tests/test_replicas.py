@@ -0,0 +1,87 @@
+import mock
+
+from typing import List
+
+from django.db import DEFAULT_DB_ALIAS
+
+from zerver.lib import replicas
+from zerver.lib.export import launch_user_message_subprocesses
+from zerver.lib.replicas import ReplicaRouter, choose_replica, get_current_replica, \
+    read_replica, use_replica, user_recently_wrote
+from zerver.lib.test_classes import ZulipTestCase
+
+class ReplicaRoutingTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        replicas.replica_lag.clear()
+
+    def test_choose_replica(self) -> None:
+        hamlet = self.example_user('hamlet')
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertIsNone(choose_replica(hamlet.id))
+
+        lags = {'replica0': 1.0, 'replica1': 60.0, 'replica2': None}
+        with self.settings(DATABASE_REPLICAS=['replica0', 'replica1', 'replica2'],
+                           DATABASE_REPLICA_MAX_LAG_SECONDS=10), \
+                mock.patch('zerver.lib.replicas.check_replica_lag',
+                           side_effect=lambda alias: lags[alias]) as mock_check:
+            self.assertEqual(choose_replica(), 'replica0')
+            self.assertEqual(choose_replica(hamlet.id), 'replica0')
+            # Lag is only checked every REPLICA_LAG_CHECK_INTERVAL seconds.
+            self.assertEqual(mock_check.call_count, 3)
+
+            replicas.replica_lag.clear()
+            lags['replica0'] = 30.0
+            self.assertIsNone(choose_replica())
+
+    def test_read_your_writes(self) -> None:
+        hamlet = self.example_user('hamlet')
+        with self.settings(DATABASE_REPLICAS=['replica0']), \
+                mock.patch('zerver.lib.replicas.check_replica_lag', return_value=0.0):
+            self.assertFalse(user_recently_wrote(hamlet.id))
+            self.assertEqual(choose_replica(hamlet.id), 'replica0')
+
+            result = self.api_post(hamlet.email, "/api/v1/messages", {
+                "type": "private",
+                "content": "Test message",
+                "to": self.example_email("othello"),
+            })
+            self.assert_json_success(result)
+            self.assertTrue(user_recently_wrote(hamlet.id))
+            self.assertIsNone(choose_replica(hamlet.id))
+            self.assertEqual(choose_replica(self.example_user('othello').id), 'replica0')
+
+    def test_router(self) -> None:
+        router = ReplicaRouter()
+        default_connection = mock.MagicMock(in_atomic_block=False)
+        self.assertEqual(router.db_for_read(None), DEFAULT_DB_ALIAS)
+        with mock.patch('zerver.lib.replicas.connections', {DEFAULT_DB_ALIAS: default_connection}), \
+                mock.patch('zerver.lib.replicas.choose_replica', return_value='replica0'):
+            with read_replica():
+                self.assertEqual(router.db_for_read(None), 'replica0')
+                self.assertEqual(router.db_for_write(None), DEFAULT_DB_ALIAS)
+            self.assertIsNone(get_current_replica())
+
+            # Not inside transactions, which may have unreplicated writes.
+            default_connection.in_atomic_block = True
+            with read_replica():
+                self.assertEqual(router.db_for_read(None), DEFAULT_DB_ALIAS)
+        self.assertFalse(router.allow_migrate('replica0', 'zerver'))
+        self.assertTrue(router.allow_migrate(DEFAULT_DB_ALIAS, 'zerver'))
+
+    def test_export_subprocesses_use_parent_replica(self) -> None:
+        def launch() -> List[List[str]]:
+            with mock.patch('subprocess.Popen') as mock_popen, \
+                    mock.patch('os.wait', return_value=(mock_popen.return_value.pid, 0)), \
+                    mock.patch('builtins.print'):
+                launch_user_message_subprocesses(threads=1, output_dir='/tmp/export')
+            return [call[0][0] for call in mock_popen.call_args_list]
+
+        [arguments] = launch()
+        self.assertNotIn('--replica', arguments)
+
+        with use_replica('replica0'):
+            self.assertEqual(get_current_replica(), 'replica0')
+            [arguments] = launch()
+        self.assertEqual(arguments[-2:], ['--replica', 'replica0'])
+        self.assertIsNone(get_current_replica())
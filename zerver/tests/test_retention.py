@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from unittest import mock
 
 from django.conf import settings
+from django.test import override_settings
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.actions import internal_send_private_message, do_add_submessage
@@ -18,6 +19,11 @@ from zerver.lib.retention import (
     move_messages_to_archive,
     restore_all_data_from_archive,
     clean_archived_data,
+    get_archiving_partitions,
+    get_next_chunk_size,
+    get_replication_lag,
+    wait_for_replication_lag,
+    ReplicationLagUnavailableError,
 )
 
 # Class with helper functions useful for testing archiving of reactions:
@@ -393,6 +399,69 @@ class TestArchiveMessagesGeneral(ArchiveMessagesTestingBase):
         for message in archived_messages:
             self.assertEqual(message.archive_transaction_id, transactions[2].id)
 
+    def test_archiving_partitions(self) -> None:
+        verona = get_stream('Verona', self.zulip_realm)
+        self._set_stream_message_retention_value(verona, 5)
+        self._set_realm_message_retention_value(self.mit_realm, None)
+
+        partitions = get_archiving_partitions([self.zulip_realm, self.mit_realm])
+        self.assertTrue(all(realm == self.zulip_realm for (realm, _, _) in partitions))
+        self.assertIn((self.zulip_realm, None, None), partitions)
+        self.assertIn((self.zulip_realm, verona.recipient, 5), partitions)
+
+        recipient_ids = [recipient.id for (_, recipient, _) in partitions if recipient is not None]
+        self.assertEqual(len(recipient_ids), len(set(recipient_ids)))
+        self.assertEqual(
+            set(recipient_ids),
+            set(Stream.objects.filter(realm=self.zulip_realm).values_list('recipient_id', flat=True))
+        )
+
+    def test_adaptive_chunk_size(self) -> None:
+        self.assertEqual(get_next_chunk_size(1000, 10.0), 1000)
+        with override_settings(RETENTION_TARGET_CHUNK_SECONDS=1.0):
+            self.assertEqual(get_next_chunk_size(1000, 1.25), 800)
+            self.assertEqual(get_next_chunk_size(1000, 10.0), 500)
+            self.assertEqual(get_next_chunk_size(1000, 0.1), 2000)
+            self.assertEqual(get_next_chunk_size(8000, 0.1), 10000)
+            self.assertEqual(get_next_chunk_size(150, 10.0), 100)
+
+    def test_replication_lag_throttling(self) -> None:
+        with mock.patch('zerver.lib.retention.get_replication_lag') as mock_lag:
+            wait_for_replication_lag()
+        mock_lag.assert_not_called()
+
+        with override_settings(RETENTION_MAX_REPLICATION_LAG_SECONDS=5), \
+                mock.patch('zerver.lib.retention.get_replication_lag', side_effect=[30.0, 2.0]), \
+                mock.patch('zerver.lib.retention.time.sleep') as mock_sleep:
+            wait_for_replication_lag()
+        mock_sleep.assert_called_once()
+
+        # An unknown lag isn't taken to be zero.
+        with override_settings(RETENTION_MAX_REPLICATION_LAG_SECONDS=5), \
+                mock.patch('zerver.lib.retention.get_replication_lag', side_effect=[None, 2.0]), \
+                mock.patch('zerver.lib.retention.logger.warning') as mock_warning, \
+                mock.patch('zerver.lib.retention.time.sleep') as mock_sleep:
+            wait_for_replication_lag()
+        mock_warning.assert_called_once()
+        mock_sleep.assert_called_once()
+
+    def test_get_replication_lag(self) -> None:
+        def mock_rows(rows: List[Tuple[Optional[str], Optional[float], Optional[bool]]]) -> Any:
+            cursor = mock.MagicMock()
+            cursor.__enter__.return_value.fetchall.return_value = rows
+            return mock.patch('zerver.lib.retention.connection.cursor', return_value=cursor)
+
+        with mock_rows([]):
+            self.assertEqual(get_replication_lag(), 0.0)
+        with mock_rows([('streaming', 1.5, False), ('streaming', None, True)]):
+            self.assertEqual(get_replication_lag(), 1.5)
+        with mock_rows([('streaming', None, False)]):
+            self.assertIsNone(get_replication_lag())
+        # Without pg_read_all_stats, postgres hides the replication state.
+        with mock_rows([(None, None, None)]):
+            with self.assertRaises(ReplicationLagUnavailableError):
+                get_replication_lag()
+
 class TestArchivingSubMessages(ArchiveMessagesTestingBase):
     def test_archiving_submessages(self) -> None:
         expired_msg_ids = self._make_expired_zulip_messages(2)
@@ -15,6 +15,7 @@ from zerver.lib.bot_lib import StateHandler, EmbeddedBotHandler, \
 from zerver.lib.bot_storage import StateError
 from zerver.lib.bot_config import set_bot_config, ConfigError, load_bot_config_template
 from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
 from zerver.models import (
     get_realm,
     UserProfile,
@@ -243,6 +244,24 @@ class TestServiceBotStateHandler(ZulipTestCase):
         second_storage.put('another big entry', 'x' * (settings.USER_STATE_SIZE_LIMIT - 40))
         second_storage.put('normal entry', 'abcd')
 
+    def test_batched_storage(self) -> None:
+        storage = StateHandler(self.bot_profile)
+        storage.put_many({'some key': 'some value', 'another key': ['a', 'list']})
+        storage.put_many({'some key': 'a new value'})
+
+        second_storage = StateHandler(self.bot_profile)
+        self.assertEqual(second_storage.get_many(['some key', 'another key']),
+                         {'some key': 'a new value', 'another key': ['a', 'list']})
+        self.assertRaisesMessage(StateError,
+                                 "Key does not exist.",
+                                 lambda: second_storage.get_many(['some key', 'nonexistent key']))
+
+        # Values already read or written are served from the cache.
+        with queries_captured() as queries:
+            self.assertEqual(second_storage.get('another key'), ['a', 'list'])
+            self.assertTrue(storage.contains('some key'))
+        self.assert_length(queries, 0)
+
     def test_entry_removal(self) -> None:
         storage = StateHandler(self.bot_profile)
         storage.put('some key', 'some value')
@@ -28,6 +28,9 @@ from zerver.data_import.import_util import (
     build_recipient,
     build_usermessages,
     build_defaultstream,
+    chunked,
+    convert_message_chunks,
+    CHUNK_ID_BLOCK_SIZE,
 )
 from zerver.data_import.sequencer import (
     NEXT_ID,
@@ -706,6 +709,39 @@ class SlackImporter(ZulipTestCase):
 
         self.assertEqual(test_reactions, reactions)
 
+    def test_convert_message_chunks_in_parallel(self) -> None:
+        output_dir = os.path.join(settings.TEST_WORKER_DIR, 'test-slack-import-parallel')
+        self.rm_tree(output_dir)
+        os.makedirs(output_dir)
+
+        def convert_chunk(chunk: List[ZerverFieldsT]) -> Tuple[ZerverFieldsT, Dict[str, List[Any]]]:
+            zerver_message = [dict(id=NEXT_ID('message'), content=message['text'])
+                              for message in chunk]
+            message_json = dict(zerver_message=zerver_message, zerver_usermessage=[])
+            return message_json, dict(texts=[message['text'] for message in chunk])
+
+        messages = [dict(text='message %d' % (i,)) for i in range(5)]
+        with mock.patch('logging.info'):
+            extras = convert_message_chunks(
+                chunks=chunked(iter(messages), 2),
+                convert_chunk=convert_chunk,
+                output_dir=output_dir,
+                id_sequences=['message'],
+                threads=2,
+            )
+        self.assertEqual(extras['texts'], [message['text'] for message in messages])
+
+        message_ids = []
+        for dump_file_id in [1, 2, 3]:
+            with open(os.path.join(output_dir, 'messages-%06d.json' % (dump_file_id,))) as f:
+                message_json = ujson.load(f)
+            ids = [message['id'] for message in message_json['zerver_message']]
+            self.assertEqual(ids[0], dump_file_id * CHUNK_ID_BLOCK_SIZE + 1)
+            message_ids += ids
+        self.assertEqual(len(set(message_ids)), 5)
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'messages-000004.json')))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'messages-000001.extra.json')))
+
     @mock.patch("zerver.data_import.slack.requests.get")
     @mock.patch("zerver.data_import.slack.process_uploads", return_value = [])
     @mock.patch("zerver.data_import.slack.build_attachment",
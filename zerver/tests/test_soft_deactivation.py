@@ -2,6 +2,8 @@
 
 import mock
 
+from typing import List
+
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.soft_deactivation import (
@@ -11,11 +13,14 @@ from zerver.lib.soft_deactivation import (
     do_soft_activate_users,
     get_soft_deactivated_users_for_catch_up,
     do_catch_up_soft_deactivated_users,
-    do_auto_soft_deactivate_users
+    do_auto_soft_deactivate_users,
+    bulk_add_missing_messages,
 )
 from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
 from zerver.models import (
-    Client, UserProfile, UserActivity, get_realm, UserMessage
+    Client, UserProfile, UserActivity, get_realm, UserMessage,
+    get_user_profile_by_id,
 )
 
 class UserSoftDeactivationTests(ZulipTestCase):
@@ -51,6 +56,24 @@ class UserSoftDeactivationTests(ZulipTestCase):
             user.refresh_from_db()
             self.assertTrue(user.long_term_idle)
 
+    def test_soft_deactivation_flushes_user_cache(self) -> None:
+        hamlet = self.example_user('hamlet')
+        iago = self.example_user('iago')
+        self.send_personal_message(iago.email, hamlet.email)
+        # Warm the cache.
+        self.assertFalse(get_user_profile_by_id(hamlet.id).long_term_idle)
+
+        with mock.patch('logging.info'):
+            do_soft_deactivate_users([hamlet])
+        self.assertTrue(get_user_profile_by_id(hamlet.id).long_term_idle)
+
+        message_id = self.send_stream_message(iago.email, 'Denmark')
+        self.assertNotEqual(get_user_profile_by_id(hamlet.id).last_active_message_id,
+                            message_id)
+        bulk_add_missing_messages([hamlet.id])
+        self.assertEqual(get_user_profile_by_id(hamlet.id).last_active_message_id,
+                         message_id)
+
     def test_get_users_for_soft_deactivation(self) -> None:
         users = [
             self.example_user('hamlet'),
@@ -151,6 +174,49 @@ class UserSoftDeactivationTests(ZulipTestCase):
             self.assertTrue(user.long_term_idle)
             self.assertEqual(user.last_active_message_id, message_id)
 
+    def test_bulk_add_missing_messages(self) -> None:
+        stream = 'Verona'
+        hamlet = self.example_user('hamlet')
+        iago = self.example_user('iago')
+        cordelia = self.example_user('cordelia')
+        for user in [hamlet, iago, cordelia]:
+            self.subscribe(user, stream)
+
+        with mock.patch('logging.info'):
+            do_soft_deactivate_users([iago, cordelia])
+
+        # cordelia misses the second message, having been unsubscribed
+        # while it was sent.
+        first_message_id = self.send_stream_message(hamlet.email, stream)
+        self.unsubscribe(cordelia, stream)
+        second_message_id = self.send_stream_message(hamlet.email, stream)
+        self.subscribe(cordelia, stream)
+        third_message_id = self.send_stream_message(hamlet.email, stream)
+        message_ids = [first_message_id, second_message_id, third_message_id]
+
+        def received_message_ids(user: UserProfile) -> List[int]:
+            return list(UserMessage.objects.filter(
+                user_profile=user, message_id__in=message_ids).order_by(
+                    'message_id').values_list('message_id', flat=True))
+
+        self.assertEqual(received_message_ids(iago), [])
+        self.assertEqual(received_message_ids(cordelia), [])
+
+        with queries_captured() as queries:
+            count = bulk_add_missing_messages([iago.id, cordelia.id])
+        # The bulk INSERT/UPDATE, plus fetching the users to flush their caches.
+        self.assert_length(queries, 2)
+        self.assertEqual(count, 5)
+        self.assertEqual(received_message_ids(iago), message_ids)
+        self.assertEqual(received_message_ids(cordelia),
+                         [first_message_id, third_message_id])
+        for user in [iago, cordelia]:
+            user.refresh_from_db()
+            self.assertEqual(user.last_active_message_id, third_message_id)
+
+        # Running it again is a no-op.
+        self.assertEqual(bulk_add_missing_messages([iago.id, cordelia.id]), 0)
+
     def test_do_auto_soft_deactivate_users(self) -> None:
         users = [
             self.example_user('iago'),
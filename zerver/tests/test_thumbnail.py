@@ -8,10 +8,14 @@ from zerver.lib.test_helpers import (
     override_settings,
     get_test_image_file
 )
-from zerver.lib.upload import upload_backend, upload_emoji_image
+from zerver.lib.upload import upload_backend, upload_emoji_image, delete_message_image, \
+    get_local_thumbnail_path, THUMBNAIL_CACHE_MAX_AGE
 from zerver.lib.users import get_api_key
+from zerver.models import Attachment
 
-from io import StringIO
+from io import BytesIO, StringIO
+from PIL import Image
+import os
 import ujson
 import urllib
 import base64
@@ -372,3 +376,88 @@ class ThumbnailTest(ZulipTestCase):
         # error message.
         result = self.client_get("/thumbnail?url=%s" % (quoted_uri,))
         self.assertEqual(result.status_code, 400, "Missing 'size' argument")
+
+    def test_pregenerated_thumbnails(self) -> None:
+        self.login(self.example_email("hamlet"))
+        fp = BytesIO()
+        Image.new('RGB', (400, 600)).save(fp, format='jpeg')
+        fp.seek(0)
+        fp.name = "tall.jpg"
+
+        with self.settings(PREGENERATE_THUMBNAILS=True):
+            result = self.client_post("/json/user_uploads", {'file': fp})
+        self.assert_json_success(result)
+        uri = ujson.loads(result.content)["uri"]
+        path_id = uri[len('/user_uploads/'):]
+        self.assertTrue(Attachment.objects.get(path_id=path_id).has_thumbnails)
+
+        thumbnail_path = get_local_thumbnail_path(path_id, 'thumbnail')
+        assert thumbnail_path is not None
+        # Stored under files/, so that sendfile can serve it.
+        self.assertTrue(thumbnail_path.startswith(os.path.join(settings.LOCAL_UPLOADS_DIR,
+                                                               'files', 'thumbnails')))
+        with open(thumbnail_path, 'rb') as f:
+            thumbnail_data = f.read()
+        thumbnail = Image.open(BytesIO(thumbnail_data))
+        self.assertEqual(thumbnail.size, (200, 300))
+        self.assertEqual(thumbnail.format, 'JPEG')
+
+        quoted_uri = urllib.parse.quote(uri[1:], safe='')
+        with self.settings(PREGENERATE_THUMBNAILS=True, THUMBOR_URL=''):
+            result = self.client_get("/thumbnail?url=%s&size=thumbnail" % (quoted_uri,))
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(b"".join(result.streaming_content), thumbnail_data)
+            self.assertIn('max-age=%d' % (THUMBNAIL_CACHE_MAX_AGE,), result['Cache-Control'])
+
+            # The full size image is just the original.
+            result = self.client_get("/thumbnail?url=%s&size=full" % (quoted_uri,))
+            self.assertEqual(result.status_code, 302, result)
+            self.assertEqual(uri, result.url)
+
+        # Deleting the upload deletes its thumbnails too.
+        delete_message_image(path_id)
+        self.assertIsNone(get_local_thumbnail_path(path_id, 'thumbnail'))
+
+    def test_pregenerated_thumbnails_not_image(self) -> None:
+        self.login(self.example_email("hamlet"))
+        fp = StringIO("zulip!")
+        fp.name = "zulip.jpeg"
+
+        with self.settings(PREGENERATE_THUMBNAILS=True):
+            result = self.client_post("/json/user_uploads", {'file': fp})
+        self.assert_json_success(result)
+        uri = ujson.loads(result.content)["uri"]
+        path_id = uri[len('/user_uploads/'):]
+        self.assertIsNone(get_local_thumbnail_path(path_id, 'thumbnail'))
+        self.assertFalse(Attachment.objects.get(path_id=path_id).has_thumbnails)
+
+        # Without a thumbnail, we fall back to thumbor.
+        quoted_uri = urllib.parse.quote(uri[1:], safe='')
+        with self.settings(PREGENERATE_THUMBNAILS=True):
+            result = self.client_get("/thumbnail?url=%s&size=thumbnail" % (quoted_uri,))
+        self.assertEqual(result.status_code, 302, result)
+        self.assertIn('/0x300/', result.url)
+
+    @use_s3_backend
+    def test_pregenerated_thumbnails_s3(self) -> None:
+        bucket = create_s3_buckets(settings.S3_AUTH_UPLOADS_BUCKET)[0]
+        self.login(self.example_email("hamlet"))
+        fp = BytesIO()
+        Image.new('RGB', (400, 600)).save(fp, format='png')
+        fp.seek(0)
+        fp.name = "tall.png"
+
+        with self.settings(PREGENERATE_THUMBNAILS=True):
+            result = self.client_post("/json/user_uploads", {'file': fp})
+        self.assert_json_success(result)
+        uri = ujson.loads(result.content)["uri"]
+        path_id = uri[len('/user_uploads/'):]
+        thumbnail_key = bucket.get_key("thumbnails/%s/thumbnail" % (path_id,))
+        self.assertIsNotNone(thumbnail_key)
+        self.assertEqual(thumbnail_key.content_type, 'image/png')
+
+        quoted_uri = urllib.parse.quote(uri[1:], safe='')
+        with self.settings(PREGENERATE_THUMBNAILS=True):
+            result = self.client_get("/thumbnail?url=%s&size=thumbnail" % (quoted_uri,))
+        self.assertEqual(result.status_code, 302, result)
+        self.assertIn("thumbnails/%s/thumbnail" % (path_id,), result.url)
@@ -119,3 +119,34 @@ class EventsTestCase(TornadoWebTestCase):
         self.assertEqual(len(events), 1)
         self.assertEqual(events[0]['data'], 'test data')
         self.assertEqual(data['result'], 'success')
+
+    def test_events_async_batched(self) -> None:
+        user_profile = self.example_user('hamlet')
+        self.login(user_profile.email)
+        event_queue_id = self.create_queue()
+        data = {
+            'queue_id': event_queue_id,
+            'last_event_id': -1,
+            'batch_window_msecs': 50,
+        }
+
+        path = '/json/events?{}'.format(urllib.parse.urlencode(data))
+        self.client_get_async(path)
+
+        def process_events() -> None:
+            users = [user_profile.id]
+            for i in range(2):
+                event = dict(
+                    type='test',
+                    data='test data %s' % (i,),
+                )
+                process_event(event, users)
+
+        self.io_loop.call_later(0.1, process_events)
+        response = self.wait()
+        data = ujson.loads(response.body)
+        events = data['events']
+        events = cast(List[Dict[str, Any]], events)
+        self.assertEqual([event['data'] for event in events],
+                         ['test data 0', 'test data 1'])
+        self.assertEqual(data['result'], 'success')
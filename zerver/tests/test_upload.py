@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from django.conf import settings
+from django.core.files import File
 from django.test import TestCase
 from unittest.mock import patch
 
@@ -24,7 +25,7 @@ from zerver.lib.upload import sanitize_name, S3UploadBackend, \
     ZulipUploadBackend, MEDIUM_AVATAR_SIZE, resize_avatar, \
     resize_emoji, BadImageError, get_realm_for_filename, \
     DEFAULT_AVATAR_SIZE, DEFAULT_EMOJI_SIZE, exif_rotate, \
-    upload_export_tarball, delete_export_tarball
+    upload_export_tarball, delete_export_tarball, upload_message_file_from_stream
 import zerver.lib.upload
 from zerver.models import Attachment, get_user, \
     Message, UserProfile, Realm, \
@@ -44,6 +45,7 @@ from zerver.lib.users import get_api_key
 
 from scripts.lib.zulip_tools import get_dev_uuid_var_path
 
+import boto.s3.multipart
 import urllib
 import ujson
 from PIL import Image
@@ -1516,6 +1518,36 @@ class S3Test(ZulipTestCase):
         self.send_stream_message(self.example_email("hamlet"), "Denmark", body, "test")
         self.assertIn('title="dummy.txt"', self.get_last_message().rendered_content)
 
+    @use_s3_backend
+    def test_file_upload_s3_from_stream(self) -> None:
+        bucket = create_s3_buckets(settings.S3_AUTH_UPLOADS_BUCKET)[0]
+        user_profile = self.example_user('hamlet')
+
+        uri = upload_message_file_from_stream(u'dummy.txt', u'text/plain',
+                                              File(io.BytesIO(b'zulip!')), user_profile)
+        path_id = re.sub('/user_uploads/', '', uri)
+        key = bucket.get_key(path_id)
+        self.assertEqual(b"zulip!", key.get_contents_as_string())
+        self.assertEqual(key.metadata["user_profile_id"], str(user_profile.id))
+        self.assertEqual(len(b"zulip!"), Attachment.objects.get(path_id=path_id).size)
+
+        # Files larger than a part are uploaded in several parts.
+        part_size = 5 * 1024 * 1024
+        data = b'z' * part_size + b'zulip!'
+        with mock.patch('zerver.lib.upload.S3_MULTIPART_CHUNK_SIZE', part_size), \
+                mock.patch('boto.s3.multipart.MultiPartUpload.upload_part_from_file',
+                           autospec=True,
+                           side_effect=boto.s3.multipart.MultiPartUpload.upload_part_from_file) \
+                as mock_upload_part:
+            uri = upload_message_file_from_stream(u'large.txt', u'text/plain',
+                                                  File(io.BytesIO(data)), user_profile)
+        self.assertEqual(mock_upload_part.call_count, 2)
+        path_id = re.sub('/user_uploads/', '', uri)
+        key = bucket.get_key(path_id)
+        self.assertEqual(data, key.get_contents_as_string())
+        self.assertEqual(key.metadata["user_profile_id"], str(user_profile.id))
+        self.assertEqual(len(data), Attachment.objects.get(path_id=path_id).size)
+
     @use_s3_backend
     def test_file_upload_s3_with_undefined_content_type(self) -> None:
         bucket = create_s3_buckets(settings.S3_AUTH_UPLOADS_BUCKET)[0]
@@ -20,7 +20,7 @@ from zerver.models import UserProfile, Recipient, Realm, \
     get_source_profile, get_system_bot, \
     ScheduledEmail, check_valid_user_ids, \
     get_user_by_id_in_realm_including_cross_realm, CustomProfileField, \
-    InvalidFakeEmailDomain, get_fake_email_domain
+    InvalidFakeEmailDomain, get_fake_email_domain, bulk_get_user_profiles_by_id
 
 from zerver.lib.avatar import avatar_url, get_gravatar_url
 from zerver.lib.exceptions import JsonableError
@@ -772,6 +772,20 @@ class UserProfileTest(ZulipTestCase):
         self.assertEqual(result[cordelia].email, cordelia)
         self.assertEqual(result[webhook_bot].email, webhook_bot)
 
+    def test_bulk_get_user_profiles_by_id(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        result = bulk_get_user_profiles_by_id([hamlet.id, cordelia.id, hamlet.id, 1234])
+        self.assertEqual(set(result), {hamlet.id, cordelia.id})
+        self.assertEqual(result[hamlet.id].email, hamlet.email)
+        self.assertEqual(result[cordelia.id].realm, get_realm('zulip'))
+
+        # Fetched from the cache, realm included, once populated.
+        with queries_captured() as queries:
+            result = bulk_get_user_profiles_by_id([hamlet.id, cordelia.id])
+            self.assertEqual(result[hamlet.id].realm.string_id, 'zulip')
+        self.assert_length(queries, 0)
+
     def test_get_accounts_for_email(self) -> None:
         def check_account_present_in_accounts(user: UserProfile, accounts: List[Dict[str, Optional[str]]]) -> None:
             for account in accounts:
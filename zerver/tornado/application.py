@@ -8,8 +8,8 @@ from zerver.lib.queue import get_queue_client
 from zerver.tornado.handlers import AsyncDjangoHandler
 
 def setup_tornado_rabbitmq() -> None:  # nocoverage
-    # When tornado is shut down, disconnect cleanly from rabbitmq
-    if settings.USING_RABBITMQ:
+    # When tornado is shut down, disconnect cleanly from the queue
+    if settings.USING_QUEUE_WORKERS:
         queue_client = get_queue_client()
         atexit.register(lambda: queue_client.close())
         autoreload.add_reload_hook(lambda: queue_client.close())
@@ -26,5 +26,6 @@ def create_tornado_application(port: int) -> tornado.web.Application:
     return tornado.web.Application([(url, AsyncDjangoHandler) for url in urls],
                                    debug=settings.DEBUG,
                                    autoreload=False,
+                                   compress_response=settings.TORNADO_COMPRESS_RESPONSES,
                                    # Disable Tornado's own request logging, since we have our own
                                    log_function=lambda x: None)
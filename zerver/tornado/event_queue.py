@@ -1,12 +1,13 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
 from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Union
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Tuple, Union
 from typing_extensions import Deque, TypedDict
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from collections import deque
+import heapq
 import os
 import time
 import logging
@@ -24,9 +25,11 @@ from zerver.tornado.handlers import clear_handler_by_id, get_handler_by_id, \
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_timer_restart
 from zerver.lib.message import MessageDict
-from zerver.lib.narrow import build_narrow_filter
+from zerver.lib.narrow import build_narrow_filter, build_narrow_index_key, \
+    get_narrow_index_keys_for_message
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
+from zerver.lib.topic import get_topic_from_message_info
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
 from zerver.tornado.sharding import get_tornado_uri, get_tornado_port, \
@@ -45,9 +48,12 @@ for host in ['127.0.0.1', 'localhost']:
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute.  Each pass only looks at the
+# queues whose expiry deadline has passed (see expiry_heap), and
+# yields back to the ioloop every EVENT_QUEUE_GC_SLICE_SECS so that a
+# large batch of expiring queues doesn't stall other requests.
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
+EVENT_QUEUE_GC_SLICE_SECS = 0.01
 
 # Capped limit for how long a client can request an event queue
 # to live
@@ -60,6 +66,11 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 # wireless routers that kill "inactive" http connections.
 HEARTBEAT_MIN_FREQ_SECS = 45
 
+# Clients can ask us to wait up to this long after an event arrives
+# before finishing their get_events request, so that events arriving
+# in quick succession are returned in a single response.
+MAX_EVENT_BATCH_WINDOW_MSECS = 100
+
 class ClientDescriptor:
     def __init__(self,
                  user_profile_id: int,
@@ -89,8 +100,11 @@ class ClientDescriptor:
         self.all_public_streams = all_public_streams
         self.client_type_name = client_type_name
         self._timeout_handle = None  # type: Any # TODO: should be return type of ioloop.call_later
+        self._batch_handle = None  # type: Any
+        self.batch_window_msecs = 0
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        self.narrow_index_key = build_narrow_index_key(narrow)
 
         # Default for lifespan_secs is DEFAULT_EVENT_QUEUE_TIMEOUT_SECS;
         # but users can set it as high as MAX_QUEUE_TIMEOUT_SECS.
@@ -149,6 +163,7 @@ class ClientDescriptor:
     def prepare_for_pickling(self) -> None:
         self.current_handler_id = None
         self._timeout_handle = None
+        self._batch_handle = None
 
     def add_event(self, event: Mapping[str, Any]) -> None:
         if self.current_handler_id is not None:
@@ -156,6 +171,14 @@ class ClientDescriptor:
             async_request_timer_restart(handler._request)
 
         self.event_queue.push(event)
+        if self.batch_window_msecs and self.current_handler_id is not None:
+            # Give other events a chance to arrive before we finish
+            # the request, so they can be returned together.
+            if self._batch_handle is None:
+                ioloop = tornado.ioloop.IOLoop.instance()
+                self._batch_handle = ioloop.call_later(self.batch_window_msecs / 1000,
+                                                       self.finish_current_handler)
+            return
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
@@ -186,9 +209,18 @@ class ClientDescriptor:
         return (self.current_handler_id is None and
                 now - self.last_connection_time >= self.queue_timeout)
 
-    def connect_handler(self, handler_id: int, client_name: str) -> None:
+    def expiry_deadline(self, now: float) -> float:
+        if self.current_handler_id is not None:
+            # A connected queue can't expire; we check it again once a
+            # full timeout has passed.
+            return now + self.queue_timeout
+        return self.last_connection_time + self.queue_timeout
+
+    def connect_handler(self, handler_id: int, client_name: str,
+                        batch_window_msecs: int=0) -> None:
         self.current_handler_id = handler_id
         self.current_client_name = client_name
+        self.batch_window_msecs = min(batch_window_msecs, MAX_EVENT_BATCH_WINDOW_MSECS)
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
 
@@ -211,10 +243,15 @@ class ClientDescriptor:
                               self.current_client_name))
         self.current_handler_id = None
         self.current_client_name = None
+        self.batch_window_msecs = 0
         if self._timeout_handle is not None:
             ioloop = tornado.ioloop.IOLoop.instance()
             ioloop.remove_timeout(self._timeout_handle)
             self._timeout_handle = None
+        if self._batch_handle is not None:
+            ioloop = tornado.ioloop.IOLoop.instance()
+            ioloop.remove_timeout(self._batch_handle)
+            self._batch_handle = None
 
     def cleanup(self) -> None:
         # Before we can GC the event queue, we need to disconnect the
@@ -341,8 +378,20 @@ class EventQueue:
 clients = {}  # type: Dict[str, ClientDescriptor]
 # maps user id to list of client descriptors
 user_clients = {}  # type: Dict[int, List[ClientDescriptor]]
+# heap of (expiry deadline, queue id), with one entry for each queue
+# in clients; entries for queues that have since been removed are
+# skipped when popped.  A queue can only have expired once its
+# deadline has passed, so gc_event_queues only needs to look at the
+# front of the heap.
+expiry_heap = []  # type: List[Tuple[float, str]]
 # maps realm id to list of client descriptors with all_public_streams=True
+# and no narrow
 realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
+# maps realm id to a dict from narrow index key (see
+# build_narrow_index_key) to list of client descriptors with a narrow;
+# this lets us only consider the narrowed clients whose narrow could
+# match a given public stream message.
+realm_clients_narrowed = {}  # type: Dict[int, Dict[Tuple[str, ...], List[ClientDescriptor]]]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -358,6 +407,8 @@ def clear_client_event_queues_for_testing() -> None:
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_clients_narrowed.clear()
+    del expiry_heap[:]
     gc_hooks.clear()
     global next_queue_id
     next_queue_id = 0
@@ -374,9 +425,28 @@ def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescript
 def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
     return realm_clients_all_streams.get(realm_id, [])
 
+def get_narrowed_client_descriptors_for_message(realm_id: int, stream_name: str,
+                                                topic_name: str,
+                                                sender_email: str) -> List[ClientDescriptor]:
+    narrowed_clients = realm_clients_narrowed.get(realm_id)
+    if not narrowed_clients:
+        return []
+    result = []  # type: List[ClientDescriptor]
+    for key in get_narrow_index_keys_for_message(stream_name, topic_name, sender_email):
+        result.extend(narrowed_clients.get(key, []))
+    return result
+
 def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
+    heapq.heappush(expiry_heap, (client.expiry_deadline(time.time()), client.event_queue.id))
+    if client.narrow != []:
+        # Narrows that can't match a public stream message the client's
+        # user didn't receive have no index key, and only get messages
+        # via user_clients.
+        if client.narrow_index_key is not None:
+            realm_clients_narrowed.setdefault(client.realm_id, {}).setdefault(
+                client.narrow_index_key, []).append(client)
+    elif client.all_public_streams:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
@@ -391,7 +461,7 @@ def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> Clie
 
 def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[int],
                        affected_realms: AbstractSet[int]) -> None:
-    def filter_client_dict(client_dict: MutableMapping[int, List[ClientDescriptor]], key: int) -> None:
+    def filter_client_dict(client_dict: MutableMapping[Any, List[ClientDescriptor]], key: Any) -> None:
         if key not in client_dict:
             return
 
@@ -407,6 +477,14 @@ def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
 
+    for id in to_remove:
+        client = clients[id]
+        if client.narrow_index_key is not None and client.realm_id in realm_clients_narrowed:
+            narrowed_clients = realm_clients_narrowed[client.realm_id]
+            filter_client_dict(narrowed_clients, client.narrow_index_key)
+            if len(narrowed_clients) == 0:
+                del realm_clients_narrowed[client.realm_id]
+
     for id in to_remove:
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
@@ -417,11 +495,26 @@ def gc_event_queues(port: int) -> None:
     to_remove = set()  # type: Set[str]
     affected_users = set()  # type: Set[int]
     affected_realms = set()  # type: Set[int]
-    for (id, client) in clients.items():
+    examined = 0
+    finished = True
+    while expiry_heap and expiry_heap[0][0] <= start:
+        if time.time() - start >= EVENT_QUEUE_GC_SLICE_SECS:
+            finished = False
+            break
+        (deadline, id) = heapq.heappop(expiry_heap)
+        client = clients.get(id)
+        if client is None:
+            # This queue was already removed, e.g. via cleanup().
+            continue
+        examined += 1
         if client.expired(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        else:
+            # The client has reconnected since this entry was added;
+            # its new deadline is necessarily later than start.
+            heapq.heappush(expiry_heap, (client.expiry_deadline(start), id))
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
@@ -429,13 +522,18 @@ def gc_event_queues(port: int) -> None:
     do_gc_event_queues(to_remove, affected_users, affected_realms)
 
     if settings.PRODUCTION:
-        logging.info(('Tornado %d removed %d expired event queues owned by %d users in %.3fs.' +
-                      '  Now %d active queues, %s')
-                     % (port, len(to_remove), len(affected_users), time.time() - start,
+        logging.info(('Tornado %d removed %d expired event queues owned by %d users '
+                      '(examined %d) in %.3fs.  Now %d active queues, %s')
+                     % (port, len(to_remove), len(affected_users), examined, time.time() - start,
                         len(clients), handler_stats_string()))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
+    if not finished:
+        # Yield to the ioloop, and continue where we left off once
+        # it has handled any pending requests.
+        tornado.ioloop.IOLoop.instance().add_callback(gc_event_queues, port)
+
 def persistent_queue_filename(port: int, last: bool=False) -> str:
     if settings.TORNADO_PROCESSES == 1:
         # Use non-port-aware, legacy version.
@@ -519,6 +617,7 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
     new_queue_data = query.get("new_queue_data")  # type: Optional[MutableMapping[str, Any]]
     client_type_name = query["client_type_name"]  # type: str
     handler_id = query["handler_id"]  # type: int
+    batch_window_msecs = query.get("batch_window_msecs", 0)  # type: int
 
     try:
         was_connected = False
@@ -573,7 +672,7 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
     except JsonableError as e:
         return dict(type="error", exception=e)
 
-    client.connect_handler(handler_id, client_type_name)
+    client.connect_handler(handler_id, client_type_name, batch_window_msecs)
     return dict(type="async")
 
 # The following functions are called from Django
@@ -789,10 +888,15 @@ def get_client_info_for_message_event(event_template: Mapping[str, Any],
         return (sender_queue_id is not None) and client.event_queue.id == sender_queue_id
 
     # If we're on a public stream, look for clients (typically belonging to
-    # bots) that are registered to get events for ALL streams.
+    # bots) that are registered to get events for ALL streams, and
+    # narrowed clients whose narrow might match this message.
     if 'stream_name' in event_template and not event_template.get("invite_only"):
         realm_id = event_template['realm_id']
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        message_dict = event_template['message_dict']
+        narrowed_clients = get_narrowed_client_descriptors_for_message(
+            realm_id, event_template['stream_name'],
+            get_topic_from_message_info(message_dict), message_dict['sender_email'])
+        for client in get_client_descriptors_for_realm_all_streams(realm_id) + narrowed_clients:
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=[],
@@ -12,6 +12,7 @@ from django.http import HttpRequest, HttpResponse
 from tornado.wsgi import WSGIContainer
 
 from zerver.lib.response import json_response
+from zerver.lib.utils import statsd
 from zerver.middleware import async_request_timer_restart, async_request_timer_stop
 from zerver.tornado.descriptors import get_descriptor_by_handler_id
 
@@ -37,6 +38,11 @@ def clear_handler_by_id(handler_id: int) -> None:
 def handler_stats_string() -> str:
     return "%s handlers, latest ID %s" % (len(handlers), current_handler_id)
 
+def record_get_events_response_stats(num_events: int, response: HttpResponse) -> None:
+    # The size is before any compression Tornado or nginx might do.
+    statsd.timing("tornado.get_events.events_per_response", num_events)
+    statsd.timing("tornado.get_events.response_bytes", len(response.content))
+
 def finish_handler(handler_id: int, event_queue_id: str,
                    contents: List[Dict[str, Any]], apply_markdown: bool) -> None:
     err_msg = "Got error finishing handler for queue %s" % (event_queue_id,)
@@ -240,4 +246,6 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
             # this file) should be using response.close() instead.
             signals.request_finished.send(sender=self.__class__)
 
+        if 'events' in result_dict:
+            record_get_events_response_stats(len(result_dict['events']), response)
         self.write_django_response_as_tornado_response(response)
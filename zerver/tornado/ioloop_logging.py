@@ -1,11 +1,13 @@
 import logging
 import select
 import time
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from django.conf import settings
 from tornado.ioloop import IOLoop, PollIOLoop
 
+from zerver.lib.utils import statsd
+
 # There isn't a good way to get at what the underlying poll implementation
 # will be without actually constructing an IOLoop, so we just assume it will
 # be epoll.
@@ -15,6 +17,10 @@ orig_poll_impl = select.epoll
 # into this early-initialized module.
 logging_data = {}  # type: Dict[str, str]
 
+# An ioloop iteration which keeps us from polling for longer than this
+# is reported as a stall, since every other request waits for it.
+IOLOOP_STALL_THRESHOLD_SECS = 0.1
+
 class InstrumentedPollIOLoop(PollIOLoop):
     def initialize(self, **kwargs):  # type: ignore # TODO investigate likely buggy monkey patching here
         super().initialize(impl=InstrumentedPoll(), **kwargs)
@@ -35,6 +41,9 @@ class InstrumentedPoll:
         self._underlying = orig_poll_impl()
         self._times = []  # type: List[Tuple[float, float]]
         self._last_print = 0.0
+        self._last_poll_end = None  # type: Optional[float]
+        self._max_stall = 0.0
+        self._stall_count = 0
 
     # Python won't let us subclass e.g. select.epoll, so instead
     # we proxy every method.  __getattr__ handles anything we
@@ -42,18 +51,35 @@ class InstrumentedPoll:
     def __getattr__(self, name: str) -> Any:
         return getattr(self._underlying, name)
 
+    def record_stall(self, t0: float) -> None:
+        # The time since the previous poll returned was spent running
+        # callbacks and handlers for a single ioloop iteration.
+        if self._last_poll_end is None:
+            return
+        duration = t0 - self._last_poll_end
+        self._max_stall = max(self._max_stall, duration)
+        if duration >= IOLOOP_STALL_THRESHOLD_SECS:
+            self._stall_count += 1
+            statsd.timing('tornado.ioloop.stall', int(duration * 1000))
+            logging.warning('Tornado %s ioloop stalled for %.3fs'
+                            % (logging_data.get('port', 'unknown'), duration))
+
     # Call the underlying poll method, and report timing data.
     def poll(self, timeout: float) -> Any:
+        t0 = time.time()
+        self.record_stall(t0)
 
         # Avoid accumulating a bunch of insignificant data points
         # from short timeouts.
         if timeout < 1e-3:
-            return self._underlying.poll(timeout)
+            result = self._underlying.poll(timeout)
+            self._last_poll_end = time.time()
+            return result
 
         # Record start and end times for the underlying poll
-        t0 = time.time()
         result = self._underlying.poll(timeout)
         t1 = time.time()
+        self._last_poll_end = t1
 
         # Log this datapoint and restrict our log to the past minute
         self._times.append((t0, t1))
@@ -70,6 +96,11 @@ class InstrumentedPoll:
                 if settings.PRODUCTION:
                     logging.info('Tornado %s %5.1f%% busy over the past %4.1f seconds'
                                  % (logging_data.get('port', 'unknown'), percent_busy, total))
-                    self._last_print = t1
+                self._last_print = t1
+                statsd.gauge('tornado.ioloop.percent_busy', percent_busy)
+                statsd.gauge('tornado.ioloop.max_stall_ms', int(self._max_stall * 1000))
+                statsd.gauge('tornado.ioloop.stalls', self._stall_count)
+                self._max_stall = 0.0
+                self._stall_count = 0
 
         return result
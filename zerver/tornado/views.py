@@ -12,7 +12,7 @@ from zerver.lib.validator import check_bool, check_int, check_list, check_string
 from zerver.models import Client, UserProfile, get_client, get_user_profile_by_id
 from zerver.tornado.event_queue import fetch_events, \
     get_client_descriptor, process_notification
-from zerver.tornado.handlers import AsyncDjangoHandler
+from zerver.tornado.handlers import AsyncDjangoHandler, record_get_events_response_stats
 from zerver.tornado.exceptions import BadEventQueueIdError
 
 @internal_notify_view(True)
@@ -70,7 +70,8 @@ def get_events_backend(request: HttpRequest, user_profile: UserProfile,
                        narrow: Iterable[Sequence[str]]=REQ(default=[], validator=check_list(None),
                                                            intentionally_undocumented=True),
                        lifespan_secs: int=REQ(default=0, converter=to_non_negative_int,
-                                              intentionally_undocumented=True)
+                                              intentionally_undocumented=True),
+                       batch_window_msecs: int=REQ(default=0, converter=to_non_negative_int)
                        ) -> HttpResponse:
     # Extract the Tornado handler from the request
     handler = request._tornado_handler  # type: AsyncDjangoHandler
@@ -90,6 +91,7 @@ def get_events_backend(request: HttpRequest, user_profile: UserProfile,
         lifespan_secs = lifespan_secs,
         narrow = narrow,
         dont_block = dont_block,
+        batch_window_msecs = batch_window_msecs,
         handler_id = handler.handler_id)
 
     if queue_id is None:
@@ -120,4 +122,6 @@ def get_events_backend(request: HttpRequest, user_profile: UserProfile,
         return response
     if result["type"] == "error":
         raise result["exception"]
-    return json_success(result["response"])
+    response = json_success(result["response"])
+    record_get_events_response_stats(len(result["response"]["events"]), response)
+    return response
@@ -2,6 +2,7 @@ from django.http import HttpRequest, HttpResponse
 from typing import Dict, Iterable, Optional, Sequence
 
 from zerver.lib.events import do_events_register
+from zerver.lib.query_budget import query_budget
 from zerver.lib.request import REQ, has_request_variables
 from zerver.lib.response import json_success
 from zerver.lib.validator import check_dict, check_string, check_list, check_bool
@@ -22,6 +23,8 @@ def _default_narrow(user_profile: UserProfile,
     return narrow
 
 NarrowT = Iterable[Sequence[str]]
+# Fetching the initial state is 31 queries; see FetchQueriesTest.
+@query_budget(35)
 @has_request_variables
 def events_register_backend(
         request: HttpRequest, user_profile: UserProfile,
@@ -20,6 +20,7 @@ from zerver.lib.actions import do_change_tos_version, \
 from zerver.lib.i18n import get_language_list, get_language_name, \
     get_language_list_for_templates, get_language_translation_data
 from zerver.lib.push_notifications import num_push_devices_for_user
+from zerver.lib.query_budget import query_budget
 from zerver.lib.streams import access_stream_by_name
 from zerver.lib.subdomains import get_subdomain
 from zerver.lib.users import compute_show_invites_and_add_streams
@@ -130,6 +131,8 @@ def compute_navbar_logo_url(page_params: Dict[str, Any]) -> str:
         navbar_logo_url = page_params["realm_logo_url"]
     return navbar_logo_url
 
+# The full page load; see test_home, which counts 42 queries.
+@query_budget(45)
 def home(request: HttpRequest) -> HttpResponse:
     if not settings.ROOT_DOMAIN_LANDING_PAGE:
         return home_real(request)
@@ -21,6 +21,7 @@ from zerver.lib.actions import recipient_for_user_profiles, do_update_message_fl
     do_mark_all_as_read, do_mark_stream_messages_as_read, extract_stream_indicator, \
     get_user_info_for_message_updates, check_schedule_message
 from zerver.lib.addressee import get_user_profiles, get_user_profiles_by_ids
+from zerver.lib.query_budget import query_budget
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.message import (
     access_message,
@@ -29,6 +30,7 @@ from zerver.lib.message import (
     get_first_visible_message_id,
 )
 from zerver.lib.response import json_success, json_error
+from zerver.lib.replicas import use_read_replica
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import access_stream_by_id, get_public_streams_queryset, \
     can_access_stream_history_by_name, can_access_stream_history_by_id, \
@@ -800,6 +802,10 @@ def parse_anchor_value(anchor_val: Optional[str],
     except ValueError:
         raise JsonableError(_("Invalid anchor"))
 
+# The message fetch itself, plus the 7 queries test_bulk_message_fetching
+# counts for turning messages into dicts.
+@query_budget(20)
+@use_read_replica
 @has_request_variables
 def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
                          anchor_val: Optional[str]=REQ(
@@ -1307,6 +1313,8 @@ def handle_deferred_message(sender: UserProfile, client: Client,
                            forwarder_user_profile=forwarder_user_profile)
     return json_success({"deliver_at": str(deliver_at_usertz)})
 
+# See test_not_too_many_queries, which counts 15 queries for sending.
+@query_budget(20)
 @has_request_variables
 def send_message_backend(request: HttpRequest, user_profile: UserProfile,
                          message_type_name: str=REQ('type'),
@@ -1653,6 +1661,7 @@ def render_message_backend(request: HttpRequest, user_profile: UserProfile,
     rendered_content = render_markdown(message, content, realm=user_profile.realm)
     return json_success({"rendered": rendered_content})
 
+@use_read_replica
 @has_request_variables
 def messages_in_narrow_backend(request: HttpRequest, user_profile: UserProfile,
                                msg_ids: List[int]=REQ(validator=check_list(check_int)),
@@ -11,7 +11,6 @@ from zerver.decorator import require_realm_admin
 from zerver.models import RealmAuditLog, UserProfile
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.response import json_error, json_success
-from zerver.lib.export import get_realm_exports_serialized
 from zerver.lib.actions import do_delete_realm_export
 
 import ujson
@@ -63,6 +62,9 @@ def export_realm(request: HttpRequest, user: UserProfile) -> HttpResponse:
 
 @require_realm_admin
 def get_realm_exports(request: HttpRequest, user: UserProfile) -> HttpResponse:
+    # Imported here, since zerver.lib.export is large and no other
+    # view needs it.
+    from zerver.lib.export import get_realm_exports_serialized
     realm_exports = get_realm_exports_serialized(user)
     return json_success({"exports": realm_exports})
 
@@ -1,6 +1,6 @@
 from django.http import HttpRequest, HttpResponse
 from zerver.lib.bot_storage import (
-    get_bot_storage,
+    get_bot_storage_values,
     set_bot_storage,
     remove_bot_storage,
     get_keys_in_bot_storage,
@@ -30,7 +30,7 @@ def get_storage(
 ) -> HttpResponse:
     keys = keys or get_keys_in_bot_storage(user_profile)
     try:
-        storage = {key: get_bot_storage(user_profile, key) for key in keys}
+        storage = get_bot_storage_values(user_profile, keys)
     except StateError as e:
         return json_error(str(e))
     return json_success({'storage': storage})
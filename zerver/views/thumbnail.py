@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 # See https://zulip.readthedocs.io/en/latest/subsystems/thumbnailing.html
+from django.conf import settings
 from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control
 from django.utils.translation import ugettext as _
 from django.http import HttpRequest, HttpResponse, HttpResponseForbidden
+from django_sendfile import sendfile
+from mimetypes import guess_type
 from typing import Optional
-from zerver.models import UserProfile, validate_attachment_request
+from zerver.models import Attachment, UserProfile, validate_attachment_request
 from zerver.lib.request import has_request_variables, REQ
 from zerver.lib.thumbnail import generate_thumbnail_url
+from zerver.lib.upload import THUMBNAIL_CACHE_MAX_AGE, THUMBNAIL_SIZES, \
+    get_local_thumbnail_path, get_signed_upload_url, get_thumbnail_path_id
 
 def validate_thumbnail_request(user_profile: UserProfile, path: str) -> Optional[bool]:
     # path here does not have a leading / as it is parsed from request hitting the
@@ -18,12 +24,38 @@ def validate_thumbnail_request(user_profile: UserProfile, path: str) -> Optional
     # This is an external link and we don't enforce restricted view policy here.
     return True
 
+def serve_pregenerated_thumbnail(request: HttpRequest, path_id: str,
+                                 size: str) -> Optional[HttpResponse]:
+    if not Attachment.objects.filter(path_id=path_id, has_thumbnails=True).exists():
+        return None
+
+    if settings.LOCAL_UPLOADS_DIR is None:
+        return redirect(get_signed_upload_url(get_thumbnail_path_id(path_id, size)))
+
+    local_path = get_local_thumbnail_path(path_id, size)
+    if local_path is None:
+        return None
+    # Thumbnails are always in the format of the original image.
+    mimetype, encoding = guess_type(path_id)
+    response = sendfile(request, local_path, mimetype=mimetype, encoding=encoding)
+    patch_cache_control(response, private=True, immutable=True, max_age=THUMBNAIL_CACHE_MAX_AGE)
+    return response
+
 @has_request_variables
 def backend_serve_thumbnail(request: HttpRequest, user_profile: UserProfile,
                             url: str=REQ(), size_requested: str=REQ("size")) -> HttpResponse:
     if not validate_thumbnail_request(user_profile, url):
         return HttpResponseForbidden(_("<p>You are not authorized to view this file.</p>"))
 
+    if (settings.PREGENERATE_THUMBNAILS and url.startswith('user_uploads/') and
+            size_requested in THUMBNAIL_SIZES):
+        # Until the thumbnail has been generated, we fall back to
+        # thumbor or the original image below.
+        response = serve_pregenerated_thumbnail(request, url[len('user_uploads/'):],
+                                                size_requested)
+        if response is not None:
+            return response
+
     size = None
     if size_requested == 'thumbnail':
         size = '0x300'
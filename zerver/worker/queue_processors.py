@@ -1,10 +1,13 @@
 # Documented in https://zulip.readthedocs.io/en/latest/subsystems/queuing.html
 from abc import ABC, abstractmethod
-from typing import Any, Callable, Dict, List, Mapping, Optional, cast, Tuple, TypeVar, Type
+from typing import Any, Callable, Deque, Dict, List, Mapping, Optional, Set, cast, Tuple, \
+    TypeVar, Type
 
 import copy
 import signal
 import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from functools import wraps
 from threading import Timer
 
@@ -15,11 +18,12 @@ from django.conf import settings
 from django.db import connection
 from zerver.models import \
     get_client, get_system_bot, PreregistrationUser, \
-    get_user_profile_by_id, Message, Realm, UserMessage, UserProfile, \
-    Client
+    get_user_profile_by_id, bulk_get_user_profiles_by_id, Message, Realm, \
+    UserMessage, UserProfile, Client
 from zerver.lib.context_managers import lockfile
 from zerver.lib.error_notify import do_report_error
-from zerver.lib.queue import SimpleQueueClient, retry_event
+from zerver.lib.queue import LocalQueueClient, QueueClient, SimpleQueueClient, \
+    queue_json_publish, retry_event
 from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.email_notifications import handle_missedmessage_emails
 from zerver.lib.push_notifications import handle_push_notification, handle_remove_push_notification, \
@@ -29,25 +33,27 @@ from zerver.lib.actions import do_send_confirmation_email, \
     internal_send_stream_message, internal_send_private_message, notify_realm_export, \
     render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read
 from zerver.lib.url_preview import preview as url_preview
-from zerver.lib.digest import handle_digest_email
+from zerver.lib.digest import bulk_handle_digest_email, handle_digest_email
 from zerver.lib.send_email import send_future_email, send_email_from_dict, \
     FromAddress, EmailNotDeliveredException, handle_send_email_format_changes
 from zerver.lib.email_mirror import process_message as mirror_email, rate_limit_mirror_by_realm, \
     is_missed_message_address, decode_stream_email_address
 from zerver.lib.streams import access_stream_by_id
-from zerver.lib.db import reset_queries
+from zerver.lib.db import check_database_connections, reset_queries
+from zerver.lib.replicas import read_replica
 from zerver.context_processors import common_context
-from zerver.lib.outgoing_webhook import do_rest_call, get_outgoing_webhook_service_handler
+from zerver.lib.outgoing_webhook import MAX_REQUESTS_PER_SERVICE_PER_BATCH, RestCall, \
+    do_rest_calls, get_outgoing_webhook_service_handler
 from zerver.models import get_bot_services, get_stream, RealmAuditLog
 from zulip_bots.lib import ExternalBotHandler, extract_query_without_mention
 from zerver.lib.bot_lib import EmbeddedBotHandler, get_bot_handler, EmbeddedBotQuitException
 from zerver.lib.exceptions import RateLimited
-from zerver.lib.export import export_realm_wrapper
 from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
+from zerver.lib.upload import generate_message_thumbnails
 
 import os
 import ujson
-from collections import defaultdict
+from collections import defaultdict, deque
 import email
 import time
 import datetime
@@ -117,7 +123,7 @@ class QueueProcessingWorker(ABC):
     queue_name = None  # type: str
 
     def __init__(self) -> None:
-        self.q = None  # type: SimpleQueueClient
+        self.q = None  # type: QueueClient
         if self.queue_name is None:
             raise WorkerDeclarationException("Queue worker declared without queue_name")
 
@@ -150,10 +156,19 @@ class QueueProcessingWorker(ABC):
         logging.exception("Problem handling data on queue %s" % (self.queue_name,))
 
     def setup(self) -> None:
-        self.q = SimpleQueueClient()
+        if settings.QUEUE_BACKEND == 'local':
+            self.q = LocalQueueClient()
+        else:
+            self.q = SimpleQueueClient()
 
     def start(self) -> None:
-        self.q.register_json_consumer(self.queue_name, self.consume_wrapper)
+        def consume(data: Dict[str, Any]) -> None:
+            # Not in consume_wrapper, which queue_json_publish also
+            # calls directly when queuing is disabled (as in tests),
+            # where the caller's connection may be in a transaction.
+            check_database_connections()
+            self.consume_wrapper(data)
+        self.q.register_json_consumer(self.queue_name, consume)
         self.q.start_consuming()
 
     def stop(self) -> None:  # nocoverage
@@ -162,11 +177,17 @@ class QueueProcessingWorker(ABC):
 class LoopQueueProcessingWorker(QueueProcessingWorker):
     sleep_delay = 0
     sleep_only_if_empty = True
+    # The most events to handle in one consume_batch call, for workers
+    # where the events queued behind a batch shouldn't wait for all of
+    # it; None for the whole queue.
+    batch_size = None  # type: Optional[int]
 
     def start(self) -> None:  # nocoverage
         while True:
-            events = self.q.drain_queue(self.queue_name, json=True)
+            events = self.q.drain_queue(self.queue_name, json=True, limit=self.batch_size)
             try:
+                if events:
+                    check_database_connections()
                 self.consume_batch(events)
             except Exception:
                 self._handle_consume_exception(events)
@@ -368,13 +389,17 @@ class MissedMessageWorker(QueueProcessingWorker):
         self.stop_timer()
 
         current_time = time.time()
-        for user_profile_id, timestamp in list(self.batch_start_by_recipient.items()):
-            if current_time - timestamp < self.BATCH_DURATION:
-                continue
+        due_user_profile_ids = [
+            user_profile_id
+            for user_profile_id, timestamp in self.batch_start_by_recipient.items()
+            if current_time - timestamp >= self.BATCH_DURATION]
+        user_profiles = bulk_get_user_profiles_by_id(due_user_profile_ids)
+        for user_profile_id in due_user_profile_ids:
             events = self.events_by_recipient[user_profile_id]
             logging.info("Batch-processing %s missedmessage_emails events for user %s" %
                          (len(events), user_profile_id))
-            handle_missedmessage_emails(user_profile_id, events)
+            handle_missedmessage_emails(user_profile_id, events,
+                                        user_profile=user_profiles.get(user_profile_id))
             del self.events_by_recipient[user_profile_id]
             del self.batch_start_by_recipient[user_profile_id]
 
@@ -473,7 +498,13 @@ class DigestWorker(QueueProcessingWorker):  # nocoverage
     # management command, not here.
     def consume(self, event: Mapping[str, Any]) -> None:
         logging.info("Received digest event: %s" % (event,))
-        handle_digest_email(event["user_profile_id"], event["cutoff"])
+        # Digests summarize days of activity, so replica lag doesn't matter.
+        with read_replica():
+            if "user_ids" in event:
+                bulk_handle_digest_email(event["user_ids"], event["cutoff"])
+            else:
+                # Legacy single-user events, queued before digests were batched.
+                handle_digest_email(event["user_profile_id"], event["cutoff"])
 
 @assign_queue('email_mirror')
 class MirrorWorker(QueueProcessingWorker):
@@ -509,11 +540,39 @@ class TestWorker(QueueProcessingWorker):
             f.write(message + '\n')
 
 @assign_queue('embed_links')
-class FetchLinksEmbedData(QueueProcessingWorker):
-    def consume(self, event: Mapping[str, Any]) -> None:
-        for url in event['urls']:
-            url_preview.get_link_embed_data(url)
+class FetchLinksEmbedData(LoopQueueProcessingWorker):
+    sleep_delay = 1
+    batch_size = 20
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        # Fetch the links for the whole batch at once, so that a slow
+        # site doesn't hold up the previews queued behind it, and
+        # update each message as soon as its own links are fetched.
+        unfetched_urls = [set(event['urls']) for event in events]
+        unfinished = []  # type: List[int]
+        for i, urls in enumerate(unfetched_urls):
+            if not urls:
+                self.update_embedded_data_or_log(events[i])
+            else:
+                unfinished.append(i)
+
+        for url in url_preview.fetch_link_embed_data(url for event in events for url in event['urls']):
+            still_unfinished = []
+            for i in unfinished:
+                unfetched_urls[i].discard(url)
+                if unfetched_urls[i]:
+                    still_unfinished.append(i)
+                else:
+                    self.update_embedded_data_or_log(events[i])
+            unfinished = still_unfinished
+
+    def update_embedded_data_or_log(self, event: Dict[str, Any]) -> None:
+        try:
+            self.update_embedded_data(event)
+        except Exception:
+            self._handle_consume_exception([event])
 
+    def update_embedded_data(self, event: Mapping[str, Any]) -> None:
         message = Message.objects.get(id=event['message_id'])
         # If the message changed, we will run this task after updating the message
         # in zerver.views.messages.update_message_backend
@@ -538,58 +597,230 @@ class FetchLinksEmbedData(QueueProcessingWorker):
                 message.sender, message, message.content, rendered_content)
 
 @assign_queue('outgoing_webhooks')
-class OutgoingWebhookWorker(QueueProcessingWorker):
-    def consume(self, event: Mapping[str, Any]) -> None:
-        message = event['message']
-        dup_event = cast(Dict[str, Any], event)
-        dup_event['command'] = message['content']
+class OutgoingWebhookWorker(LoopQueueProcessingWorker):
+    sleep_delay = 1
+    batch_size = 50
 
-        services = get_bot_services(event['user_profile_id'])
-        for service in services:
-            dup_event['service_name'] = str(service.name)
-            service_handler = get_outgoing_webhook_service_handler(service)
-            request_data = service_handler.build_bot_request(dup_event)
-            if request_data:
-                do_rest_call(service.base_url,
-                             request_data,
-                             dup_event,
-                             service_handler)
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        calls = []  # type: List[RestCall]
+        calls_per_url = defaultdict(int)  # type: Dict[str, int]
+        waiting_to_retry = False
+        for event in events:
+            if event.get('retry_at', 0) > time.time():
+                # See request_retry; put it back until it's time.
+                queue_json_publish(self.queue_name, event, lambda x: None)
+                waiting_to_retry = True
+                continue
+
+            message = event['message']
+            event['command'] = message['content']
+
+            services = get_bot_services(event['user_profile_id'])
+            if 'service_name' in event:
+                # A retried or deferred request, for just one service.
+                services = [service for service in services
+                            if str(service.name) == event['service_name']]
+            for service in services:
+                # Each service's request is handled separately (and
+                # concurrently), so each gets its own copy of the event.
+                service_event = dict(event, service_name=str(service.name))
+                if calls_per_url[service.base_url] >= MAX_REQUESTS_PER_SERVICE_PER_BATCH:
+                    # The next batch waits for this one to finish, so
+                    # a slow server mustn't get many requests in it.
+                    queue_json_publish(self.queue_name, service_event, lambda x: None)
+                    continue
+                calls_per_url[service.base_url] += 1
+                service_handler = get_outgoing_webhook_service_handler(service)
+                request_data = service_handler.build_bot_request(service_event)
+                if request_data:
+                    calls.append((service.base_url, request_data, service_event, service_handler))
+
+        if waiting_to_retry and not calls:
+            # Avoid spinning while the queue only has events that
+            # aren't ready to be retried.
+            time.sleep(self.sleep_delay)
+
+        do_rest_calls(calls)
 
 @assign_queue('embedded_bots')
-class EmbeddedBotWorker(QueueProcessingWorker):
+class EmbeddedBotWorker(LoopQueueProcessingWorker):
+    sleep_delay = 1
+    # Messages for different bots are handled concurrently by this
+    # many threads, so that a slow bot doesn't hold up the others.
+    max_threads = 8
+    # After a bot has spent this long on one message, we stop waiting
+    # for it (though we can't interrupt it), and its remaining
+    # messages are put back on the queue.
+    bot_timeout_seconds = 30
+    # Bot handlers are kept initialized between messages, but
+    # recreated this often to pick up configuration changes.
+    bot_handler_max_age_seconds = 10 * 60
+
+    def __init__(self) -> None:
+        super().__init__()
+        # (bot handler, time created), by (bot user ID, service name).
+        self.bot_handlers = {}  # type: Dict[Tuple[int, str], Tuple[Any, float]]
+        # Each bot's messages are handled by its own single thread,
+        # reused from batch to batch.  Since a bot that timed out gets
+        # no more messages until its thread finishes, each bot can
+        # leave behind at most one stuck thread.
+        self.executors = {}  # type: Dict[int, ThreadPoolExecutor]
+        # Bots that timed out, and whose threads are still running.
+        self.stuck_bots = set()  # type: Set[int]
 
     def get_bot_api_client(self, user_profile: UserProfile) -> EmbeddedBotHandler:
         return EmbeddedBotHandler(user_profile)
 
-    def consume(self, event: Mapping[str, Any]) -> None:
+    def get_bot_handler(self, user_profile: UserProfile, service_name: str) -> Any:
+        key = (user_profile.id, service_name)
+        if key in self.bot_handlers:
+            bot_handler, created = self.bot_handlers[key]
+            if time.time() - created < self.bot_handler_max_age_seconds:
+                return bot_handler
+
+        bot_handler = get_bot_handler(service_name)
+        if bot_handler is None:
+            return None
+        if hasattr(bot_handler, 'initialize'):
+            bot_handler.initialize(self.get_bot_api_client(user_profile))
+        self.bot_handlers[key] = (bot_handler, time.time())
+        return bot_handler
+
+    def drop_bot_handlers(self, user_profile_id: int) -> None:
+        for key in list(self.bot_handlers):
+            if key[0] == user_profile_id:
+                self.bot_handlers.pop(key, None)
+
+    def handle_event(self, event: Mapping[str, Any],
+                     user_profile: Optional[UserProfile]=None) -> None:
         user_profile_id = event['user_profile_id']
-        user_profile = get_user_profile_by_id(user_profile_id)
+        if user_profile is None:
+            user_profile = get_user_profile_by_id(user_profile_id)
 
         message = cast(Dict[str, Any], event['message'])
 
         # TODO: Do we actually want to allow multiple Services per bot user?
         services = get_bot_services(user_profile_id)
         for service in services:
-            bot_handler = get_bot_handler(str(service.name))
-            if bot_handler is None:
-                logging.error("Error: User %s has bot with invalid embedded bot service %s" % (
-                    user_profile_id, service.name))
-                continue
             try:
-                if hasattr(bot_handler, 'initialize'):
-                    bot_handler.initialize(self.get_bot_api_client(user_profile))
+                bot_handler = self.get_bot_handler(user_profile, str(service.name))
+                if bot_handler is None:
+                    logging.error("Error: User %s has bot with invalid embedded bot service %s" % (
+                        user_profile_id, service.name))
+                    continue
+                client = self.get_bot_api_client(user_profile)
                 if event['trigger'] == 'mention':
                     message['content'] = extract_query_without_mention(
                         message=message,
-                        client=cast(ExternalBotHandler, self.get_bot_api_client(user_profile)),
+                        client=cast(ExternalBotHandler, client),
                     )
                     assert message['content'] is not None
                 bot_handler.handle_message(
                     message=message,
-                    bot_handler=self.get_bot_api_client(user_profile)
+                    bot_handler=client
                 )
             except EmbeddedBotQuitException as e:
                 logging.warning(str(e))
+            except Exception:
+                # Don't reuse a handler that might be in a bad state.
+                self.drop_bot_handlers(user_profile_id)
+                raise
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        # A bot still stuck on a message from an earlier batch can't
+        # be given more messages until it's done, since bot handlers
+        # aren't necessarily thread-safe; put them back until then.
+        ready_events = []
+        for event in events:
+            if event['user_profile_id'] in self.stuck_bots:
+                queue_json_publish(self.queue_name, event, lambda x: None)
+            else:
+                ready_events.append(event)
+        if events and not ready_events:
+            # Avoid spinning while the queue only has messages for
+            # stuck bots.
+            time.sleep(self.sleep_delay)
+        events = ready_events
+
+        if len(events) <= 1:
+            for event in events:
+                self.handle_event(event)
+            return
+
+        # Each bot's messages are handled in order by a single thread,
+        # for the same reason.
+        remaining = defaultdict(deque)  # type: Dict[int, Deque[Dict[str, Any]]]
+        for event in events:
+            remaining[event['user_profile_id']].append(event)
+        bots = bulk_get_user_profiles_by_id(remaining.keys())
+
+        # When each running bot started on its current message.
+        started = {}  # type: Dict[int, float]
+        finished = set()  # type: Set[int]
+        # Protects remaining, started, finished, and self.stuck_bots,
+        # which are shared with the threads.
+        lock = threading.Lock()
+
+        def next_event(user_profile_id: int) -> Optional[Dict[str, Any]]:
+            with lock:
+                # Empty, or taken away below if the bot timed out.
+                bot_events = remaining.get(user_profile_id)
+                if not bot_events:
+                    return None
+                started[user_profile_id] = time.time()
+                return bot_events.popleft()
+
+        def handle_bot_events(user_profile_id: int) -> None:
+            try:
+                check_database_connections()
+                reset_queries()
+                event = next_event(user_profile_id)
+                while event is not None:
+                    try:
+                        self.handle_event(event, bots.get(user_profile_id))
+                    except Exception:
+                        self._handle_consume_exception([event])
+                    event = next_event(user_profile_id)
+            finally:
+                with lock:
+                    finished.add(user_profile_id)
+                    self.stuck_bots.discard(user_profile_id)
+                # The thread may sit idle until the bot's next
+                # message, so don't hold on to a database connection.
+                connection.close()
+
+        def submit(user_profile_id: int) -> Future:
+            if user_profile_id not in self.executors:
+                self.executors[user_profile_id] = ThreadPoolExecutor(max_workers=1)
+            with lock:
+                started[user_profile_id] = time.time()
+            return self.executors[user_profile_id].submit(handle_bot_events, user_profile_id)
+
+        # At most max_threads bots are handled at once; stuck ones
+        # don't count.
+        waiting = deque(remaining)  # type: Deque[int]
+        futures = {}  # type: Dict[Future, int]
+        while waiting or futures:
+            while waiting and len(futures) < self.max_threads:
+                user_profile_id = waiting.popleft()
+                futures[submit(user_profile_id)] = user_profile_id
+            done, pending = wait(futures, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                del futures[future]
+            for future in pending:
+                user_profile_id = futures[future]
+                with lock:
+                    if user_profile_id in finished or \
+                            time.time() - started[user_profile_id] <= self.bot_timeout_seconds:
+                        continue
+                    unhandled = remaining.pop(user_profile_id)
+                    self.stuck_bots.add(user_profile_id)
+                del futures[future]
+                logging.warning("Embedded bot %s timed out handling a message" % (user_profile_id,))
+                # If it ever finishes, it'll get a fresh handler.
+                self.drop_bot_handlers(user_profile_id)
+                for event in unhandled:
+                    queue_json_publish(self.queue_name, event, lambda x: None)
 
 @assign_queue('deferred_work')
 class DeferredWorker(QueueProcessingWorker):
@@ -614,14 +845,19 @@ class DeferredWorker(QueueProcessingWorker):
                         "Maximum retries exceeded for trigger:%s event:clear_push_device_tokens" % (
                             event['user_profile_id'],))
                 retry_event(self.queue_name, event, failure_processor)
+        elif event['type'] == 'generate_thumbnails':
+            generate_message_thumbnails(event['path_id'])
         elif event['type'] == 'realm_export':
+            # Imported here, since only this worker needs it.
+            from zerver.lib.export import export_realm_wrapper
             start = time.time()
             realm = Realm.objects.get(id=event['realm_id'])
             output_dir = tempfile.mkdtemp(prefix="zulip-export-")
 
-            public_url = export_realm_wrapper(realm=realm, output_dir=output_dir,
-                                              threads=6, upload=True, public_only=True,
-                                              delete_after_upload=True)
+            with read_replica():
+                public_url = export_realm_wrapper(realm=realm, output_dir=output_dir,
+                                                  threads=6, upload=True, public_only=True,
+                                                  delete_after_upload=True)
             assert public_url is not None
 
             # Update the extra_data field now that the export is complete.
@@ -0,0 +1,250 @@
+import random
+import statistics
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import mock
+import ujson
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connection, transaction
+from django.http import HttpRequest
+from django.test import override_settings
+
+from zerver.lib.actions import bulk_add_subscriptions, check_message, \
+    do_create_realm, do_send_messages, do_update_message_flags
+from zerver.lib.addressee import Addressee
+from zerver.lib.bulk_create import bulk_create_streams, bulk_create_users
+from zerver.lib.db import reset_queries
+from zerver.lib.events import do_events_register
+from zerver.lib.generate_test_data import config, load_generators, parse_file
+from zerver.lib.message import get_raw_unread_data
+from zerver.lib.topic import DB_TOPIC_NAME
+from zerver.models import Stream, UserMessage, UserProfile, \
+    flush_per_request_caches, get_client
+from zerver.tornado.event_queue import allocate_client_descriptor, \
+    process_message_event
+from zerver.views.messages import get_messages_backend
+
+class BenchmarkRealm:
+    """A synthetic realm: `users` are all subscribed to `large_stream`,
+    and each of `streams` has a random tenth of them."""
+
+    def __init__(self, num_users: int, num_streams: int, num_messages: int,
+                 num_spare_streams: int) -> None:
+        # Not from the seeded `random`, since rolled-back realms may
+        # linger in the remote cache under their old subdomain.
+        string_id = 'benchmark%d' % (int(time.time() * 1000),)
+        self.realm = do_create_realm(string_id, 'Benchmark')
+        self.client = get_client('benchmark')
+
+        bulk_create_users(self.realm, {
+            ('user%d@%s.example.com' % (i, string_id), 'User %d' % (i,), 'user%d' % (i,), True)
+            for i in range(num_users)})
+        self.users = list(UserProfile.objects.filter(realm=self.realm, is_bot=False).order_by('id'))
+
+        stream_names = ['stream%d' % (i,) for i in range(num_streams)]
+        spare_stream_names = ['spare%d' % (i,) for i in range(num_spare_streams)]
+        bulk_create_streams(self.realm, {
+            name: {'description': name}
+            for name in ['large'] + stream_names + spare_stream_names})
+        streams = {stream.name: stream for stream in Stream.objects.filter(realm=self.realm)}
+        self.large_stream = streams['large']
+        self.streams = [streams[name] for name in stream_names]
+        # Left without subscribers, for benchmarking bulk_add_subscriptions.
+        self.spare_streams = [streams[name] for name in spare_stream_names]
+
+        bulk_add_subscriptions([self.large_stream], self.users)
+        for stream in self.streams:
+            bulk_add_subscriptions([stream], random.sample(self.users, max(1, num_users // 10)))
+
+        self.paragraphs = [paragraph for paragraph in parse_file(
+            config, load_generators(config), config['corpus']['filename']) if paragraph.strip()]
+        self.send_history(num_messages)
+
+    def content(self) -> str:
+        return random.choice(self.paragraphs)
+
+    def prep_stream_message(self, stream: Stream) -> Dict[str, Any]:
+        return check_message(random.choice(self.users), self.client,
+                             Addressee.for_stream(stream, 'topic %d' % (random.randrange(5),)),
+                             self.content())
+
+    def prep_private_message(self, num_recipients: int) -> Dict[str, Any]:
+        recipients = random.sample(self.users, num_recipients + 1)
+        return check_message(recipients[0], self.client,
+                             Addressee.for_user_ids([user.id for user in recipients[1:]], self.realm),
+                             self.content())
+
+    def send_history(self, num_messages: int) -> None:
+        # A tenth of messages go to the large stream, and three tenths
+        # are private messages, so that seeding doesn't take forever.
+        messages = []  # type: List[Optional[Dict[str, Any]]]
+        for i in range(num_messages):
+            kind = i % 10
+            if kind == 0:
+                messages.append(self.prep_stream_message(self.large_stream))
+            elif kind <= 6:
+                messages.append(self.prep_stream_message(random.choice(self.streams)))
+            else:
+                messages.append(self.prep_private_message(random.choice([1, 3])))
+            if len(messages) == 100:
+                do_send_messages(messages)
+                messages = []
+        do_send_messages(messages)
+
+def time_benchmark(func: Callable[[int], Any], iterations: int) -> Dict[str, Any]:
+    """Runs func(iteration) the given number of times, returning
+    median timings and database query counts."""
+    times = []  # type: List[float]
+    query_counts = []  # type: List[int]
+    db_times = []  # type: List[float]
+    for i in range(iterations):
+        flush_per_request_caches()
+        reset_queries()
+        start = time.time()
+        func(i)
+        times.append(time.time() - start)
+        queries = connection.connection.queries if connection.connection is not None else []
+        query_counts.append(len(queries))
+        db_times.append(sum(float(query['time']) for query in queries))
+    return dict(
+        iterations=iterations,
+        median_seconds=round(statistics.median(times), 5),
+        min_seconds=round(min(times), 5),
+        median_db_seconds=round(statistics.median(db_times), 5),
+        median_queries=statistics.median(query_counts),
+        max_queries=max(query_counts),
+    )
+
+class Command(BaseCommand):
+    help = """Benchmark the core message paths against a synthetic realm.
+
+The realm is created inside a transaction that is rolled back at the
+end, so the database is left unchanged.  Results are printed as JSON;
+see tools/benchmark-backend for comparing them between commits.
+
+Example: ./manage.py benchmark_backend --users=1000 --messages=20000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--users', type=int, default=200,
+                            help='Number of users in the synthetic realm')
+        parser.add_argument('--streams', type=int, default=20,
+                            help='Number of streams in the synthetic realm')
+        parser.add_argument('--messages', type=int, default=5000,
+                            help='Number of messages of history in the synthetic realm')
+        parser.add_argument('--iterations', type=int, default=10,
+                            help='Number of times to run each benchmark')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed, for building the same realm each time')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        random.seed(options['seed'])
+        # Deliver events to the "Tornado" code in this process, where
+        # we capture them (see run_benchmarks), rather than to a real
+        # queue or Tornado server.
+        with override_settings(USING_QUEUE_WORKERS=False, TORNADO_SERVER=None,
+                               INLINE_URL_EMBED_PREVIEW=False), \
+                transaction.atomic():
+            result = self.run_benchmarks(options)
+            transaction.set_rollback(True)
+        self.stdout.write(ujson.dumps(result, indent=4))
+
+    def run_benchmarks(self, options: Dict[str, Any]) -> Dict[str, Any]:
+        iterations = options['iterations']
+        # The most recent event sent to Tornado.
+        notifications = []  # type: List[Dict[str, Any]]
+
+        def capture_notification(notice: Dict[str, Any]) -> None:
+            notifications[:] = [notice]
+
+        with mock.patch('zerver.tornado.event_queue.process_notification',
+                        side_effect=capture_notification):
+            start = time.time()
+            bench = BenchmarkRealm(options['users'], options['streams'],
+                                   options['messages'], iterations)
+            setup_time = time.time() - start
+
+            results = {}  # type: Dict[str, Dict[str, Any]]
+            results['send_private_message'] = time_benchmark(
+                lambda i: do_send_messages([bench.prep_private_message(1)]), iterations)
+            results['send_huddle_message'] = time_benchmark(
+                lambda i: do_send_messages([bench.prep_private_message(3)]), iterations)
+            results['send_large_stream_message'] = time_benchmark(
+                lambda i: do_send_messages([bench.prep_stream_message(bench.large_stream)]),
+                iterations)
+            message_event = notifications[0]
+
+            results['bulk_add_subscriptions'] = time_benchmark(
+                lambda i: bulk_add_subscriptions([bench.spare_streams[i]], bench.users),
+                iterations)
+
+            user = bench.users[0]
+            results.update(self.benchmark_reads(bench, user, iterations))
+
+            # Mark a different batch of the user's unread messages as
+            # read each time.
+            unread_ids = list(UserMessage.objects.filter(user_profile=user).extra(
+                where=[UserMessage.where_unread()]).order_by('message_id').values_list(
+                    'message_id', flat=True))
+            results['do_update_message_flags'] = time_benchmark(
+                lambda i: do_update_message_flags(user, bench.client, 'add', 'read',
+                                                  unread_ids[i * 100:(i + 1) * 100]),
+                iterations)
+
+        # Tornado's share of sending a message to the large stream,
+        # with every subscriber having a connected client.
+        for subscriber in bench.users:
+            allocate_client_descriptor(dict(
+                user_profile_id=subscriber.id,
+                realm_id=bench.realm.id,
+                event_types=None,
+                client_type_name='benchmark',
+                apply_markdown=True,
+                client_gravatar=False,
+                all_public_streams=False,
+                queue_timeout=600,
+                last_connection_time=time.time(),
+                narrow=[]))
+        results['tornado_process_message_event'] = time_benchmark(
+            lambda i: process_message_event(message_event['event'], message_event['users']),
+            iterations)
+
+        return dict(
+            realm=dict(users=options['users'], streams=options['streams'],
+                       messages=options['messages']),
+            setup_seconds=round(setup_time, 3),
+            results=results,
+        )
+
+    def benchmark_reads(self, bench: BenchmarkRealm, user: UserProfile,
+                        iterations: int) -> Dict[str, Dict[str, Any]]:
+        results = {}  # type: Dict[str, Dict[str, Any]]
+        request = HttpRequest()
+        request.user = user
+        request._log_data = dict()
+        topic = UserMessage.objects.filter(
+            user_profile=user, message__recipient=bench.large_stream.recipient).values_list(
+                'message__' + DB_TOPIC_NAME, flat=True)[0]
+        narrows = {
+            'all': None,
+            'stream': [dict(operator='stream', operand=bench.large_stream.name)],
+            'topic': [dict(operator='stream', operand=bench.large_stream.name),
+                      dict(operator='topic', operand=topic)],
+            'private': [dict(operator='is', operand='private')],
+        }  # type: Dict[str, Any]
+        for name, narrow in narrows.items():
+            results['get_messages_%s' % (name,)] = time_benchmark(
+                lambda i, narrow=narrow: get_messages_backend(
+                    request, user, anchor_val='newest', num_before=100, num_after=0,
+                    narrow=narrow),
+                iterations)
+
+        results['get_raw_unread_data'] = time_benchmark(
+            lambda i: get_raw_unread_data(user), iterations)
+
+        # Without the round trip to Tornado to allocate the event queue.
+        with mock.patch('zerver.lib.events.request_event_queue', return_value='benchmark'), \
+                mock.patch('zerver.lib.events.get_user_events', return_value=[]):
+            results['do_events_register'] = time_benchmark(
+                lambda i: do_events_register(user, bench.client), iterations)
+        return results
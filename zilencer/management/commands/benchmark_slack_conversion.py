@@ -0,0 +1,138 @@
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import ujson
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.data_import.slack import convert_slack_workspace_messages, \
+    slack_workspace_to_realm
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+def write_json(path: str, data: Any) -> None:
+    with open(path, 'w') as f:
+        ujson.dump(data, f)
+
+def generate_slack_export(slack_data_dir: str, num_messages: int, num_users: int,
+                          num_channels: int, num_days: int) -> List[Dict[str, Any]]:
+    """Writes a synthetic Slack export to slack_data_dir, returning the
+    user list, in the format the users.list API would."""
+    users = []
+    for i in range(num_users):
+        users.append({
+            'id': 'U%08d' % (i,),
+            'team_id': 'T00000001',
+            'name': 'user%d' % (i,),
+            'real_name': 'User %d' % (i,),
+            'deleted': False,
+            'is_mirror_dummy': False,
+            'is_primary_owner': i == 0,
+            'profile': {
+                'email': 'user%d@example.com' % (i,),
+                'avatar_hash': 'abcdef%d' % (i,),
+            },
+        })
+    write_json(os.path.join(slack_data_dir, 'users.json'), users)
+
+    start = time.time() - num_days * SECONDS_PER_DAY
+    channels = []
+    for i in range(num_channels):
+        channels.append({
+            'id': 'C%08d' % (i,),
+            'name': 'channel%d' % (i,),
+            'created': start,
+            'is_archived': False,
+            'purpose': {'value': 'Channel %d' % (i,)},
+            'members': [user['id'] for user in users],
+        })
+    write_json(os.path.join(slack_data_dir, 'channels.json'), channels)
+
+    # Spread the messages evenly over the channel/day files, with the
+    # first few files getting one extra message each, so that we
+    # generate exactly num_messages.
+    messages_per_file, extra_messages = divmod(num_messages, num_channels * num_days)
+    for day in range(num_days):
+        date = time.strftime('%Y-%m-%d', time.gmtime(start + day * SECONDS_PER_DAY))
+        for channel_index, channel in enumerate(channels):
+            count = messages_per_file
+            if day * num_channels + channel_index < extra_messages:
+                count += 1
+            if count == 0:
+                continue
+            messages = []
+            for j in range(count):
+                sender = random.choice(users)
+                mentioned = random.choice(users)
+                messages.append({
+                    'type': 'message',
+                    'user': sender['id'],
+                    'text': 'Hello <@%s>, see *this* and <https://example.com|that> (%d)' % (
+                        mentioned['id'], j),
+                    'ts': '%.6f' % (start + day * SECONDS_PER_DAY + j,),
+                })
+            channel_dir = os.path.join(slack_data_dir, channel['name'])
+            os.makedirs(channel_dir, exist_ok=True)
+            write_json(os.path.join(channel_dir, date + '.json'), messages)
+    return users
+
+class Command(BaseCommand):
+    help = """Benchmark converting a synthetic Slack export's messages.
+
+Example: ./manage.py benchmark_slack_conversion --messages=10000000 --threads=8"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--messages', type=int, default=100000,
+                            help='Number of messages in the synthetic export')
+        parser.add_argument('--users', type=int, default=100,
+                            help='Number of users in the synthetic export')
+        parser.add_argument('--channels', type=int, default=20,
+                            help='Number of channels in the synthetic export')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Number of days of history in the synthetic export')
+        parser.add_argument('--threads', type=int, default=6,
+                            help='Number of processes to convert messages with')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        work_dir = tempfile.mkdtemp(prefix='zulip-slack-benchmark-')
+        slack_data_dir = os.path.join(work_dir, 'slack')
+        output_dir = os.path.join(work_dir, 'converted')
+        os.makedirs(slack_data_dir)
+        os.makedirs(output_dir)
+        try:
+            start = time.time()
+            users = generate_slack_export(slack_data_dir, options['messages'], options['users'],
+                                          options['channels'], options['days'])
+            generate_time = time.time() - start
+
+            realm, slack_user_id_to_zulip_user_id, slack_recipient_name_to_zulip_recipient_id, \
+                added_channels, added_mpims, dm_members, avatar_list, \
+                emoji_url_map = slack_workspace_to_realm(settings.EXTERNAL_HOST, 0, users,
+                                                         '', slack_data_dir, {})
+
+            start = time.time()
+            convert_slack_workspace_messages(
+                slack_data_dir, users, 0, slack_user_id_to_zulip_user_id,
+                slack_recipient_name_to_zulip_recipient_id, added_channels, added_mpims,
+                dm_members, realm, realm['zerver_userprofile'], realm['zerver_realmemoji'],
+                settings.EXTERNAL_HOST, output_dir, threads=options['threads'])
+            convert_time = time.time() - start
+
+            result = dict(
+                messages=options['messages'],
+                threads=options['threads'],
+                generate_seconds=round(generate_time, 3),
+                convert_seconds=round(convert_time, 3),
+                messages_per_second=round(options['messages'] / convert_time, 1),
+                # ru_maxrss is in kilobytes on Linux.
+                max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                max_child_rss_kb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            )
+            self.stdout.write(ujson.dumps(result, indent=4))
+        finally:
+            shutil.rmtree(work_dir)
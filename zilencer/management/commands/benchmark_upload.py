@@ -0,0 +1,76 @@
+import os
+import resource
+import shutil
+import tempfile
+import time
+from typing import Any
+
+import ujson
+from django.core.files import File
+from django.core.management.base import CommandParser
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.upload import delete_message_image, upload_message_file, \
+    upload_message_file_from_stream
+from zerver.models import Attachment
+
+class Command(ZulipBaseCommand):
+    help = """Benchmark uploading a message file through the configured upload backend.
+
+Since max_rss_kb is the peak for the whole process, run each --mode separately
+to compare them.
+
+Example: ./manage.py benchmark_upload --email=iago@zulip.com --size=25 --mode=stream"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--email', dest='email', required=True,
+                            help='Email address of the user to upload the file as')
+        parser.add_argument('--size', type=int, default=25,
+                            help='Size of the uploaded file, in megabytes')
+        parser.add_argument('--uploads', type=int, default=5,
+                            help='Number of times to upload the file')
+        parser.add_argument('--mode', choices=['stream', 'bytes'], default='stream',
+                            help='Upload the file in chunks, or read it into memory first')
+        self.add_realm_args(parser)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        user_profile = self.get_user(options['email'], realm)
+
+        work_dir = tempfile.mkdtemp(prefix='zulip-upload-benchmark-')
+        file_path = os.path.join(work_dir, 'benchmark.bin')
+        file_size = options['size'] * 1024 * 1024
+        with open(file_path, 'wb') as f:
+            for i in range(options['size']):
+                f.write(os.urandom(1024 * 1024))
+
+        uris = []
+        try:
+            start = time.time()
+            for i in range(options['uploads']):
+                with open(file_path, 'rb') as f:
+                    if options['mode'] == 'stream':
+                        uris.append(upload_message_file_from_stream(
+                            'benchmark.bin', 'application/octet-stream', File(f), user_profile))
+                    else:
+                        uris.append(upload_message_file(
+                            'benchmark.bin', file_size, 'application/octet-stream',
+                            f.read(), user_profile))
+            upload_time = time.time() - start
+
+            result = dict(
+                mode=options['mode'],
+                size_mb=options['size'],
+                uploads=options['uploads'],
+                upload_seconds=round(upload_time, 3),
+                mb_per_second=round(options['size'] * options['uploads'] / upload_time, 1),
+                # ru_maxrss is in kilobytes on Linux.
+                max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            )
+            self.stdout.write(ujson.dumps(result, indent=4))
+        finally:
+            for uri in uris:
+                path_id = uri[len('/user_uploads/'):]
+                delete_message_image(path_id)
+                Attachment.objects.filter(path_id=path_id).delete()
+            shutil.rmtree(work_dir)
@@ -698,15 +698,15 @@ def generate_and_send_messages(data: Tuple[int, Sequence[Sequence[int]], Mapping
     return tot_messages
 
 def send_messages(messages: List[Message]) -> None:
-    # We disable USING_RABBITMQ here, so that deferred work is
+    # We disable USING_QUEUE_WORKERS here, so that deferred work is
     # executed in do_send_message_messages, rather than being
     # queued.  This is important, because otherwise, if run-dev.py
     # wasn't running when populate_db was run, a developer can end
     # up with queued events that reference objects from a previous
     # life of the database, which naturally throws exceptions.
-    settings.USING_RABBITMQ = False
+    settings.USING_QUEUE_WORKERS = False
     do_send_messages([{'message': message} for message in messages])
-    settings.USING_RABBITMQ = True
+    settings.USING_QUEUE_WORKERS = True
 
 def choose_date_sent(num_messages: int, tot_messages: int, threads: int) -> datetime:
     # Spoofing time not supported with threading
@@ -84,6 +84,12 @@ BROWSER_ERROR_REPORTING = False
 LOGGING_SHOW_MODULE = False
 LOGGING_SHOW_PID = False
 SLOW_QUERY_LOGS_STREAM = None  # type: Optional[str]
+REQUEST_PROFILE_SAMPLE_RATE = 0.0
+REQUEST_PROFILE_SLOW_THRESHOLD_SECONDS = 1.0
+# None, 'warn', or 'fail'; see zerver/lib/query_budget.py.
+QUERY_BUDGET_MODE = None  # type: Optional[str]
+QUERY_BUDGET_DEFAULT_MAX_QUERIES = 50
+QUERY_BUDGET_MAX_REPEATS = 10
 
 # File uploads and avatars
 DEFAULT_AVATAR_URI = '/static/images/default-avatar.png'
@@ -109,14 +115,24 @@ MEMCACHED_LOCATION = '127.0.0.1:11211'
 MEMCACHED_USERNAME = None if get_secret("memcached_password") is None else "zulip"
 RABBITMQ_HOST = '127.0.0.1'
 RABBITMQ_USERNAME = 'zulip'
+# 'rabbitmq', or 'local' for the SQLite-backed LocalQueueClient.
+QUEUE_BACKEND = 'rabbitmq'
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REMOTE_POSTGRES_HOST = ''
 REMOTE_POSTGRES_PORT = ''
 REMOTE_POSTGRES_SSLMODE = ''
+PGBOUNCER_TRANSACTION_MODE = False
+DATABASE_CONNECTION_MAX_AGE = 600
+DATABASE_HEALTH_CHECK_IDLE_SECONDS = 60
+# 'host' or 'host:port' of postgres streaming replicas; see zerver/lib/replicas.py.
+REMOTE_POSTGRES_REPLICAS = []  # type: List[str]
+DATABASE_REPLICA_MAX_LAG_SECONDS = 10
+DATABASE_REPLICA_STICKY_SECONDS = 30
 THUMBOR_URL = ''
 THUMBOR_SERVES_CAMO = False
 THUMBNAIL_IMAGES = False
+PREGENERATE_THUMBNAILS = False
 SENDFILE_BACKEND = None  # type: Optional[str]
 
 # ToS/Privacy templates
@@ -139,6 +155,8 @@ RATE_LIMITING = True
 RATE_LIMITING_AUTHENTICATE = True
 SEND_LOGIN_EMAILS = True
 EMBEDDED_BOTS_ENABLED = False
+# How long to wait for an outgoing webhook bot's server to respond.
+OUTGOING_WEBHOOK_TIMEOUT_SECONDS = 10
 
 # Two Factor Authentication is not yet implementation-complete
 TWO_FACTOR_AUTHENTICATION_ENABLED = False
@@ -211,6 +229,11 @@ SYSTEM_ONLY_REALMS = {"zulip"}
 # The values will also be added to ALLOWED_HOSTS.
 REALM_HOSTS = {}  # type: Dict[str, str]
 
+# Whether Tornado should gzip-compress get_events responses for
+# clients that accept it.  In production, nginx compresses responses
+# itself, so this is only useful if Tornado is served some other way.
+TORNADO_COMPRESS_RESPONSES = False
+
 # Whether the server is using the Pgroonga full-text search
 # backend.  Plan is to turn this on for everyone after further
 # testing.
@@ -353,6 +376,16 @@ OFFLINE_THRESHOLD_SECS = 5 * 60
 # permanently deleted.
 ARCHIVED_DATA_VACUUMING_DELAY_DAYS = 7
 
+# If set, the message retention system adjusts its chunk size so that
+# archiving a chunk of messages takes about this many seconds.
+RETENTION_TARGET_CHUNK_SECONDS = None  # type: Optional[float]
+# If set, the message retention system pauses before each chunk while
+# any replica's replay lag exceeds this many seconds.  This needs
+# postgres 10 or newer, and the database role to be a member of
+# pg_read_all_stats (`GRANT pg_read_all_stats TO zulip;`), since
+# otherwise postgres hides the lag.
+RETENTION_MAX_REPLICATION_LAG_SECONDS = None  # type: Optional[float]
+
 # Enables billing pages and plan-based feature gates. If False, all features
 # are available to all realms.
 BILLING_ENABLED = False
@@ -353,6 +353,20 @@ SESSION_COOKIE_AGE = 60 * 60 * 24 * 7 * 2  # 2 weeks
 # system-level monitoring tools.
 #LOGGING_SHOW_PID = False
 
+# Fraction of requests (0.0 to 1.0) for which Zulip records which SQL
+# queries, cache keys, and markdown rendering the request did.  Those
+# taking at least REQUEST_PROFILE_SLOW_THRESHOLD_SECONDS are written
+# to /var/log/zulip/request_profile.log; summarize them with
+# `manage.py request_profile_report`.
+#REQUEST_PROFILE_SAMPLE_RATE = 0.01
+#REQUEST_PROFILE_SLOW_THRESHOLD_SECONDS = 1.0
+
+# If set to 'warn', Zulip logs a warning for each request that makes
+# more database queries than its view's budget (by default
+# QUERY_BUDGET_DEFAULT_MAX_QUERIES), or that runs the same query more
+# than QUERY_BUDGET_MAX_REPEATS times.
+#QUERY_BUDGET_MODE = 'warn'
+
 # Controls whether or not Zulip will provide inline image preview when
 # a link to an image is referenced in a message.  Note: this feature
 # can also be disabled in a realm's organization settings.
@@ -418,6 +432,23 @@ ENABLE_GRAVATAR = True
 #REMOTE_POSTGRES_PORT = '5432'
 #REMOTE_POSTGRES_SSLMODE = 'require'
 
+# If postgres is reached through pgbouncer in transaction pooling mode,
+# set this so that Zulip avoids features that need a dedicated server
+# connection (server-side cursors).  Each Zulip process keeps its
+# connection for DATABASE_CONNECTION_MAX_AGE seconds; long-running
+# processes check connections that have been idle for
+# DATABASE_HEALTH_CHECK_IDLE_SECONDS before reusing them.
+#PGBOUNCER_TRANSACTION_MODE = True
+#DATABASE_CONNECTION_MAX_AGE = 600
+#DATABASE_HEALTH_CHECK_IDLE_SECONDS = 60
+
+# Postgres streaming replicas ('host' or 'host:port'), to which some
+# read-only pages and API endpoints (message history and search,
+# /stats, activity reports, digest emails and exports) are sent, as
+# long as they're no more than DATABASE_REPLICA_MAX_LAG_SECONDS behind.
+#REMOTE_POSTGRES_REPLICAS = ['replica1.example.com']
+#DATABASE_REPLICA_MAX_LAG_SECONDS = 10
+
 # If you want to set a Terms of Service for your server, set the path
 # to your markdown file, and uncomment the following line.
 #TERMS_OF_SERVICE = '/etc/zulip/terms.md'
@@ -579,6 +610,10 @@ CAMO_URI = '/external_content/'
 # RABBITMQ_HOST = "127.0.0.1"
 # To use another rabbitmq user than the default 'zulip', set RABBITMQ_USERNAME here.
 # RABBITMQ_USERNAME = 'zulip'
+#
+# Small single-server installations can instead use a local queue
+# stored in SQLite, which doesn't require running RabbitMQ at all.
+# QUEUE_BACKEND = 'local'
 
 # Memcached configuration
 #
@@ -616,6 +651,12 @@ CAMO_URI = '/external_content/'
 # previews should be thumbnailed by thumbor, which saves bandwidth but
 # can modify the image's appearance.
 #THUMBNAIL_IMAGES = True
+#
+# This setting makes Zulip generate thumbnails of uploaded images
+# itself, in the deferred_work queue processor, and serve them
+# directly from the upload storage.  It works without thumbor, though
+# images from other sites are then served unthumbnailed.
+#PREGENERATE_THUMBNAILS = True
 
 # Controls the Jitsi Meet video call integration.  By default, the
 # integration uses the SaaS meet.jit.si server.  You can specify
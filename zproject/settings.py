@@ -270,7 +270,7 @@ DATABASES = {"default": {
     # Host = '' => connect to localhost by default
     'HOST': '',
     'SCHEMA': 'zulip',
-    'CONN_MAX_AGE': 600,
+    'CONN_MAX_AGE': DATABASE_CONNECTION_MAX_AGE,
     'OPTIONS': {
         'connection_factory': TimeTrackingConnection
     },
@@ -296,13 +296,37 @@ elif REMOTE_POSTGRES_HOST != '':
     else:
         DATABASES['default']['OPTIONS']['sslmode'] = 'verify-full'
 
+if PGBOUNCER_TRANSACTION_MODE:
+    # Server-side cursors, which Django uses for QuerySet.iterator(),
+    # can't outlive their transaction when pgbouncer may hand the
+    # next transaction a different server connection.
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# Read-only code paths can be sent to replicas; see zerver/lib/replicas.py.
+DATABASE_REPLICAS = []  # type: List[str]
+for replica_number, replica in enumerate(REMOTE_POSTGRES_REPLICAS):
+    replica_alias = 'replica%d' % (replica_number,)
+    DATABASES[replica_alias] = deepcopy(DATABASES['default'])
+    replica_host, _, replica_port = replica.partition(':')
+    DATABASES[replica_alias].update({
+        'HOST': replica_host,
+        'PORT': replica_port or DATABASES['default'].get('PORT', ''),
+        'TEST': {'MIRROR': 'default'},
+    })
+    DATABASE_REPLICAS.append(replica_alias)
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS = ['zerver.lib.replicas.ReplicaRouter']
+
 POSTGRES_MISSING_DICTIONARIES = bool(get_config('postgresql', 'missing_dictionaries', None))
 
 ########################################################################
 # RABBITMQ CONFIGURATION
 ########################################################################
 
-USING_RABBITMQ = True
+# Whether queue_json_publish sends events to the queue processors,
+# via QUEUE_BACKEND (RabbitMQ, or the local SQLite queue), rather than
+# processing them synchronously, as the test suite does.
+USING_QUEUE_WORKERS = True
 RABBITMQ_PASSWORD = get_secret("rabbitmq_password")
 
 ########################################################################
@@ -651,6 +675,7 @@ ERROR_FILE_LOG_PATH = zulip_path("/var/log/zulip/errors.log")
 MANAGEMENT_LOG_PATH = zulip_path("/var/log/zulip/manage.log")
 WORKER_LOG_PATH = zulip_path("/var/log/zulip/workers.log")
 JSON_PERSISTENT_QUEUE_FILENAME_PATTERN = zulip_path("/home/zulip/tornado/event_queues%s.json")
+LOCAL_QUEUE_DB_PATH = zulip_path("/home/zulip/local_queue.sqlite3")
 EMAIL_LOG_PATH = zulip_path("/var/log/zulip/send_email.log")
 EMAIL_MIRROR_LOG_PATH = zulip_path("/var/log/zulip/email_mirror.log")
 EMAIL_DELIVERER_LOG_PATH = zulip_path("/var/log/zulip/email-deliverer.log")
@@ -667,6 +692,7 @@ SOFT_DEACTIVATION_LOG_PATH = zulip_path("/var/log/zulip/soft_deactivation.log")
 TRACEMALLOC_DUMP_DIR = zulip_path("/var/log/zulip/tracemalloc")
 SCHEDULED_MESSAGE_DELIVERER_LOG_PATH = zulip_path("/var/log/zulip/scheduled_message_deliverer.log")
 RETENTION_LOG_PATH = zulip_path("/var/log/zulip/message_retention.log")
+REQUEST_PROFILE_LOG_PATH = zulip_path("/var/log/zulip/request_profile.log")
 
 # The EVENT_LOGS feature is an ultra-legacy piece of code, which
 # originally logged all significant database changes for debugging.
@@ -699,7 +725,10 @@ LOGGING = {
     'formatters': {
         'default': {
             '()': 'zerver.lib.logging_util.ZulipFormatter',
-        }
+        },
+        'message_only': {
+            'format': '%(message)s',
+        },
     },
     'filters': {
         'ZulipLimiter': {
@@ -763,6 +792,15 @@ LOGGING = {
             'formatter': 'default',
             'filename': LDAP_LOG_PATH,
         },
+        'request_profile_file': {
+            # Every Django and Tornado process writes to this file, so
+            # it's rotated by logrotate, like the others here; see
+            # zerver/lib/request_profile.py.
+            'level': 'DEBUG',
+            'class': 'logging.handlers.WatchedFileHandler',
+            'formatter': 'message_only',
+            'filename': REQUEST_PROFILE_LOG_PATH,
+        },
     },
     'loggers': {
         # The Python logging module uses a hierarchy of logger names for config:
@@ -884,6 +922,10 @@ LOGGING = {
         'zulip.queue': {
             'level': 'WARNING',
         },
+        'zulip.request_profile': {
+            'handlers': ['request_profile_file'],
+            'propagate': False,
+        },
         'zulip.retention': {
             'handlers': ['file', 'errors_file'],
             'propagate': False,
@@ -54,6 +54,10 @@ if "CASPER_TESTS" in os.environ:
 if "RUNNING_OPENAPI_CURL_TEST" in os.environ:
     RUNNING_OPENAPI_CURL_TEST = True
 
+# Set by `test-backend --query-budget`; see zerver/lib/query_budget.py.
+if "QUERY_BUDGET_MODE" in os.environ:
+    QUERY_BUDGET_MODE = os.environ["QUERY_BUDGET_MODE"]
+
 # Decrease the get_updates timeout to 1 second.
 # This allows CasperJS to proceed quickly to the next test step.
 POLL_TIMEOUT = 1000
@@ -82,10 +86,10 @@ AUTH_LDAP_REVERSE_EMAIL_SEARCH = LDAPSearch("ou=users,dc=zulip,dc=com",
 TEST_SUITE = True
 RATE_LIMITING = False
 RATE_LIMITING_AUTHENTICATE = False
-# Don't use rabbitmq from the test suite -- the user_profile_ids for
+# Don't use the queue workers from the test suite -- the user_profile_ids for
 # any generated queue elements won't match those being used by the
 # real app.
-USING_RABBITMQ = False
+USING_QUEUE_WORKERS = False
 
 # Disable the tutorial because it confuses the client tests.
 TUTORIAL_ENABLED = False